@@ -0,0 +1,118 @@
+"""
+Module to make the frames of a movie and stream them to ffmpeg.
+
+The figure is made once, by the [plot type]_setup() function in plots.py, for the
+first history file. Then each frame only changes the parts that move with time
+(the field, velocity and wind vectors, tracks, and time series cursor) using
+[plot type]_update(). The frames are drawn by a pool of forked processes, which
+each get a copy of the figure, and are sent in order to ffmpeg through a pipe,
+so no png files are needed unless they are asked for.
+"""
+
+import sys
+import numpy as np
+import xarray as xr
+import multiprocessing as mp
+from subprocess import Popen as Po
+from subprocess import PIPE as Pi
+
+from importlib import reload
+import plots; reload(plots)
+
+import matplotlib.pyplot as plt
+from matplotlib import mathtext
+
+# These are set by make_movie() and inherited by the forked processes.
+frame_args = dict()
+
+def init_frame():
+    # Labels with math (e.g. units) keep the fonts they were drawn with in the parent,
+    # and the forked processes would share the file positions of those fonts.
+    mathtext.MathTextParser._parse_cached.cache_clear()
+
+def get_frame(jj):
+    # draw frame jj and return the rgb bytes
+    Q = frame_args['Q']
+    M = frame_args['M']
+    F = frame_args['F']
+    if jj != F['jj']:
+        Q['fn'] = frame_args['fn_list'][jj]
+        ds = xr.open_dataset(Q['fn'])
+        frame_args['update'](Q, M, F, ds)
+        ds.close()
+        F['jj'] = jj
+    fig = F['fig']
+    fig.canvas.draw()
+    if jj in frame_args['png_list']:
+        fig.savefig(frame_args['outdir'] / ('plot_%04d.png' % (jj)))
+    if frame_args['mov']:
+        return np.asarray(fig.canvas.buffer_rgba())[:,:,:3].tobytes()
+    else:
+        return b''
+
+def make_movie(Q, M, fn_list, outdir, Nproc=4, png_list=[], mov=True):
+    """
+    Make the frames for the history files in fn_list, and the movie outdir/movie.mp4
+    if mov is True. Frames whose number is in png_list are also saved as
+    outdir/plot_[frame number].png. If mov is False all the frames are saved as png's.
+    """
+    NF = len(fn_list)
+    if not mov:
+        png_list = range(NF)
+    Q['fn'] = fn_list[0]
+    ds = xr.open_dataset(Q['fn'])
+    F = getattr(plots, Q['pt'] + '_setup')(Q, M, ds)
+    ds.close()
+    F['jj'] = 0
+    # after the first plot we no longer change vlims
+    Q['avl'] = False
+    fig = F['fig']
+    fig.canvas.draw()
+    w, h = fig.canvas.get_width_height()
+
+    frame_args['Q'] = Q
+    frame_args['M'] = M
+    frame_args['F'] = F
+    frame_args['update'] = getattr(plots, Q['pt'] + '_update')
+    frame_args['fn_list'] = fn_list
+    frame_args['outdir'] = outdir
+    frame_args['png_list'] = set(png_list)
+    frame_args['mov'] = mov
+
+    if mov:
+        cmd_list = ['ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+            '-s', '%dx%d' % (w, h), '-r', '8', '-i', '-', '-vcodec', 'libx264',
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            '-pix_fmt', 'yuv420p', '-crf', '25', str(outdir / 'movie.mp4')]
+        log_fn = outdir / 'ffmpeg.log'
+        log = open(log_fn, 'w')
+        proc = Po(cmd_list, stdin=Pi, stdout=log, stderr=log)
+
+    done = False
+    try:
+        with mp.get_context('fork').Pool(Nproc, initializer=init_frame) as pool:
+            for jj, frame in enumerate(pool.imap(get_frame, range(NF))):
+                if np.mod(jj,10) == 0:
+                    print('Plot %d out %d' % (jj, NF))
+                    sys.stdout.flush()
+                if mov:
+                    proc.stdin.write(frame)
+        done = True
+    finally:
+        # also clean up if a frame failed, so ffmpeg is not left waiting for input
+        if mov:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                # ffmpeg already quit, and its log will say why
+                pass
+            if done:
+                proc.wait()
+            else:
+                proc.kill()
+                proc.wait()
+            log.close()
+            with open(log_fn, 'r') as f:
+                print('\n' + f.read())
+        plt.close(fig)
+        plt.rcdefaults()
@@ -14,6 +14,7 @@ import pandas as pd
 
 from lo_tools import Lfun, zfun, zrfun
 from lo_tools import plotting_functions as pfun
+from lo_tools import station_functions as stafun
 
 import xarray as xr
 
@@ -52,6 +53,53 @@ def get_tracks(Q, Ldir):
     tr_fn = Ldir['LOo'] / 'tracks2' / Ldir['gtagex'] / (Q['exp'] + '_surf_' + Q['ttag']) / ('release_' + Q['ds0'] + '.nc')
     #print(str(tr_fn))
     Q['tr_fn'] = tr_fn
+
+def get_track_data(Q):
+    # read the tracks made by get_tracks()
+    tr_ds = xr.open_dataset(Q['tr_fn'], decode_times=False)
+    TR = dict()
+    TR['ot'] = tr_ds['ot'].values
+    TR['lon'] = tr_ds.lon.values
+    TR['lat'] = tr_ds.lat.values
+    tr_ds.close()
+    return TR
+
+def add_tracks(ax, TR, iot, focus=False):
+    """
+    Add the particle tracks up to time index iot, and return a dict of the
+    artists, to move to another time with update_tracks(). With focus=True
+    these are the fancy tracks with narrowing tails used in the Phab close-ups.
+    """
+    lon = TR['lon']
+    lat = TR['lat']
+    A = dict()
+    if focus:
+        A['start'] = ax.plot(lon[0,:], lat[0,:],'o',mec='gold', mfc='gold', ms=3)[0]
+    else:
+        A['start'] = ax.plot(lon[0,:], lat[0,:],'og', ms=5)[0]
+    A['lines'] = ax.plot(lon[:iot+1,:], lat[:iot+1,:],'-r', alpha=.5, lw=1)
+    if focus:
+        # the tail markers for the 12 times before iot, oldest first
+        A['tails'] = [ax.plot(lon[0,:], lat[0,:],'o', mec='r', mfc='r', ms=7 - nt/2,
+            alpha=.5)[0] for nt in range(12, 0, -1)]
+        A['now'] = ax.plot(lon[iot,:], lat[iot,:],'o', mec='k', mfc='r', ms=8)[0]
+    else:
+        A['now'] = ax.plot(lon[iot,:], lat[iot,:],'o', mec='k', mfc='r')[0]
+    update_tracks(A, TR, iot)
+    return A
+
+def update_tracks(A, TR, iot):
+    # move the tracks made by add_tracks() to time index iot
+    lon = TR['lon']
+    lat = TR['lat']
+    A['start'].set_visible(iot > 2)
+    for ii, line in enumerate(A['lines']):
+        line.set_data(lon[:iot+1,ii], lat[:iot+1,ii])
+    if 'tails' in A.keys():
+        for nt, tail in zip(range(12, 0, -1), A['tails']):
+            tail.set_data(lon[max(iot-nt,0),:], lat[max(iot-nt,0),:])
+            tail.set_visible(iot - nt >= 0)
+    A['now'].set_data(lon[iot,:], lat[iot,:])
     
 def get_speed(ds, nlev):
     fld00 = np.zeros(ds.mask_rho.shape)
@@ -67,7 +115,7 @@ def get_speed(ds, nlev):
     return fld
 
 def get_arag(ds, Q, aa, nlev):
-    from PyCO2SYS import CO2SYS
+    from lo_tools import carbon_functions as carbfun
     G = zrfun.get_basic_info(Q['fn'], only_G=True)
     # find indices that encompass region aa
     i0 = zfun.find_nearest_ind(G['lon_rho'][0,:], aa[0]) - 1
@@ -75,76 +123,19 @@ def get_arag(ds, Q, aa, nlev):
     j0 = zfun.find_nearest_ind(G['lat_rho'][:,0], aa[2]) - 1
     j1 = zfun.find_nearest_ind(G['lat_rho'][:,0], aa[3]) + 2
     px, py = pfun.get_plon_plat(G['lon_rho'][j0:j1,i0:i1], G['lat_rho'][j0:j1,i0:i1])
-    # NEW: using gsw to create in-situ density
-    import gsw
-    lon = G['lon_rho'][j0:j1,i0:i1]
-    lat = G['lat_rho'][j0:j1,i0:i1]
-    v_dict = dict()
-    vn_in_list = ['temp', 'salt', 'alkalinity', 'TIC']
-    for cvn in vn_in_list:
-        L = ds[cvn][0,nlev,j0:j1,i0:i1].values
-        v_dict[cvn] = L
-    Ld = G['h'][j0:j1,i0:i1]
-    if nlev == -1: # make sure we use the correct z
-        Ld = 0 * Ld
-    Lpres = gsw.p_from_z(-Ld, lat) # pressure [dbar]
-    SA = gsw.SA_from_SP(v_dict['salt'], Lpres, lon, lat)
-    CT = gsw.CT_from_pt(SA, v_dict['temp'])
-    rho = gsw.rho(SA, CT, Lpres) # in situ density
-    Ltemp = gsw.t_from_CT(SA, CT, Lpres) # in situ temperature
-    # convert from umol/L to umol/kg using in situ dentity
-    Lalkalinity = 1000 * v_dict['alkalinity'] / rho
-    Lalkalinity[Lalkalinity < 100] = np.nan
-    LTIC = 1000 * v_dict['TIC'] / rho
-    LTIC[LTIC < 100] = np.nan
-    Lpres = zfun.fillit(Lpres)
-    Ltemp = zfun.fillit(Ltemp)
-    CO2dict = CO2SYS(Lalkalinity, LTIC, 1, 2, v_dict['salt'], Ltemp, Ltemp,
-        Lpres, Lpres, 50, 2, 1, 10, 1, NH3=0.0, H2S=0.0)
-    # PH = CO2dict['pHout']
-    # PH = zfun.fillit(PH.reshape((v_dict['salt'].shape)))
-    ARAG = CO2dict['OmegaARout']
-    ARAG = ARAG.reshape((v_dict['salt'].shape))
-    fld = ARAG
+    # using gsw to create in-situ density, and the same carbonate chemistry as CO2SYS
+    C = carbfun.get_his_carbon(Q['fn'], nlev, G, jsl=slice(j0,j1), isl=slice(i0,i1),
+        ds=ds, cache=Q['carbon_cache'])
+    fld = C['ARAG']
     return px, py, fld
     
 def get_arag_full(ds, Q, nlev):
     # a simpler version of get_arag where we use the full field
     # as is appropriate for the wgh case
-    from PyCO2SYS import CO2SYS
+    from lo_tools import carbon_functions as carbfun
     G = zrfun.get_basic_info(Q['fn'], only_G=True)
-    px, py = pfun.get_plon_plat(G['lon_rho'], G['lat_rho'])
-    # NEW: using gsw to create in-situ density
-    import gsw
-    lon = G['lon_rho']
-    lat = G['lat_rho']
-    v_dict = dict()
-    vn_in_list = ['temp', 'salt', 'alkalinity', 'TIC']
-    for cvn in vn_in_list:
-        L = ds[cvn][0,nlev,:,:].values
-        v_dict[cvn] = L
-    Ld = G['h']
-    if nlev == -1: # make sure we use the correct z
-        Ld = 0 * Ld
-    Lpres = gsw.p_from_z(-Ld, lat) # pressure [dbar]
-    SA = gsw.SA_from_SP(v_dict['salt'], Lpres, lon, lat)
-    CT = gsw.CT_from_pt(SA, v_dict['temp'])
-    rho = gsw.rho(SA, CT, Lpres) # in situ density
-    Ltemp = gsw.t_from_CT(SA, CT, Lpres) # in situ temperature
-    # convert from umol/L to umol/kg using in situ dentity
-    Lalkalinity = 1000 * v_dict['alkalinity'] / rho
-    Lalkalinity[Lalkalinity < 100] = np.nan
-    LTIC = 1000 * v_dict['TIC'] / rho
-    LTIC[LTIC < 100] = np.nan
-    Lpres = zfun.fillit(Lpres)
-    Ltemp = zfun.fillit(Ltemp)
-    CO2dict = CO2SYS(Lalkalinity, LTIC, 1, 2, v_dict['salt'], Ltemp, Ltemp,
-        Lpres, Lpres, 50, 2, 1, 10, 1, NH3=0.0, H2S=0.0)
-    # PH = CO2dict['pHout']
-    # PH = zfun.fillit(PH.reshape((v_dict['salt'].shape)))
-    ARAG = CO2dict['OmegaARout']
-    ARAG = ARAG.reshape((v_dict['salt'].shape))
-    fld = ARAG
+    C = carbfun.get_his_carbon(Q['fn'], nlev, G, ds=ds, cache=Q['carbon_cache'])
+    fld = C['ARAG']
     return fld
 
 def get_ax_limits(Q):
@@ -229,15 +220,17 @@ def get_moor_info(Q):
     return M
 
 def plot_time_series(ax, M, T):
+    # Returns a dict of the parts that change with time, for update_time_series().
+    P = dict()
     iot = zfun.find_nearest_ind(M['ot'], T['ocean_time'])
     zeta = M['zeta']*3.28084 # convert meters to feet
     ax.plot(M['ot'], zeta, '-k', lw=2)
-    ax.plot(T['ocean_time'], zeta[iot],'ok', ms=20)
+    P['dot'] = ax.plot(T['ocean_time'], zeta[iot],'ok', ms=20)[0]
     x0 = M['ot'][0]; x1 = M['ot'][-1]
     x11 = T['ocean_time']
     y0 = np.floor(zeta.min())-5
     y1 = np.ceil(zeta.max())+5
-    ax.fill([x0, x11, x11, x0], [y0, y0, y1, y1], 'k', alpha=.2)
+    P['fill'] = ax.fill([x0, x11, x11, x0], [y0, y0, y1, y1], 'k', alpha=.2)[0]
     ax.axhline(c='k')
     ax.axhline(y=3, c='gray',alpha=.5)
     ax.axhline(y=-3, c='gray',alpha=.5)
@@ -247,9 +240,7 @@ def plot_time_series(ax, M, T):
         '-3', va='center', ha='center', c='gray', weight='bold')
     ax.set_yticks([])    
     ax.set_xticks([])
-    dt_local = get_dt_local(T['dt'])
-    ax.text(.05,.07, datetime.strftime(dt_local,'%m/%d/%Y - %I%p')+' '+dt_local.tzname(),
-        transform=ax.transAxes)
+    P['text'] = ax.text(.05,.07, get_time_text(T), transform=ax.transAxes)
     ax.text(.95,.97, 'Sea Surface Height [ft]', ha='right', va='top', style='italic', c='k',
         transform=ax.transAxes)
     # add day/night
@@ -264,6 +255,21 @@ def plot_time_series(ax, M, T):
         ax.plot([srise, sset],[0, 0],'-', c='orange', lw=5, alpha=.7)
     ax.set_xlim(x0, x1)
     ax.set_ylim(y0, y1)
+    return P
+
+def update_time_series(P, M, T):
+    # move the time in the plot made by plot_time_series()
+    iot = zfun.find_nearest_ind(M['ot'], T['ocean_time'])
+    zeta = M['zeta']*3.28084 # convert meters to feet
+    P['dot'].set_data([T['ocean_time']], [zeta[iot]])
+    xy = P['fill'].get_xy()
+    xy[1:3,0] = T['ocean_time']
+    P['fill'].set_xy(xy)
+    P['text'].set_text(get_time_text(T))
+
+def get_time_text(T):
+    dt_local = get_dt_local(T['dt'])
+    return datetime.strftime(dt_local,'%m/%d/%Y - %I%p')+' '+dt_local.tzname()
 
 def get_moor(ds0, ds1, Ldir, Q, M):
     """
@@ -273,24 +279,40 @@ def get_moor(ds0, ds1, Ldir, Q, M):
     calling function is concerned, and so does not have to be returned.
     """
     m_fn_list = Lfun.get_fn_list('hourly', Ldir, ds0, ds1)
-    ot_list = []
-    dt_list = []
-    zeta_list = []
-    uwind_list = []
-    vwind_list = []
     G = zrfun.get_basic_info(m_fn_list[0], only_G=True)
     
-    mi = zfun.find_nearest_ind(G['lon_rho'][0,:], M['lon'])
-    mj = zfun.find_nearest_ind(G['lat_rho'][:,0], M['lat'])
-    for fn in m_fn_list:
-        T = zrfun.get_basic_info(fn, only_T=True)
-        dt_list.append(T['dt'])
-        ds = xr.open_dataset(fn, decode_times=False)
-        ot_list.append(ds['ocean_time'][0].values)
-        zeta_list.append(ds['zeta'][0,mj,mi].values)
-        uwind_list.append(ds['Uwind'][0,mj,mi].values)
-        vwind_list.append(ds['Vwind'][0,mj,mi].values)
-        ds.close()
+    # Use the station store if it has all the times (it is kept up to date by
+    # post/stations1), otherwise read the history files.
+    sta_dir = stafun.get_sta_dir(Ldir)
+    name = 'dm_' + Q['dom']
+    stafun.register(sta_dir, G, {name: (M['lon'], M['lat'])}, method='nearest')
+    ot0 = stafun.get_fn_ot(m_fn_list[0])
+    ot1 = stafun.get_fn_ot(m_fn_list[-1])
+    D = stafun.read_station(sta_dir, name, vn_list=['zeta', 'Uwind', 'Vwind'], ot0=ot0, ot1=ot1)
+    if stafun.is_complete(D['ot'], ot0, ot1):
+        print('Using the station store for ' + name)
+        dt_list = [Lfun.modtime_to_datetime(ot) for ot in D['ot']]
+        ot_list = list(D['ot'])
+        zeta_list = list(D['zeta'])
+        uwind_list = list(D['Uwind'])
+        vwind_list = list(D['Vwind'])
+    else:
+        ot_list = []
+        dt_list = []
+        zeta_list = []
+        uwind_list = []
+        vwind_list = []
+        mi = zfun.find_nearest_ind(G['lon_rho'][0,:], M['lon'])
+        mj = zfun.find_nearest_ind(G['lat_rho'][:,0], M['lat'])
+        for fn in m_fn_list:
+            T = zrfun.get_basic_info(fn, only_T=True)
+            dt_list.append(T['dt'])
+            ds = xr.open_dataset(fn, decode_times=False)
+            ot_list.append(ds['ocean_time'][0].values)
+            zeta_list.append(ds['zeta'][0,mj,mi].values)
+            uwind_list.append(ds['Uwind'][0,mj,mi].values)
+            vwind_list.append(ds['Vwind'][0,mj,mi].values)
+            ds.close()
     ot = zfun.fillit(np.array(ot_list))
     zeta = zfun.fillit(np.array(zeta_list))
     uwind = zfun.fillit(np.array(uwind_list))
@@ -369,10 +391,13 @@ def add_bathy_contours(ax, ds, depth_levs = [200], txt=False, c='k', lw=0.5):
                     ha='right', transform=ax.transAxes)
             ii += 1
 
-def add_velocity_vectors(ax, aa, ds, fn, v_scl=3, nngrid=80, zlev='top'):
+def add_velocity_vectors(ax, aa, ds, fn, v_scl=3, nngrid=80, zlev='top', G=None, aaa=None):
     # v_scl: scale velocity vector (smaller to get longer arrows)
+    # Pass G and the axis limits aaa used for the regular grid (the default is
+    # ax.axis()) when making this again for a new time. Returns the quiver.
     # GET DATA
-    G = zrfun.get_basic_info(fn, only_G=True)
+    if G is None:
+        G = zrfun.get_basic_info(fn, only_G=True)
     if zlev == 'top':
         u = ds['u'][0, -1, :, :].values
         v = ds['v'][0, -1, :, :].values
@@ -385,7 +410,8 @@ def add_velocity_vectors(ax, aa, ds, fn, v_scl=3, nngrid=80, zlev='top'):
     u[np.isnan(u)] = 0
     v[np.isnan(v)] = 0
     # create regular grid
-    aaa = ax.axis()
+    if aaa is None:
+        aaa = ax.axis()
     daax = aaa[1] - aaa[0]
     daay = aaa[3] - aaa[2]
     axrat = np.cos(np.deg2rad(aaa[2])) * daax / daay
@@ -397,7 +423,7 @@ def add_velocity_vectors(ax, aa, ds, fn, v_scl=3, nngrid=80, zlev='top'):
     vv = zfun.interp2(xx, yy, G['lon_v'], G['lat_v'], v)
     mask = uu != 0
     # plot velocity vectors
-    ax.quiver(xx[mask], yy[mask], uu[mask], vv[mask],
+    return ax.quiver(xx[mask], yy[mask], uu[mask], vv[mask],
         units='y', scale=v_scl, scale_units='y', color='b')
         
 def add_wind(ax, M, T):
@@ -405,11 +431,18 @@ def add_wind(ax, M, T):
     # scl is windspeed [knots] for a 1 inch circle or arrow
     # this makes a circle 1 inch (72 points) in radius
     # and a vector 1 inch long for a windspeed of "scl" knots
+    # Returns the vector, to pass to add_wind_vector() for a new time.
+    ax.plot(M['lon'],M['lat'],'o', ms=144, mfc='None', mec='k', mew=1.5, alpha=.6)
+    return add_wind_vector(ax, M, T)
+
+def add_wind_vector(ax, M, T, wv=None):
+    # just the vector from add_wind(), removing the old one wv if given
+    if wv is not None:
+        wv.remove()
     iot = zfun.find_nearest_ind(M['ot'], T['ocean_time'])
     uwind = M['uwind'][iot]
     vwind = M['vwind'][iot]
-    ax.plot(M['lon'],M['lat'],'o', ms=144, mfc='None', mec='k', mew=1.5, alpha=.6)
-    ax.quiver(M['lon'],M['lat'], uwind*1.94384, vwind*1.94384,
+    return ax.quiver(M['lon'],M['lat'], uwind*1.94384, vwind*1.94384,
             scale=M['wscl'], scale_units='inches',
             headwidth=5,headlength=5, color='k')
             
@@ -18,15 +18,13 @@ run dm_plot -tracks True -mov True -lt hourly -ds0 2021.07.04 -gtx cas6_v00_uu0m
 """
 
 import argparse
-import numpy as np
 from datetime import datetime, timedelta
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
 
 from lo_tools import Lfun
 
 from importlib import reload
 import plots; reload(plots)
+import dm_movie; reload(dm_movie)
 import dm_pfun; reload(dm_pfun)
 import pinfo; reload(pinfo)
 
@@ -52,6 +50,12 @@ parser.add_argument('-emask', default=False, type=Lfun.boolean_string)
 parser.add_argument('-tracks', default=False, type=Lfun.boolean_string)
 parser.add_argument('-ttag', default='base', type=str) # tag for tracking
 parser.add_argument('-test', default=False, type=Lfun.boolean_string)
+# save ARAG in a carbon_cache folder next to the history files, to use again
+parser.add_argument('-carbon_cache', default=False, type=Lfun.boolean_string)
+# number of processes drawing movie frames
+parser.add_argument('-Nproc', type=int, default=4)
+# movie frames to also save as png's, e.g. 72 or 0,72, or all
+parser.add_argument('-png', type=str, default='')
 
 args = parser.parse_args()
 Q = args.__dict__
@@ -126,30 +130,12 @@ elif len(fn_list) > 1:
     moviename = Q['pt'] + '_' + Q['dom'] + '_' + Q['vn'] + '_' + bot_tag
     outdir = outdir0 / moviename
     Lfun.make_dir(outdir, clean=True)
-    # plot to a folder of files
-    jj = 0
-    for fn in fn_list:
-        nouts = ('0000' + str(jj))[-4:]
-        outname = 'plot_' + nouts + '.png'
-        outfile = outdir / outname
-        if np.mod(jj,10) == 0:
-            print('Plot %d out %d' % (jj, len(fn_list)))
-        Q['fn'] = fn
-        Q['fn_out'] = outfile
-        whichplot(Q, M)
-        # after the first plot we no longer change vlims
-        Q['avl'] = False
-        jj += 1
-    # and make a movie
-    if Q['mov']:
-        cmd_list = ['ffmpeg','-r','8','-i', str(outdir)+'/plot_%04d.png', '-vcodec', 'libx264',
-            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
-            '-pix_fmt', 'yuv420p', '-crf', '25', str(outdir)+'/movie.mp4']
-        proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-        stdout, stderr = proc.communicate()
-        if True:
-            if len(stdout) > 0:
-                print('\n'+stdout.decode())
-            if len(stderr) > 0:
-                print('\n'+stderr.decode())
-        
\ No newline at end of file
+    # make the frames and stream them to ffmpeg
+    if Q['png'] == 'all':
+        png_list = range(len(fn_list))
+    elif len(Q['png']) > 0:
+        png_list = [int(item) for item in Q['png'].split(',')]
+    else:
+        png_list = []
+    dm_movie.make_movie(Q, M, fn_list, outdir, Nproc=Q['Nproc'], png_list=png_list,
+        mov=Q['mov'])
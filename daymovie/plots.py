@@ -1,5 +1,12 @@
 """
 Module of plotting functions.
+
+Each plot type has three functions, e.g. for P1:
+- P1_setup(Q, M, ds) makes the figure for the history file Dataset ds, and returns
+a dict F of the parts that change with time
+- P1_update(Q, M, F, ds) changes those parts for another history file, which is
+how dm_movie.py makes the frames of a movie without making a new figure each time
+- P1(Q, M) makes a single plot of Q['fn']
 """
 
 # imports
@@ -25,34 +32,28 @@ from datetime import datetime, timedelta
 import pandas as pd
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
-def P1(Q, M):
-    fig = plt.figure(figsize=Q['figsize'])
-    fs = Q['fontsize']
-    plt.rc('font', size=fs)
-    
-    ds = xr.open_dataset(Q['fn'])
-    if Q['dom'] in ['full', 'Psouth']:
-        Q['aa'] = pfun.get_aa(ds)
+def get_fld(Q, ds, arag_full_list=[], wetdry=False):
+    """
+    Get the field to plot from ds. Returns (px, py) for ARAG fields that are only
+    calculated over the region aa, or else None, and the field.
+    """
     aa = Q['aa']
-    
     vn = Q['vn']
     if Q['bot']:
         nlev = 0
-        tstr = 'Bottom'
     else:
         nlev = -1
-        tstr = 'Surface'
-        
-    px, py = pfun.get_plon_plat(ds['lon_rho'].values, ds['lat_rho'].values)
+    pxy = None
     if vn == 'speed':
         fld = dm_pfun.get_speed(ds, nlev)
     elif vn == 'ARAG':
-        if Q['dom'] in ['wgh','Psouth']:
+        if Q['dom'] in arag_full_list:
             fld = dm_pfun.get_arag_full(ds, Q, nlev)
         else:
             px, py, fld = dm_pfun.get_arag(ds, Q, aa, nlev)
             # we get px, py because ARAG is automatically only calulated over
             # a limited domain (aa)
+            pxy = (px, py)
     else:
         fld = ds[vn][0,nlev,:,:].values*pinfo.fac_dict[vn]
         
@@ -62,12 +63,51 @@ def P1(Q, M):
         # set vmax and vmin if needed
         dm_pfun.get_vlims(ds, fld, Q)
         
-    # account for WET_DRY
-    # NOTE: I think this will fail for cases which have wet-dry, when we try to plot ARAG
-    # but do NOT use the dm_pfun.get_arag_full method. It works for dom = wgh.
-    if 'wetdry_mask_rho' in ds.data_vars:
-        mwd = ds.wetdry_mask_rho[0,:,:].values.squeeze()
-        fld[mwd==0] = np.nan
+    if wetdry:
+        # account for WET_DRY
+        # NOTE: I think this will fail for cases which have wet-dry, when we try to plot ARAG
+        # but do NOT use the dm_pfun.get_arag_full method. It works for dom = wgh.
+        if 'wetdry_mask_rho' in ds.data_vars:
+            mwd = ds.wetdry_mask_rho[0,:,:].values.squeeze()
+            fld[mwd==0] = np.nan
+    return pxy, fld
+
+def finish(Q, F):
+    # save or show a single plot
+    if len(str(Q['fn_out'])) > 0:
+        plt.savefig(Q['fn_out'])
+        plt.close()
+    else:
+        plt.show()
+    plt.rcdefaults()
+
+def P1(Q, M):
+    ds = xr.open_dataset(Q['fn'])
+    F = P1_setup(Q, M, ds)
+    ds.close()
+    finish(Q, F)
+
+def P1_setup(Q, M, ds):
+    F = dict()
+    fig = plt.figure(figsize=Q['figsize'])
+    fs = Q['fontsize']
+    plt.rc('font', size=fs)
+    
+    if Q['dom'] in ['full', 'Psouth']:
+        Q['aa'] = pfun.get_aa(ds)
+    aa = Q['aa']
+    
+    vn = Q['vn']
+    if Q['bot']:
+        tstr = 'Bottom'
+    else:
+        tstr = 'Surface'
+        
+    pxy, fld = get_fld(Q, ds, arag_full_list=['wgh','Psouth'], wetdry=True)
+    if pxy is None:
+        px, py = pfun.get_plon_plat(ds['lon_rho'].values, ds['lat_rho'].values)
+    else:
+        px, py = pxy
         
     # MAP FIELD
     ax = plt.subplot2grid((7,1), (0,0), rowspan=6)
@@ -82,10 +122,15 @@ def P1(Q, M):
         dm_pfun.add_bathy_contours(ax, ds, depth_levs=[100, 200], c='c', lw=1)
         
     if vn == 'speed':
+        # save what we need to make the vectors again for a new time
+        F['G'] = zrfun.get_basic_info(Q['fn'], only_G=True)
+        F['vaa'] = ax.axis()
         if Q['dom'] == 'PS':
-            dm_pfun.add_velocity_vectors(ax, aa, ds, Q['fn'], v_scl=Q['v_scl'], nngrid=400)
+            F['nngrid'] = 400
         else:
-            dm_pfun.add_velocity_vectors(ax, aa, ds, Q['fn'], v_scl=Q['v_scl'])
+            F['nngrid'] = 80
+        F['vv'] = dm_pfun.add_velocity_vectors(ax, aa, ds, Q['fn'], v_scl=Q['v_scl'],
+            nngrid=F['nngrid'], G=F['G'])
         
     pfun.add_coast(ax, color='k')
     ax.axis(aa)
@@ -101,20 +146,13 @@ def P1(Q, M):
     
     # Wind vector
     T = zrfun.get_basic_info(Q['fn'], only_T=True)
-    dm_pfun.add_wind(ax, M, T)
+    F['wv'] = dm_pfun.add_wind(ax, M, T)
     dm_pfun.add_wind_text(ax, aa, M, fs)
     
     if Q['tracks']:
-        tr_ds = xr.open_dataset(Q['tr_fn'], decode_times=False)
-        tracks_ot = tr_ds['ot'].values
-        tracks_lon = tr_ds.lon.values
-        tracks_lat = tr_ds.lat.values
-        iot = zfun.find_nearest_ind(tracks_ot, T['ocean_time'])
-        if iot > 2:
-            ax.plot(tracks_lon[0,:], tracks_lat[0,:],'og', ms=5)
-        ax.plot(tracks_lon[:iot+1,:], tracks_lat[:iot+1,:],'-r', alpha=.5, lw=1)
-        ax.plot(tracks_lon[iot,:], tracks_lat[iot,:],'o', mec='k', mfc='r')
-        tr_ds.close()
+        F['TR'] = dm_pfun.get_track_data(Q)
+        iot = zfun.find_nearest_ind(F['TR']['ot'], T['ocean_time'])
+        F['tr'] = dm_pfun.add_tracks(ax, F['TR'], iot)
         
     # axes labeling
     ax.set_xticks(Q['xtl'])
@@ -122,55 +160,60 @@ def P1(Q, M):
     ax.tick_params(labelsize=.7*fs)
     
     # MOORING TIME SERIES
-    ax = plt.subplot2grid((7,1), (6,0), rowspan=1)
-    dm_pfun.plot_time_series(ax, M, T)
+    axm = plt.subplot2grid((7,1), (6,0), rowspan=1)
+    F['ts'] = dm_pfun.plot_time_series(axm, M, T)
     
     fig.tight_layout()
     
-    # FINISH
-    ds.close()
-    if len(str(Q['fn_out'])) > 0:
-        plt.savefig(Q['fn_out'])
-        plt.close()
-    else:
-        plt.show()
-    plt.rcdefaults()
+    F['fig'] = fig
+    F['ax'] = ax
+    F['cs'] = cs
+    return F
+
+def P1_update(Q, M, F, ds):
+    ax = F['ax']
+    pxy, fld = get_fld(Q, ds, arag_full_list=['wgh','Psouth'], wetdry=True)
+    F['cs'].set_array(fld)
+    if 'vv' in F.keys():
+        F['vv'].remove()
+        F['vv'] = dm_pfun.add_velocity_vectors(ax, Q['aa'], ds, Q['fn'], v_scl=Q['v_scl'],
+            nngrid=F['nngrid'], G=F['G'], aaa=F['vaa'])
+    T = zrfun.get_basic_info(Q['fn'], only_T=True)
+    F['wv'] = dm_pfun.add_wind_vector(ax, M, T, wv=F['wv'])
+    if Q['tracks']:
+        iot = zfun.find_nearest_ind(F['TR']['ot'], T['ocean_time'])
+        dm_pfun.update_tracks(F['tr'], F['TR'], iot)
+    dm_pfun.update_time_series(F['ts'], M, T)
     
 def Phab(Q, M):
+    ds = xr.open_dataset(Q['fn'])
+    F = Phab_setup(Q, M, ds)
+    ds.close()
+    finish(Q, F)
+
+def Phab_setup(Q, M, ds):
     # This is a modified version of P1 that is designed for the HAB Bulletin.
     # Adds two panels to the right that are close-ups of selected regions
+    F = dict()
     fig = plt.figure(figsize=Q['figsize'])
     fs = Q['fontsize']
     plt.rc('font', size=fs)
     
-    ds = xr.open_dataset(Q['fn'])
     if Q['dom'] == 'full':
         Q['aa'] = pfun.get_aa(ds)
     aa = Q['aa']
     
     vn = Q['vn']
     if Q['bot']:
-        nlev = 0
         tstr = 'Bottom'
     else:
-        nlev = -1
         tstr = 'Surface'
         
-    px, py = pfun.get_plon_plat(ds['lon_rho'].values, ds['lat_rho'].values)
-    if vn == 'speed':
-        fld = dm_pfun.get_speed(ds, nlev)
-    elif vn == 'ARAG':
-        px, py, fld = dm_pfun.get_arag(ds, Q, aa, nlev)
-        # we get px, py because ARAG is automatically only calulated over
-        # a limited domain (aa)
+    pxy, fld = get_fld(Q, ds)
+    if pxy is None:
+        px, py = pfun.get_plon_plat(ds['lon_rho'].values, ds['lat_rho'].values)
     else:
-        fld = ds[vn][0,nlev,:,:].values*pinfo.fac_dict[vn]
-        
-    if Q['emask']:
-        fld = dm_pfun.mask_edges(ds, fld, Q)
-    if Q['avl']:
-        # set vmax and vmin if needed
-        dm_pfun.get_vlims(ds, fld, Q)
+        px, py = pxy
         
     # MAP FIELD
     ax = plt.subplot2grid((7,2), (0,0), rowspan=6)
@@ -183,7 +226,12 @@ def Phab(Q, M):
         dm_pfun.add_bathy_contours(ax, ds, txt=False, depth_levs=[200])
         
     if vn == 'speed':
-        dm_pfun.add_velocity_vectors(ax, aa, ds, Q['fn'], v_scl=Q['v_scl'])
+        # save what we need to make the vectors again for a new time
+        F['G'] = zrfun.get_basic_info(Q['fn'], only_G=True)
+        F['vaa'] = ax.axis()
+        F['nngrid'] = 80
+        F['vv'] = dm_pfun.add_velocity_vectors(ax, aa, ds, Q['fn'], v_scl=Q['v_scl'],
+            G=F['G'])
         
     pfun.add_coast(ax, color='k')
     ax.axis(aa)
@@ -199,20 +247,13 @@ def Phab(Q, M):
     
     # Wind vector
     T = zrfun.get_basic_info(Q['fn'], only_T=True)
-    dm_pfun.add_wind(ax, M, T)
+    F['wv'] = dm_pfun.add_wind(ax, M, T)
     dm_pfun.add_wind_text(ax, aa, M, fs)
     
     if Q['tracks']:
-        tr_ds = xr.open_dataset(Q['tr_fn'], decode_times=False)
-        tracks_ot = tr_ds['ot'].values
-        tracks_lon = tr_ds.lon.values
-        tracks_lat = tr_ds.lat.values
-        iot = zfun.find_nearest_ind(tracks_ot, T['ocean_time'])
-        if iot > 2:
-            ax.plot(tracks_lon[0,:], tracks_lat[0,:],'og', ms=5)
-        ax.plot(tracks_lon[:iot+1,:], tracks_lat[:iot+1,:],'-r', alpha=.5, lw=1)
-        ax.plot(tracks_lon[iot,:], tracks_lat[iot,:],'o', mec='k', mfc='r')
-        tr_ds.close()
+        F['TR'] = dm_pfun.get_track_data(Q)
+        iot = zfun.find_nearest_ind(F['TR']['ot'], T['ocean_time'])
+        F['tr'] = dm_pfun.add_tracks(ax, F['TR'], iot)
         
     # axes labeling
     ax.set_xticks(Q['xtl'])
@@ -221,20 +262,7 @@ def Phab(Q, M):
     
     # MOORING TIME SERIES
     axm = plt.subplot2grid((7,2), (6,0), rowspan=1)
-    dm_pfun.plot_time_series(axm, M, T)
-    
-    def add_focus_tracks(ax, iot):
-        # fancy tracks with narrowing tails
-        if iot > 2:
-            ax.plot(tracks_lon[0,:], tracks_lat[0,:],'o',mec='gold', mfc='gold', ms=3)
-        ax.plot(tracks_lon[:iot+1,:], tracks_lat[:iot+1,:],'-r', alpha=.5, lw=1)
-        iiot = 0
-        while iiot < iot:
-            if (iot - iiot) <= 12:
-                iims = 7 - (iot - iiot)/2
-                ax.plot(tracks_lon[iiot,:], tracks_lat[iiot,:],'o', mec='r', mfc='r', ms=iims, alpha=.5)
-            iiot += 1
-        ax.plot(tracks_lon[iot,:], tracks_lat[iot,:],'o', mec='k', mfc='r', ms=8)
+    F['ts'] = dm_pfun.plot_time_series(axm, M, T)
     
     # Focus plot 1
     ax1 = plt.subplot2grid((2,2), (0,1))
@@ -247,7 +275,7 @@ def Phab(Q, M):
     pfun.add_coast(ax1, linewidth=1.5)
     pfun.add_bathy_contours(ax1, ds, txt=False, depth_levs=[200])
     if Q['tracks']:
-        add_focus_tracks(ax1, iot)
+        F['tr1'] = dm_pfun.add_tracks(ax1, F['TR'], iot, focus=True)
     ax1.axis(aa1)
     pfun.dar(ax1)
     # 2025.04.28 Add the ESP mooring location
@@ -264,21 +292,33 @@ def Phab(Q, M):
     pfun.add_coast(ax2, linewidth=1.5)
     dm_pfun.add_bathy_contours(ax2, ds, txt=False, depth_levs=[200])
     if Q['tracks']:
-        add_focus_tracks(ax2, iot)
+        F['tr2'] = dm_pfun.add_tracks(ax2, F['TR'], iot, focus=True)
     ax2.axis(aa2)
     pfun.dar(ax2)
     
     plt.tight_layout()
     plt.subplots_adjust(left=.03, bottom=.03, right=.97, top=.97, wspace=0, hspace=None)
     
-    # FINISH
-    ds.close()
-    if len(str(Q['fn_out'])) > 0:
-        plt.savefig(Q['fn_out'])
-        plt.close()
-    else:
-        plt.show()
-    plt.rcdefaults()
+    F['fig'] = fig
+    F['ax'] = ax
+    F['cs'] = cs
+    return F
+
+def Phab_update(Q, M, F, ds):
+    ax = F['ax']
+    pxy, fld = get_fld(Q, ds)
+    F['cs'].set_array(fld)
+    if 'vv' in F.keys():
+        F['vv'].remove()
+        F['vv'] = dm_pfun.add_velocity_vectors(ax, Q['aa'], ds, Q['fn'], v_scl=Q['v_scl'],
+            nngrid=F['nngrid'], G=F['G'], aaa=F['vaa'])
+    T = zrfun.get_basic_info(Q['fn'], only_T=True)
+    F['wv'] = dm_pfun.add_wind_vector(ax, M, T, wv=F['wv'])
+    if Q['tracks']:
+        iot = zfun.find_nearest_ind(F['TR']['ot'], T['ocean_time'])
+        for tr in ['tr', 'tr1', 'tr2']:
+            dm_pfun.update_tracks(F[tr], F['TR'], iot)
+    dm_pfun.update_time_series(F['ts'], M, T)
     
 # def P2(Q, M):
 #     # modified from P1 to be more square, for the wcvi domain
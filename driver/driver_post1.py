@@ -14,6 +14,11 @@ python driver_post1.py -gtx cas7_t0_x4b -r forecast -ro 0 -test True -override_c
 To run for real on apogee
 python driver_post1.py -gtx cas7_t0_x4b -r forecast -ro 0 < /dev/null > post.log &
 
+Add -engine True to have the jobs with a post/[job]/consumer.py (e.g. surface1,
+sequim1) get their fields from lo_tools/post_engine.py, which reads each history
+file only once. The other jobs run at the same time as the engine, at most -Njobs
+of them at once.
+
 NOTE: the "< /dev/null" appears to be necessary when running by hand and you stay
 logged on because (maybe) the daymovie0 job is somehow expecting standard input,
 and when it doesn't get it the job is "Stopped" and you have to use "fg" to start it again.
@@ -39,6 +44,12 @@ parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_strin
 # The special argument below will pass -test False in the cmd_list.
 # This is useful for fixing specific problems without having to re-run all jobs.
 parser.add_argument('-override_cmd_list_test', default=False, type=Lfun.boolean_string)
+# Set to True to run the jobs at the same time, with those that have a consumer.py
+# served by lo_tools/post_engine.py, which reads each history file once.
+parser.add_argument('-engine', default=False, type=Lfun.boolean_string)
+# With -engine True, the number of jobs without a consumer.py to run at once
+# (some, like daymovie0, use several processes themselves)
+parser.add_argument('-Njobs', default=2, type=int)
 # get the args and put into Ldir
 args = parser.parse_args()
 argsd = args.__dict__
@@ -118,23 +129,15 @@ tt0 = time()
 if Ldir['testing'] == True:
     job_list = ['drifters2']
 else:
-    job_list = ['ubc1', 'layers1', 'nest_wgh', 'daymovie0', 'surface1', 'sequim1',
-        'nest_oly', 'drifters2']
+    job_list = ['ubc1', 'layers1', 'nest_wgh', 'stations1', 'daymovie0', 'surface1',
+        'sequim1', 'nest_oly', 'drifters2']
     # job_list = ['ubc1', 'layers1', 'nest_wgh', 'daymovie0', 'surface1', 'sequim1',
     #     'nest_oly', 'drifters2','lowpass0']
 
-for job in job_list:
-    
-    # make clean output directories (often just a place for Info)
-    out_dir = Ldir['LOo'] / 'post' / Ldir['gtagex'] / ('f' + Ldir['date_string']) / job
-    Lfun.make_dir(out_dir, clean=True)
-    Lfun.make_dir(out_dir / 'Data')
-    Lfun.make_dir(out_dir / 'Info')
-    
-    if Ldir['testing']:
-        print(job.center(60, '-'))
-        print(str(out_dir))
-    
+def get_out_dir(job):
+    return Ldir['LOo'] / 'post' / Ldir['gtagex'] / ('f' + Ldir['date_string']) / job
+
+def get_cmd_list(job):
     j_fn = Ldir['LO'] / 'post' / job / 'post_main.py'
     if args.override_cmd_list_test == False: # the default
         cmd_list = ['python3', str(j_fn),
@@ -146,16 +149,11 @@ for job in job_list:
                     '-gtx', Ldir['gtagex'], '-ro', str(Ldir['roms_out_num']),
                     '-r', Ldir['run_type'], '-d', Ldir['date_string'],
                     '-job', job, '-test', 'False']
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    stdout, stderr = proc.communicate()
-    with open(out_dir / 'Info' / 'screen_output.txt', 'w') as fout:
-        fout.write(stdout.decode())
-    if len(stderr) > 0:
-        with open(out_dir / 'Info' / 'subprocess_error.txt', 'w') as ffout:
-            ffout.write(stderr.decode())
-            
+    return cmd_list
+
+def print_results(job):
     # the screen output below is intended to end up in the log that the cron job makes
-    res_fn = out_dir / 'Info' / 'results.txt'
+    res_fn = get_out_dir(job) / 'Info' / 'results.txt'
     if res_fn.is_file():
         with open(res_fn, 'r') as fout:
             for line in fout:
@@ -164,6 +162,87 @@ for job in job_list:
         print('ERROR: missing results.txt file')
     print('')
     sys.stdout.flush()
+
+for job in job_list:
+    
+    # make clean output directories (often just a place for Info)
+    out_dir = get_out_dir(job)
+    Lfun.make_dir(out_dir, clean=True)
+    Lfun.make_dir(out_dir / 'Data')
+    Lfun.make_dir(out_dir / 'Info')
+    
+    if Ldir['testing']:
+        print(job.center(60, '-'))
+        print(str(out_dir))
+    
+    if Ldir['engine']:
+        continue # the jobs are started below
+    
+    proc = Po(get_cmd_list(job), stdout=Pi, stderr=Pi)
+    stdout, stderr = proc.communicate()
+    with open(out_dir / 'Info' / 'screen_output.txt', 'w') as fout:
+        fout.write(stdout.decode())
+    if len(stderr) > 0:
+        with open(out_dir / 'Info' / 'subprocess_error.txt', 'w') as ffout:
+            ffout.write(stderr.decode())
+    print_results(job)
+
+def run_jobs(p_list, Njobs):
+    # Run post_main.py for the jobs in p_list, in order, with at most Njobs
+    # running at once. This runs in its own process, alongside the engine.
+    proc_dict = dict()
+    for job in p_list:
+        while sum([proc.poll() == None for proc in proc_dict.values()]) >= Njobs:
+            sleep(5)
+        Info_dir = get_out_dir(job) / 'Info'
+        proc_dict[job] = Po(get_cmd_list(job),
+            stdout=open(Info_dir / 'screen_output.txt', 'w'),
+            stderr=open(Info_dir / 'subprocess_error.txt', 'w'))
+    for job in p_list:
+        proc_dict[job].wait()
+        err_fn = get_out_dir(job) / 'Info' / 'subprocess_error.txt'
+        if err_fn.stat().st_size == 0:
+            err_fn.unlink()
+
+if Ldir['engine']:
+    # Jobs with a post/[job]/consumer.py get their fields from post_engine.run(),
+    # which reads each history file once. The rest run post_main.py as usual,
+    # Njobs at a time, at the same time as the engine.
+    import multiprocessing as mp
+    from lo_tools import post_engine
+    fn_list = Lfun.get_fn_list('hourly', Ldir, ds0, ds1)
+    c_list = []
+    p_list = []
+    for job in job_list:
+        jLdir = Ldir.copy()
+        jLdir['job'] = job
+        # defaults from post_argfun.intro()
+        jLdir['Nproc'] = 10
+        jLdir['exact_z'] = False
+        if args.override_cmd_list_test:
+            jLdir['testing'] = False
+        try:
+            c = post_engine.get_consumer(jLdir, fn_list)
+        except Exception as e:
+            print('Problem making consumer for %s, running post_main.py instead' % (job))
+            print(e)
+            c = None
+        if c is None:
+            p_list.append(job)
+        else:
+            c_list.append(c)
+    # (fork so the launcher knows get_cmd_list() etc.)
+    launcher = mp.get_context('fork').Process(target=run_jobs, args=(p_list, max(1, Ldir['Njobs'])))
+    launcher.start()
+    if len(c_list) > 0:
+        try:
+            post_engine.run(fn_list, c_list)
+        except Exception as e:
+            print('Problem in post_engine.run()')
+            print(e)
+    launcher.join()
+    for job in job_list:
+        print_results(job)
     
 print('Total time for all post jobs = %0.1f sec' % (time()-tt0))
     
@@ -30,6 +30,9 @@ apogee (-Nproc 10, the default)
 Update 2025.07.04: I added z_rho and z_w to the files, and compressed when saving.
 Each output file is now about 780 MB, simlilar to a history file as expected.
 
+See also extract_month_mean_stream.py, which makes the same files in one pass and
+updates the monthly climatologies as it goes.
+
 """
 
 import sys
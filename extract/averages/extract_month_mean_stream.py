@@ -0,0 +1,242 @@
+"""
+Driver to create monthly mean files and update the monthly climatologies, in one
+pass over the daily lowpassed.nc files.
+
+This makes the same monthly_mean_[year]_[month].nc files as extract_month_mean.py.
+Each month is done by one process that reads its lowpassed files once, updating
+running (Welford) accumulators for the mean and, with -stats True, the variance,
+min, and max. Months are done in parallel using Nproc processes.
+
+As each month finishes it is also added to the climatology for that calendar month.
+The climatology accumulators (the running mean over years, and the sum of squared
+differences, min, and max if you use -stats) are saved as checkpoints in
+LO_roms/[gtagex]/climatologies/accumulators/, along with the list of years they
+include. So when a new month is done the climatology is extended by that month
+instead of being recomputed from all the monthly means. The climatologies are
+written to LO_roms/[gtagex]/climatologies/monthly_clim_[month].nc, as in
+climatology_by_month.py.
+
+The accumulators for a calendar month are rebuilt from all the
+monthly_mean_[year]_[month].nc files in the averages folder when they do not
+exist yet (e.g. the first time this is run where climatology_by_month.py made the
+climatologies), or when a month that is already in the climatology is made again,
+since its old monthly mean can no longer be taken out of the accumulators.
+
+Output with -stats True:
+LO_roms/[gtagex]/averages/monthly_stats_[year]_[month].nc
+    [vn]_var, [vn]_min, [vn]_max of the daily lowpassed fields in the month
+LO_roms/[gtagex]/climatologies/monthly_clim_stats_[month].nc
+    [vn]_var, [vn]_min, [vn]_max of the monthly means over years
+
+Test on mac:
+run extract_month_mean_stream -gtx cas7_t0_x4b -0 2020.01.01 -1 2020.03.31 -Nproc 3
+
+NOTE: As with extract_month_mean.py the days in the -0 and -1 inputs are ignored.
+
+"""
+
+import sys
+import os
+import pandas as pd
+import xarray as xr
+import numpy as np
+from datetime import datetime
+import multiprocessing as mp
+from time import time
+
+from lo_tools import Lfun, zrfun
+from lo_tools import extract_argfun as exfun
+
+Ldir = exfun.intro() # this handles the argument passing
+
+ds0 = Ldir['ds0']
+ds1 = Ldir['ds1']
+dt0 = datetime.strptime(ds0, Lfun.ds_fmt)
+dt1 = datetime.strptime(ds1, Lfun.ds_fmt)
+
+dti = pd.date_range(dt0, dt1, freq='ME', inclusive='right')
+# This is a DatetimeIndex of the last day of each month in the range,
+# including the last month.
+
+# output locations
+out_dir = Ldir['roms_out'] / Ldir['gtagex'] / 'averages'
+clim_dir = Ldir['roms_out'] / Ldir['gtagex'] / 'climatologies'
+accum_dir = clim_dir / 'accumulators'
+Lfun.make_dir(out_dir)
+Lfun.make_dir(accum_dir)
+
+S_info_dict = Lfun.csv_to_dict(Ldir['grid'] / 'S_COORDINATE_INFO.csv')
+S = zrfun.get_S(S_info_dict)
+
+def save_nc(ds, out_fn, **kwargs):
+    # Save with compression, writing to a temp file first so that an
+    # interrupted job never leaves a partial file behind.
+    temp_fn = out_fn.parent / (out_fn.name + '.temp')
+    temp_fn.unlink(missing_ok=True)
+    # (only for floats: the _FillValue in enc_dict overflows for integers like Vtransform)
+    Enc_dict = {vn:zrfun.enc_dict for vn in ds.data_vars if ds[vn].dtype.kind == 'f'}
+    ds.to_netcdf(temp_fn, encoding=Enc_dict, **kwargs)
+    os.replace(temp_fn, out_fn)
+
+def new_accum():
+    return {'n':dict(), 'mean':dict(), 'M2':dict(), 'min':dict(), 'max':dict()}
+
+def update_accum(A, vn, x):
+    # Welford update of the accumulators in dict A with the new field x.
+    # Only the mean is kept unless we are using -stats True.
+    A['n'][vn] = A['n'].get(vn, 0) + 1
+    if A['n'][vn] == 1:
+        A['mean'][vn] = x.astype(float)
+        if Ldir['stats']:
+            A['M2'][vn] = np.zeros(x.shape)
+            A['min'][vn] = x.copy()
+            A['max'][vn] = x.copy()
+    else:
+        delta = x - A['mean'][vn]
+        A['mean'][vn] += delta / A['n'][vn]
+        if Ldir['stats']:
+            A['M2'][vn] += delta * (x - A['mean'][vn])
+            A['min'][vn] = np.minimum(A['min'][vn], x)
+            A['max'][vn] = np.maximum(A['max'][vn], x)
+
+def stats_ds(A, ds_template):
+    # Pack the variance, min, and max in a Dataset.
+    ds = xr.Dataset(coords=ds_template.coords)
+    for vn in A['mean'].keys():
+        dims = ds_template[vn].dims
+        ds[vn + '_var'] = (dims, A['M2'][vn] / A['n'][vn])
+        ds[vn + '_min'] = (dims, A['min'][vn])
+        ds[vn + '_max'] = (dims, A['max'][vn])
+    return ds
+
+def do_month(dt):
+    # Make the monthly mean (and stats) for the month ending on dt.
+    tt0 = time()
+    this_ym = dt.strftime('%Y_%m')
+    fn_list = Lfun.get_fn_list('lowpass', Ldir,
+        datetime(dt.year,dt.month,1).strftime(Lfun.ds_fmt), dt.strftime(Lfun.ds_fmt))
+    missing = [fn for fn in fn_list if not fn.is_file()]
+    if len(missing) > 0:
+        print('%s: skipping, missing %d lowpassed files, e.g. %s' % (this_ym, len(missing), str(missing[0])))
+        sys.stdout.flush()
+        return None
+    A = new_accum()
+    for fn in fn_list:
+        ds = xr.open_dataset(fn, decode_times=False)
+        if fn == fn_list[0]:
+            # the fields that change with time get averaged, and the others
+            # (grid info) are copied from the first file
+            mean_full = ds.load()
+            vn_list = [vn for vn in ds.data_vars if 'ocean_time' in ds[vn].dims]
+        for vn in vn_list:
+            update_accum(A, vn, ds[vn].values)
+        ds.close()
+    for vn in vn_list:
+        mean_full[vn].values = A['mean'][vn].astype(mean_full[vn].dtype)
+
+    # add z_rho and z_w fields
+    NT, N, NR, NC = mean_full.salt.shape
+    mean_full.update({'z_rho':(('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), np.nan*np.ones((NT, N, NR, NC)))})
+    mean_full.update({'z_w':(('ocean_time', 's_w', 'eta_rho', 'xi_rho'), np.nan*np.ones((NT, N+1, NR, NC)))})
+    mean_full.z_rho.attrs = {'units':'m', 'long_name': 'vertical position on s_rho grid, positive up'}
+    mean_full.z_w.attrs = {'units':'m', 'long_name': 'vertical position on s_w grid, positive up'}
+    h = mean_full.h.to_numpy()
+    zeta = mean_full.zeta[0,:,:].to_numpy().squeeze()
+    z_rho, z_w = zrfun.get_z(h, zeta, S)
+    mean_full['z_rho'][0,:,:,:] = z_rho
+    mean_full['z_w'][0,:,:,:] = z_w
+
+    save_nc(mean_full, out_dir / ('monthly_mean_' + this_ym + '.nc'), unlimited_dims=['ocean_time'])
+    if Ldir['stats']:
+        save_nc(stats_ds(A, mean_full), out_dir / ('monthly_stats_' + this_ym + '.nc'))
+    mean_full.close()
+    print('%s: time to make monthly_mean = %0.1f minutes' % (this_ym, (time()-tt0)/60))
+    sys.stdout.flush()
+    return dt
+
+def rebuild_accum(mstr, vn_list):
+    # Make the climatology accumulators for calendar month mstr from all the
+    # monthly means for that month in out_dir.
+    A = new_accum()
+    year_list = []
+    for fn in sorted(out_dir.glob('monthly_mean_*_' + mstr + '.nc')):
+        mm = xr.open_dataset(fn, decode_times=False)
+        for vn in vn_list:
+            update_accum(A, vn, mm[vn].values)
+        mm.close()
+        year_list.append(int(fn.stem.split('_')[2]))
+    return A, year_list
+
+def add_to_clim(dt):
+    # Add the monthly mean for the month ending on dt to the checkpointed
+    # climatology accumulators for that calendar month, and save the climatology.
+    mstr = ('000' + str(dt.month))[-2:]
+    accum_fn = accum_dir / ('clim_accum_' + mstr + '.nc')
+    mm = xr.open_dataset(out_dir / ('monthly_mean_' + dt.strftime('%Y_%m') + '.nc'),
+        decode_times=False).load()
+    vn_list = [vn for vn in mm.data_vars if 'ocean_time' in mm[vn].dims]
+    if accum_fn.is_file():
+        acc = xr.open_dataset(accum_fn, decode_times=False).load()
+        acc.close()
+        year_list = [int(item) for item in str(acc.attrs['years']).split(',')]
+        if bool(acc.attrs['stats']) != Ldir['stats']:
+            print('WARNING: -stats %s does not match the accumulators in %s: not updating the climatology'
+                % (str(Ldir['stats']), str(accum_fn)))
+            return
+        if dt.year in year_list:
+            # this month was made again, so we start over
+            print(' - %d is already in the climatology for month %s: rebuilding it from the monthly means'
+                % (dt.year, mstr))
+            A, year_list = rebuild_accum(mstr, vn_list)
+        else:
+            A = new_accum()
+            for vn in vn_list:
+                A['n'][vn] = len(year_list)
+                A['mean'][vn] = acc[vn].values
+                if Ldir['stats']:
+                    for a in ['M2','min','max']:
+                        A[a][vn] = acc[vn + '_' + a].values
+            for vn in vn_list:
+                update_accum(A, vn, mm[vn].values)
+            year_list = sorted(year_list + [dt.year])
+    else:
+        # the first time: start from all the monthly means we have, which
+        # include the one we just made
+        A, year_list = rebuild_accum(mstr, vn_list)
+        print(' - starting the climatology accumulators for month %s from the monthly means for %s'
+            % (mstr, ','.join([str(item) for item in year_list])))
+
+    # save the accumulators
+    acc = xr.Dataset(coords=mm.coords)
+    for vn in vn_list:
+        acc[vn] = (mm[vn].dims, A['mean'][vn])
+        if Ldir['stats']:
+            for a in ['M2','min','max']:
+                acc[vn + '_' + a] = (mm[vn].dims, A[a][vn])
+    acc.attrs['years'] = ','.join([str(item) for item in year_list])
+    acc.attrs['stats'] = int(Ldir['stats'])
+    save_nc(acc, accum_fn)
+
+    # save the climatology
+    clim = mm.copy()
+    for vn in vn_list:
+        clim[vn].values = A['mean'][vn].astype(mm[vn].dtype)
+    clim.attrs['years'] = acc.attrs['years']
+    save_nc(clim, clim_dir / ('monthly_clim_' + mstr + '.nc'))
+    if Ldir['stats']:
+        clim_stats = stats_ds(A, mm)
+        clim_stats.attrs['years'] = acc.attrs['years']
+        save_nc(clim_stats, clim_dir / ('monthly_clim_stats_' + mstr + '.nc'))
+    print(' - saved the climatology for month %s (%d years: %s)' % (mstr, len(year_list), acc.attrs['years']))
+    sys.stdout.flush()
+
+tt00 = time()
+Nproc = max(1, min(Ldir['Nproc'], len(dti)))
+# fork so the workers inherit Ldir, S, etc.
+with mp.get_context('fork').Pool(Nproc) as pool:
+    # the climatology is updated in this process, in month order
+    for dt in pool.imap(do_month, list(dti)):
+        if dt is not None:
+            add_to_clim(dt)
+
+print('Total time = %0.1f minutes' % ((time()-tt00)/60))
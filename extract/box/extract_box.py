@@ -253,7 +253,7 @@ if (Ldir['surf']==False) and (Ldir['bot']==False):
     for ii in range(NT):
         h = ds.h.values
         zeta = ds.zeta[ii,:,:].values
-        z_rho, z_w = zrfun.get_z(h, zeta, S)
+        z_rho, z_w = zrfun.get_z(h, zeta, S, cache=True)
         ds['z_rho'][ii,:,:,:] = z_rho
         ds['z_w'][ii,:,:,:] = z_w
     ds.to_netcdf(box_fn)
@@ -19,9 +19,19 @@ which is too much for even the 32 GB on my mac.
 I consider this code a hack to solve a pressing problem, but in the long run I will
 be using more sophisticated tools like zarr and dask.
 
+NEW: extract_box_dask.py does the same job using dask, with bounded memory and no
+temporary files, and it can write zarr. Try that first.
+
 Testing:
 run extract_box_chunks.py -gtx cas6_v0_live -job byrd -surf True -uv_to_rho True -test True
 
+Restarting: each finished chunk gets a manifest file (chunk_0000_info.csv etc.) recording
+a hash of the job settings and of the names, sizes, and modification times of its input
+history files, and the size of the chunk file. If a job dies part way through, just run the
+same command again: chunks with a matching manifest are kept, and only the missing or stale
+ones (e.g. a history file that has been replaced) are extracted before the final ncrcat.
+Use -resume False to start from scratch.
+
 Production run:
 python extract_box_chunks.py -gtx cas6_v0_live -ro 0 -lt hourly -0 2019.01.01 -1 2019.12.31 -job byrd -surf True -uv_to_rho True > byrd.log &
 
@@ -34,6 +44,7 @@ from lo_tools import Lfun, zfun, zrfun
 from subprocess import Popen as Po
 from subprocess import PIPE as Pi
 import os
+import hashlib
 from time import time
 import numpy as np
 import xarray as xr
@@ -65,6 +76,8 @@ parser.add_argument('-Nproc', type=int, default=10)
 parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_string)
 # Optional: for cleanup
 parser.add_argument('-clean', '--cleanup', default=True, type=Lfun.boolean_string) # if True, will not delete chunk_XXXX files at end
+# Optional: set to False to ignore chunks finished by an earlier run of the same job
+parser.add_argument('-resume', default=True, type=Lfun.boolean_string)
 # get the args and put into Ldir
 args = parser.parse_args()
 # test that main required arguments were provided
@@ -109,10 +122,11 @@ else:
     bb_str = '_'
 
 out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'box' / (Ldir['job'] + bb_str + dd_str + '_chunks')
-Lfun.make_dir(out_dir, clean=True)
+# NOTE: we keep temp_chunks from an earlier run so that we can resume
+Lfun.make_dir(out_dir, clean=not Ldir['resume'])
 
 temp_chunk_dir = out_dir / 'temp_chunks'  # kmh edit: add temp dir
-Lfun.make_dir(temp_chunk_dir, clean=True) 
+Lfun.make_dir(temp_chunk_dir, clean=not Ldir['resume'])
 
 # get list of files to work on
 fn_list = Lfun.get_fn_list(Ldir['list_type'], Ldir, Ldir['ds0'], Ldir['ds1'])
@@ -176,6 +190,29 @@ def messages(mess_str, stdout, stderr):
 
 # naming the final output file
 box_fn_final = out_dir / (Ldir['job'] + bb_str + dd_str + '.nc')
+box_fn_final.unlink(missing_ok=True)
+
+def get_chunk_hash(this_fn_list):
+    # A hash of everything that determines the contents of a chunk: the job
+    # settings and the name, size, and modification time of each input file.
+    # We do not hash the contents of the history files because that would
+    # take about as long as the extraction.
+    hash_list = [vn_list, str((ilon0, ilon1, ilat0, ilat1)),
+        str((Ldir['surf'], Ldir['bot'], Ldir['uv_to_rho']))]
+    for fn in this_fn_list:
+        fst = fn.stat()
+        hash_list.append('%s %d %0.6f' % (str(fn), fst.st_size, fst.st_mtime))
+    return hashlib.md5('\n'.join(hash_list).encode()).hexdigest()
+
+def chunk_is_done(box_fn, info_fn, chunk_hash):
+    # True if the chunk file exists and matches its manifest
+    if (not box_fn.is_file()) or (not info_fn.is_file()):
+        return False
+    info = Lfun.csv_to_dict(info_fn)
+    if (info['chunk_hash'] == chunk_hash) and (int(info['out_size']) == box_fn.stat().st_size):
+        return True
+    else:
+        return False
 
 ## Start of chunks loop
 tt00 = time()
@@ -197,6 +234,7 @@ else:
     
 
 counter = 0
+bad_chunk_list = []
 for this_cca in ccas:
     cc0 = this_cca[0]
     cc1 = this_cca[-1]
@@ -209,10 +247,20 @@ for this_cca in ccas:
     box_fn = temp_chunk_dir / ('chunk_' + ('0000' + str(counter))[-4:] +'.nc') 
     # also make a temporary name for adding variables
     box_temp_fn = temp_chunk_dir / ('chunk_temp_' + ('0000' + str(counter))[-4:] +'.nc')
+    # and the manifest that marks the chunk as finished
+    info_fn = temp_chunk_dir / ('chunk_' + ('0000' + str(counter))[-4:] +'_info.csv')
     # name the temp dir to accumulate individual extractions
     temp_dir = temp_chunk_dir / 'temp_dir'
 
+    chunk_hash = get_chunk_hash(this_fn_list)
+    if Ldir['resume'] and chunk_is_done(box_fn, info_fn, chunk_hash):
+        print('Keeping ' + box_fn.name + ' from an earlier run')
+        counter += 1
+        continue
+    chunk_ok = True
+
     box_fn.unlink(missing_ok=True)
+    info_fn.unlink(missing_ok=True)
     box_temp_fn.unlink(missing_ok=True)
     Lfun.make_dir(temp_dir, clean=True)
 
@@ -263,6 +311,13 @@ for this_cca in ccas:
         ii += 1
     print(' Time to for initial extraction = %0.2f sec' % (time()- tt0))
     sys.stdout.flush()
+    # check that ncks worked for every file, e.g. it fails for a corrupt history file
+    if len(list(temp_dir.glob('box_*.nc'))) != N:
+        print(' * Missing extractions for ' + box_fn.name + ', skipping to next chunk')
+        sys.stdout.flush()
+        bad_chunk_list.append(box_fn.name)
+        counter += 1
+        continue
 
     # Ensure that all days have the same fill value.  This was required for cas6_v3_lo8b
     # when passing from 2021.10.31 to 2021.11.01 because they had inconsistent fill values,
@@ -306,7 +361,7 @@ for this_cca in ccas:
             for ii in range(NT):
                 h = ds.h.values
                 zeta = ds.zeta[ii,:,:].values
-                z_rho, z_w = zrfun.get_z(h, zeta, S)
+                z_rho, z_w = zrfun.get_z(h, zeta, S, cache=True)
                 ds['z_rho'][ii,:,:,:] = z_rho
                 ds['z_w'][ii,:,:,:] = z_w
             ds.to_netcdf(box_temp_fn)
@@ -377,6 +432,7 @@ for this_cca in ccas:
         except Exception as e:
             print('Exception during uv_to_rho step')
             print(e)
+            chunk_ok = False
     
     # squeeze the resulting file
     try:
@@ -391,6 +447,7 @@ for this_cca in ccas:
     except Exception as e:
         print(' * Exception during squeeze')
         print(e)
+        chunk_ok = False
         
     # compress the resulting file
     try:
@@ -407,17 +464,32 @@ for this_cca in ccas:
         print(' * Exception compress step')
         print(e)
 
+    # write the manifest
+    if chunk_ok:
+        info = {'chunk_hash': chunk_hash, 'fn0': str(this_fn_list[0]), 'fn1': str(this_fn_list[-1]),
+            'nfiles': N, 'out_size': box_fn.stat().st_size}
+        Lfun.dict_to_csv(info, info_fn)
+    else:
+        bad_chunk_list.append(box_fn.name)
+
     # clean up
     Lfun.make_dir(temp_dir, clean=True)
     temp_dir.rmdir()
     
     counter += 1
     ## End of month loop
+
+if len(bad_chunk_list) > 0:
+    print('\nERROR: these chunks did not finish:')
+    for item in bad_chunk_list:
+        print(' ' + item)
+    print('Fix the problem and run the same command again to do just these chunks.')
+    sys.exit()
     
 # concatenate the chunks into one file
 tt0 = time()
 pp1 = Po(['ls', str(temp_chunk_dir)], stdout=Pi)
-pp2 = Po(['grep','chunk_'], stdin=pp1.stdout, stdout=Pi)
+pp2 = Po(['grep','-E',r'^chunk_[0-9]{4}\.nc$'], stdin=pp1.stdout, stdout=Pi)
 cmd_list = ['ncrcat','-p', str(temp_chunk_dir), '-O', str(box_fn_final)]
 proc = Po(cmd_list, stdin=pp2.stdout, stdout=Pi, stderr=Pi)
 stdout, stderr = proc.communicate()
@@ -0,0 +1,296 @@
+"""
+Code to extract a box-like region, typically for another modeler to use
+as a boundary contition.  In cases where it gets velocity in addition to
+the rho-grid variables the grid limits mimic the standard ROMS organization,
+with the outermost corners being on the rho-grid.
+
+Job definitions are in LO/extract/box/job_definitions.py
+
+This "dask" version does the same job as extract_box.py and extract_box_chunks.py
+but without ncks, ncrcat, or temporary files. It opens the whole list of history
+files lazily with xr.open_mfdataset(), and the box window, surf/bot selection,
+z variables, and uv_to_rho interpolation are all done as chunked dask operations.
+Nothing is computed until the result is written, which happens one time-chunk
+(-tchunk saves) at a time, so the memory needed is set by the chunk size and the
+number of workers (-Nproc), not by the length of the extraction. This solves the
+problem that led to extract_box_chunks.py (a year of hourly surface fields for the
+byrd job).
+
+Use -fmt zarr to write a zarr store instead of NetCDF.
+
+Testing:
+run extract_box_dask -gtx cas6_v0_live -job byrd -surf True -uv_to_rho True -test True
+
+Production run:
+python extract_box_dask.py -gtx cas6_v0_live -ro 0 -lt hourly -0 2019.01.01 -1 2019.12.31 -job byrd -surf True -uv_to_rho True -Nproc 8 > byrd.log &
+
+"""
+
+# imports
+import sys
+import argparse
+from lo_tools import Lfun, zfun, zrfun
+import os
+import shutil
+from time import time
+import numpy as np
+import xarray as xr
+import dask
+import dask.array as da
+from dask.diagnostics import ProgressBar
+
+pid = os.getpid()
+print(' extract_box_dask '.center(60,'='))
+print('PID for this job = ' + str(pid))
+
+# command line arugments
+parser = argparse.ArgumentParser()
+# which run to use
+parser.add_argument('-gtx', '--gtagex', type=str)   # e.g. cas6_v3_lo8b
+parser.add_argument('-ro', '--roms_out_num', type=int) # 2 = Ldir['roms_out2'], etc.
+# select time period and frequency
+parser.add_argument('-0', '--ds0', type=str) # e.g. 2019.07.04
+parser.add_argument('-1', '--ds1', type=str) # e.g. 2019.07.06
+parser.add_argument('-lt', '--list_type', type=str) # list type: hourly, daily, weekly, lowpass
+# select job name
+parser.add_argument('-job', type=str) # job name
+# these flags get only surface or bottom fields if True
+# - cannot have both True -
+parser.add_argument('-surf', default=False, type=Lfun.boolean_string)
+parser.add_argument('-bot', default=False, type=Lfun.boolean_string)
+# set this to True to interpolate all u, and v fields to the rho-grid
+parser.add_argument('-uv_to_rho', default=False, type=Lfun.boolean_string)
+# Optional: number of dask worker threads
+parser.add_argument('-Nproc', type=int, default=4)
+# Optional: number of saves in each chunk written to the output
+parser.add_argument('-tchunk', type=int, default=24)
+# Optional: output format, nc or zarr
+parser.add_argument('-fmt', type=str, default='nc')
+# Optional: for testing
+parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_string)
+# get the args and put into Ldir
+args = parser.parse_args()
+# test that main required arguments were provided
+argsd = args.__dict__
+for a in ['gtagex']:
+    if argsd[a] == None:
+        print('*** Missing required argument: ' + a)
+        sys.exit()
+gridname, tag, ex_name = args.gtagex.split('_')
+# get the dict Ldir
+Ldir = Lfun.Lstart(gridname=gridname, tag=tag, ex_name=ex_name)
+# add more entries to Ldir
+for a in argsd.keys():
+    if a not in Ldir.keys():
+        Ldir[a] = argsd[a]
+
+# testing
+if Ldir['testing']:
+    Ldir['roms_out_num'] = 0
+    Ldir['ds0'] = '2019.07.04'
+    Ldir['ds1'] = '2019.07.06'
+    Ldir['list_type'] = 'hourly'
+
+# set where to look for model output
+if Ldir['roms_out_num'] == 0:
+    pass
+elif Ldir['roms_out_num'] > 0:
+    Ldir['roms_out'] = Ldir['roms_out' + str(Ldir['roms_out_num'])]
+
+# check for input conflicts:
+if Ldir['surf'] and Ldir['bot']:
+    print('Error: cannot have surf and bot both True.')
+    sys.exit()
+if Ldir['fmt'] not in ['nc', 'zarr']:
+    print('Error: fmt must be nc or zarr.')
+    sys.exit()
+
+# output location
+out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'box'
+Lfun.make_dir(out_dir)
+dd_str = Ldir['ds0'] + '_' + Ldir['ds1']
+if Ldir['surf']:
+    bb_str = '_surf_'
+elif Ldir['bot']:
+    bb_str = '_bot_'
+else:
+    bb_str = '_'
+box_fn = out_dir / (Ldir['job'] + bb_str + dd_str + '.' + Ldir['fmt'])
+if box_fn.is_dir():
+    shutil.rmtree(str(box_fn)) # a zarr store is a directory
+else:
+    box_fn.unlink(missing_ok=True)
+
+# get list of files to work on
+fn_list = Lfun.get_fn_list(Ldir['list_type'], Ldir, Ldir['ds0'], Ldir['ds1'])
+G, S, T = zrfun.get_basic_info(fn_list[0])
+Lon = G['lon_rho'][0,:]
+Lat = G['lat_rho'][:,0]
+
+def check_bounds(lon, lat):
+    # error checking
+    if (lon < Lon[0]) or (lon > Lon[-1]):
+        print('ERROR: lon out of bounds ')
+        sys.exit()
+    if (lat < Lat[0]) or (lat > Lat[-1]):
+        print('ERROR: lat out of bounds ')
+        sys.exit()
+    # get indices
+    ilon = zfun.find_nearest_ind(Lon, lon)
+    ilat = zfun.find_nearest_ind(Lat, lat)
+    return ilon, ilat
+
+# get the job_definitions module, looking first in LO_user
+pth = Ldir['LO'] / 'extract' / 'box'
+upth = Ldir['LOu'] / 'extract' / 'box'
+if (upth / 'job_definitions.py').is_file():
+    print('Importing job_definitions from LO_user')
+    job_definitions = Lfun.module_from_file('job_definitions', upth / 'job_definitions.py')
+else:
+    print('Importing job_definitions from LO')
+    job_definitions = Lfun.module_from_file('job_definitions', pth / 'job_definitions.py')
+aa, vn_list = job_definitions.get_box(Ldir['job'], Lon, Lat)
+lon0, lon1, lat0, lat1 = aa
+ilon0, ilat0 = check_bounds(lon0, lat0)
+ilon1, ilat1 = check_bounds(lon1, lat1)
+
+# do a final check to drop missing variables from the list
+ds = xr.open_dataset(fn_list[0])
+print('Original vn_list:')
+print(' ' + vn_list)
+vn_list = (',').join([item for item in vn_list.split(',') if item in ds.data_vars])
+print('Trimmed vn_list:')
+print(' ' + vn_list)
+ds.close()
+vn_List = vn_list.split(',')
+
+# The index window, matching the ncks calls in extract_box.py.
+# NOTE: unlike ncks, isel() slices are EXCLUSIVE of the last point.
+isel_dict = {'xi_rho':slice(ilon0, ilon1+1), 'eta_rho':slice(ilat0, ilat1+1),
+    'xi_u':slice(ilon0, ilon1), 'eta_u':slice(ilat0, ilat1+1),
+    'xi_v':slice(ilon0, ilon1+1), 'eta_v':slice(ilat0, ilat1)}
+if Ldir['surf']:
+    isel_dict['s_rho'] = S['N']-1
+elif Ldir['bot']:
+    isel_dict['s_rho'] = 0
+
+def preprocess(ds):
+    # applied to each history file before they are combined, so that we
+    # never even set up reads of variables or points outside the box
+    return ds[vn_List].isel(isel_dict, missing_dims='ignore', drop=True)
+
+# Set the number of workers used by all the dask operations below.
+# NOTE: reads from NetCDF files are serialized by a lock in xarray, so the
+# gain from more workers is in the z, uv_to_rho, and compression steps.
+dask.config.set(scheduler='threads', num_workers=Ldir['Nproc'])
+
+tt00 = time()
+# open the files lazily: this only reads the metadata
+tt0 = time()
+ds = xr.open_mfdataset(fn_list, preprocess=preprocess, combine='nested',
+    concat_dim='ocean_time', data_vars='minimal', coords='minimal', compat='override',
+    join='override', chunks={})
+# one chunk per tchunk saves, and the full box in each chunk (chunks={} above
+# keeps the chunking of the NetCDF files, which may split the box, and z_block()
+# below needs the full horizontal grid in each block)
+chunk_dict = {dim: -1 for dim in ds.dims}
+chunk_dict['ocean_time'] = Ldir['tchunk']
+ds = ds.chunk(chunk_dict)
+NT = len(ds.ocean_time)
+print('Time to open %d files = %0.2f sec' % (len(fn_list), time()- tt0))
+sys.stdout.flush()
+
+# add z variables
+if (Ldir['surf']==False) and (Ldir['bot']==False):
+    if 'zeta' in ds.data_vars:
+        h = ds.h.values
+        NR, NC = h.shape
+        def z_block(zeta, only_rho=False, only_w=False):
+            # z for a chunk of zeta(ocean_time, eta_rho, xi_rho)
+            nt = zeta.shape[0]
+            if only_rho:
+                nz = S['N']
+            else:
+                nz = S['N'] + 1
+            z = np.nan * np.ones((nt, nz, NR, NC))
+            for ii in range(nt):
+                zrfun.get_z(h, zeta[ii,:,:], S, only_rho=only_rho, only_w=only_w,
+                    cache=True, out=z[ii,:,:,:])
+            return z
+        zeta = ds.zeta.data
+        z_rho = da.map_blocks(z_block, zeta, only_rho=True, dtype=float,
+            new_axis=1, chunks=(zeta.chunks[0], (S['N'],), (NR,), (NC,)))
+        z_w = da.map_blocks(z_block, zeta, only_w=True, dtype=float,
+            new_axis=1, chunks=(zeta.chunks[0], (S['N']+1,), (NR,), (NC,)))
+        ds['z_rho'] = (('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), z_rho)
+        ds['z_w'] = (('ocean_time', 's_w', 'eta_rho', 'xi_rho'), z_w)
+        ds.z_rho.attrs = {'units':'m', 'long_name': 'vertical position on s_rho grid, positive up'}
+        ds.z_w.attrs = {'units':'m', 'long_name': 'vertical position on s_w grid, positive up'}
+    else:
+        print(' * Skipping z variables because zeta is not in vn_list')
+
+if Ldir['uv_to_rho']:
+    # interpolate anything on the u and v grids to the rho grid, assuming
+    # zero values where masked, and leaving a masked ring around the outermost edge
+    Maskr = ds.mask_rho.values == 1 # True over water
+    for vn in list(ds.data_vars):
+        dims = ds[vn].dims
+        if ('ocean_time' not in dims) or (('xi_u' not in dims) and ('xi_v' not in dims)):
+            continue
+        uu = ds[vn].data
+        uu = da.where(da.isnan(uu), 0, uu)
+        if 'xi_u' in dims:
+            UU = (uu[...,1:-1,1:]+uu[...,1:-1,:-1])/2
+        else:
+            UU = (uu[...,1:,1:-1]+uu[...,:-1,1:-1])/2
+        pad = [(0,0)]*(UU.ndim-2) + [(1,1),(1,1)]
+        uuu = da.pad(UU, pad, mode='constant', constant_values=np.nan)
+        uuu = da.where(Maskr, uuu, np.nan).rechunk({-2:-1, -1:-1}) # full box in each chunk
+        attrs = ds[vn].attrs
+        ds = ds.drop_vars(vn)
+        ds[vn] = (dims[:-2] + ('eta_rho', 'xi_rho'), uuu)
+        ds[vn].attrs = attrs
+
+# remove singleton dimensions, as in the other box extractions
+ds = ds.squeeze(drop=True)
+# and drop coordinates left over from the u and v grids
+ds = ds.drop_vars([vn for vn in ds.coords if len(ds[vn].dims) == 0])
+ds = ds.drop_dims([dim for dim in ['eta_u','xi_u','eta_v','xi_v']
+    if (dim in ds.dims) and not any([dim in ds[vn].dims for vn in ds.data_vars])])
+
+# write the result, computing one chunk at a time
+tt0 = time()
+print('Writing ' + box_fn.name + ' (' + str(NT) + ' times)')
+sys.stdout.flush()
+for vn in ds.variables:
+    # drop encoding (chunking, compression) inherited from the history files
+    ds[vn].encoding = {}
+if Ldir['fmt'] == 'nc':
+    Enc_dict = dict()
+    for vn in ds.data_vars:
+        if 'ocean_time' in ds[vn].dims:
+            chunksizes = tuple([min(Ldir['tchunk'], NT) if dim == 'ocean_time'
+                else ds.sizes[dim] for dim in ds[vn].dims])
+            Enc_dict[vn] = {'zlib':True, 'complevel':1, '_FillValue':1e20,
+                'chunksizes':chunksizes}
+    with ProgressBar():
+        ds.to_netcdf(box_fn, encoding=Enc_dict)
+elif Ldir['fmt'] == 'zarr':
+    with ProgressBar():
+        ds.to_zarr(box_fn, mode='w')
+ds.close()
+print('Time to extract and write = %0.2f sec' % (time()- tt0))
+
+# Finale
+print('\nSize of full rho-grid = %s' % (str(G['lon_rho'].shape)))
+print(' \nContents of extracted box file: '.center(60,'-'))
+# check on the results
+if Ldir['fmt'] == 'nc':
+    ds = xr.open_dataset(box_fn)
+elif Ldir['fmt'] == 'zarr':
+    ds = xr.open_zarr(box_fn)
+for vn in ds.data_vars:
+    print('%s %s' % (vn, str(ds[vn].shape)))
+ds.close()
+print('\nPath to file:\n%s' % (str(box_fn)))
+print('\nTotal time = %0.2f sec' % (time()- tt00))
@@ -5,6 +5,7 @@ Module of functions for cast extractions.
 from lo_tools import zfun, zrfun
 
 import subprocess
+import sys
 import xarray as xr
 import numpy as np
 from datetime import timedelta
@@ -71,6 +72,69 @@ def get_cast(out_fn, fn, lon, lat, npzd):
     foo.to_netcdf(out_fn)
     foo.close()
         
+def get_casts(fn, cid_list, lon_list, lat_list, npzd, G, S):
+    """
+    Extract casts at many places from a single history file fn, returning
+    an xarray Dataset with dimensions (cast, s_rho) and (cast, s_w), and
+    the cast ids as the coordinate "cast". This is like running get_cast()
+    for each cast, but it opens the history file once and gets all the casts
+    with one read per variable. Casts outside the grid or on land are dropped.
+    """
+    Lon = G['lon_rho'][0,:]
+    Lat = G['lat_rho'][:,0]
+    
+    # error checking, and get indices
+    cid_good = []; ix_list = []; iy_list = []
+    for cid, lon, lat in zip(cid_list, lon_list, lat_list):
+        if (lon < Lon[0]) or (lon > Lon[-1]):
+            print('ERROR: lon out of bounds ' + str(int(cid)))
+            continue
+        if (lat < Lat[0]) or (lat > Lat[-1]):
+            print('ERROR: lat out of bounds ' + str(int(cid)))
+            continue
+        ix = zfun.find_nearest_ind(Lon, lon)
+        iy = zfun.find_nearest_ind(Lat, lat)
+        if G['mask_rho'][iy,ix] == 0:
+            print('ERROR: point on land mask ' + str(int(cid)))
+            continue
+        cid_good.append(int(cid)); ix_list.append(ix); iy_list.append(iy)
+    if len(cid_good) == 0:
+        return None
+        
+    v_list = ['salt','temp','h']
+    if npzd == 'new':
+        v_list += ['phytoplankton','chlorophyll','zooplankton','SdetritusN','LdetritusN','oxygen','alkalinity','TIC','NO3','NH4']
+    elif npzd == 'old':
+        v_list += ['phytoplankton','zooplankton','detritus','Ldetritus','oxygen','alkalinity','TIC','NO3']
+    elif npzd == 'none':
+        pass
+    else:
+        print('Error: unrecognized npzd')
+        sys.exit()
+    
+    # pointwise indexing: xarray reads the smallest block of the file that
+    # holds all the points, and then picks out the columns
+    ds = xr.open_dataset(fn)
+    iy_da = xr.DataArray(iy_list, dims='cast')
+    ix_da = xr.DataArray(ix_list, dims='cast')
+    foo = ds[v_list].isel(eta_rho=iy_da, xi_rho=ix_da).squeeze('ocean_time').load()
+    foo = foo.transpose('cast', ...)
+    ds.close()
+    # make ocean_time a function of cast, so that we can combine casts from many files
+    foo = foo.assign_coords(cast=cid_good,
+        ocean_time=('cast', np.full(len(cid_good), foo.ocean_time.values)))
+    
+    # Add z-coordinates, vectorized over casts
+    z_rho, z_w = zrfun.get_z(foo['h'].values, np.zeros(len(cid_good)), S)
+    foo['z_rho'] = (('cast', 's_rho'), z_rho.reshape(S['N'], -1).T)
+    foo['z_w'] = (('cast', 's_w'), z_w.reshape(S['N']+1, -1).T)
+    foo.z_rho.attrs['long_name'] = 'vertical position on s_rho grid, positive up, zero at surface'
+    foo.z_rho.attrs['units'] = 'm'
+    foo.z_w.attrs['long_name'] = 'vertical position on s_w grid, positive up, zero at surface'
+    foo.z_w.attrs['units'] = 'm'
+    foo.salt.attrs['units'] = 'g kg-1'
+    return foo
+        
 def get_his_fn_from_dt(Ldir, dt):
     # This creates the Path of a ROMS file from its datetime
     date_string = dt.strftime(Ldir['ds_fmt'])
@@ -0,0 +1,93 @@
+"""
+This is code for doing cast extractions. It gets the same casts as extract_casts.py
+and extract_casts_fast.py, but instead of running a separate python process
+and ncks call for each cast, it groups the casts by history file and gets
+all the casts from a file at once (see cast_functions.get_casts()). So a year
+of casts costs one pass over the history files that have casts in them.
+
+The output is a single file with all the casts:
+LO_output/extract/[gtagex]/cast/[source]_[otype]_[year]/casts.nc
+with dimensions (cast, s_rho) and (cast, s_w), where the coordinate "cast" is the cid.
+Use -per_cast True to also write one file per cast ([cid].nc), as the other
+cast extractors do.
+
+Test on mac in ipython:
+run extract_casts_grouped -gtx cas7_t0_x4b -source ecology -otype ctd -year 2017 -test True
+
+"""
+
+import sys
+import pandas as pd
+import xarray as xr
+
+from lo_tools import Lfun, zrfun
+from lo_tools import extract_argfun as exfun
+import cast_functions as cfun
+
+from time import time
+
+Ldir = exfun.intro() # this handles the argument passing
+
+year_str = str(Ldir['year'])
+
+out_dir = (Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'cast' /
+    (Ldir['source'] + '_' + Ldir['otype'] + '_' + year_str))
+Lfun.make_dir(out_dir, clean=True)
+
+info_fn = Ldir['LOo'] / 'obs' / Ldir['source'] / Ldir['otype'] / ('info_' + year_str + '.p')
+if info_fn.is_file():
+    tt0 = time()
+    info_df = pd.read_pickle(info_fn)
+
+    # group the casts by history file
+    fn_dict = dict()
+    for cid in info_df.index:
+        fn = cfun.get_his_fn_from_dt(Ldir, info_df.loc[cid,'time'])
+        if fn.is_file(): # useful for testing
+            if fn not in fn_dict.keys():
+                fn_dict[fn] = []
+            fn_dict[fn].append(cid)
+    fn_list = sorted(fn_dict.keys())
+    if len(fn_list) == 0:
+        print('No history files found for these casts')
+        sys.exit()
+    if Ldir['testing']:
+        fn_list = fn_list[:4]
+
+    G, S, T = zrfun.get_basic_info(fn_list[0])
+    # check on which bio variables to get
+    ds = xr.open_dataset(fn_list[0])
+    if 'NH4' in ds.data_vars:
+        npzd = 'new'
+    elif 'NO3' in ds.data_vars:
+        npzd = 'old'
+    else:
+        npzd = 'none'
+    ds.close()
+
+    # do the extractions
+    ds_list = []
+    ncast = 0
+    for fn in fn_list:
+        cid_list = fn_dict[fn]
+        foo = cfun.get_casts(fn, cid_list, info_df.loc[cid_list,'lon'].to_numpy(),
+            info_df.loc[cid_list,'lat'].to_numpy(), npzd, G, S)
+        if foo is None:
+            nget = 0
+        else:
+            ds_list.append(foo)
+            nget = len(foo.cast)
+            ncast += nget
+        print('Got %d of %d casts from %s' % (nget, len(cid_list), str(fn.parent.name) + '/' + fn.name))
+        sys.stdout.flush()
+
+    # save the results
+    if len(ds_list) > 0:
+        ds = xr.concat(ds_list, dim='cast', coords='minimal', compat='override').sortby('cast')
+        ds.ocean_time.encoding['units'] = Ldir['roms_time_units']
+        ds.to_netcdf(out_dir / 'casts.nc')
+        if Ldir['per_cast']:
+            for cid in ds.cast.values:
+                ds.sel(cast=cid).drop_vars('cast').to_netcdf(out_dir / (str(int(cid)) + '.nc'))
+        ds.close()
+    print('Extracted %d casts from %d history files in %0.2f sec' % (ncast, len(fn_list), time()-tt0))
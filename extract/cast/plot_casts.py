@@ -15,7 +15,7 @@ from time import time
 
 in_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'cast' / Ldir['cruises']
 
-fn_list = list(in_dir.glob('*.nc'))
+fn_list = [fn for fn in in_dir.glob('*.nc') if fn.name != 'casts.nc'] # casts.nc has all the casts
 
 foo = xr.open_dataset(fn_list[0])
 for vn in foo.data_vars:
@@ -20,6 +20,9 @@ atm fields if they are there and bio fields for old and new code versions if the
 
 2024.11.30: I added compression to the final output.
 
+For long backfills see extract_lowpass_stream.py, which makes the same files but
+reads each hourly file only once instead of about three times.
+
 Test on mac:
 run extract_lowpass -gtx cas7_t0_x4b -0 2017.07.04 -1 2017.07.04 -Nproc 4 -test True
 
@@ -0,0 +1,167 @@
+"""
+Driver to make tidally averaged files, reading each hourly file only once.
+
+This makes the same lowpassed.nc files as extract_lowpass.py, but instead of reading
+the 71 hourly files for each day separately (so consecutive days re-read 47 of the
+same files) it walks through the hourly files in order. Each field that is read is
+multiplied by its Godin filter weight and added to the sums for every day whose 71-hour
+window it falls in (at most three). When a window is complete that day's lowpassed.nc
+is written and its sums are dropped, so we only ever hold three days of partial sums.
+
+To use more cores the days are split into Nproc blocks of consecutive days, and each
+block is streamed by its own process. The only files read more than once are the 47
+hours at the seams between blocks. Each process holds four copies of the fields, so
+use a smaller Nproc than with extract_lowpass.py on big grids.
+
+Test on mac:
+run extract_lowpass_stream -gtx cas7_t0_x4b -0 2017.07.04 -1 2017.07.06 -Nproc 1 -test True
+
+"""
+
+import sys
+import pandas as pd
+import xarray as xr
+import numpy as np
+from datetime import datetime, timedelta
+import multiprocessing as mp
+from time import time
+
+from lo_tools import Lfun, zfun
+from lo_tools import extract_argfun as exfun
+
+Ldir = exfun.intro() # this handles the argument passing
+
+ds0 = Ldir['ds0']
+ds1 = Ldir['ds1']
+dt0 = datetime.strptime(ds0, Lfun.ds_fmt)
+dt1 = datetime.strptime(ds1, Lfun.ds_fmt)
+# days at the middle of each lowpass
+dtlp_list = [datetime.strptime(item, Lfun.ds_fmt) for item in Lfun.date_list_utility(dt0, dt1)]
+NT = len(dtlp_list)
+
+# All the hourly files we need. Starting the list a day before dt0 means that the
+# 71 files for day k are fn_list[24*k+1 : 24*k+72], the same as in lp_worker.py.
+fn_list = Lfun.get_fn_list('hourly', Ldir,
+    (dt0 - timedelta(days=1)).strftime(Lfun.ds_fmt),
+    (dt1 + timedelta(days=1)).strftime(Lfun.ds_fmt))
+nwin = 71
+
+# filter shape
+gs = zfun.godin_shape() # length 71, sum = 1
+
+# determine variables to process
+ds = xr.open_dataset(fn_list[1])
+vnl0 = list(ds.data_vars)
+vnl1 = [vn for vn in vnl0 if 'time' in ds[vn].attrs.keys()]
+
+# starter list
+vn_list = ['zeta','salt','temp','u','v','w','ubar','vbar','AKs','AKv']
+
+# add bio variables if available
+if ('NO3' in vnl1) and ('NH4' not in vnl1): # old bio version
+    vn_list += ['NO3','phytoplankton','zooplankton',
+        'detritus','Ldetritus','oxygen','TIC','alkalinity']
+elif ('NO3' in vnl1) and ('NH4' in vnl1): # new bio version
+    vn_list += ['NO3','NH4','phytoplankton','zooplankton',
+        'LdetritusN','SdetritusN','oxygen','TIC','alkalinity']
+
+# add atm variables if available
+if 'Pair' in vnl1:
+    vn_list += ['Pair','Uwind','Vwind','shflux','ssflux',
+        'latent','sensible','lwrad','swrad',
+        'sustr','svstr','bustr','bvstr']
+
+# check that all variables are actually there
+vn_list = [vn for vn in vn_list if vn in vnl0]
+
+# override for testing
+if Ldir['testing']:
+    print('Testing')
+    print('- variables that would have been processed:')
+    print(vn_list)
+    vn_list = ['zeta','salt','temp','u','v']
+
+# dimensions of the output fields
+dims_dict = {vn: ds[vn].dims[1:] for vn in vn_list}
+ds.close()
+
+# The grid fields and attributes to add to the output, to make it easy to use with
+# plotting and extraction tools in the same way as history files. We only load the
+# grid fields (which bring their lon, lat, and s coordinates with them), not the
+# 3-D fields, since the worker processes inherit ds_his.
+his_fn = Ldir['roms_out'] / Ldir['gtagex'] / ('f' + ds0) / 'ocean_his_0002.nc'
+ds = xr.open_dataset(his_fn)
+grid_list = ['mask_rho','mask_u','mask_v','mask_psi',
+    'f','h','hc','Cs_r','Cs_w','Vtransform','pm','pn']
+ds_his = ds[grid_list].load()
+attrs_dict = {vn: ds[vn].attrs for vn in vn_list}
+ds.close()
+
+def write_lp(lp, dtlp):
+    # Save the sums for one day as lowpassed.nc
+    lp_full = xr.Dataset()
+    for vn in vn_list:
+        lp_full[vn] = (dims_dict[vn], lp[vn])
+    # add a time dimension
+    lp_full = lp_full.expand_dims('ocean_time')
+    lp_full['ocean_time'] = (('ocean_time'), pd.DatetimeIndex([dtlp + timedelta(days=0.5)]))
+    for vn in ['rho','u','v','psi']:
+        # note that we have to be explicit for coords
+        lp_full.coords['lon_'+vn] = ds_his.coords['lon_'+vn].copy()
+        lp_full.coords['lat_'+vn] = ds_his.coords['lat_'+vn].copy()
+    for vn in ['rho','u','v','psi']:
+        lp_full['mask_'+vn] = ds_his['mask_'+vn].copy()
+    for vn in ['s_rho','s_w']:
+        lp_full.coords[vn] = ds_his.coords[vn].copy()
+    for vn in ['f','h','hc','Cs_r','Cs_w','Vtransform','pm','pn']:
+        lp_full[vn] = ds_his[vn].copy()
+    # also add attributes
+    for vn in vn_list:
+        for att in ['long_name', 'units']:
+            if att in attrs_dict[vn]:
+                lp_full[vn].attrs[att] = attrs_dict[vn][att]
+    out_dir = Ldir['roms_out'] / Ldir['gtagex'] / ('f' + dtlp.strftime(Lfun.ds_fmt))
+    out_fn = out_dir / 'lowpassed.nc'
+    out_fn.unlink(missing_ok=True)
+    lp_full.to_netcdf(out_fn, unlimited_dims=['ocean_time'])
+    lp_full.close()
+
+def stream_days(k_list):
+    # Make the lowpassed files for the consecutive days k_list (indices into
+    # dtlp_list), reading each hourly file once.
+    k0 = k_list[0]
+    k1 = k_list[-1]
+    lp_dict = dict() # partial sums, keyed by day index
+    tt0 = time()
+    for n in range(24*k0 + 1, 24*k1 + nwin + 1):
+        ds = xr.open_dataset(fn_list[n])
+        F = dict()
+        for vn in vn_list:
+            F[vn] = ds[vn].values[0]
+        ds.close()
+        # add this hour to every day whose window it falls in
+        for k in range(k0, k1+1):
+            ig = n - (24*k + 1) # index into the filter weights
+            if 0 <= ig < nwin:
+                if k not in lp_dict.keys():
+                    lp_dict[k] = {vn: np.zeros(F[vn].shape) for vn in vn_list}
+                for vn in vn_list:
+                    lp_dict[k][vn] += gs[ig] * F[vn]
+                if ig == nwin - 1:
+                    # the window is complete
+                    write_lp(lp_dict.pop(k), dtlp_list[k])
+                    print(' - %s: %0.1f minutes' % (dtlp_list[k].strftime(Lfun.ds_fmt),
+                        (time()-tt0)/60))
+                    sys.stdout.flush()
+
+tt00 = time()
+Nproc = min(Ldir['Nproc'], NT)
+k_lists = [list(item) for item in np.array_split(np.arange(NT), Nproc)]
+if Nproc > 1:
+    # fork so the workers inherit fn_list, vn_list, ds_his, etc.
+    with mp.get_context('fork').Pool(Nproc) as pool:
+        pool.map(stream_days, k_lists, chunksize=1)
+else:
+    stream_days(k_lists[0])
+
+print('Total time to make %d tidal averages = %0.1f minutes' % (NT, (time()-tt00)/60))
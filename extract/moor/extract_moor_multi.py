@@ -0,0 +1,371 @@
+"""
+This is code for doing mooring extractions for all the stations in a job at once.
+
+It does the same job as multi_mooring_driver.py, but instead of running extract_moor.py
+(and so reading all the history files) once for each station, it reads each history
+file once and gets the columns for all the stations, with a single read per variable.
+So the time scales with the number of history files, not files x stations.
+
+The results are one file per station in LO_output/extract/[gtagex]/moor/[job]/ with
+the same format as those from extract_moor.py. Use -combined True to instead get
+a single file [job]_[ds0]_[ds1].nc in the same folder where all variables have a
+"station" dimension after ocean_time.
+
+Test on mac in ipython:
+run extract_moor_multi -gtx cas7_t0_x4b -test True
+
+The same job would be run with flags as:
+python extract_moor_multi.py -gtx cas7_t0_x4b -ro 0 -0 2017.07.04 -1 2017.07.06 -lt hourly -job orca -get_all True > emm.log &
+
+"""
+
+# imports
+import sys
+from lo_tools import Lfun, zrfun, zfun
+import argparse
+from time import time
+import numpy as np
+import xarray as xr
+import netCDF4 as nc
+import multiprocessing as mp
+
+# command line arugments
+parser = argparse.ArgumentParser()
+# which run to use
+parser.add_argument('-gtx', '--gtagex', type=str)   # e.g. cas7_t0_x4b
+parser.add_argument('-ro', '--roms_out_num', type=int) # 1 = Ldir['roms_out1'], etc.
+# select time period and frequency
+parser.add_argument('-0', '--ds0', type=str) # e.g. 2017.07.04
+parser.add_argument('-1', '--ds1', type=str) # e.g. 2017.07.06
+parser.add_argument('-lt', '--list_type', type=str)
+# list type: hourly, daily, lowpass, average, etc.
+# select job name
+parser.add_argument('-job', type=str) # job name
+# select categories of variables to extract (defined in extract_moor.py)
+parser.add_argument('-get_tsa', type=zfun.boolean_string, default=False)
+parser.add_argument('-get_vel', type=zfun.boolean_string, default=False)
+parser.add_argument('-get_bio', type=zfun.boolean_string, default=False)
+parser.add_argument('-get_surfbot', type=zfun.boolean_string, default=False)
+parser.add_argument('-get_pressure', type=zfun.boolean_string, default=False)
+# OR select all of them
+parser.add_argument('-get_all', type=zfun.boolean_string, default=False)
+# Optional: write a single file with a station dimension
+parser.add_argument('-combined', type=zfun.boolean_string, default=False)
+# Optional: number of processes reading history files
+parser.add_argument('-Nproc', type=int, default=4)
+# Optional: for testing
+parser.add_argument('-test', '--testing', default=False, type=zfun.boolean_string)
+# get the args and put into Ldir
+args = parser.parse_args()
+# test that main required arguments were provided (other)
+argsd = args.__dict__
+for a in ['gtagex']:
+    if argsd[a] == None:
+        print('*** Missing required argument: ' + a)
+        sys.exit()
+gridname, tag, ex_name = args.gtagex.split('_')
+# get the dict Ldir
+Ldir = Lfun.Lstart(gridname=gridname, tag=tag, ex_name=ex_name)
+# add more entries to Ldir
+for a in argsd.keys():
+    if a not in Ldir.keys():
+        Ldir[a] = argsd[a]
+# testing
+if Ldir['testing']:
+    Ldir['roms_out_num'] = 0
+    Ldir['ds0'] = '2017.07.04'
+    Ldir['ds1'] = '2017.07.06'
+    Ldir['list_type'] = 'hourly'
+    Ldir['job'] = 'orca'
+    Ldir['get_all'] = True
+# set where to look for model output
+if Ldir['roms_out_num'] == 0:
+    pass
+elif Ldir['roms_out_num'] > 0:
+    Ldir['roms_out'] = Ldir['roms_out' + str(Ldir['roms_out_num'])]
+# set variable list flags
+if Ldir['get_all']:
+    Ldir['get_tsa'] = True
+    Ldir['get_vel'] = True
+    Ldir['get_bio'] = True
+    Ldir['get_surfbot'] = True
+
+# do the extraction
+tt00 = time()
+
+# get the job_lists module, looking first in LO_user
+pth = Ldir['LO'] / 'extract' / 'moor'
+upth = Ldir['LOu'] / 'extract' / 'moor'
+if (upth / 'job_lists.py').is_file():
+    print('Importing job_lists from LO_user')
+    job_lists = Lfun.module_from_file('job_lists', upth / 'job_lists.py')
+else:
+    print('Importing job_lists from LO')
+    job_lists = Lfun.module_from_file('job_lists', pth / 'job_lists.py')
+sta_dict = job_lists.get_sta_dict(Ldir['job'])
+
+# set output location
+out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'moor'
+jout_dir = out_dir / Ldir['job']
+Lfun.make_dir(jout_dir)
+dd_str = Ldir['ds0'] + '_' + Ldir['ds1']
+# temporary file with all stations, written as we go
+temp_fn = jout_dir / ('temp_' + Ldir['job'] + '_' + dd_str + '.nc')
+temp_fn.unlink(missing_ok=True)
+print('Results will go to %s' % (str(jout_dir)))
+
+fn_list = Lfun.get_fn_list(Ldir['list_type'], Ldir, Ldir['ds0'], Ldir['ds1'])
+G, S, T = zrfun.get_basic_info(fn_list[0])
+Lon = G['lon_rho'][0,:]
+Lat = G['lat_rho'][:,0]
+
+def find_good(ilat, ilon, mask):
+    # same as in extract_moor.py, but returns None instead of exiting
+    if mask == 'rho':
+        # look on all four sides
+        jig_list = [[0,0],[1,0],[-1,0],[0,1],[0,-1]]
+    elif mask == 'u':
+        # just look to west
+        jig_list = [[0,0],[0,-1]]
+    elif mask == 'v':
+        # just look to south
+        jig_list = [[0,0],[-1,0]]
+    for jig in jig_list:
+        Ilat = ilat + jig[0]
+        Ilon = ilon + jig[1]
+        if G['mask_'+mask][Ilat,Ilon] == 1:
+            print('   - %s: (%d, %d) => (%d, %d), jig = [%d, %d]' %
+                (mask, ilat, ilon, Ilat, Ilon, jig[0], jig[1]))
+            return Ilat, Ilon
+    print('ERROR: no good nearby point found on mask for ' + mask)
+    return None
+
+# get indices for all the stations up front
+sn_list = []
+ind_dict = {'rho':[[],[]], 'u':[[],[]], 'v':[[],[]]}
+for sn in sta_dict.keys():
+    lon, lat = sta_dict[sn][:2]
+    print(sn)
+    # error checking
+    if (lon < Lon[0]) or (lon > Lon[-1]) or (lat < Lat[0]) or (lat > Lat[-1]):
+        print('ERROR: lon, lat out of bounds for ' + sn)
+        continue
+    ilon = zfun.find_nearest_ind(Lon, lon)
+    ilat = zfun.find_nearest_ind(Lat, lat)
+    rho_ind = find_good(ilat, ilon, 'rho')
+    if rho_ind == None:
+        continue
+    u_ind = find_good(rho_ind[0], rho_ind[1], 'u')
+    v_ind = find_good(rho_ind[0], rho_ind[1], 'v')
+    if (u_ind == None) or (v_ind == None):
+        continue
+    sn_list.append(sn)
+    for gtype, ind in zip(['rho','u','v'], [rho_ind, u_ind, v_ind]):
+        ind_dict[gtype][0].append(ind[0])
+        ind_dict[gtype][1].append(ind[1])
+NS = len(sn_list)
+if NS == 0:
+    print('No good stations')
+    sys.exit()
+# index arrays for pointwise selection, e.g. isel(eta_u=isel_dict['u']['eta_u'], ...)
+isel_dict = dict()
+for gtype in ['rho','u','v']:
+    isel_dict[gtype] = {'eta_'+gtype: xr.DataArray(ind_dict[gtype][0], dims='station'),
+        'xi_'+gtype: xr.DataArray(ind_dict[gtype][1], dims='station')}
+
+# check to see if we are working with the old or new NPZDOC variables
+ds = xr.open_dataset(fn_list[0])
+if 'NH4' in ds.data_vars:
+    # updated ROMS
+    bio_list = ',NO3,NH4,phytoplankton,zooplankton,SdetritusN,LdetritusN,SdetritusC,LdetritusC,oxygen,alkalinity,TIC,rho'
+else:
+    # original version
+    bio_list = ',NO3,phytoplankton,zooplankton,detritus,Ldetritus,oxygen,alkalinity,TIC,rho'
+
+# check to see if the model has WETDRY in use
+do_wetdry = False
+if 'wetdry_mask_rho' in ds.data_vars:
+    do_wetdry = True
+
+vn_list = 'h,zeta'
+if do_wetdry:
+    vn_list += ',wetdry_mask_rho'
+if Ldir['get_tsa']:
+    vn_list += ',salt,temp,AKs,AKv'
+if Ldir['get_vel']:
+    vn_list += ',u,v,w,ubar,vbar'
+    if do_wetdry:
+        vn_list += ',wetdry_mask_u,wetdry_mask_v'
+if Ldir['get_bio']:
+    vn_list += bio_list
+if Ldir['get_surfbot']:
+    vn_list += ',Pair,Uwind,Vwind,shflux,ssflux,latent,sensible,lwrad,swrad,sustr,svstr,bustr,bvstr'
+if Ldir['get_pressure']: # fields used for 1-D pressure analysis
+    vn_list += ',salt,temp,u,v,Pair,Uwind,Vwind'
+
+# do a final check to drop missing variables (and repeats) from the list
+vn_List = []
+for vn in vn_list.split(','):
+    if (vn in ds.data_vars) and (vn not in vn_List):
+        vn_List.append(vn)
+
+# sort out the grid and the vertical dimension of each variable
+gtype_dict = dict()
+vdim_dict = dict()
+for vn in vn_List:
+    dims = ds[vn].dims
+    for gtype in ['rho','u','v']:
+        if 'xi_'+gtype in dims:
+            gtype_dict[vn] = gtype
+    vdim_dict[vn] = None
+    for vdim in ['s_rho','s_w']:
+        if vdim in dims:
+            vdim_dict[vn] = vdim
+# time-dependent variables
+vn_List_t = [vn for vn in vn_List if 'ocean_time' in ds[vn].dims]
+ds.close()
+
+def get_block(fn_sublist):
+    # Get all stations from a list of history files. Returns a dict of arrays
+    # with dimensions (ocean_time, station) or (ocean_time, station, s_rho), etc.
+    B = {'ocean_time': []}
+    for vn in vn_List_t:
+        B[vn] = []
+    for fn in fn_sublist:
+        ds = xr.open_dataset(fn)
+        # time as seconds since modtime0, in case history files use different units
+        ot = ds.ocean_time.values
+        B['ocean_time'].append((ot - np.datetime64(Lfun.modtime0)) / np.timedelta64(1,'s'))
+        for vn in vn_List_t:
+            # pointwise indexing: this reads the smallest block of the file
+            # that has all the stations, and then picks out the columns
+            B[vn].append(ds[vn].isel(isel_dict[gtype_dict[vn]]).transpose('ocean_time','station',...).values)
+        ds.close()
+    for vn in B.keys():
+        B[vn] = np.concatenate(B[vn], axis=0)
+    return B
+
+# Create the temporary output file, with an unlimited time dimension so that
+# we can write to it as we go.
+tnc = nc.Dataset(temp_fn, 'w')
+tnc.createDimension('ocean_time', None)
+tnc.createDimension('station', NS)
+tnc.createDimension('s_rho', S['N'])
+tnc.createDimension('s_w', S['N']+1)
+vv = tnc.createVariable('ocean_time', float, ('ocean_time',))
+vv.units = Ldir['roms_time_units']
+for vn in vn_List_t:
+    if vdim_dict[vn] == None:
+        dims = ('ocean_time', 'station')
+    else:
+        dims = ('ocean_time', 'station', vdim_dict[vn])
+    tnc.createVariable(vn, float, dims, fill_value=1e20)
+tnc.close()
+
+# Read the history files, Nproc at a time, in blocks of a few files each so that
+# we do not need to hold the whole record in memory.
+tt0 = time()
+NT = len(fn_list)
+print('Times to extract =  %d' % (NT))
+nblock = 24
+block_list = [fn_list[ii:ii+nblock] for ii in range(0, NT, nblock)]
+it0 = 0
+with mp.get_context('fork').Pool(Ldir['Nproc']) as pool:
+    # imap returns the blocks in order
+    for B in pool.imap(get_block, block_list):
+        nt = len(B['ocean_time'])
+        tnc = nc.Dataset(temp_fn, 'a')
+        tnc['ocean_time'][it0:it0+nt] = B['ocean_time']
+        for vn in vn_List_t:
+            tnc[vn][it0:it0+nt] = B[vn]
+        tnc.close()
+        it0 += nt
+        print(str(it0), end=', ')
+        sys.stdout.flush()
+print('\n - time to read history files %0.2f sec' % (time()-tt0))
+
+# Add the static variables, coordinates, and z, and write the results. We open the
+# temporary file lazily and do this tblock times at a time, so that we never hold
+# the whole record in memory. The first block of each output file is written by
+# xarray, and later blocks are appended to it with netCDF4.
+ds = xr.open_dataset(temp_fn)
+ds0 = xr.open_dataset(fn_list[0])
+ds = ds.assign_coords(station=sn_list, s_rho=S['s_rho'], s_w=S['s_w'])
+for gtype in ['rho','u','v']:
+    ii = ind_dict[gtype]
+    ds.coords['lon_'+gtype] = ('station', G['lon_'+gtype][ii[0], ii[1]])
+    ds.coords['lat_'+gtype] = ('station', G['lat_'+gtype][ii[0], ii[1]])
+ds['h'] = ('station', ds0.h.values[ind_dict['rho'][0], ind_dict['rho'][1]])
+# add any missing attributes
+for vn in ds.data_vars:
+    if vn in ds0.data_vars:
+        for att in ['long_name','units']:
+            if att in ds0[vn].attrs:
+                ds[vn].attrs[att] = ds0[vn].attrs[att]
+ds0.close()
+# add units to salt
+if 'salt' in ds.data_vars:
+    ds.salt.attrs['units'] = 'g kg-1'
+# update the time long name
+ds.ocean_time.attrs['long_name'] = 'Time [UTC]'
+# update format attribute
+ds.attrs['format'] = 'netCDF-4'
+
+def add_z(dsb):
+    # add z_rho and z_w to a block of times
+    zeta = dsb.zeta.values
+    nt = zeta.shape[0]
+    hh = dsb.h.values * np.ones_like(zeta)
+    z_rho, z_w = zrfun.get_z(hh.flatten(), zeta.flatten(), S)
+    # the returned z arrays have vertical position first, so we
+    # move it last, to be consistent with all other variables
+    dsb['z_rho'] = (('ocean_time', 'station', 's_rho'), np.transpose(z_rho.reshape((S['N'], nt, NS)), (1,2,0)))
+    dsb['z_w'] = (('ocean_time', 'station', 's_w'), np.transpose(z_w.reshape((S['N']+1, nt, NS)), (1,2,0)))
+    dsb.z_rho.attrs['units'] = 'm'
+    dsb.z_w.attrs['units'] = 'm'
+    dsb.z_rho.attrs['long name'] = 'vertical position on s_rho grid, positive up'
+    dsb.z_w.attrs['long name'] = 'vertical position on s_w grid, positive up'
+    return dsb
+
+# the output files, and the station in each (None for all of them)
+if Ldir['combined']:
+    out_list = [(jout_dir / (Ldir['job'] + '_' + dd_str + '.nc'), None)]
+else:
+    out_list = [(jout_dir / (sn + '_' + dd_str + '.nc'), sn) for sn in sn_list]
+for out_fn, sn in out_list:
+    out_fn.unlink(missing_ok=True)
+
+tt0 = time()
+NT = len(ds.ocean_time)
+tblock = 720
+tnc = nc.Dataset(temp_fn)
+for it0 in range(0, NT, tblock):
+    it1 = min(it0 + tblock, NT)
+    dsb = add_z(ds.isel(ocean_time=slice(it0, it1)).load())
+    # the time as saved in the temporary file
+    ot = nc.num2date(tnc['ocean_time'][it0:it1], tnc['ocean_time'].units)
+    for out_fn, sn in out_list:
+        if sn == None:
+            dso = dsb
+        else:
+            dso = dsb.sel(station=sn).drop_vars('station')
+        if it0 == 0:
+            dso.to_netcdf(out_fn, unlimited_dims=['ocean_time'])
+        else:
+            onc = nc.Dataset(out_fn, 'a')
+            otv = onc['ocean_time']
+            otv[it0:it1] = nc.date2num(ot, otv.units, calendar=getattr(otv, 'calendar', 'standard'))
+            for vn in dso.data_vars:
+                if 'ocean_time' in dso[vn].dims:
+                    onc[vn][it0:it1] = np.ma.masked_invalid(dso[vn].values)
+            onc.close()
+tnc.close()
+ds.close()
+temp_fn.unlink(missing_ok=True)
+print(' - time to write results %0.2f sec' % (time()-tt0))
+if Ldir['combined']:
+    print('Path to file:\n%s' % (str(out_list[0][0])))
+else:
+    print('Path to files:\n%s' % (str(jout_dir)))
+
+print('- total Elapsed time was %0.2f sec' % (time()-tt00))
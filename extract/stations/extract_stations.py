@@ -0,0 +1,90 @@
+"""
+Code to append hourly surface time series (zeta, Uwind, Vwind) at all the
+registered stations to the station store, from a user-specified model run.
+See lo_tools/station_functions.py for how the store works.
+
+Only the history files after the last time already in the store are read,
+so this can be run again to extend the store, e.g. as a year of a run is finished.
+
+Use -job to first register the stations in a job from extract/moor/job_lists.py
+(located like extract_moor.py does). The tide gauges are registered by
+extract/tide/extract_tide.py, and the daymovie mooring points by daymovie/dm_plot.py.
+
+Test on mac:
+run extract_stations -gtx cas7_t0_x4b -test True
+
+Run for real on apogee:
+python extract_stations.py -gtx cas7_t0_x4b -ro 2 -0 2017.01.01 -1 2017.12.31 > test.log &
+
+"""
+
+# imports
+import sys
+from lo_tools import Lfun, zrfun, zfun
+from lo_tools import station_functions as stafun
+import argparse
+from time import time
+
+# command line arugments
+parser = argparse.ArgumentParser()
+# which run to use
+parser.add_argument('-gtx', '--gtagex', type=str)   # e.g. cas7_t0_x4b
+parser.add_argument('-ro', '--roms_out_num', default=0, type=int) # 1 = Ldir['roms_out1'], etc.
+# select time period
+parser.add_argument('-0', '--ds0', default='2017.07.04', type=str)
+parser.add_argument('-1', '--ds1', default='2017.07.06', type=str)
+# Optional: register the stations in a job from extract/moor/job_lists.py
+parser.add_argument('-job', default='', type=str)
+# Optional: number of processes reading history files
+parser.add_argument('-Nproc', type=int, default=4)
+# Optional: for testing
+parser.add_argument('-test', '--testing', default=False, type=zfun.boolean_string)
+# get the args and put into Ldir
+args = parser.parse_args()
+# test that main required arguments were provided (other)
+argsd = args.__dict__
+for a in ['gtagex']:
+    if argsd[a] == None:
+        print('*** Missing required argument: ' + a)
+        sys.exit()
+gridname, tag, ex_name = args.gtagex.split('_')
+# get the dict Ldir
+Ldir = Lfun.Lstart(gridname=gridname, tag=tag, ex_name=ex_name)
+# add more entries to Ldir
+for a in argsd.keys():
+    if a not in Ldir.keys():
+        Ldir[a] = argsd[a]
+# testing
+if Ldir['testing']:
+    Ldir['job'] = 'orca'
+# set where to look for model output
+if Ldir['roms_out_num'] == 0:
+    pass
+elif Ldir['roms_out_num'] > 0:
+    Ldir['roms_out'] = Ldir['roms_out' + str(Ldir['roms_out_num'])]
+
+sta_dir = stafun.get_sta_dir(Ldir)
+fn_list = Lfun.get_fn_list('hourly', Ldir, Ldir['ds0'], Ldir['ds1'])
+
+if len(Ldir['job']) > 0:
+    # get the job_lists module, looking first in LO_user
+    pth = Ldir['LO'] / 'extract' / 'moor'
+    upth = Ldir['LOu'] / 'extract' / 'moor'
+    if (upth / 'job_lists.py').is_file():
+        print('Importing job_lists from LO_user')
+        job_lists = Lfun.module_from_file('job_lists', upth / 'job_lists.py')
+    else:
+        print('Importing job_lists from LO')
+        job_lists = Lfun.module_from_file('job_lists', pth / 'job_lists.py')
+    sta_dict = job_lists.get_sta_dict(Ldir['job'])
+    G = zrfun.get_basic_info(fn_list[0], only_G=True)
+    stafun.register(sta_dir, G, sta_dict, method='moor')
+
+reg_df = stafun.get_registry(sta_dir)
+print(reg_df)
+
+# do the extraction
+tt0 = time()
+nfile = stafun.update(sta_dir, fn_list, Nproc=Ldir['Nproc'])
+print('\nRead %d of %d history files' % (nfile, len(fn_list)))
+print('Time to do extractions = %0.1f sec' % (time()-tt0))
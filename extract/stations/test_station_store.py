@@ -0,0 +1,137 @@
+"""
+Code to test the register, append, overwrite, and trim logic of the station store in
+lo_tools/station_functions.py, using a temporary folder and made-up data,
+so it does not need any model output.
+
+Run with:
+python test_station_store.py
+(or with pytest)
+"""
+
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+
+from lo_tools import station_functions as stafun
+
+def make_sdir():
+    sdir = Path(tempfile.mkdtemp()) / 'sta0'
+    sdir.mkdir()
+    return sdir
+
+def make_G():
+    # a small grid with no land
+    lon, lat = np.meshgrid(np.linspace(-125, -122, 30), np.linspace(46, 49, 30))
+    return {'lon_rho': lon, 'lat_rho': lat, 'mask_rho': np.ones(lon.shape)}
+
+def hours(h0, h1):
+    # ocean_time for hours h0 to h1 - 1
+    return 3600.0 * np.arange(h0, h1)
+
+def check_store(sdir, ot, D):
+    # every column has exactly the rows we expect
+    S = stafun.read_station(sdir.parent, sdir.name)
+    assert np.array_equal(S['ot'], ot)
+    for vn in D.keys():
+        assert np.array_equal(S[vn], D[vn], equal_nan=True), vn
+    for fn in sdir.glob('*.bin'):
+        assert fn.stat().st_size == 8*len(ot), fn.name
+
+def test_append():
+    sdir = make_sdir()
+    ot = hours(0, 24)
+    assert stafun.append(sdir, ot, {'zeta': ot/100}) == 24
+    # times we already have are skipped
+    ot2 = hours(12, 48)
+    assert stafun.append(sdir, ot2, {'zeta': ot2/100}) == 24
+    # a new column gets nan for the earlier rows, and an old one that is
+    # missing gets nan for the new rows
+    ot3 = hours(48, 72)
+    assert stafun.append(sdir, ot3, {'Uwind': ot3/10}) == 24
+    ot_all = hours(0, 72)
+    zeta = ot_all/100
+    zeta[48:] = np.nan
+    Uwind = ot_all/10
+    Uwind[:48] = np.nan
+    check_store(sdir, ot_all, {'zeta': zeta, 'Uwind': Uwind})
+
+def test_overwrite():
+    sdir = make_sdir()
+    # yesterday's forecast, three days long
+    ot = hours(0, 72)
+    stafun.append(sdir, ot, {'zeta': np.zeros(72)}, overwrite=True)
+    # today's forecast starts a day later and replaces the last two days
+    ot2 = hours(24, 96)
+    assert stafun.append(sdir, ot2, {'zeta': np.ones(72)}, overwrite=True) == 72
+    zeta = np.ones(96)
+    zeta[:24] = 0
+    check_store(sdir, hours(0, 96), {'zeta': zeta})
+
+def test_trim_recovery():
+    sdir = make_sdir()
+    ot = hours(0, 24)
+    stafun.append(sdir, ot, {'zeta': ot/100, 'Uwind': ot/10})
+    # a crash after writing some of the data columns, but before ot.bin
+    with open(sdir / 'zeta.bin', 'ab') as f:
+        np.arange(5, dtype='<f8').tofile(f)
+    # the reader only sees the good rows
+    S = stafun.read_station(sdir.parent, sdir.name)
+    assert len(S['zeta']) == 24
+    # and the next append trims the extra rows first
+    ot2 = hours(24, 48)
+    stafun.append(sdir, ot2, {'zeta': ot2/100, 'Uwind': ot2/10})
+    ot_all = hours(0, 48)
+    check_store(sdir, ot_all, {'zeta': ot_all/100, 'Uwind': ot_all/10})
+    # a trim that stopped after ot.bin leaves longer data columns, which is fine
+    os.truncate(sdir / 'ot.bin', 8*40)
+    S = stafun.read_station(sdir.parent, sdir.name)
+    assert np.array_equal(S['zeta'], ot_all[:40]/100)
+    # trim() does ot.bin first, so a reader never sees a data column shorter than ot
+    truncate = os.truncate
+    fn_list = []
+    def truncate_and_log(fn, size):
+        fn_list.append(Path(fn).name)
+        truncate(fn, size)
+    stafun.os.truncate = truncate_and_log
+    try:
+        stafun.trim(sdir, 30)
+    finally:
+        stafun.os.truncate = truncate
+    assert fn_list[0] == 'ot.bin'
+    check_store(sdir, ot_all[:30], {'zeta': ot_all[:30]/100, 'Uwind': ot_all[:30]/10})
+
+def test_register_race():
+    sta_dir = make_sdir().parent
+    G = make_G()
+    sta_dict = {'sta1': (-124, 47.5)}
+    ot = hours(0, 24)
+    # another job registers the same new station and appends to it while
+    # this one is resolving the grid point
+    get_ji = stafun.get_ji
+    def get_ji_and_other_job(*args):
+        stafun.get_ji = get_ji
+        stafun.register(sta_dir, G, sta_dict)
+        stafun.append(sta_dir / 'sta1', ot, {'zeta': ot/100})
+        return get_ji(*args)
+    stafun.get_ji = get_ji_and_other_job
+    try:
+        reg_df = stafun.register(sta_dir, G, sta_dict)
+    finally:
+        stafun.get_ji = get_ji
+    # and its data is still there
+    assert list(reg_df.index) == ['sta1']
+    check_store(sta_dir / 'sta1', ot, {'zeta': ot/100})
+    # a station that moves starts over
+    reg_df = stafun.register(sta_dir, G, {'sta1': (-123, 47.5)})
+    assert reg_df.loc['sta1','lon'] == -123
+    assert not (sta_dir / 'sta1' / 'zeta.bin').exists()
+    # and no temporary folders are left
+    assert list((sta_dir / '.temp').iterdir()) == []
+
+if __name__ == '__main__':
+    test_append()
+    test_overwrite()
+    test_trim_recovery()
+    test_register_race()
+    print('All station store tests passed')
@@ -9,6 +9,12 @@ it sequentially within this program. The less-than-expected speedup may be becau
 each job only takes about a second, and there is overhead to spinning up new python
 jobs because of imports.
 
+So the default (-pool True) is now to use a pool of Nproc long-lived worker
+processes that share the setup done here and get one history file name at a time,
+using the functions in extract_sections_one_time.py. The results are written to
+temp_dir/all.nc as they arrive, so ncrcat is not needed. Use -pool False to go back
+to the subprocess + ncrcat method.
+
 Also, this is a memory-intensive calculation, so be careful about using Nproc > 10
 (10 is the default in extract_argfun).
 
@@ -46,68 +52,129 @@ Lfun.make_dir(temp_dir, clean=True)
 if Ldir['testing']:
     fn_list = fn_list[:3]
 
-# loop over all jobs
-tt0 = time()
-N = len(fn_list)
-proc_list = []
-for ii in range(N):
-    # Launch a job and add its process to a list.
-    fn = fn_list[ii]
-    ii_str = ('0000' + str(ii))[-5:]
-    out_fn = temp_dir / ('CC_' + ii_str + '.nc')
-    # use subprocesses
-    cmd_list = ['python3', 'extract_sections_one_time.py',
-            '-sect_df_fn', str(sect_df_fn),
-            '-in_fn',str(fn),
-            '-out_fn', str(out_fn),
-            '-get_bio', str(Ldir['get_bio'])]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-    # If we have accumulated Nproc jobs, or are at the end of the
-    # total number of jobs, then stop and make sure all the jobs
-    # in proc_list have finished, using the communicate method.
-    if ((np.mod(ii,Ldir['Nproc']) == 0) and (ii > 0)) or (ii == N-1):
-        for proc in proc_list:
-            stdout, stderr = proc.communicate()
-            if len(stdout) > 0:
-                print('\nSTDOUT:')
-                print(stdout.decode())
+if Ldir['pool']:
+    # Long-lived workers: each worker is forked from this process so it
+    # already has sect_df, vn_list, and the static fields, and just gets
+    # history file names. Results are written into one NetCDF file as they
+    # come back, so there are no per-hour temp files and no ncrcat.
+    import netCDF4 as nc
+    import multiprocessing as mp
+    import extract_sections_one_time as esot
+
+    ds = xr.open_dataset(fn_list[0])
+    vn_list = esot.get_vn_list(ds, Ldir['get_bio'])
+    CC = esot.get_static(ds, sect_df)
+    NZ = ds.sizes['s_rho']
+    ds.close()
+    NP = len(sect_df)
+
+    def get_one_file(fn):
+        ds = xr.open_dataset(fn)
+        C = esot.get_one_time(ds, sect_df, vn_list)
+        # time as seconds since modtime0, in case history files use different units
+        C['time'] = (ds.ocean_time.values[0] - np.datetime64(Lfun.modtime0)) / np.timedelta64(1,'s')
+        ds.close()
+        return C
+
+    temp_fn = str(temp_dir)+'/all.nc'
+    tt0 = time()
+    N = len(fn_list)
+    foo = nc.Dataset(temp_fn, 'w')
+    foo.createDimension('time', None)
+    foo.createDimension('z', NZ)
+    foo.createDimension('p', NP)
+    vv = foo.createVariable('time', float, ('time',))
+    vv.units = Ldir['roms_time_units']
+    for vn in ['h', 'dd']:
+        vv = foo.createVariable(vn, float, ('p',))
+        vv[:] = CC[vn]
+    with mp.get_context('fork').Pool(Ldir['Nproc']) as pool:
+        for ii, C in enumerate(pool.imap(get_one_file, fn_list, chunksize=4)):
+            if ii == 0:
+                # make the variables using the types we actually got
+                foo.createVariable('zeta', C['zeta'].dtype, ('time','p'))
+                for vn in vn_list + ['vel']:
+                    foo.createVariable(vn, C[vn].dtype, ('time','z','p'))
+            foo['time'][ii] = C['time']
+            foo['zeta'][ii,:] = C['zeta']
+            for vn in vn_list + ['vel']:
+                foo[vn][ii,:,:] = C[vn]
+            # Print screen output about progress.
+            if (np.mod(ii,10) == 0) and ii>0:
+                print(str(ii), end=', ')
                 sys.stdout.flush()
-            if len(stderr) > 0:
-                print('\nSTDERR:')
-                print(stderr.decode())
+            if (np.mod(ii,50) == 0) and (ii > 0):
+                print('') # line feed
                 sys.stdout.flush()
-        # Then initialize a new list.
-        proc_list = []
-    # Print screen output about progress.
-    if (np.mod(ii,10) == 0) and ii>0:
-        print(str(ii), end=', ')
-        sys.stdout.flush()
-    if (np.mod(ii,50) == 0) and (ii > 0):
-        print('') # line feed
+            if (ii == N-1):
+                print(str(ii))
+                sys.stdout.flush()
+    foo.close()
+    print('Total processing time = %0.2f sec' % (time()-tt0))
+
+else:
+    # loop over all jobs
+    tt0 = time()
+    N = len(fn_list)
+    proc_list = []
+    for ii in range(N):
+        # Launch a job and add its process to a list.
+        fn = fn_list[ii]
+        ii_str = ('0000' + str(ii))[-5:]
+        out_fn = temp_dir / ('CC_' + ii_str + '.nc')
+        # use subprocesses
+        cmd_list = ['python3', 'extract_sections_one_time.py',
+                '-sect_df_fn', str(sect_df_fn),
+                '-in_fn',str(fn),
+                '-out_fn', str(out_fn),
+                '-get_bio', str(Ldir['get_bio'])]
+        proc = Po(cmd_list, stdout=Pi, stderr=Pi)
+        proc_list.append(proc)
+        # If we have accumulated Nproc jobs, or are at the end of the
+        # total number of jobs, then stop and make sure all the jobs
+        # in proc_list have finished, using the communicate method.
+        if ((np.mod(ii,Ldir['Nproc']) == 0) and (ii > 0)) or (ii == N-1):
+            for proc in proc_list:
+                stdout, stderr = proc.communicate()
+                if len(stdout) > 0:
+                    print('\nSTDOUT:')
+                    print(stdout.decode())
+                    sys.stdout.flush()
+                if len(stderr) > 0:
+                    print('\nSTDERR:')
+                    print(stderr.decode())
+                    sys.stdout.flush()
+            # Then initialize a new list.
+            proc_list = []
+        # Print screen output about progress.
+        if (np.mod(ii,10) == 0) and ii>0:
+            print(str(ii), end=', ')
+            sys.stdout.flush()
+        if (np.mod(ii,50) == 0) and (ii > 0):
+            print('') # line feed
+            sys.stdout.flush()
+        if (ii == N-1):
+            print(str(ii))
+            sys.stdout.flush()
+    
+    print('Total processing time = %0.2f sec' % (time()-tt0))
+
+    # concatenate the records into one file
+    # This bit of code is a nice example of how to replicate a bash pipe
+    pp1 = Po(['ls', str(temp_dir)], stdout=Pi)
+    pp2 = Po(['grep','CC'], stdin=pp1.stdout, stdout=Pi)
+    temp_fn = str(temp_dir)+'/all.nc'
+    cmd_list = ['ncrcat','-p', str(temp_dir), '-O', temp_fn]
+    proc = Po(cmd_list, stdin=pp2.stdout, stdout=Pi, stderr=Pi)
+    stdout, stderr = proc.communicate()
+    if len(stdout) > 0:
+        print('\nSTDOUT:')
+        print(stdout.decode())
         sys.stdout.flush()
-    if (ii == N-1):
-        print(str(ii))
+    if len(stderr) > 0:
+        print('\nSTDERR:')
+        print(stderr.decode())
         sys.stdout.flush()
-    
-print('Total processing time = %0.2f sec' % (time()-tt0))
-
-# concatenate the records into one file
-# This bit of code is a nice example of how to replicate a bash pipe
-pp1 = Po(['ls', str(temp_dir)], stdout=Pi)
-pp2 = Po(['grep','CC'], stdin=pp1.stdout, stdout=Pi)
-temp_fn = str(temp_dir)+'/all.nc'
-cmd_list = ['ncrcat','-p', str(temp_dir), '-O', temp_fn]
-proc = Po(cmd_list, stdin=pp2.stdout, stdout=Pi, stderr=Pi)
-stdout, stderr = proc.communicate()
-if len(stdout) > 0:
-    print('\nSTDOUT:')
-    print(stdout.decode())
-    sys.stdout.flush()
-if len(stderr) > 0:
-    print('\nSTDERR:')
-    print(stderr.decode())
-    sys.stdout.flush()
         
 """
 Next we want to repackage these results into one NetCDF file per section, with all times.
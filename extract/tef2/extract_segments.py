@@ -9,6 +9,9 @@ Performance: 2.5 minutes for test
 
 Use -get_bio True to get all bio tracers
 Use -test True for more screen output and a shorter extraction
+Use -pool False to run each hour as a separate python subprocess (the old way).
+The default is a pool of Nproc long-lived workers that set up the segment
+indexing once and then get one history file name at a time.
 
 """
 from lo_tools import Lfun, zrfun
@@ -53,43 +56,77 @@ fn_list = Lfun.get_fn_list('hourly', Ldir, Ldir['ds0'], Ldir['ds1'], his_num=Ldi
 if Ldir['testing']:
     fn_list = fn_list[:3]
 
-print('Doing initial data extraction:')
-# We do extractions one hour at a time, as separate subprocess jobs.
-# Files are saved to temp_dir.
-tt000 = time()
-proc_list = []
-N = len(fn_list)
-for ii in range(N):
-    fn = fn_list[ii]
+if Ldir['pool']:
+    # Long-lived workers: each worker is forked from this process so it
+    # already has the segment indices and grid info, and just gets history
+    # file names. The results come back as small DataFrames, so there are no
+    # temp files.
+    import multiprocessing as mp
+    import extract_segments_one_time as esot
     
-    d = fn.parent.name.replace('f','')
-    nhis = int(fn.name.split('.')[0].split('_')[-1])
+    seg_info_dict = pd.read_pickle(seg_info_dict_fn)
+    j_dict, i_dict = esot.get_ji(seg_info_dict)
+    G, S, T = zrfun.get_basic_info(fn_list[0])
     
-    cmd_list = ['python3', 'extract_segments_one_time.py',
-            '-in_fn',str(fn),
-            '-out_dir',str(temp_dir),
-            '-file_num',str(ii),
-            '-seg_fn',str(seg_info_dict_fn),
-            '-get_bio', str(Ldir['get_bio']),
-            '-test', str(Ldir['testing'])]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-
-    Nproc = Ldir['Nproc']
-    if ((np.mod(ii,Nproc) == 0) and (ii > 0)) or (ii == N-1):
-        tt0 = time()
-        for proc in proc_list:
-            stdout, stderr = proc.communicate()
-            if Ldir['testing']:
-                print(' sdtout '.center(60,'-'))
-                print(stdout.decode())
-            if len(stderr) > 0:
-                print(' stderr '.center(60,'-'))
-                print(stderr.decode())
-        print(' - %d out of %d: %d took %0.2f sec' % (ii, N, Nproc, time()-tt0))
-        sys.stdout.flush()
-        proc_list = []
-print('Total elapsed time = %0.2f sec' % (time()-tt000))
+    def get_one_file(fn):
+        ds = xr.open_dataset(fn)
+        A = esot.get_one_time(ds, G, S, j_dict, i_dict, Ldir['get_bio'])
+        ot = ds['ocean_time'].values[0]
+        ds.close()
+        return ot, A
+        
+    print('Doing initial data extraction:')
+    tt000 = time()
+    N = len(fn_list)
+    ot_list = []
+    A_df_list = []
+    with mp.get_context('fork').Pool(Ldir['Nproc']) as pool:
+        for ii, (ot, A) in enumerate(pool.imap(get_one_file, fn_list, chunksize=4)):
+            ot_list.append(ot)
+            A_df_list.append(A)
+            if ((np.mod(ii,100) == 0) and (ii > 0)) or (ii == N-1):
+                print(' - %d out of %d: %0.2f sec' % (ii, N, time()-tt000))
+                sys.stdout.flush()
+    print('Total elapsed time = %0.2f sec' % (time()-tt000))
+
+else:
+    print('Doing initial data extraction:')
+    # We do extractions one hour at a time, as separate subprocess jobs.
+    # Files are saved to temp_dir.
+    tt000 = time()
+    proc_list = []
+    N = len(fn_list)
+    for ii in range(N):
+        fn = fn_list[ii]
+    
+        d = fn.parent.name.replace('f','')
+        nhis = int(fn.name.split('.')[0].split('_')[-1])
+    
+        cmd_list = ['python3', 'extract_segments_one_time.py',
+                '-in_fn',str(fn),
+                '-out_dir',str(temp_dir),
+                '-file_num',str(ii),
+                '-seg_fn',str(seg_info_dict_fn),
+                '-get_bio', str(Ldir['get_bio']),
+                '-test', str(Ldir['testing'])]
+        proc = Po(cmd_list, stdout=Pi, stderr=Pi)
+        proc_list.append(proc)
+
+        Nproc = Ldir['Nproc']
+        if ((np.mod(ii,Nproc) == 0) and (ii > 0)) or (ii == N-1):
+            tt0 = time()
+            for proc in proc_list:
+                stdout, stderr = proc.communicate()
+                if Ldir['testing']:
+                    print(' sdtout '.center(60,'-'))
+                    print(stdout.decode())
+                if len(stderr) > 0:
+                    print(' stderr '.center(60,'-'))
+                    print(stderr.decode())
+            print(' - %d out of %d: %d took %0.2f sec' % (ii, N, Nproc, time()-tt0))
+            sys.stdout.flush()
+            proc_list = []
+    print('Total elapsed time = %0.2f sec' % (time()-tt000))
 
 """
 Now we repackage all these single-time extractions into an xarray Dataset.  This is
@@ -105,20 +142,22 @@ I'm sure there is a more clever way to do this in xarray, but I am not yet profi
 enough with that module.
 """
 
-# get a list of all our pandas DataFrames
-A_list = list(temp_dir.glob('A*.p'))
-A_list.sort()
-# make a list of the datetimes and form a time index
-ot_list = []
-for fn in fn_list:
-    ds = xr.open_dataset(fn)
-    ot = ds['ocean_time'].values[0]
-    ot_list.append(ot)
+if not Ldir['pool']:
+    # get a list of all our pandas DataFrames
+    A_list = list(temp_dir.glob('A*.p'))
+    A_list.sort()
+    A_df_list = [pd.read_pickle(A_fn) for A_fn in A_list]
+    # make a list of the datetimes
+    ot_list = []
+    for fn in fn_list:
+        ds = xr.open_dataset(fn)
+        ot = ds['ocean_time'].values[0]
+        ot_list.append(ot)
+# form a time index
 ot_ind = pd.Index(ot_list)
 # make a list of the output as DataArrays
 x_list = []
-for A_fn in A_list:
-    A = pd.read_pickle(A_fn)
+for A in A_df_list:
     x_list.append(xr.DataArray(A, dims=('seg','vn')))
 # and concatenate that list into a single DataArray, with time as the concatenating dimension
 da = xr.concat(x_list, pd.Index(ot_ind, name='time'))
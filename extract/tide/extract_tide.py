@@ -12,15 +12,19 @@ Performance:
 20 sec for three days, both mac and apogee
 2000 sec for a year on apogee
 
+The time series are now kept in the station store (lo_tools/station_functions.py),
+so this only reads the history files that are not already in it (e.g. ones added by
+extract/stations/extract_stations.py), and a re-run takes a few seconds.
+
 """
 
 # imports
 import sys
 from lo_tools import Lfun, zrfun, zfun
+from lo_tools import station_functions as stafun
 import argparse
 from time import time
 import numpy as np
-import xarray as xr
 import pandas as pd
 
 # command line arugments
@@ -85,71 +89,6 @@ for sn in sn_df_dfo.index:
 in_dir0 = Ldir['roms_out'] / Ldir['gtagex']
 G, S, T = zrfun.get_basic_info(in_dir0 / ('f' + Ldir['ds0']) / 'ocean_his_0002.nc')
 
-def get_ji_good(G, lat00, lon00):
-    # Function to find the indices of the nearest unmasked point.
-    
-    # G is the grid info dict
-    # lat00, lon00 is the mooring/cast location
-
-    # useful things
-    lat = G['lat_rho']
-    lon = G['lon_rho']
-    yvec = G['lat_rho'][:,0]
-    xvec = G['lon_rho'][0,:]
-    mask = G['mask_rho']
-
-    # Out of bounds error checking
-    if (lat00 < yvec[0]) or (lat00 > yvec[-1]):
-        print(' ERROR: lat00 out of bounds ')
-        sys.exit()
-    if (lon00 < xvec[0]) or (lon00 > xvec[-1]):
-        print(' ERROR: lon00 out of bounds ')
-        sys.exit()
-
-    # initial guess
-    j0 = zfun.find_nearest_ind(yvec, lat00)
-    i0 = zfun.find_nearest_ind(xvec, lon00)
-
-    # starting point
-    lat0 = lat[j0,i0]
-    lon0 = lon[j0,i0]
-
-    pad = 5 # how far to look (points)
-
-    # indices of box to search over
-    jmax = len(yvec)-1
-    imax = len(xvec)-1
-    J = np.arange(j0-pad,j0+pad)
-    I = np.arange(i0-pad, i0+pad)
-
-    # account for out-of-range points (not needed?)
-    if I[0] < 0:
-        I = I - I[0]
-    if I[-1] > imax:
-        I = I - (I[-1] - imax)
-    if J[0] < 0:
-        J = J - J[0]
-    if J[-1] > jmax:
-        J = J - (J[-1] - jmax)
-
-    # array of indices to search
-    ii, jj = np.meshgrid(I, J)
-
-    # sub arrays, distances
-    llat = lat[jj,ii]
-    llon = lon[jj,ii]
-    xxx, yyy = zfun.ll2xy(llon, llat, lon0, lat0)
-    ddd = np.sqrt(xxx**2 + yyy**2) # distance from original point
-    mmask = mask[jj,ii] 
-    mm = mmask==1 # Boolean array of good points
-    dddm = ddd[mm] # vector of good distances
-
-    # indices of best point
-    jgood = jj[mm][dddm==dddm.min()][0]
-    igood = ii[mm][dddm==dddm.min()][0]
-    
-    return jgood, igood
-
 for sn in sn_df.index:
     # Find the closest good grid indices and pack everything
     # in a single DataFrame.
@@ -157,7 +96,7 @@ for sn in sn_df.index:
     lon00 = sn_df.loc[sn,'lon']
     name = sn_df.loc[sn,'name']
     # get indices
-    jgood, igood = get_ji_good(G, lat00, lon00)
+    jgood, igood = stafun.get_ji_good(G, lat00, lon00)
     sn_df.loc[sn,'jgood'] = jgood
     sn_df.loc[sn,'igood'] = igood
     print('%s (j,i)=(%d,%d)' % (name, jgood, igood))
@@ -195,22 +134,30 @@ if Ldir['testing']:
 # generate list of files to open
 fn_list = Lfun.get_fn_list('hourly', Ldir, Ldir['ds0'], Ldir['ds1'])
 
-# initialize a DataFrame to hold results
-ssh_df = pd.DataFrame(columns=sn_df.index)
-# do the extraction
+# do the extraction, using the station store (see lo_tools/station_functions.py)
+# so that only the history files not already in it are read
 tt0 = time()
-jj = sn_df.jgood.to_numpy(dtype=int)
-ii = sn_df.igood.to_numpy(dtype=int)
-for fn in fn_list:
-    ds = xr.open_dataset(fn)
-    ssh = ds.zeta[0,:,:].values
-    # extract using fancy indexing
-    sn_ssh = ssh[jj,ii]
-    tt = pd.Timestamp(ds.ocean_time.values[0])
-    ssh_df.loc[tt,:] = sn_ssh
-    ds.close()
-print('\nTime to do extractions = %0.1f sec' % (time()-tt0))
-# performance: 21 sec for three days on my mac
+sta_dir = stafun.get_sta_dir(Ldir)
+name_list = ['tide_' + str(sn) for sn in sn_df.index]
+stafun.register(sta_dir, G, {name: (sn_df.loc[sn,'lon'], sn_df.loc[sn,'lat'])
+    for name, sn in zip(name_list, sn_df.index)}, method='good')
+nfile = stafun.update(sta_dir, fn_list, name_list=name_list)
+print('\nRead %d of %d history files' % (nfile, len(fn_list)))
+ot0 = stafun.get_fn_ot(fn_list[0])
+ot1 = stafun.get_fn_ot(fn_list[-1])
+if all([stafun.is_complete(stafun.read_station(sta_dir, name, vn_list=[],
+        ot0=ot0, ot1=ot1)['ot'], ot0, ot1) for name in name_list]):
+    ssh_df = stafun.read_stations(sta_dir, name_list, 'zeta', ot0=ot0, ot1=ot1)
+else:
+    # e.g. for times before the start of the store, which is only appended to
+    print('Station store does not cover these times: reading the history files')
+    jj = sn_df.jgood.to_numpy(dtype=int)
+    ii = sn_df.igood.to_numpy(dtype=int)
+    ot, A = stafun.extract_files(fn_list, jj, ii, vn_list=['zeta'])
+    ssh_df = pd.DataFrame(A['zeta'], columns=name_list,
+        index=pd.to_datetime([Lfun.modtime_to_datetime(t) for t in ot]))
+ssh_df.columns = sn_df.index
+print('Time to do extractions = %0.1f sec' % (time()-tt0))
 
 # save the output in a single file
 if Ldir['testing'] == False:
@@ -15,6 +15,11 @@ run make_forcing_main.py -g cas7 -r backfill -d 2019.07.04 -f atm02 -test True
 NEW 2025.07.30: For start_type = forecast this writes the forcing files
 to separate day folders.
 
+NEW: The work is done by lo_tools/atm_functions.py (through atm_fun.py), which caches
+the index maps from each wrf grid to the ROMS grid in LO_output/forcing/[gridname]/atm_cache,
+and processes the hours in parallel. Each variable is then written once, straight to its
+day folder.
+
 NOTE: atm_fun.py calls the old seawater routines in order to use the
 "dist" method for getting grid angles for vector wind rotation.
 Eventually we should just do this by hand.
@@ -37,28 +42,18 @@ result_dict['start_dt'] = datetime.now()
 
 # ****************** CASE-SPECIFIC CODE *****************
 
-import os
-import time
-import shutil
 import xarray as xr
 import numpy as np
-from scipy.spatial import cKDTree
 from subprocess import Popen as Po
 from subprocess import PIPE as Pi
 
-from lo_tools import Lfun, zfun, zrfun
+from lo_tools import Lfun, zrfun
 import atm_fun as afun
 
 verbose = False
 if Ldir['testing']:
     verbose = True
 
-# This directory is created, along with Info and Data subdirectories, by ffun.intro()
-out_dir_data = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / \
-    ('f' + Ldir['date_string']) / Ldir['frc'] / 'Data'
-# We use this as a scratch directory for processsed files. Then either move the results to the
-# main folder, or split them up into the forecast days.
-
 # Set where are files located, and other situational choices.
 do_d3 = True
 do_d4 = True
@@ -107,11 +102,6 @@ for hr in hr_vec:
     d2_list.append(in_dir / ('wrfout.ocean_d2.' + d_str + '00.f' + hr_str + '.0000'))
     d3_list.append(in_dir / ('wrfout.ocean_d3.' + d_str + '00.f' + hr_str + '.0000'))
     d4_list.append(in_dir / ('wrfout.ocean_d4.' + d_str + '00.f' + hr_str + '.0000'))
-    
-# Create dict that relates a d2 filename to a time index (used when writing to NetCDF)
-d2i_dict = {}
-for i, v in enumerate(d2_list):
-    d2i_dict[v] = i
         
 # Check for existence of files. If any d2 are missing then exit.
 planB = False
@@ -152,20 +142,17 @@ if planB == False:
     lon = G['lon_rho']
     lat = G['lat_rho']
     
-    # Get WRF grids and grid size information (e.g. dx2_km = 12.5)
-    # Note: lat, lon are only in the first file of the day (hour zero)
-    lon2, lat2, dx2_km = afun.get_wrf_grid(d2_list[0])
+    # Get the index maps, rotation matrices, and masks to go from each wrf grid
+    # to the ROMS grid. These are cached, so they are only made the first time
+    # we see a new wrf grid.
+    fn_dict = {'d2':d2_list[0]}
     if do_d3:
-        try:
-            lon3, lat3, dx3_km = afun.get_wrf_grid(d3_list[0])
-        except:
-            do_d3 = False
+        fn_dict['d3'] = d3_list[0]
     if do_d4:
-        try:
-            # sometimes there are empty files
-            lon4, lat4, dx4_km = afun.get_wrf_grid(d4_list[0])
-        except:
-            do_d4 = False
+        fn_dict['d4'] = d4_list[0]
+    cache_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / 'atm_cache'
+    Lfun.make_dir(cache_dir)
+    maps = afun.get_maps(lon, lat, fn_dict, cache_dir)
         
     outvar_list = afun.outvar_list
         
@@ -174,242 +161,74 @@ if planB == False:
     D = dict()
     for vn in outvar_list:
         D[vn] = omat.copy()
-
-    # Find index to trim Eastern part of wrf fields
-    lon_max = lon[0,-1] # easternmost edge of ROMS grid
-    imax2 = zfun.find_nearest_ind(lon2[0,:], lon_max + .5)
-    lon2 = lon2[:,:imax2]
-    lat2 = lat2[:, :imax2]
-    if do_d3:
-        imax3 = zfun.find_nearest_ind(lon3[0,:], lon_max + .5)
-        lon3 = lon3[:,:imax3]
-        lat3 = lat3[:, :imax3]
-    if do_d4:
-        imax4 = zfun.find_nearest_ind(lon4[0,:], lon_max + .5)
-        lon4 = lon4[:,:imax4]
-        lat4 = lat4[:, :imax4]
-
-    # Prepare coordinate arrays for interpolation
-    XY = np.array((lon.flatten(), lat.flatten())).T # shape is (NR*NC, 2)
-    XY2 = np.array((lon2.flatten(), lat2.flatten())).T
-    if do_d3:
-        XY3 = np.array((lon3.flatten(), lat3.flatten())).T
-    if do_d4:
-        XY4 = np.array((lon4.flatten(), lat4.flatten())).T
-
-    # get nearest neighbor trees to use with wrf grids to interpolate
-    # values from the wrf grids onto the ROMS grid
-    IM2 = cKDTree(XY2).query(XY); IM2 = IM2[1]
-    if do_d3:
-        IM3 = cKDTree(XY3).query(XY); IM3 = IM3[1]
-    if do_d4:
-        IM4 = cKDTree(XY4).query(XY); IM4 = IM4[1]
     
-    # Find coordinate rotation matrices to translate wrf velocity from
-    # wrf grid directions to ROMS standard E+, N+
-    ca2, sa2 = afun.get_angle(lon2, lat2)
-    if do_d3:
-        ca3, sa3 = afun.get_angle(lon3, lat3)
-    if do_d4:
-        ca4, sa4 = afun.get_angle(lon4, lat4)
-
-    # Get the d3 and d4 masks. We appear to be avoiding a strip on the N.  Why?
-    # We use these to overwrite just the parts where we have higher resolution wrf data.
-    if do_d3:
-        plon3_poly = np.concatenate((lon3[0,4:],lon3[:-5,-1],lon3[-5,4::-1],lon3[:-5:-1,4]))
-        plat3_poly = np.concatenate((lat3[0,4:],lat3[:-5,-1],lat3[-5,4::-1],lat3[:-5:-1,4]))
-        M3 = afun.get_indices_in_polygon(plon3_poly, plat3_poly, lon, lat)
-    if do_d4:
-        plon4_poly = np.concatenate((lon4[0,4:],lon4[:-5,-1],lon4[-5,4::-1],lon4[:-5:-1,4]))
-        plat4_poly = np.concatenate((lat4[0,4:],lat4[:-5,-1],lat4[-5,4::-1],lat4[:-5:-1,4]))
-        M4 = afun.get_indices_in_polygon(plon4_poly, plat4_poly, lon, lat)
-    
-    # MAIN TASK: loop over all hours
-
-    dall_list = zip(d2_list, d3_list, d4_list)
-    # Check out help(zip) to see how this works.  It creates an interable
-    # that returns tuples made sequentially from entries of the things you zipped.
-    # Note that this always works because we made our lists synthetically without regard
-    # for if the files existed.
-    for fn2, fn3, fn4 in dall_list:
+    # MAIN TASK: process all hours, in parallel
+    fn_dict_list = [{'d2':fn2, 'd3':fn3, 'd4':fn4}
+        for fn2, fn3, fn4 in zip(d2_list, d3_list, d4_list)]
+    for tt, H in enumerate(afun.get_hours(fn_dict_list, maps, outvar_list, NR, NC)):
         if verbose:
-            print('Working on ' + str(fn2).split('/')[-1] + ' and etc.')
-    
-        # flags to allow processing more files
-        do_this_d3 = True
-        do_this_d4 = True
-    
-        # if we are missing a d3 or d4 file then we don't work on it
-        if not fn3.is_file():
-            print(' - missing ' + str(fn3))
-            do_this_d3 = False
-        if not fn4.is_file():
-            print(' - missing ' + str(fn4))
-            do_this_d4 = False
-
-        try:
+            print('Working on ' + str(d2_list[tt]).split('/')[-1] + ' and etc.')
+        for note in H['notes']:
+            print(note)
+        if H['error'] is not None:
             # On 2022.06.07 one of the d2 files showed up with a time index of length 0
             # (it should have been 1).  This is designed to respond to that specific error.
-            # I could wrap the whole job in a try-except but I like to keep it more specific.
-            ov2_dict = afun.gather_and_process_fields(fn2, imax2, ca2, sa2, outvar_list)
-        except Exception as e:
             print('Error in gather and process d2 fields - going to Plan B')
-            print(e)
+            print(H['error'])
+            planB = True
+            break
+        if len(H['nan_list']) > 0:
+            print('** WARNING Nans in combined output ' + H['nan_list'][0])
+            print('Going to planB')
             planB = True
             break
-
-        ovi2_dict = afun.interp_to_roms(ov2_dict, outvar_list, IM2, NR, NC)
-    
-        if do_this_d3:
-            try:
-                ov3_dict = afun.gather_and_process_fields(fn3, imax3, ca3, sa3, outvar_list)
-                ovi3_dict = afun.interp_to_roms(ov3_dict, outvar_list, IM3, NR, NC)
-            except:
-                print(' - could not process ' + str(fn3))
-                do_this_d3 = False
-    
-        if do_this_d4:
-            try:
-                ov4_dict = afun.gather_and_process_fields(fn4, imax4, ca4, sa4, outvar_list)
-                ovi4_dict = afun.interp_to_roms(ov4_dict, outvar_list, IM4, NR, NC)
-            except:
-                print(' - could not process ' + str(fn4))
-                do_this_d4 = False
-    
-        # combine the grids
-        ovc_dict = dict()
-        for ovn in outvar_list:
-            v2 = ovi2_dict[ovn]
-            v = v2.copy()
-            if do_this_d3:
-                v3 = ovi3_dict[ovn]
-                v[M3] = v3[M3]
-            if do_this_d4:
-                v4 = ovi4_dict[ovn]
-                v[M4] = v4[M4]
-            if np.sum(np.isnan(v)) > 0:
-                print('** WARNING Nans in combined output ' + ovn)
-                print('Going to planB part 1')
-                planB = True
-                break # break from outvar_list loop
-            ovc_dict[ovn] = v
-
-        if planB == True:
-            print('Going to planB part 2')
-            break # break from dall_list loop
-    
         # save to dict
-        tt = d2i_dict[fn2]
         for vn in outvar_list:
-            this_field = ovc_dict[vn]
-            #this_field[G['mask_rho']==0] = np.nan
-            D[vn][tt,:,:] = this_field
-    
-    # combine everything into a single dataset and save to Data
-    for vn in outvar_list:
-        out_fn = out_dir_data / (vn + '.nc')
-        out_fn.unlink(missing_ok=True)
-        ds = xr.Dataset()
-        vinfo = zrfun.get_varinfo(vn)
-        tname =  vinfo['time_name']
-        dims = (tname,) + vinfo['space_dims_tup']
-        # take time derivative or rain, converting [mm]
-        # to [kg m-2 s-1]
-        if vn == 'rain':
-            rmat = D[vn].copy()
-            rrmat = np.ones(rmat.shape)
-            rrmat[:-1,:,:] = np.diff(rmat, axis=0) / 3600
-            rrmat[-1,:,:] = rrmat[-2,:,:]
-            D[vn] = rrmat
-
-        # Enforce limits on Tair and Qair 2026.01.10
-        if vn == 'Qair':
-            qmat = D[vn].copy()
-            qmat[qmat<0] = 0
-            qmat[qmat>100] = 100
-            D[vn] = qmat
-        if vn == 'Tair':
-            tmat = D[vn].copy()
-            tmat[tmat<-20] = -20
-            tmat[tmat>45] = 45
-            D[vn] = tmat
-        
-        ds[vn] = (dims, D[vn])
-        ds[vn].attrs['units'] = vinfo['units']
-        ds[vn].attrs['long_name'] = vinfo['long_name']
-        # time coordinate
-        ds[tname] = ((tname,), mod_time_vec)
-        ds[tname].attrs['units'] = Lfun.roms_time_units
-        ds[tname].attrs['long_name'] = 'ocean time'
-        # and save to NetCDF
-        Enc_dict = {vn:zrfun.enc_dict for vn in ds.data_vars}
-        ds.to_netcdf(out_fn, encoding=Enc_dict)
-        ds.close()
-
-    # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>><<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-    # Then reorganize the results:
-    # - backfill: move from Data folder to main folder
-    # - forecast: split using ncks into separate day folders
+            D[vn][tt,:,:] = H['fields'][vn]
+
+if planB == False:
+    # take time derivative of rain, converting [mm]
+    # to [kg m-2 s-1]
+    rmat = D['rain']
+    rrmat = np.ones(rmat.shape)
+    rrmat[:-1,:,:] = np.diff(rmat, axis=0) / 3600
+    rrmat[-1,:,:] = rrmat[-2,:,:]
+    D['rain'] = rrmat
+
+    # Enforce limits on Tair and Qair 2026.01.10
+    qmat = D['Qair']
+    qmat[qmat<0] = 0
+    qmat[qmat>100] = 100
+    tmat = D['Tair']
+    tmat[tmat<-20] = -20
+    tmat[tmat>45] = 45
+
+    # Write each variable once, straight to where it goes:
+    # - backfill: the main folder
+    # - forecast: separate day folders, each with hours 0 to 24 of its day
+    # (this used to be done by saving to the Data folder and then moving or splitting
+    # the files with ncks)
     out_fn_list = [] # start a complete list of all files created
     if Ldir['run_type'] == 'backfill':
-        in_dir = out_dir_data
         out_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / \
             ('f' + Ldir['date_string']) / Ldir['frc']
         for vn in outvar_list:
-            in_fn = in_dir / (vn + '.nc')
             out_fn = out_dir / (vn + '.nc')
-            out_fn.unlink(missing_ok=True)
-            shutil.move(in_fn, out_fn)
-            # since we move the files, we automatically clean up the Data folder
+            afun.write_forcing(vn, D[vn], mod_time_vec, out_fn)
             out_fn_list.append(out_fn)
     elif Ldir['run_type'] == 'forecast':
-        try:
-            in_dir = out_dir_data
-            ds00 = Ldir['date_string']
-            dt00 = datetime.strptime(ds00, Lfun.ds_fmt)
-            for day in range(Ldir['forecast_days']):
-                dt0 = dt00 + timedelta(days=day)
-                dt1 = dt00 + timedelta(days=day+1)
-                ds0 = datetime.strftime(dt0, format=Lfun.ds_fmt)
-                ds1 = datetime.strftime(dt1, format=Lfun.ds_fmt)
-                ds0_for_ncks = datetime.strftime(dt0, format='%Y-%m-%d')
-                ds1_for_ncks = datetime.strftime(dt1, format='%Y-%m-%d')
-                out_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / \
-                    ('f' + ds0) / Ldir['frc']
-                Lfun.make_dir(out_dir)
-                for vn in outvar_list:
-                    in_fn = in_dir / (vn + '.nc')
-                    out_fn = out_dir / (vn + '.nc')
-                    out_fn.unlink(missing_ok=True)
-                    out_fn_list.append(out_fn)
-                    ds = xr.open_dataset(in_fn)
-                    # start creating the command list
-                    cmd_list = ['ncks']
-                    for vn1 in ds.data_vars:
-                        vnda = ds[vn1] # get the DataArray for each variable
-                        vnda_dim_tup = vnda.dims
-                        for item in vnda_dim_tup:
-                            if 'time' in item:
-                                time_name = item
-                                cmd_list += ['-d',time_name+','+ds0_for_ncks+','+ds1_for_ncks]
-                    cmd_list.append(str(in_fn))
-                    cmd_list.append(str(out_fn))
-                    #print(cmd_list)
-                    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-                    stdout, stderr = proc.communicate()
-                    if len(stderr) > 0:
-                        print('Error using ncks for %s' % (vn))
-                        planB = True
-                        break
-                    ds.close()
-        except Exception as e:
-            print('Error using ncks to split forecast forcing')
-            print(e)
-            planB = True
-    # Cleaning up
-    if planB == False:
-        Lfun.make_dir(out_dir_data, clean=True)
-    # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>><<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+        dt00 = datetime.strptime(Ldir['date_string'], Lfun.ds_fmt)
+        for day in range(Ldir['forecast_days']):
+            dt0 = dt00 + timedelta(days=day)
+            ds0 = datetime.strftime(dt0, format=Lfun.ds_fmt)
+            out_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / \
+                ('f' + ds0) / Ldir['frc']
+            Lfun.make_dir(out_dir)
+            it = slice(24*day, 24*day + 25)
+            for vn in outvar_list:
+                out_fn = out_dir / (vn + '.nc')
+                afun.write_forcing(vn, D[vn][it,:,:], mod_time_vec[it], out_fn)
+                out_fn_list.append(out_fn)
 
 if planB == True:
     # We make this an if instead of elif because planB might have been set to True
@@ -6,7 +6,6 @@ import os, sys
 from datetime import datetime, timedelta
 import numpy as np
 import pickle
-from scipy.spatial import cKDTree
 import gsw
 import warnings
 
@@ -18,6 +17,7 @@ import pandas as pd
 
 from lo_tools import Lfun, zfun, zrfun
 from lo_tools import hycom_functions as hfun
+from lo_tools import ocn_functions as ocnfun
 
 def messages(mess_str, stdout, stderr):
     # utility function to help with subprocess errors
@@ -146,40 +146,9 @@ def checknan(fld):
     if np.isnan(fld).sum() > 0:
         print('WARNING: nans in data field')    
 
-def extrap_nearest_to_masked(X, Y, fld, fld0=0):
-    """
-    INPUT: fld is a 2D array (np.ndarray or np.ma.MaskedArray) on spatial grid X, Y
-    OUTPUT: a numpy array of the same size with no mask
-    and no missing values.        
-    If input is a masked array:        
-        * If it is ALL masked then return an array filled with fld0.         
-        * If it is PARTLY masked use nearest neighbor interpolation to
-        fill missing values, and then return data.        
-        * If it is all unmasked then return the data.    
-    If input is not a masked array:        
-        * Return the array.    
-    """
-    # first make sure nans are masked
-    if np.ma.is_masked(fld) == False:
-        fld = np.ma.masked_where(np.isnan(fld), fld)
-        
-    if fld.all() is np.ma.masked:
-        #print('  filling with ' + str(fld0))
-        fldf = fld0 * np.ones(fld.data.shape)
-        fldd = fldf.data
-        checknan(fldd)
-        return fldd
-    else:
-        # do the extrapolation using nearest neighbor
-        fldf = fld.copy() # initialize the "filled" field
-        xyorig = np.array((X[~fld.mask],Y[~fld.mask])).T
-        xynew = np.array((X[fld.mask],Y[fld.mask])).T
-        a = cKDTree(xyorig).query(xynew)
-        aa = a[1]
-        fldf[fld.mask] = fld[~fld.mask][aa]
-        fldd = fldf.data
-        checknan(fldd)
-        return fldd
+# This uses the cached index maps in lo_tools/ocn_functions.py, and works on
+# a whole 3D field (levels, M, L) at once as well as on 2D fields.
+extrap_nearest_to_masked = ocnfun.extrap_nearest_to_masked
 
 def get_extrapolated(in_fn, L, M, N, X, Y, lon, lat, z, Ldir):
     """
@@ -222,10 +191,7 @@ def get_extrapolated(in_fn, L, M, N, X, Y, lon, lat, z, Ldir):
             v0 = np.nanmax(v)
         if vn in ['t3d', 's3d']:
             # print(' -- extrapolating ' + vn)
-            for k in range(N):
-                fld = v[k, :, :]
-                fldf = extrap_nearest_to_masked(X, Y, fld, fld0=v0)
-                V[vn][k, :, :] = fldf
+            V[vn] = extrap_nearest_to_masked(X, Y, v, fld0=v0)
         elif vn in ['u3d', 'v3d']:
             # print(' -- extrapolating ' + vn)
             vv = v.copy()
@@ -304,93 +270,6 @@ def get_zr(G, S, vn):
         print('Unknown variable name for get_zr: ' + vn)
     return zr
 
-def get_zinds(h, S, z):
-    """
-    Precalculate the array of indices to go from HYCOM z to ROMS z.
-    This just finds the vertical index in HYCOM z for each ROMS z_rho
-    value in the whole 3D array, with the index being the UPPER one of
-    the two HYCOM z indices that any ROMS z falls between.
-    """
-    tt0 = time()
-    zr = zrfun.get_z(h, 0*h, S, only_rho=True)
-    zrf = zr.flatten()
-    zinds = np.nan * np.ones_like(zrf)
-    if isinstance(z, np.ma.MaskedArray):
-        z = z.data
-    for ii in range(len(z)-1):
-        zlo = z[ii]; zhi = z[ii+1]
-        mask = (zrf>zlo) & (zrf<=zhi)
-        zinds[mask] = ii+1 # this is where the UPPER index is enforced
-    zinds = zinds.astype(int)
-    if isinstance(zinds, np.ma.MaskedArray):
-        zinds = zinds.data
-    # if verbose:
-    #     print(' --create zinds array took %0.1f seconds' % (time() - tt0))
-    return zinds
-
-def get_interpolated(G, S, b, lon, lat, z, N, zinds):
-    """
-    This does the horizontal and vertical interpolation to get from
-    extrapolated, filtered HYCOM fields to ROMS fields.
-
-    We use fast nearest neighbor interpolation as much as possible.
-    Also we interpolate everything to the ROMS rho grid, and then crudely
-    interpolate to the u and v grids at the last moment.  Much simpler.
-    """
-    
-    # start input dict
-    c = {}
-    
-    # precalculate useful arrays that are used for horizontal interpolation
-    if isinstance(lon, np.ma.MaskedArray):
-        lon = lon.data
-    if isinstance(lat, np.ma.MaskedArray):
-        lat = lat.data
-    Lon, Lat = np.meshgrid(lon,lat)
-    XYin = np.array((Lon.flatten(), Lat.flatten())).T
-    XYr = np.array((G['lon_rho'].flatten(), G['lat_rho'].flatten())).T
-    h = G['h']
-    IMr = cKDTree(XYin).query(XYr)[1]
-    
-    # 2D fields
-    for vn in ['ssh', 'ubar', 'vbar']:
-        vv = b[vn].flatten()[IMr].reshape(h.shape)
-        if vn == 'ubar':
-            vv = (vv[:,:-1] + vv[:,1:])/2
-        elif vn == 'vbar':
-            vv = (vv[:-1,:] + vv[1:,:])/2
-        vvc = vv.copy()
-        # always a good idea to make sure dict entries are not just pointers
-        # to arrays that might be changed later, hence the .copy()
-        c[vn] = vvc
-        checknan(vvc)
-        
-    # 3D fields
-    # create intermediate arrays which are on the ROMS lon_rho, lat_rho grid
-    # but have the HYCOM vertical grid (N layers)
-    F = np.nan * np.ones(((N,) + h.shape))
-    vi_dict = {}
-    for vn in ['theta', 's3d', 'u3d', 'v3d']:
-        FF = F.copy()
-        for nn in range(N):
-            vin = b[vn][nn,:,:].flatten()
-            FF[nn,:,:] = vin[IMr].reshape(h.shape)
-        checknan(FF)
-        vi_dict[vn] = FF
-    
-    # do the vertical interpolation from HYCOM to ROMS z positions
-    for vn in ['theta', 's3d', 'u3d', 'v3d']:
-        vi = vi_dict[vn]
-        hinds = np.indices((S['N'], G['M'], G['L']))
-        vvf = vi[zinds, hinds[1].flatten(), hinds[2].flatten()]
-        vv = vvf.reshape((S['N'], G['M'], G['L']))
-        vvc = vv.copy()
-        if vn == 'u3d':
-            vvc = (vvc[:,:,:-1] + vvc[:,:,1:])/2
-        elif vn == 'v3d':
-            vvc = (vvc[:,:-1,:] + vvc[:,1:,:])/2
-        checknan(vvc)
-        c[vn] = vvc
-    return c
-
+get_zinds = ocnfun.get_zinds
 
+get_interpolated = ocnfun.get_interpolated
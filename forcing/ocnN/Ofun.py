@@ -0,0 +1,160 @@
+"""
+Functions for ocnN, to sample the fields from the history files of another run
+onto the nest grid.
+
+The sampling is nearest-neighbor on each s_rho level (the nest uses the same
+vertical grid as the parent). The indices of the parent points to use for each nest
+point only depend on the two grids and on start_type, so get_indices() makes them
+once (with a cKDTree on the trimmed parent grid for each of the rho, u, and v grids)
+and saves them to a cache directory, to reuse on later days. Then get_one_time() is
+just a gather for each field.
+
+This used to be done by get_one_time.py, run as a separate process for each
+history file, which rebuilt the trees for each time and saved its result to a
+temp pickle file.
+"""
+
+import sys
+import pickle
+import numpy as np
+import xarray as xr
+from scipy.spatial import cKDTree
+
+from lo_tools import zfun
+from lo_tools import ocn_functions as ocnfun
+
+tag_list = ['rho', 'u', 'v']
+
+def get_bounds(x_big, y_big, x_small, y_small, pad=3):
+    """
+    This function takes two pairs of plaid, 2-D, lon, lat arrays:
+    - one pair bigger (that we hope to nest inside) and
+    - one pair smaller (the grid of the nest)
+    and returns the indices to use for making a trimmed version of
+    the bigger grid that the smaller grid still fits inside.
+    We add "pad" around the edges to make sure things fit comfortably.
+    """
+    # First: error checking
+    if (x_small[0,0] < x_big[0,pad]) or (x_small[0,-1] > x_big[0,-pad]):
+        print('ERROR: lon out of bounds ')
+        sys.exit()
+    if (y_small[0,0] < y_big[pad,0]) or (y_small[-1,0] > y_big[-pad,0]):
+        print('ERROR: lat out of bounds ')
+        sys.exit()
+    # Second: get indices
+    ix0 = zfun.find_nearest_ind(x_big[0,:], x_small[0,0]) - pad
+    ix1 = zfun.find_nearest_ind(x_big[0,:], x_small[0,-1]) + pad
+    iy0 = zfun.find_nearest_ind(y_big[:,0], y_small[0,0]) - pad
+    iy1 = zfun.find_nearest_ind(y_big[:,0], y_small[-1,0]) + pad
+    return ix0, ix1, iy0, iy1
+
+def get_vn_dict(do_bio):
+    # associate variables to process with grids
+    vn_dict = {'salt':('rho',3), 'temp':('rho',3), 'zeta':('rho',2),
+            'u':('u',3), 'v':('v',3), 'ubar':('u',2), 'vbar':('v',2)}
+    if do_bio:
+        # Note: designed to work with updated ROMS 2023.05.14
+        bvn_list = ['NO3', 'NH4', 'chlorophyll', 'phytoplankton', 'zooplankton',
+                'LdetritusN', 'SdetritusN', 'LdetritusC', 'SdetritusC',
+                'TIC', 'alkalinity', 'oxygen']
+        for bvn in bvn_list:
+            vn_dict[bvn] = ('rho',3)
+    return vn_dict
+
+def get_indices(grid_fn, his_fn, start_type, cache_dir):
+    """
+    Get the dict I of sampling indices for the nest grid in grid_fn from the parent
+    grid in his_fn. For each tag in tag_list it has:
+    bounds = (iy0, iy1, ix0, ix1) to trim the parent grid
+    mask = nest points to fill (True)
+    inds = flat index into the trimmed parent field for each of those points
+    and I['h'] is the nest h. The result is cached in cache_dir, keyed by the
+    signature of the two grids and start_type.
+    """
+    # the new grid
+    ds = xr.open_dataset(grid_fn)
+    hh = ds.h.values
+    xx = {}; yy = {}; mm = {}
+    for tag in tag_list:
+        xx[tag] = ds['lon_' + tag].values
+        yy[tag] = ds['lat_' + tag].values
+        mm[tag] = ds['mask_' + tag].values
+    ds.close()
+    # the old grid
+    ds = xr.open_dataset(his_fn)
+    x = {}; y = {}; m = {}
+    for tag in tag_list:
+        x[tag] = ds['lon_' + tag].values
+        y[tag] = ds['lat_' + tag].values
+        m[tag] = ds['mask_' + tag].values # 1=water
+    ds.close()
+
+    if start_type in ['continuation','perfect']:
+        pad = 10
+    elif start_type == 'new':
+        pad = 0
+    else:
+        print('Error: Unrecognized start_type')
+        sys.exit()
+
+    key = ocnfun.get_sig(*[a[tag] for a in [xx, yy, mm, x, y, m] for tag in tag_list],
+        np.array([pad]))
+    cache_fn = cache_dir / ('ocnN_indices_' + key + '.p')
+    if cache_fn.is_file():
+        return pickle.load(open(cache_fn, 'rb'))
+
+    if pad > 0:
+        # mask out the inside of the nest fields, since we only use
+        # the edges (unless Ldir['start_type']=='new')
+        for tag in tag_list:
+            mm[tag][pad:-pad, pad:-pad] = 0 # this speeds things up
+    I = {'h': hh}
+    for tag in tag_list:
+        # trim the old grid before making the search tree
+        ix0, ix1, iy0, iy1 = get_bounds(x[tag], y[tag], xx[tag], yy[tag])
+        xtrim = x[tag][iy0:iy1, ix0:ix1]
+        ytrim = y[tag][iy0:iy1, ix0:ix1]
+        mtrim = m[tag][iy0:iy1, ix0:ix1]
+        xyorig = np.array((xtrim[mtrim==1],ytrim[mtrim==1])).T
+        xynew = np.array((xx[tag][mm[tag]==1],yy[tag][mm[tag]==1])).T
+        aa = cKDTree(xyorig).query(xynew, workers=-1)[1]
+        I[tag] = {'bounds': (iy0, iy1, ix0, ix1), 'mask': mm[tag]==1,
+            'inds': np.flatnonzero(mtrim==1)[aa]}
+    # write to a temp file first so that a job running at the same time
+    # never reads a partial file
+    temp_fn = cache_dir / (cache_fn.name + '.temp')
+    pickle.dump(I, open(temp_fn, 'wb'))
+    temp_fn.replace(cache_fn)
+    return I
+
+def get_one_time(his_fn, I, vn_dict):
+    """
+    Sample the fields in vn_dict from his_fn onto the nest grid, using the
+    indices I from get_indices(). Returns a dict of the fields, and ocean_time.
+    """
+    data_dict = dict()
+    ds = xr.open_dataset(his_fn, decode_times=False)
+    data_dict['ocean_time'] = ds.ocean_time.values[0]
+    for vn in vn_dict.keys():
+        tag = vn_dict[vn][0]
+        iy0, iy1, ix0, ix1 = I[tag]['bounds']
+        mask = I[tag]['mask']
+        # read the trimmed field (all levels) and gather
+        vtrim = ds[vn][0, ..., iy0:iy1, ix0:ix1].values
+        vtrim = vtrim.reshape(vtrim.shape[:-2] + (-1,))
+        vv = np.nan * np.ones(vtrim.shape[:-1] + mask.shape)
+        vv[..., mask] = vtrim[..., I[tag]['inds']]
+        if vn == 'zeta':
+            # NOTE: it would be better to automate this instead of hard-coding!
+            # change sea level to match what was used in pgrid for z_offset.
+            # z_offset = -1 # backed off on this because of wgh2 blowup issue 2024.12.01
+            z_offset = -0.5
+            vv = vv + z_offset
+            # enforce a minimum depth
+            hh = I['h']
+            min_depth = 0.3
+            zmask = vv+hh <= min_depth
+            vv[zmask] = -hh[zmask] + min_depth
+        data_dict[vn] = vv
+    ds.close()
+    return data_dict
@@ -12,6 +12,11 @@ Testing:
 run make_forcing_main.py -g wgh2 -gtx cas7_t0_x4b -ro 0 -r backfill -s continuation -d 2017.07.04 -f ocnN -do_bio True -test True
 
 Performance: 6 minutes per day on mac for wgh1 grid with do_bio = True and start_type = new.
+
+The sampling indices are made once by Ofun.get_indices() and cached in
+LO_output/forcing/[gridname]/ocnN_cache, and then the times are sampled in
+parallel by a pool of workers (this used to run get_one_time.py as a separate
+process for each time, with temp pickle files).
 """
 
 from pathlib import Path
@@ -29,11 +34,10 @@ result_dict['start_dt'] = datetime.now()
 import xarray as xr
 from time import time
 import numpy as np
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
-import pickle
+import multiprocessing as mp
 
 from lo_tools import Lfun, zfun, zrfun, Ofun_nc
+import Ofun
 
 # this directory is created, along with Info and Data subdirectories, by ffun.intro()
 out_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / ('f' + Ldir['date_string']) / Ldir['frc']
@@ -52,92 +56,61 @@ if Ldir['testing']:
     verbose = True
     h_list = h_list[:2]
 
-# +++++++++++ parallel subprocess +++++++++++++++++++++++++++++++++++
-temp_dir = out_dir / 'Data'
-Lfun.make_dir(temp_dir, clean=True)
+# Sampling indices, made once for this parent and nest grid and cached
+# for later days.
+tt0 = time()
+grid_fn = Ldir['grid'] / 'grid.nc'
+cache_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / 'ocnN_cache'
+Lfun.make_dir(cache_dir)
+I = Ofun.get_indices(grid_fn, h_list[0], Ldir['start_type'], cache_dir)
+vn_dict = Ofun.get_vn_dict(Ldir['do_bio'])
+print('Time to get indices = %0.1f sec' % (time()-tt0))
+
+def get_one_time(ii):
+    return Ofun.get_one_time(h_list[ii], I, vn_dict)
+
+# Sample all the times in parallel, putting the results directly into the
+# Dataset for the climatology file, using zrfun.get_varinfo().
+tt0 = time()
 Nproc = 10
 NT = len(h_list)
-proc_list = []
-tt0 = time()
-temp_out_fn_list = []
 print('Working on ' + Ldir['frc'] + ' (' + str(NT) + ' times)')
-for ii in range(NT):
-    grid_fn = str(Ldir['grid'] / 'grid.nc')
-    his_fn = str(h_list[ii])
-    count_str = ('000000' + str(ii))[-6:]
-    temp_out_fn = temp_dir / ('data_dict_' + count_str + '.p')
-    temp_out_fn_list.append(temp_out_fn)
-    this_dir = str(Ldir['LO'] / 'forcing' / Ldir['frc']) + '/'
-    cmd_list = ['python', this_dir + 'get_one_time.py', '-grid_fn', grid_fn,
-         '-his_fn', his_fn, '-start_type', Ldir['start_type'], '-out_fn', str(temp_out_fn),
-         '-do_bio', str(Ldir['do_bio'])]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-        
-    if ((np.mod(ii,Nproc) == 0) and (ii > 0)) or (ii == NT-1):
-        for proc in proc_list:
-            stdout, stderr = proc.communicate()
-            # make sure everyone is finished before continuing
-            if verbose and (len(stdout) > 0):
-                print('\n'+stdout.decode())
-            if len(stderr) > 0:
-                print('\n'+stderr.decode())
-        proc_list = []
-    ii += 1
+out_fn = out_dir / 'ocean_clm.nc'
+out_fn.unlink(missing_ok=True)
+ds = xr.Dataset()
+ot_vec = np.nan * np.ones(NT)
+# fork so the workers inherit h_list, I, and vn_dict
+with mp.get_context('fork').Pool(min(Nproc, NT)) as pool:
+    for ii, dd in enumerate(pool.imap(get_one_time, range(NT))):
+        for vn in dd.keys():
+            ddv = dd[vn]
+            if verbose: # debugging
+                print('\n%d %s max = %0.1f' % (ii,vn,np.nanmax(ddv)))
+            if vn == 'ocean_time':
+                ot_vec[ii] = ddv
+            else:
+                if ii == 0:
+                    # Initialize the Dataset
+                    vinfo = zrfun.get_varinfo(vn, vartype='climatology')
+                    dims = (vinfo['time_name'],) + vinfo['space_dims_tup']
+                    ds[vn] = (dims, np.nan * np.ones((NT,) + ddv.shape))
+                    ds[vn].attrs['units'] = vinfo['units']
+                    ds[vn].attrs['long_name'] = vinfo['long_name']
+                ds[vn][ii, ...] = ddv
 print('Time to run all extractions = %0.1f sec' % (time()-tt0))
 sys.stdout.flush()
-# +++++++++ end parallel subprocess +++++++++++++++++++++++++++++++++
 
 # Write files to NetCDF.
 
-# Write climatology file making use of zrfun.get_varinfo().
+# Write climatology file.
 tt0 = time()
-out_fn = out_dir / 'ocean_clm.nc'
-out_fn.unlink(missing_ok=True)
-ds = xr.Dataset()
-# Initialize Dataset and save variable names to loop over
-dd0 = pickle.load(open(temp_out_fn_list[0], 'rb'))
-ddk = dd0.keys()
-for vn in ddk:
-    if vn == 'ocean_time':
-        pass
-    else:
-        vinfo = zrfun.get_varinfo(vn, vartype='climatology')
-        dims = (vinfo['time_name'],) + vinfo['space_dims_tup']
-        ds[vn] = (dims, np.nan * np.ones((NT,) + dd0[vn].shape))
-        ds[vn].attrs['units'] = vinfo['units']
-        ds[vn].attrs['long_name'] = vinfo['long_name']
-# loop over the temp files
-ot_vec = np.nan * np.ones(NT)
-ii = 0
-tt00 = time()
-for temp_out_fn in temp_out_fn_list:
-    dd = pickle.load(open(temp_out_fn, 'rb'))
-    for vn in ddk:
-        ddv = dd[vn]
-        if verbose: # debugging
-            print('\n%d %s max = %0.1f' % (ii,vn,np.nanmax(ddv)))
-        if vn == 'ocean_time':
-            ot_vec[ii] = ddv
-        else:
-            if ddv.ndim == 2:
-                ds[vn][ii, :, :] = ddv
-            elif ddv.ndim == 3:
-                ds[vn][ii, :, :, :] = ddv
-            else:
-                print('problem with ndim?')
-    ii += 1
-print('-- Put data in ds for clim file: %0.2f sec' % (time()-tt00))
 # Add the time coordinates
-for vn in ddk:
-    if vn == 'ocean_time':
-        pass
-    else:
-        vinfo = zrfun.get_varinfo(vn, vartype='climatology')
-        tname = vinfo['time_name']
-        # time coordinate
-        ds[tname] = ((tname,), ot_vec)
-        ds[tname].attrs['units'] = Lfun.roms_time_units
+for vn in vn_dict.keys():
+    vinfo = zrfun.get_varinfo(vn, vartype='climatology')
+    tname = vinfo['time_name']
+    # time coordinate
+    ds[tname] = ((tname,), ot_vec)
+    ds[tname].attrs['units'] = Lfun.roms_time_units
 # and save to NetCDF
 Enc_dict = {vn:zrfun.enc_dict for vn in ds.data_vars}
 ds.to_netcdf(out_fn, encoding=Enc_dict)
@@ -167,9 +140,6 @@ Ofun_nc.make_bry_file(in_fn, out_fn)
 print('- Write bry file: %0.2f sec' % (time()-tt0))
 sys.stdout.flush()
 
-# clean up
-Lfun.make_dir(temp_dir, clean=True)
-    
 def print_info(fn):
     print('\n' + str(fn))
     ds = xr.open_dataset(fn, decode_times=False)
@@ -26,8 +26,7 @@ out_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / ('f' + date_string) / Ldi
 
 import xarray as xr
 import numpy as np
-from scipy.spatial import cKDTree
-from lo_tools import zrfun
+from lo_tools import Lfun, zrfun
 from lo_tools import tpxo_functions as tpxo_fun
 
 out_fn = out_dir / 'tides.nc'
@@ -36,6 +35,9 @@ grid_fn = Ldir['grid'] / 'grid.nc'
 
 G = zrfun.get_basic_info(grid_fn, only_G=True)
 NR, NC = G['lon_rho'].shape
+rlon = G['lon_rho']
+rlat = G['lat_rho']
+rmask = G['mask_rho'] # 0 = land
 
 # >>>>>>>>>>> get tpxo fields >>>>>>>>>>>>>>>>>>>>>>>
 # >>>>>>>>>> and interpolate to ROMS grid >>>>>>>>>>>
@@ -66,71 +68,43 @@ else:
 for item in item_list:
     R_dict[item] = nmat.copy()
 
-counter = 0
-for con in c_list:
-
-    # this is where we do the entire tpxo9 extraction and processing
-    om, lon, lat, plon, plat, h, amp, phase, umajor, uminor, uincl, uphase = \
-        tpxo_fun.get_tpxo_clip(Ldir, con, time_dt, domain_tup)
+# ad hoc amplitude adjustments
+fadj_dict = {'o1':1.21*1.087, 'k1':1.21*1.11, 'p1':1.21, 'q1':1.21,
+    'm2':1.17*1.075, 's2':1.261*1.13, 'n2':1.196*1.11, 'k2':1.2*1.11}
+if ad_hoc_adjustment:
+    print('> tide00 doing ad hoc adjustment of amplitudes <')
+
+# This is where we do the entire tpxo9 extraction and processing, and make the
+# index to interpolate to the ROMS grid using nearest neighbor. These do not depend
+# on the day, so they are cached, and only made the first time for a grid.
+cache_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / 'tide_cache'
+Lfun.make_dir(cache_dir)
+T = tpxo_fun.get_roms_tpxo(Ldir, G, c_list, domain_tup, cache_dir)
+pu, pf = tpxo_fun.get_nodal(c_list, [time_dt])
+
+for counter, con in enumerate(c_list):
     
-    if ad_hoc_adjustment:
-        print('> tide00 doing ad hoc adjustment of amplitudes <')
-        # ad hoc amplitude adjustments
-        if con == 'o1':
-            fadj = 1.21*1.087
-        elif con == 'k1':
-            fadj = 1.21*1.11
-        elif con == 'p1':
-            fadj = 1.21
-        elif con == 'q1':
-            fadj = 1.21
-        elif con == 'm2':
-            fadj = 1.17*1.075
-        elif con == 's2':
-            fadj = 1.261*1.13
-        elif con == 'n2':
-            fadj = 1.196*1.11
-        elif con == 'k2':
-            fadj = 1.2*1.11
-        amp = fadj * amp
-        umajor = fadj * umajor
-        uminor = fadj * uminor
-        
-    c_dict[con] = 2*np.pi/(om*3600)
+    c_dict[con] = 2*np.pi/(T[con]['om']*3600)
     
-    tpxo_dict = {'tide_Eamp':amp,
-                'tide_Ephase':phase,
-                'tide_Cangle':uincl,
-                'tide_Cphase':uphase,
-                'tide_Cmax':umajor,
-                'tide_Cmin':uminor}
-        
-    if counter == 0:
-        # >>> prepare for interpolation to ROMS grid using nearest neighbor >>>
-        rlon = G['lon_rho']
-        rlat = G['lat_rho']
-        rmask = G['mask_rho'] # 0 = land
-        
-        XY = np.array((rlon.flatten(), rlat.flatten())).T # shape is (NR*NC, 2)
-        XY2 = np.array((lon[~np.isnan(amp)].flatten(), lat[~np.isnan(amp)].flatten())).T
-
-        # get nearest neighbor trees to use with tpxo grids to interpolate
-        # values from the tpxo grid onto the ROMS grid
-        IM2 = cKDTree(XY2).query(XY); IM2 = IM2[1]
+    if ad_hoc_adjustment:
+        fadj = fadj_dict[con]
+    else:
+        fadj = 1
+    F = tpxo_fun.get_roms_fields(T[con], pu[0,counter], pf[0,counter], rmask, fadj=fadj)
         
     for item in item_list:
-        this_tpxo_field = tpxo_dict[item]
-        this_tpxo_field = this_tpxo_field[~np.isnan(amp)].flatten()
-        new_roms_field = np.nan * np.ones(NR*NC)
-        new_roms_field = this_tpxo_field[IM2]
-        new_roms_field = new_roms_field.reshape((NR, NC))
-        new_roms_field[rmask==0] = np.nan
+        new_roms_field = F[item]
         R_dict[item][counter,:,:] = new_roms_field
         
         if Ldir['testing']:
             import matplotlib.pyplot as plt
             from lo_tools import plotting_functions as pfun
             
+            # the tpxo9 field, for comparison
+            om, lon, lat, plon, plat, h, amp, phase, umajor, uminor, uincl, uphase = \
+                tpxo_fun.get_tpxo_clip(Ldir, con, time_dt, domain_tup)
+            amp = fadj * amp
+            
             plt.close('all')
             dmin = 0
             dmax = 360
@@ -156,8 +130,6 @@ for con in c_list:
             pfun.end_plot()
             break
 
-    counter += 1
-
 # >>>>>>>> write to NetCDF >>>>>>>>>>>>>>>>>>>>>>>>>>>
 
 # Create the period and Eamp arrays
@@ -4,6 +4,9 @@ This is the main program for making the TIDE forcing file.
 NEW 2025.08.18: For start_type = forecast this writes the forcing files
 to separate day folders.
 
+NEW: The tpxo9 fields on the ROMS grid are cached in LO_output/forcing/[gridname]/tide_cache
+(see tpxo_functions.get_roms_tpxo()) so for each day we only apply the nodal corrections.
+
 Test on mac in ipython:
 
 run make_forcing_main.py -g cas7 -r forecast -f tide01 -test True
@@ -29,7 +32,6 @@ if ad_hoc_adjustment:
 
 import xarray as xr
 import numpy as np
-from scipy.spatial import cKDTree
 from lo_tools import Lfun, zrfun
 from lo_tools import tpxo_functions as tpxo_fun
 
@@ -37,6 +39,9 @@ grid_fn = Ldir['grid'] / 'grid.nc'
 
 G = zrfun.get_basic_info(grid_fn, only_G=True)
 NR, NC = G['lon_rho'].shape
+rlon = G['lon_rho']
+rlat = G['lat_rho']
+rmask = G['mask_rho'] # 0 = land
 
 # make it write forecast forcing to separate folders
 date_string_list = []
@@ -50,9 +55,41 @@ elif Ldir['run_type'] == 'forecast':
                 ds0 = datetime.strftime(dt0, format=Ldir['ds_fmt'])
                 date_string_list.append(ds0)
 
+# Constituents to work on
+if Ldir['testing']:
+    c_list = ['m2']
+else:
+    c_list =  ['m2','s2','k1','o1', 'n2','p1','k2','q1']
+Ncons = len(c_list)
+
+# Set the domain to extract.
+domain_tup = (-131, -121, 41, 53)
+
+if Ldir['testing']:
+    item_list = ['tide_Eamp']
+else:
+    item_list = ['tide_Eamp', 'tide_Ephase',
+                    'tide_Cangle', 'tide_Cphase', 'tide_Cmax', 'tide_Cmin']
+
+# ad hoc amplitude adjustments
+fadj_dict = {'o1':1.21*1.087, 'k1':1.21*1.11, 'p1':1.21, 'q1':1.21,
+    'm2':1.17*1.075, 's2':1.261*1.13, 'n2':1.196*1.11, 'k2':1.2*1.11}
+
+# >>>>>>>>>>> get tpxo fields >>>>>>>>>>>>>>>>>>>>>>>
+# This is where we do the entire tpxo9 extraction and processing, and make the
+# index to interpolate to the ROMS grid using nearest neighbor. These do not depend
+# on the day, so they are cached, and only made the first time for a grid.
+cache_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / 'tide_cache'
+Lfun.make_dir(cache_dir)
+T = tpxo_fun.get_roms_tpxo(Ldir, G, c_list, domain_tup, cache_dir)
+
+# Then get the nodal corrections for all the days at once (packed day, constituent).
+dt_list = [datetime.strptime(date_string, Ldir['ds_fmt']) for date_string in date_string_list]
+pu, pf = tpxo_fun.get_nodal(c_list, dt_list)
+
 # this loop works for both backfill and forecast
 out_fn_list = []
-for date_string in date_string_list:
+for dd, date_string in enumerate(date_string_list):
     print('\nWorking on ' + date_string)
     out_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / ('f' + date_string) / Ldir['frc']
     Lfun.make_dir(out_dir)
@@ -60,99 +97,38 @@ for date_string in date_string_list:
     out_fn_list.append(out_fn) # used at the end to check results
     out_fn.unlink(missing_ok=True)
 
-    # >>>>>>>>>>> get tpxo fields >>>>>>>>>>>>>>>>>>>>>>>
-    # >>>>>>>>>> and interpolate to ROMS grid >>>>>>>>>>>
-
-    # Constituents to work on
-    if Ldir['testing']:
-        c_list = ['m2']
-    else:
-        c_list =  ['m2','s2','k1','o1', 'n2','p1','k2','q1']
+    # >>>>>>>>>> apply nodal corrections on the ROMS grid >>>>>>>>>>>
     c_dict = dict() # a place to hold the period data
 
-    # Set the day to look at, and the dmain to extract.
-    time_dt = datetime.strptime(date_string, Ldir['ds_fmt'])
-    domain_tup = (-131, -121, 41, 53)
-
-    Ncons = len(c_list)
-
     # Initialize output arrays
     R_dict = dict()
     nmat = np.nan * np.ones((Ncons,NR,NC))
-
-    if Ldir['testing']:
-        item_list = ['tide_Eamp']
-    else:
-        item_list = ['tide_Eamp', 'tide_Ephase',
-                        'tide_Cangle', 'tide_Cphase', 'tide_Cmax', 'tide_Cmin']
-        
     for item in item_list:
         R_dict[item] = nmat.copy()
 
-    counter = 0
-    for con in c_list:
-
-        # this is where we do the entire tpxo9 extraction and processing
-        om, lon, lat, plon, plat, h, amp, phase, umajor, uminor, uincl, uphase = \
-            tpxo_fun.get_tpxo_clip(Ldir, con, time_dt, domain_tup)
+    for counter, con in enumerate(c_list):
         
-        if ad_hoc_adjustment:
-            # ad hoc amplitude adjustments
-            if con == 'o1':
-                fadj = 1.21*1.087
-            elif con == 'k1':
-                fadj = 1.21*1.11
-            elif con == 'p1':
-                fadj = 1.21
-            elif con == 'q1':
-                fadj = 1.21
-            elif con == 'm2':
-                fadj = 1.17*1.075
-            elif con == 's2':
-                fadj = 1.261*1.13
-            elif con == 'n2':
-                fadj = 1.196*1.11
-            elif con == 'k2':
-                fadj = 1.2*1.11
-            amp = fadj * amp
-            umajor = fadj * umajor
-            uminor = fadj * uminor
-            
-        c_dict[con] = 2*np.pi/(om*3600)
+        c_dict[con] = 2*np.pi/(T[con]['om']*3600)
         
-        tpxo_dict = {'tide_Eamp':amp,
-                    'tide_Ephase':phase,
-                    'tide_Cangle':uincl,
-                    'tide_Cphase':uphase,
-                    'tide_Cmax':umajor,
-                    'tide_Cmin':uminor}
-            
-        if counter == 0:
-            # >>> prepare for interpolation to ROMS grid using nearest neighbor >>>
-            rlon = G['lon_rho']
-            rlat = G['lat_rho']
-            rmask = G['mask_rho'] # 0 = land
-            
-            XY = np.array((rlon.flatten(), rlat.flatten())).T # shape is (NR*NC, 2)
-            XY2 = np.array((lon[~np.isnan(amp)].flatten(), lat[~np.isnan(amp)].flatten())).T
-
-            # get nearest neighbor trees to use with tpxo grids to interpolate
-            # values from the tpxo grid onto the ROMS grid
-            IM2 = cKDTree(XY2).query(XY); IM2 = IM2[1]
+        if ad_hoc_adjustment:
+            fadj = fadj_dict[con]
+        else:
+            fadj = 1
+        F = tpxo_fun.get_roms_fields(T[con], pu[dd,counter], pf[dd,counter], rmask, fadj=fadj)
             
         for item in item_list:
-            this_tpxo_field = tpxo_dict[item]
-            this_tpxo_field = this_tpxo_field[~np.isnan(amp)].flatten()
-            new_roms_field = np.nan * np.ones(NR*NC)
-            new_roms_field = this_tpxo_field[IM2]
-            new_roms_field = new_roms_field.reshape((NR, NC))
-            new_roms_field[rmask==0] = np.nan
+            new_roms_field = F[item]
             R_dict[item][counter,:,:] = new_roms_field
             
             if Ldir['testing']:
                 import matplotlib.pyplot as plt
                 from lo_tools import plotting_functions as pfun
                 
+                # the tpxo9 field, for comparison
+                om, lon, lat, plon, plat, h, amp, phase, umajor, uminor, uincl, uphase = \
+                    tpxo_fun.get_tpxo_clip(Ldir, con, dt_list[dd], domain_tup)
+                amp = fadj * amp
+                
                 plt.close('all')
                 dmin = 0
                 dmax = 360
@@ -178,8 +154,6 @@ for date_string in date_string_list:
                 pfun.end_plot()
                 break
 
-        counter += 1
-
     # >>>>>>>> write to NetCDF >>>>>>>>>>>>>>>>>>>>>>>>>>>
 
     # Create the period and Eamp arrays
@@ -0,0 +1,300 @@
+"""
+Functions to use with atmospheric forcing.  Translated from matlab to python.
+
+These are shared by forcing/atm00, atm01, atm01_oae, and atm02 (through the atm_fun.py
+in each of those folders).
+
+The steps that only depend on the WRF and ROMS grids (the nearest neighbor index
+from each WRF domain to the ROMS grid, the rotation angles, and the polygon masks of
+the d3 and d4 domains) are done by get_maps(), which caches them on disk. Then the
+hours are processed in parallel by get_hours(), which is just reading, unit conversion,
+and gathers for each hour.
+"""
+
+import pickle
+import multiprocessing as mp
+import numpy as np
+import xarray as xr
+import seawater as sw
+import matplotlib.path as mpath
+from scipy.spatial import cKDTree
+
+from lo_tools import Lfun, zfun, zrfun
+from lo_tools import ocn_functions as ocnfun
+
+invar_list = ['Q2', 'T2', 'PSFC', 'U10', 'V10','RAINC', 'RAINNC', 'SWDOWN', 'GLW']
+
+outvar_list = ['Pair','rain','swrad','lwrad_down','Tair','Qair','Uwind','Vwind']
+
+def get_wrf_grid(fn):
+    wds = xr.open_dataset(fn)
+    lon = wds['XLONG'].values.squeeze()
+    lat = wds['XLAT'].values.squeeze()
+    if False: # Make True to see wrf variable names
+        print('\n' + fn.name.split('/')[-1].center(60,'-'))
+        vn_list = []
+        for vn in wds.data_vars:
+            print(vn)
+    wds.close()
+    # Get grid size info at the middle of each wrf domain
+    NR, NC = lon.shape
+    jj = int(NR/2); ii = int(NC/2)
+    dx_km, dd_deg = sw.dist(lat[jj,ii], [lon[jj,ii], lon[jj+1,ii+1]])
+    return lon, lat, dx_km
+
+def get_angle(lon, lat):
+    # used to find the angle "theta" of the wrf grids and then return
+    # cosine and sine arrays that we use later to rotate the wrf
+    # velocities to ROMS E-N orientation.
+    NR, NC = lon.shape
+    theta = np.nan * np.ones_like(lon)
+    for jj in range(NR):
+        junk, theta[jj,:-1] = sw.dist(lat[jj,:], lon[jj,:])
+    # we repeat the last column because sw.dist returns NC-1
+    theta[:,-1] = theta[:,-2]
+    if False:
+        print(' THETA '.center(60,'-'))
+        print(theta[10,-10:])
+    # We use negative of the angle because re are rotating back to zero.
+    ca = np.cos(-np.pi*theta/180)
+    sa = np.sin(-np.pi*theta/180)
+    return ca, sa
+
+def get_indices_in_polygon(plon_poly, plat_poly, lon, lat):
+    # get Boolean mask array "M" that is true for points
+    # in lon, lat that are in the polygon plon_poly, plat_poly
+    V = np.ones((len(plon_poly),2))
+    V[:,0] = plon_poly
+    V[:,1] = plat_poly
+    P = mpath.Path(V)
+    Rlon = lon.flatten()
+    Rlat = lat.flatten()
+    R = np.ones((len(Rlon),2))
+    R[:,0] = Rlon
+    R[:,1] = Rlat
+    M = P.contains_points(R) # boolean
+    M = M.reshape(lon.shape)
+    return M
+
+def gather_and_process_fields(fn, imax, ca, sa, outvar_list):
+    # This is where we define any transformations to get from WRF to ROMS variables.
+    # we pass outvar_list only because it may have been shortened by the calling program
+    # while testing.
+    ds = xr.open_dataset(fn)
+    iv_dict = dict()
+    for ivn in invar_list:
+        # we trim fields to match the trimmed coordinate arrays
+        iv_dict[ivn] = ds[ivn][0,:,:imax].values.squeeze()
+    ds.close()
+    # then convert to ROMS units/properties, still on the WRF grid
+    ov_dict = dict()
+    for ovn in outvar_list:
+        if ovn == 'Pair':
+            # convert Pa to mbar
+            ov_dict[ovn] = iv_dict['PSFC']/100
+        elif ovn == 'rain':
+            # This is accumulated precipitation [mm] and will be converted to
+            # the units expected by ROMS [kg m-2 s-1] in the main code after
+            # all hours have been gathered into one array (because we have to
+            # take a time derivative).
+            ov_dict[ovn] = iv_dict['RAINC']+iv_dict['RAINNC']
+        elif ovn == 'Tair':
+            # convert K to C
+            ov_dict[ovn] = iv_dict['T2'] - 273.15
+        elif ovn == 'swrad':
+            # account for reflection
+            ov_dict[ovn] = iv_dict['SWDOWN'] * (1 - 0.1446)
+        elif ovn == 'lwrad_down':
+            # account for reflection
+            ov_dict[ovn] = iv_dict['GLW']
+        elif ovn == 'Qair':
+            # calculate relative humidity [%]
+             ov_dict[ovn] = Z_wmo_RH(ov_dict['Pair'], ov_dict['Tair'], iv_dict['Q2'])
+        elif ovn == 'Uwind':
+            # % rotate velocity to E-W and N-S
+            ov_dict[ovn] = ca*iv_dict['U10'] + sa*iv_dict['V10']
+        elif ovn == 'Vwind':
+            # % rotate velocity to E-W and N-S
+            ov_dict[ovn] = ca*iv_dict['V10'] - sa*iv_dict['U10']
+    return ov_dict
+
+def interp_to_roms(ov_dict, outvar_list, IMn, NR, NC):
+    ovi_dict = dict()
+    for ovn in outvar_list:
+        v = ov_dict[ovn].flatten()
+        ovi_dict[ovn] = v[IMn].reshape((NR,NC))
+    return ovi_dict
+
+def get_maps(lon, lat, fn_dict, cache_dir):
+    """
+    Get what we need to go from each WRF domain to the ROMS grid lon, lat (rho grid).
+    fn_dict has the first file (hour zero, which has the grid) of each domain to use,
+    e.g. {'d2':fn2, 'd3':fn3, 'd4':fn4}. Returns a dict, keyed by domain, of dicts with:
+    imax = index to trim the Eastern part of the wrf fields
+    IM = index of the nearest point on the trimmed wrf grid for each ROMS point
+    ca, sa = to rotate the wrf velocities to E+, N+
+    M = Boolean mask of the ROMS points where this domain overwrites the coarser
+        ones (d3 and d4 only)
+    A d3 or d4 domain whose grid we can't read (sometimes there are empty files) is
+    left out. The maps are cached in cache_dir, keyed by the signature of the grids.
+    """
+    lon_max = lon[0,-1] # easternmost edge of ROMS grid
+    XY = np.array((lon.flatten(), lat.flatten())).T # shape is (NR*NC, 2)
+    maps = dict()
+    for dom in fn_dict.keys():
+        # Note: lat, lon are only in the first file of the day (hour zero)
+        if dom == 'd2':
+            lonw, latw, dx_km = get_wrf_grid(fn_dict[dom])
+        else:
+            try:
+                lonw, latw, dx_km = get_wrf_grid(fn_dict[dom])
+            except:
+                continue
+        key = ocnfun.get_sig(lonw, latw, lon, lat)
+        cache_fn = cache_dir / ('atm_maps_' + dom + '_' + key + '.p')
+        if cache_fn.is_file():
+            maps[dom] = pickle.load(open(cache_fn, 'rb'))
+            continue
+        m = dict()
+        # Find index to trim Eastern part of wrf fields
+        m['imax'] = zfun.find_nearest_ind(lonw[0,:], lon_max + .5)
+        lonw = lonw[:,:m['imax']]
+        latw = latw[:,:m['imax']]
+        # get nearest neighbor tree to use with the wrf grid to interpolate
+        # values from the wrf grid onto the ROMS grid
+        XYw = np.array((lonw.flatten(), latw.flatten())).T
+        m['IM'] = cKDTree(XYw).query(XY)[1]
+        # Find coordinate rotation matrices to translate wrf velocity from
+        # wrf grid directions to ROMS standard E+, N+
+        m['ca'], m['sa'] = get_angle(lonw, latw)
+        if dom != 'd2':
+            # Get the d3 and d4 masks. We appear to be avoiding a strip on the N.  Why?
+            # We use these to overwrite just the parts where we have higher resolution wrf data.
+            plon_poly = np.concatenate((lonw[0,4:],lonw[:-5,-1],lonw[-5,4::-1],lonw[:-5:-1,4]))
+            plat_poly = np.concatenate((latw[0,4:],latw[:-5,-1],latw[-5,4::-1],latw[:-5:-1,4]))
+            m['M'] = get_indices_in_polygon(plon_poly, plat_poly, lon, lat)
+        # write to a temp file first so that a job running at the same time
+        # never reads a partial file
+        temp_fn = cache_dir / (cache_fn.name + '.temp')
+        pickle.dump(m, open(temp_fn, 'wb'))
+        temp_fn.replace(cache_fn)
+        maps[dom] = m
+    return maps
+
+def get_one_hour(fn_dict, maps, outvar_list, NR, NC):
+    """
+    Process the wrf files for one hour (fn_dict keyed by domain as in get_maps()) and
+    combine them on the ROMS grid, using d3 and d4 where we have them. Returns a dict:
+    fields = dict of the combined fields (None if we could not process d2)
+    error = the exception from processing d2, if any
+    notes = list of messages about missing d3 and d4 files or ones we could not process
+    nan_list = the variables that have nans in the combined fields
+    """
+    H = {'fields':None, 'error':None, 'notes':[], 'nan_list':[]}
+    ovi_dict = dict()
+    for dom in ['d2', 'd3', 'd4']:
+        fn = fn_dict[dom]
+        # if we are missing a d3 or d4 file then we don't work on it
+        if dom != 'd2' and not fn.is_file():
+            H['notes'].append(' - missing ' + str(fn))
+            continue
+        if dom not in maps.keys():
+            continue
+        m = maps[dom]
+        if dom == 'd2':
+            try:
+                # On 2022.06.07 one of the d2 files showed up with a time index of length 0
+                # (it should have been 1).  This is designed to respond to that specific error.
+                ov_dict = gather_and_process_fields(fn, m['imax'], m['ca'], m['sa'], outvar_list)
+            except Exception as e:
+                H['error'] = e
+                return H
+            ovi_dict[dom] = interp_to_roms(ov_dict, outvar_list, m['IM'], NR, NC)
+        else:
+            try:
+                ov_dict = gather_and_process_fields(fn, m['imax'], m['ca'], m['sa'], outvar_list)
+                ovi_dict[dom] = interp_to_roms(ov_dict, outvar_list, m['IM'], NR, NC)
+            except:
+                H['notes'].append(' - could not process ' + str(fn))
+    # combine the grids
+    H['fields'] = dict()
+    for ovn in outvar_list:
+        v = ovi_dict['d2'][ovn].copy()
+        for dom in ['d3', 'd4']:
+            if dom in ovi_dict.keys():
+                M = maps[dom]['M']
+                v[M] = ovi_dict[dom][ovn][M]
+        if np.sum(np.isnan(v)) > 0:
+            H['nan_list'].append(ovn)
+        H['fields'][ovn] = v
+    return H
+
+def do_hour(ii):
+    # for get_hours(): the arguments are inherited by the forked workers
+    fn_dict_list, maps, outvar_list, NR, NC = hour_args
+    return get_one_hour(fn_dict_list[ii], maps, outvar_list, NR, NC)
+
+def get_hours(fn_dict_list, maps, outvar_list, NR, NC, Nproc=10):
+    """
+    Process the hours with get_one_hour(), in parallel using Nproc workers. This is a
+    generator, returning the result for each hour in order. If you stop early
+    (e.g. to go to planB) the workers are stopped too.
+    """
+    global hour_args
+    hour_args = (fn_dict_list, maps, outvar_list, NR, NC)
+    with mp.get_context('fork').Pool(Nproc) as pool:
+        for H in pool.imap(do_hour, range(len(fn_dict_list))):
+            yield H
+
+def write_forcing(vn, A, ot_vec, out_fn):
+    """
+    Write the field A (time, eta_rho, xi_rho) of the variable vn, at times
+    ot_vec (seconds), to the forcing file out_fn.
+    """
+    out_fn.unlink(missing_ok=True)
+    ds = xr.Dataset()
+    vinfo = zrfun.get_varinfo(vn)
+    tname =  vinfo['time_name']
+    dims = (tname,) + vinfo['space_dims_tup']
+    ds[vn] = (dims, A)
+    ds[vn].attrs['units'] = vinfo['units']
+    ds[vn].attrs['long_name'] = vinfo['long_name']
+    # time coordinate
+    ds[tname] = ((tname,), ot_vec)
+    ds[tname].attrs['units'] = Lfun.roms_time_units
+    ds[tname].attrs['long_name'] = 'ocean time'
+    # and save to NetCDF
+    Enc_dict = {vn:zrfun.enc_dict for vn in ds.data_vars}
+    ds.to_netcdf(out_fn, encoding=Enc_dict)
+    ds.close()
+
+def Z_wmo_RH(P,T,Q):
+    # 5/21/2011 Nick Lederer, modified by Parker MacCready, and recoded
+    # from matlab to python by PM 2019.05.16.  Tested against the matlab version
+    # using Z_wmo_RH(1000, 10, .001) and both give 13.031628710406915.
+    #
+    #  this converts mixing ratio (kg kg-1) which is the usual WRF output [CHECK!], into
+    #  relative humidity (%) which is what ROMS expects
+    #
+    #  INPUT:
+    #  P in hectaPascal or millibar
+    #  T in Celcius
+    #  Q in kg kg-1
+    #
+    #  OUTPUT:
+    #  RH in percent
+    #
+    #  all equations come from Chapter 4 of
+    #  http://www.wmo.int/pages/prog/www/IMOP/publications/CIMO-Guide/
+    #  CIMO_Guide-7th_Edition-2008.html
+    #
+    #  WMO GUIDE TO METEOROLOGICAL INSTRUMENTS AND METHODS OF OBSERVATION
+    #           WMO-No. 8 (Seventh edition) (6 August 2008)
+    #
+    # Note 2019.05.15: this document no longer exists on the web.
+    e_prime = Q*P/(0.62198+Q) # WHO equation 4.A.6
+    fp = 1.0016 + 3.15e-6*P - 0.074/P # from Annex 4.B
+    ew = 6.112*np.exp(17.62*T/(243.12 + T)) # from Annex 4.B
+    ew_prime = fp*ew # from Annex 4.B
+    RH = 100 * e_prime/ew_prime # from Annex 4.B
+    return RH
@@ -0,0 +1,330 @@
+"""
+Functions for the carbonate chemistry of ROMS fields: in situ density, pH, and
+aragonite saturation state (ARAG).
+
+These give the same results as the PyCO2SYS call used in the plotting and post code:
+
+CO2SYS(alkalinity, TIC, 1, 2, salt, temp, temp, pres, pres, 50, 2, 1, 10, 1, NH3=0.0, H2S=0.0)
+
+(Total pH scale, K1 and K2 from Lueker et al. 2000, KSO4 from Dickson 1990, total
+borate from Uppstrom 1974, with alkalinity and TIC in umol/kg from the in situ
+density) but only the parts needed for pH and ARAG are evaluated, and the pH solver
+uses the analytic slope of the alkalinity equation. PyCO2SYS does much more for each
+point (e.g. buffer factors using autograd) so this is many times faster. The results
+are the same as from CO2SYS() to round-off error. (pfun.get_bot_top_arag() used to use
+pyco2.sys() with a slightly different gas constant, which changes ARAG by about 1e-6.)
+
+The parts that do not change with time, the pressure and absolute salinity anomaly
+ratio at the water points of a level, are made by get_static() and kept in memory,
+and then get_carbon() only works on the water points, in chunks.
+
+get_his_carbon() does this for the bottom or surface of a history file, optionally
+saving the results in a carbon_cache folder next to the history file.
+"""
+
+import numpy as np
+import xarray as xr
+import gsw
+import os
+import sys
+from pathlib import Path
+
+from lo_tools import ocn_functions as ocnfun
+
+# gas constant [ml bar-1 K-1 mol-1], the DOEv2 value used by CO2SYS()
+RGas = 83.1451
+# total phosphate and silicate [umol/kg], as in the CO2SYS call above
+TP = 2
+TSi = 50
+
+# caches, keyed by the signatures of the arrays used to make them
+static_cache = dict()
+
+def get_static(lon, lat, z, mask, key=None):
+    """
+    The parts of the carbon calculation that do not change with time, for a level
+    at z (m, negative down, e.g. -h for the bottom) on the grid lon, lat, at the
+    points where mask is 1 (water). Returns a dict with the flat index of these points
+    (iw), and lon, lat, pressure (pres, dbar) and the absolute salinity anomaly
+    ratio (saar) packed as vectors of these points.
+
+    Cached by key, or by the signature of the arrays.
+    """
+    if key is None:
+        key = ocnfun.get_sig(lon, lat, z, mask)
+    if key not in static_cache.keys():
+        C = dict()
+        C['shape'] = np.shape(lon)
+        z = z * np.ones(C['shape'])
+        iw = np.flatnonzero((mask == 1) & ~np.isnan(z))
+        C['iw'] = iw
+        C['lon'] = lon.flatten()[iw]
+        C['lat'] = lat.flatten()[iw]
+        C['pres'] = gsw.p_from_z(z.flatten()[iw], C['lat'])
+        C['saar'] = gsw.SAAR(C['pres'], C['lon'], C['lat'])
+        static_cache[key] = C
+    return static_cache[key]
+
+def get_carbon(C, v_dict, mask=None, chunk=100000):
+    """
+    Returns a dict of the in situ density (rho, kg m-3), PH, and ARAG fields for a
+    level with static parts C (from get_static), from the fields in v_dict: temp
+    (potential temperature, degC), salt (practical salinity), and alkalinity and
+    TIC (umol/L). These are nan on land, where the optional mask (e.g. a wetdry mask)
+    is 0, and (for PH and ARAG) where alkalinity or TIC is less than 100 umol/kg.
+
+    The water points are done in chunks of length chunk, to save memory.
+    """
+    iw = C['iw']
+    if mask is not None:
+        keep = mask.flatten()[iw] == 1
+    else:
+        keep = np.ones(len(iw), dtype=bool)
+    out_dict = dict()
+    for vn in ['rho', 'PH', 'ARAG']:
+        out_dict[vn] = np.nan * np.ones(len(iw))
+    for i0 in range(0, len(iw), chunk):
+        ii = np.arange(i0, min(i0 + chunk, len(iw)))
+        ii = ii[keep[ii]]
+        V = {vn: np.asarray(v_dict[vn], dtype=float).flatten()[iw[ii]]
+            for vn in ['temp', 'salt', 'alkalinity', 'TIC']}
+        pres = C['pres'][ii]
+        SA = (35.16504/35) * V['salt'] * (1 + C['saar'][ii])
+        CT = gsw.CT_from_pt(SA, V['temp'])
+        rho = gsw.rho(SA, CT, pres) # in situ density
+        temp = gsw.t_from_CT(SA, CT, pres) # in situ temperature
+        # convert from umol/L to umol/kg using in situ dentity
+        alk = 1000 * V['alkalinity'] / rho
+        tic = 1000 * V['TIC'] / rho
+        out_dict['rho'][ii] = rho
+        good = (alk >= 100) & (tic >= 100)
+        out_dict['PH'][ii[good]], out_dict['ARAG'][ii[good]] = get_ph_arag(alk[good],
+            tic[good], V['salt'][good], temp[good], pres[good])
+    for vn in out_dict.keys():
+        fld = np.nan * np.ones(C['shape'])
+        fld.flat[iw] = out_dict[vn]
+        out_dict[vn] = fld
+    return out_dict
+
+def get_ph_arag(alk, tic, salt, temp, pres):
+    """
+    pH (Total scale) and aragonite saturation state from vectors of alkalinity and
+    TIC (umol/kg), practical salinity, in situ temperature (degC), and pressure (dbar).
+    """
+    K = get_constants(salt, temp, pres)
+    TA = alk * 1e-6
+    TC = tic * 1e-6
+    H = solve_H(TA, TC, K)
+    CO3 = TC * K['K1'] * K['K2'] / (H**2 + K['K1'] * H + K['K1'] * K['K2'])
+    ph = -np.log10(H)
+    arag = CO3 * K['TCa'] / K['KAr']
+    return ph, arag
+
+def get_constants(salt, temp, pres):
+    """
+    The total concentrations (mol/kg) and equilibrium constants at pressure, with
+    the ones for H+ on the Total scale, except KSO4 and KF which are on the Free scale.
+    """
+    S = salt
+    TK = temp + 273.15
+    TC = temp
+    Pbar = pres / 10
+    lnTK = np.log(TK)
+    sqrS = np.sqrt(S)
+    K = dict()
+    # totals from salinity
+    K['TB'] = 0.0004157 * S / 35
+    K['TF'] = (0.000067 / 18.998) * S / 1.80655
+    K['TSO4'] = (0.14 / 96.062) * S / 1.80655
+    K['TCa'] = 0.02128 / 40.087 * S / 1.80655
+    K['TP'] = TP * 1e-6
+    K['TSi'] = TSi * 1e-6
+    IonS = 19.924 * S / (1000 - 1.005 * S)
+    # KSO4 (Dickson 1990) and KF (Dickson and Riley 1979) on the Free scale
+    KSO4 = np.exp(-4276.1 / TK + 141.328 - 23.093 * lnTK
+        + (-13856 / TK + 324.57 - 47.986 * lnTK) * np.sqrt(IonS)
+        + (35474 / TK - 771.54 + 114.723 * lnTK) * IonS
+        + (-2698 / TK) * np.sqrt(IonS) * IonS
+        + (1776 / TK) * IonS**2) * (1 - 0.001005 * S)
+    KF = np.exp(1590.2 / TK - 12.641 + 1.525 * IonS**0.5) * (1 - 0.001005 * S)
+    # SWS to Total at zero pressure, for the constants given on the Total scale
+    SWStoTOT0 = (1 + K['TSO4'] / KSO4) / (1 + K['TSO4'] / KSO4 + K['TF'] / KF)
+    KSO4 = KSO4 * pfac(-18.03 + 0.0466 * TC + 0.000316 * TC**2,
+        (-4.53 + 0.09 * TC) / 1000, Pbar, TK)
+    KF = KF * pfac(-9.78 - 0.009 * TC - 0.000942 * TC**2,
+        (-3.91 + 0.054 * TC) / 1000, Pbar, TK)
+    K['KSO4'] = KSO4
+    K['KF'] = KF
+    # SWS to Total at pressure, to put all the others on the Total scale
+    pHfactor = (1 + K['TSO4'] / KSO4) / (1 + K['TSO4'] / KSO4 + K['TF'] / KF)
+    # Free to Total, for the H+ terms in the alkalinity
+    K['FREEtoTOT'] = 1 + K['TSO4'] / KSO4
+    # KB (Dickson 1990)
+    lnKBtop = (-8966.9 - 2890.53 * sqrS - 77.942 * S + 1.728 * sqrS * S - 0.0996 * S**2)
+    KB = np.exp(lnKBtop / TK + 148.0248 + 137.1942 * sqrS + 1.62142 * S
+        + (-24.4344 - 25.085 * sqrS - 0.2474 * S) * lnTK + 0.053105 * sqrS * TK)
+    K['KB'] = KB / SWStoTOT0 * pfac(-29.48 + 0.1622 * TC - 0.002608 * TC**2,
+        -2.84 / 1000, Pbar, TK) * pHfactor
+    # KW (Millero 1995)
+    KW = np.exp(148.9802 - 13847.26 / TK - 23.6521 * lnTK
+        + (-5.977 + 118.67 / TK + 1.0495 * lnTK) * sqrS - 0.01615 * S)
+    K['KW'] = KW * pfac(-20.02 + 0.1119 * TC - 0.001409 * TC**2,
+        (-5.13 + 0.0794 * TC) / 1000, Pbar, TK) * pHfactor
+    # KP1, KP2, KP3 (Yao and Millero 1995)
+    KP1 = np.exp(-4576.752 / TK + 115.54 - 18.453 * lnTK
+        + (-106.736 / TK + 0.69171) * sqrS + (-0.65643 / TK - 0.01844) * S)
+    KP2 = np.exp(-8814.715 / TK + 172.1033 - 27.927 * lnTK
+        + (-160.34 / TK + 1.3566) * sqrS + (0.37335 / TK - 0.05778) * S)
+    KP3 = np.exp(-3070.75 / TK - 18.126
+        + (17.27039 / TK + 2.81197) * sqrS + (-44.99486 / TK - 0.09984) * S)
+    K['KP1'] = KP1 * pfac(-14.51 + 0.1211 * TC - 0.000321 * TC**2,
+        (-2.67 + 0.0427 * TC) / 1000, Pbar, TK) * pHfactor
+    K['KP2'] = KP2 * pfac(-23.12 + 0.1758 * TC - 0.002647 * TC**2,
+        (-5.15 + 0.09 * TC) / 1000, Pbar, TK) * pHfactor
+    K['KP3'] = KP3 * pfac(-26.57 + 0.202 * TC - 0.003042 * TC**2,
+        (-4.08 + 0.0714 * TC) / 1000, Pbar, TK) * pHfactor
+    # KSi (Yao and Millero 1995)
+    KSi = np.exp(-8904.2 / TK + 117.4 - 19.334 * lnTK
+        + (-458.79 / TK + 3.5913) * np.sqrt(IonS)
+        + (188.74 / TK - 1.5998) * IonS
+        + (-12.1652 / TK + 0.07871) * IonS**2) * (1 - 0.001005 * S)
+    K['KSi'] = KSi * pfac(-29.48 + 0.1622 * TC - 0.002608 * TC**2,
+        -2.84 / 1000, Pbar, TK) * pHfactor
+    # K1 and K2 (Lueker et al. 2000)
+    pK1 = (3633.86 / TK - 61.2172 + 9.6777 * lnTK - 0.011555 * S + 0.0001152 * S**2)
+    pK2 = (471.78 / TK + 25.929 - 3.16967 * lnTK - 0.01781 * S + 0.0001122 * S**2)
+    K['K1'] = 10.0**-pK1 / SWStoTOT0 * pfac(-25.5 + 0.1271 * TC,
+        (-3.08 + 0.0877 * TC) / 1000, Pbar, TK) * pHfactor
+    K['K2'] = 10.0**-pK2 / SWStoTOT0 * pfac(-15.82 - 0.0219 * TC,
+        (1.13 - 0.1475 * TC) / 1000, Pbar, TK) * pHfactor
+    # aragonite solubility (Mucci 1983, pressure correction from Millero 1979)
+    logKAr = (-171.945 - 0.077993 * TK + 2903.293 / TK + 71.595 * np.log10(TK)
+        + (-0.068393 + 0.0017276 * TK + 88.135 / TK) * sqrS
+        - 0.10018 * S + 0.0059415 * sqrS * S)
+    K['KAr'] = 10.0**logKAr * pfac(-48.76 + 0.5304 * TC + 2.8,
+        (-11.76 + 0.3692 * TC) / 1000, Pbar, TK)
+    return K
+
+def pfac(deltaV, Kappa, Pbar, TK):
+    # pressure correction factor for an equilibrium constant
+    return np.exp((-deltaV + 0.5 * Kappa * Pbar) * Pbar / (RGas * TK))
+
+def get_alk(H, TC, K):
+    """
+    Total alkalinity (mol/kg) and its derivative with respect to H, for TIC TC and
+    [H+] H (Total scale).
+    """
+    K1 = K['K1']; K2 = K['K2']
+    KP1 = K['KP1']; KP2 = K['KP2']; KP3 = K['KP3']
+    f = 1 / K['FREEtoTOT']
+    Hfree = H * f
+    D = H**2 + K1 * H + K1 * K2
+    E = H**3 + KP1 * H**2 + KP1 * KP2 * H + KP1 * KP2 * KP3
+    N = KP1 * KP2 * H + 2 * KP1 * KP2 * KP3 - H**3
+    alk = (TC * K1 * (H + 2 * K2) / D
+        + K['TB'] * K['KB'] / (K['KB'] + H)
+        + K['KW'] / H
+        + K['TP'] * N / E
+        + K['TSi'] * K['KSi'] / (K['KSi'] + H)
+        - Hfree
+        - K['TSO4'] * Hfree / (Hfree + K['KSO4'])
+        - K['TF'] * Hfree / (Hfree + K['KF']))
+    dalk = (TC * K1 * (D - (H + 2 * K2) * (2 * H + K1)) / D**2
+        - K['TB'] * K['KB'] / (K['KB'] + H)**2
+        - K['KW'] / H**2
+        + K['TP'] * ((KP1 * KP2 - 3 * H**2) * E
+            - N * (3 * H**2 + 2 * KP1 * H + KP1 * KP2)) / E**2
+        - K['TSi'] * K['KSi'] / (K['KSi'] + H)**2
+        - f
+        - f * K['TSO4'] * K['KSO4'] / (Hfree + K['KSO4'])**2
+        - f * K['TF'] * K['KF'] / (Hfree + K['KF'])**2)
+    return alk, dalk
+
+def solve_H(TA, TC, K, tol=1e-8):
+    """
+    Solve for [H+] (Total scale) from total alkalinity TA and TIC TC (mol/kg), using
+    Newton's method in pH from the initial guess of Munhoven (2013), like PyCO2SYS.
+    """
+    pH = get_initial_pH(TA, TC, K)
+    todo = np.ones(len(pH), dtype=bool)
+    while todo.any():
+        H = 10.0**-pH[todo]
+        Kt = {k: (v[todo] if np.ndim(v) > 0 else v) for k, v in K.items()}
+        alk, dalk = get_alk(H, TC[todo], Kt)
+        # d(alk)/d(pH) = -ln(10) H d(alk)/dH
+        dpH = (alk - TA[todo]) / (np.log(10) * H * dalk)
+        # limit big jumps
+        dpH = np.where(np.abs(dpH) > 1, np.sign(dpH), dpH)
+        pH[todo] = pH[todo] + dpH
+        # points that have converged, or gone bad, are done
+        done = ~(np.abs(dpH) >= tol)
+        ii = np.flatnonzero(todo)
+        todo[ii[done]] = False
+    return 10.0**-pH
+
+def get_initial_pH(TA, TC, K):
+    # initial pH for solve_H(), following section 3.2.2 of Munhoven (2013)
+    TB = K['TB']; K1 = K['K1']; K2 = K['K2']; KB = K['KB']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        c2 = KB * (1 - TB / TA) + K1 * (1 - TC / TA)
+        c1 = K1 * (KB * (1 - TB / TA - TC / TA) + K2 * (1 - 2 * TC / TA))
+        c0 = K1 * K2 * KB * (1 - (2 * TC + TB) / TA)
+        c21min = c2**2 - 3 * c1
+        c21min_positive = c21min > 0
+        sq21 = np.where(c21min_positive, np.sqrt(c21min), 0.0)
+        Hmin = np.where(c2 < 0, (sq21 - c2) / 3, -c1 / (c2 + sq21))
+        Hpoly = Hmin**3 + c2 * Hmin**2 + c1 * Hmin + c0
+        H0 = np.where(c21min_positive & (Hpoly < 0), Hmin + np.sqrt(-Hpoly / sq21), 1e-7)
+    H0 = np.where(np.isnan(H0), 1e-7, H0)
+    H0 = np.where(TA <= 0, 1e-3, np.where(TA >= 2 * TC + TB, 1e-10, H0))
+    return -np.log10(H0)
+
+def get_his_carbon(fn, nlev, G, jsl=slice(None), isl=slice(None), ds=None, cache=False):
+    """
+    Returns a dict of the rho, PH, and ARAG fields for the bottom (nlev = 0) or
+    surface (nlev = -1) of history file fn, with grid G (from zrfun.get_basic_info),
+    on the region G['lon_rho'][jsl, isl]. Pass ds if fn is already open.
+
+    With cache=True the results are saved in a carbon_cache folder next to fn, and
+    used again the next time, as long as fn has not been changed. There is no
+    wetdry masking here.
+    """
+    fn = Path(fn)
+    lon = G['lon_rho'][jsl, isl]
+    lat = G['lat_rho'][jsl, isl]
+    mask = G['mask_rho'][jsl, isl]
+    if nlev == 0:
+        z = -G['h'][jsl, isl]
+    elif nlev == -1:
+        z = 0 * G['h'][jsl, isl]
+    else:
+        print('get_his_carbon() error: nlev must be 0 or -1')
+        sys.exit()
+    key = ocnfun.get_sig(lon, lat, z, mask)
+    if cache:
+        st = fn.stat()
+        cache_dir = fn.parent / 'carbon_cache'
+        cache_fn = cache_dir / (fn.stem + '_' + str(nlev) + '_' + key[:12] + '.npz')
+        if cache_fn.is_file():
+            A = np.load(cache_fn)
+            if (A['mtime'] == st.st_mtime) and (A['size'] == st.st_size):
+                return {vn: A[vn] for vn in ['rho', 'PH', 'ARAG']}
+    C = get_static(lon, lat, z, mask, key=key)
+    if ds is None:
+        ds1 = xr.open_dataset(fn)
+    else:
+        ds1 = ds
+    v_dict = dict()
+    for vn in ['temp', 'salt', 'alkalinity', 'TIC']:
+        v_dict[vn] = ds1[vn][0,nlev,jsl,isl].values
+    if ds is None:
+        ds1.close()
+    out_dict = get_carbon(C, v_dict)
+    if cache:
+        cache_dir.mkdir(exist_ok=True)
+        # write to a temp file first so that a job running at the same time
+        # never reads a partial file
+        temp_fn = cache_dir / (cache_fn.stem + '_' + str(os.getpid()) + '.npz')
+        np.savez(temp_fn, mtime=st.st_mtime, size=st.st_size, **out_dict)
+        temp_fn.replace(cache_fn)
+    return out_dict
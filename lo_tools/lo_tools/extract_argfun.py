@@ -21,6 +21,9 @@ def intro():
     parser.add_argument('-source', type=str) # e.g. dfo
     parser.add_argument('-otype', type=str) # observation type, e.g. ctd, bottle, etc.
     parser.add_argument('-year', type=int) # e.g. 2019
+    parser.add_argument('-per_cast', type=Lfun.boolean_string, default=False) # also write one file per cast
+    # arguments used by extract/averages
+    parser.add_argument('-stats', type=Lfun.boolean_string, default=False) # also save variance, min, max
     # arguments used by extract/tef and tef2
     parser.add_argument('-sect_name', type=str, default='ai1')
     parser.add_argument('-get_bio', type=Lfun.boolean_string, default=False)
@@ -28,6 +31,7 @@ def intro():
     parser.add_argument('-ctag','--collection_tag', type=str)
     parser.add_argument('-riv', type=str) # e.g. riv00
     parser.add_argument('-his_num', type=int, default=2) # use 1 to start with ocean_his_0001.nc
+    parser.add_argument('-pool', type=Lfun.boolean_string, default=True) # use long-lived workers instead of subprocesses
     
     # get the args and put into Ldir
     args = parser.parse_args()
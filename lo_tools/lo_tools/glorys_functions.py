@@ -10,6 +10,7 @@ import numpy as np
 import sys
 
 from lo_tools import Lfun, zfun, zrfun
+from lo_tools import ocn_functions as ocnfun
 Ldir = Lfun.Lstart()
 
 # get Copernicus login credentials
@@ -186,12 +187,13 @@ def interpolate_glorys_to_roms(fng, vn, vng, gtag, zr, G, hollow=False, verbose=
         # since this is the slowest step you can turn it off for testing
         tt0 = time()
         # Next fill in remaining missing values using nearest neighbor.
-        from scipy.spatial import cKDTree
         z2,y2,x2 = np.meshgrid(zz,yy,xx, indexing='ij')
         mask2 = ~ np.isnan(data)
         Data = data[mask2].flatten()
         zyx2 = np.array((z2[mask2].flatten(),y2[mask2].flatten(),x2[mask2].flatten())).T
-        zyxT = cKDTree(zyx2)
+        # The tree only depends on the glorys grid and mask, so it is cached and
+        # shared by fields and days with the same mask (e.g. salt and temp).
+        zyxT = ocnfun.get_tree(zyx2, key=ocnfun.get_sig(zz, yy, xx, mask2))
         if verbose:
             print('- time to make tree = %0.1f sec' % (time()-tt0))
         tt0 = time()
@@ -241,12 +243,11 @@ def interpolate_glorys_to_roms_2d(fng, vn, vng, gtag, G, verbose=False, testing=
         # since this is the slowest step you can turn it off for testing
         tt0 = time()
         # Next fill in remaining missing values using nearest neighbor.
-        from scipy.spatial import cKDTree
         y2,x2 = np.meshgrid(yy,xx, indexing='ij')
         mask2 = ~ np.isnan(data)
         Data = data[mask2].flatten()
         yx2 = np.array((y2[mask2].flatten(),x2[mask2].flatten())).T
-        yxT = cKDTree(yx2)
+        yxT = ocnfun.get_tree(yx2, key=ocnfun.get_sig(yy, xx, mask2))
         if verbose:
             print('- time to make tree = %0.1f sec' % (time()-tt0))
         tt0 = time()
@@ -0,0 +1,138 @@
+"""
+Functions for making horizontal layers at fixed z from ROMS fields, used by the
+post/layers* jobs.
+
+The vertical interpolation to a given z is a two-point stencil in each water column:
+the indices of the s_rho levels just below and above z, and the fraction of the way
+between them. These "weights" only depend on z_rho, so we make them once (e.g. for each
+day, from the daily mean zeta) and then the layers of every field at every time are a
+vectorized gather. The result is the same as pfun.get_laym() given the same zfull.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4 as nc
+
+from lo_tools import zrfun
+
+def get_zfull(h, zeta, S, which_grid='rho'):
+    """
+    Like pfun.get_zfull() but for any zeta: z on the s_rho levels with the bottom (-h)
+    and the free surface (zeta) added, on the rho, u, or v grid.
+    """
+    z_rho = zrfun.get_z(h, zeta, S, only_rho=True, cache=True)
+    zfull = np.concatenate((-h[None,:,:], z_rho, zeta[None,:,:]), axis=0)
+    if which_grid == 'u':
+        zfull = zfull[:, :, 0:-1] + np.diff(zfull, axis=2)/2
+    elif which_grid == 'v':
+        zfull = zfull[:, 0:-1, :] + np.diff(zfull, axis=1)/2
+    return zfull
+
+def get_weights(zfull, z_list, mask=None):
+    """
+    Make the interpolation weights for the layers at the z values in z_list (m,
+    positive up), using zfull from get_zfull(). Returns a dict with the s_rho level
+    indices i0 and i1 and the fraction fr, each packed as (len(z_list), M, L). fr is
+    nan where the layer is not defined (z below the bottom or above the free
+    surface) and where mask == 0.
+    """
+    N = zfull.shape[0] - 2 # number of s_rho levels
+    W = {'i0':[], 'i1':[], 'fr':[]}
+    for z in z_list:
+        # index in zfull of the first level above z (see pfun.get_layer())
+        ind1 = np.argmax(zfull > z, axis=0)[None,:,:]
+        ind0 = ind1 - 1
+        ind0[ind0<0] = 0
+        z1 = np.take_along_axis(zfull, ind1, axis=0)
+        z0 = np.take_along_axis(zfull, ind0, axis=0)
+        dz = z1 - z0
+        dz[dz == 0] = np.nan # mask bad points
+        fr = (z - z0) / dz
+        if mask is not None:
+            fr[:, mask == 0] = np.nan
+        # Convert to indices on the s_rho levels: the bottom and top of zfull
+        # carry the values of the bottom and top s_rho levels (see pfun.make_full()).
+        W['i0'].append(np.clip(ind0 - 1, 0, N-1))
+        W['i1'].append(np.clip(ind1 - 1, 0, N-1))
+        W['fr'].append(fr)
+    for k in W.keys():
+        W[k] = np.concatenate(W[k], axis=0)
+    return W
+
+def get_layers(fld, W):
+    """
+    Apply the weights W from get_weights() to the field fld (N, M, L), returning
+    the layers (len(z_list), M, L).
+    """
+    fld0 = np.take_along_axis(fld, W['i0'], axis=0)
+    fld1 = np.take_along_axis(fld, W['i1'], axis=0)
+    return fld0*(1 - W['fr']) + fld1*W['fr']
+
+def get_daily_zeta(fn_list):
+    """
+    Read zeta from the files in fn_list, and return:
+    zeta_dict = the mean zeta for each day (keyed by the date of ocean_time)
+    day_list = the day of each file, to use as a key to zeta_dict
+    """
+    zeta_dict = dict()
+    count_dict = dict()
+    day_list = []
+    for fn in fn_list:
+        ds = xr.open_dataset(fn)
+        day = pd.Timestamp(ds.ocean_time.values[0]).strftime('%Y.%m.%d')
+        zeta = ds.zeta[0,:,:].values.astype(float)
+        ds.close()
+        if day in zeta_dict.keys():
+            zeta_dict[day] += zeta
+            count_dict[day] += 1
+        else:
+            zeta_dict[day] = zeta
+            count_dict[day] = 1
+        day_list.append(day)
+    for day in zeta_dict.keys():
+        zeta_dict[day] /= count_dict[day]
+    return zeta_dict, day_list
+
+class LayersFile:
+    """
+    Writes a NetCDF file one time at a time, with an unlimited ocean_time dimension,
+    compressed and chunked by time. Use add_static() and add_var() to define the
+    fields, and then write() for each time.
+    """
+    def __init__(self, out_fn, time_units):
+        out_fn.unlink(missing_ok=True)
+        self.ds = nc.Dataset(out_fn, 'w')
+        self.ds.createDimension('ocean_time', None)
+        vv = self.ds.createVariable('ocean_time', float, ('ocean_time',))
+        vv.units = time_units
+        self.nt = 0
+
+    def add_dims(self, dims, shape):
+        for dim, n in zip(dims, shape):
+            if dim not in self.ds.dimensions:
+                self.ds.createDimension(dim, n)
+
+    def add_static(self, vn, dims, a, attrs=dict()):
+        # a field without ocean_time, e.g. lon_rho
+        self.add_dims(dims, a.shape)
+        vv = self.ds.createVariable(vn, a.dtype, dims)
+        vv[:] = a
+        vv.setncatts(attrs)
+
+    def add_var(self, vn, dims, attrs=dict(), dtype=float):
+        # a field that will be written by write(), where dims do not include ocean_time
+        chunksizes = (1,) + tuple([len(self.ds.dimensions[dim]) for dim in dims])
+        vv = self.ds.createVariable(vn, dtype, ('ocean_time',) + dims,
+            zlib=True, complevel=1, fill_value=1e20, chunksizes=chunksizes)
+        vv.setncatts(attrs)
+
+    def write(self, ot, v_dict):
+        # ot = ocean_time (in time_units), and v_dict has the fields for this time
+        self.ds['ocean_time'][self.nt] = ot
+        for vn in v_dict.keys():
+            self.ds[vn][self.nt] = np.ma.masked_invalid(v_dict[vn])
+        self.nt += 1
+
+    def close(self):
+        self.ds.close()
@@ -0,0 +1,183 @@
+"""
+Functions for the ocn forcing (forcing/ocn00-04 and ocnG00-01) that fill and
+interpolate the HYCOM or GLORYS fields onto the ROMS grid.
+
+The slow parts of this are finding nearest neighbors with cKDTree, and the mask
+of the source fields (and hence the neighbors) is the same for most levels,
+variables, and days. So here we cache the index maps that the trees produce:
+- the fill indices for a mask, keyed by the mask itself (its "signature")
+- the horizontal and vertical interpolation indices for a source grid and a
+ROMS grid
+and then filling or interpolating a field is just a numpy gather, done for all
+levels of a field at once. The results are identical to the original per-level
+code in Ofun.py.
+
+For GLORYS (glorys_functions.py) the points to fill move with zeta, so there we
+just cache the tree made from the unmasked GLORYS points with get_tree().
+
+The caches live for the life of the process, which is one forcing run.
+"""
+
+import numpy as np
+from hashlib import sha1
+from scipy.spatial import cKDTree
+
+from lo_tools import zrfun
+
+# caches, keyed by the signatures of the arrays used to make them
+fill_cache = dict()
+interp_cache = dict()
+tree_cache = dict()
+
+def get_sig(*a_list):
+    """
+    A signature for a list of arrays, used as a key for the caches.
+    """
+    s = sha1()
+    for a in a_list:
+        a = np.ascontiguousarray(np.ma.getdata(a))
+        s.update(str((a.dtype, a.shape)).encode())
+        s.update(a.tobytes())
+    return s.hexdigest()
+
+def get_tree(xy, key=None):
+    """
+    A cKDTree for the points xy (n, ndim), cached so that fields with
+    the same mask share one tree. Pass a key (e.g. the signature of the
+    grid and mask that xy came from) to skip making the signature of xy.
+    """
+    if key is None:
+        key = get_sig(xy)
+    if key not in tree_cache.keys():
+        tree_cache[key] = cKDTree(xy)
+    return tree_cache[key]
+
+def checknan(fld):
+    """
+    A utility function that issues a warning if there are nans in fld.
+    """
+    if np.isnan(fld).sum() > 0:
+        print('WARNING: nans in data field')
+
+def get_mask(fld):
+    # mask of the missing values in fld: masked or nan
+    return np.ma.getmaskarray(fld) | np.isnan(np.ma.getdata(fld))
+
+def get_fill_inds(X, Y, mask):
+    """
+    Get the index map to fill the masked points of a 2D field on the grid X, Y,
+    or of each level of a 3D field (levels, M, L), with their nearest unmasked
+    neighbor in the same level. Returns (inew, iorig, iall), flat indices of the
+    masked points, of the points to copy into them, and of the points in levels
+    that are all masked. Cached by the signature of X, Y, and mask.
+    """
+    key = (get_sig(X, Y), get_sig(mask))
+    if key not in fill_cache.keys():
+        if mask.ndim == 2:
+            inew = np.flatnonzero(mask)
+            iorig = np.array([], dtype=int)
+            iall = np.array([], dtype=int)
+            if mask.all():
+                iall = inew
+                inew = np.array([], dtype=int)
+            elif mask.any():
+                xyorig = np.array((X[~mask],Y[~mask])).T
+                xynew = np.array((X[mask],Y[mask])).T
+                aa = cKDTree(xyorig).query(xynew)[1]
+                iorig = np.flatnonzero(~mask)[aa]
+        else:
+            # combine the maps for each level, which are cached too
+            nxy = X.size
+            I = {'inew':[], 'iorig':[], 'iall':[]}
+            for k in range(mask.shape[0]):
+                for kk, ind in zip(I.keys(), get_fill_inds(X, Y, mask[k,:,:])):
+                    I[kk].append(ind + k*nxy)
+            inew, iorig, iall = [np.concatenate(I[kk]) for kk in I.keys()]
+        fill_cache[key] = (inew, iorig, iall)
+    return fill_cache[key]
+
+def extrap_nearest_to_masked(X, Y, fld, fld0=0):
+    """
+    INPUT: fld is a 2D or 3D (levels, M, L) array (np.ndarray or
+    np.ma.MaskedArray) on spatial grid X, Y, with masked or nan values missing.
+    OUTPUT: a numpy array of the same size with no mask and no missing values.
+    In each level:
+        * If it is ALL missing then fill with fld0.
+        * If it is PARTLY missing use nearest neighbor interpolation to
+        fill missing values.
+        * If nothing is missing then return the data.
+    """
+    inew, iorig, iall = get_fill_inds(X, Y, get_mask(fld))
+    fldd = np.ma.getdata(fld).astype(float)
+    ff = fldd.reshape(-1) # a view of fldd
+    ff[inew] = ff[iorig]
+    ff[iall] = fld0
+    checknan(fldd)
+    return fldd
+
+def get_zinds(h, S, z):
+    """
+    Precalculate the array of indices to go from HYCOM z to ROMS z.
+    This just finds the vertical index in HYCOM z for each ROMS z_rho
+    value in the whole 3D array, with the index being the UPPER one of
+    the two HYCOM z indices that any ROMS z falls between, and is flattened
+    to use with get_interpolated(). ROMS z above or below the range of HYCOM
+    z get the index of the nearest end.
+    """
+    zr = zrfun.get_z(h, 0*h, S, only_rho=True)
+    z = np.ma.getdata(z)
+    zinds = np.searchsorted(z, zr.flatten(), side='left')
+    zinds[zinds > len(z)-1] = len(z) - 1
+    return zinds
+
+def get_interp_inds(G, lon, lat, zinds):
+    """
+    Get the flat indices that do the horizontal (nearest neighbor) and vertical
+    (from zinds) interpolation from the HYCOM grid lon, lat to the
+    ROMS rho grid. Cached by the signature of the grids and zinds.
+    """
+    lon = np.ma.getdata(lon)
+    lat = np.ma.getdata(lat)
+    key = get_sig(lon, lat, G['lon_rho'], G['lat_rho'], zinds)
+    if key not in interp_cache.keys():
+        Lon, Lat = np.meshgrid(lon,lat)
+        XYin = np.array((Lon.flatten(), Lat.flatten())).T
+        XYr = np.array((G['lon_rho'].flatten(), G['lat_rho'].flatten())).T
+        IMr = cKDTree(XYin).query(XYr)[1]
+        # index into a HYCOM 3D field flattened over (N, M, L)
+        NR = G['lon_rho'].size
+        IM3 = zinds.reshape((-1, NR)) * Lon.size + IMr.reshape((1, NR))
+        interp_cache[key] = (IMr, IM3)
+    return interp_cache[key]
+
+def get_interpolated(G, S, b, lon, lat, z, N, zinds):
+    """
+    This does the horizontal and vertical interpolation to get from
+    extrapolated, filtered HYCOM fields to ROMS fields.
+
+    We use fast nearest neighbor interpolation as much as possible.
+    Also we interpolate everything to the ROMS rho grid, and then crudely
+    interpolate to the u and v grids at the last moment.  Much simpler.
+    """
+    c = {}
+    h = G['h']
+    IMr, IM3 = get_interp_inds(G, lon, lat, zinds)
+    # 2D fields
+    for vn in ['ssh', 'ubar', 'vbar']:
+        vv = b[vn].flatten()[IMr].reshape(h.shape)
+        if vn == 'ubar':
+            vv = (vv[:,:-1] + vv[:,1:])/2
+        elif vn == 'vbar':
+            vv = (vv[:-1,:] + vv[1:,:])/2
+        c[vn] = vv
+        checknan(vv)
+    # 3D fields
+    for vn in ['theta', 's3d', 'u3d', 'v3d']:
+        vv = b[vn].flatten()[IM3].reshape((S['N'], G['M'], G['L']))
+        if vn == 'u3d':
+            vv = (vv[:,:,:-1] + vv[:,:,1:])/2
+        elif vn == 'v3d':
+            vv = (vv[:,:-1,:] + vv[:,1:,:])/2
+        checknan(vv)
+        c[vn] = vv
+    return c
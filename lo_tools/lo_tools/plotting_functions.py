@@ -35,17 +35,19 @@ month_color_dict = dict(zip(range(1,13),
     'lightsalmon', 'mediumorchid', 'slateblue', 'purple']))
 bbox = dict(facecolor='w', edgecolor='None',alpha=.5)
 
-def get_bot_top_arag(fn, aa=[]):
+def get_bot_top_arag(fn, aa=[], cache=False):
     """
     Returns bottom and top Aragonite Saturation State fields for a given history file.
     
     You can also provide an optional list of axis limits, "aa".
     
     It also returns plon and plat for pcolormesh plotting.
+    
+    The carbonate chemistry is done by lo_tools/carbon_functions.py, which can also
+    save the results next to the history file (cache=True) to use again.
     """
     import xarray as xr
-    from PyCO2SYS import CO2SYS
-    import gsw
+    from lo_tools import carbon_functions as carbfun
     G = zrfun.get_basic_info(fn, only_G=True)
     ds = xr.open_dataset(fn)
     if len(aa) == 4:
@@ -63,40 +65,11 @@ def get_bot_top_arag(fn, aa=[]):
         j0 = 0; j1 = nrows
     lon = G['lon_rho'][j0:j1,i0:i1]
     lat = G['lat_rho'][j0:j1,i0:i1]
-    hh = G['h'][j0:j1,i0:i1]
     px, py = get_plon_plat(lon, lat)
-    v_dict = dict()
-    vn_in_list = ['temp', 'salt', 'alkalinity', 'TIC']
     for nlev in [0,-1]:
-        if nlev == 0:
-            zz = -hh
-        elif nlev == -1:
-            zz = 0 * hh
-        for cvn in vn_in_list:
-            v_dict[cvn] = ds[cvn][0,nlev,j0:j1,i0:i1].values.squeeze()
-            # # debugging
-            # print('%s %s' % (cvn, str(v_dict[cvn].shape)))
-            # sys.stdout.flush()
-        pres = gsw.p_from_z(zz, lat) # pressure [dbar]
-        SA = gsw.SA_from_SP(v_dict['salt'], pres, lon, lat)
-        CT = gsw.CT_from_pt(SA, v_dict['temp'])
-        rho = gsw.rho(SA, CT, pres) # in situ density
-        temp = gsw.t_from_CT(SA, CT, pres) # in situ temperature
-        # convert from umol/L to umol/kg using in situ dentity
-        alkalinity = 1000 * v_dict['alkalinity'] / rho
-        alkalinity[alkalinity < 100] = np.nan
-        TIC = 1000 * v_dict['TIC'] / rho
-        TIC[TIC < 100] = np.nan
-        # See LPM/co2sys_test/test0.py for info.
-        import PyCO2SYS as pyco2
-        CO2dict = pyco2.sys(par1=alkalinity, par2=TIC, par1_type=1, par2_type=2,
-            salinity=v_dict['salt'], temperature=temp, pressure=pres,
-            total_silicate=50, total_phosphate=2,
-            opt_pH_scale=1, opt_k_carbonic=10, opt_k_bisulfate=1)
-        ph = CO2dict['pH']
-        arag = CO2dict['saturation_aragonite']
-        ph = ph.reshape(pres.shape)
-        arag = arag.reshape(pres.shape)
+        C = carbfun.get_his_carbon(fn, nlev, G, jsl=slice(j0,j1), isl=slice(i0,i1),
+            ds=ds, cache=cache)
+        arag = C['ARAG']
         # account for WET_DRY
         if 'wetdry_mask_rho' in ds.data_vars:
             mwd = ds.wetdry_mask_rho[0,j0:j1,i0:i1].values.squeeze()
@@ -105,6 +78,7 @@ def get_bot_top_arag(fn, aa=[]):
             arag_bot = arag
         elif nlev == -1:
             arag_top = arag
+    ds.close()
     return arag_bot, arag_top, px, py
 
 def start_plot(fs=14, figsize=(14,10)):
@@ -368,7 +342,7 @@ def get_zfull(ds, fn, which_grid):
     # get zfull field on "which_grid" ('rho', 'u', or 'v')
     G, S, T = zrfun.get_basic_info(fn)
     zeta = 0 * G['h']
-    zr_mid = zrfun.get_z(G['h'], zeta, S, only_rho=True)
+    zr_mid = zrfun.get_z(G['h'], zeta, S, only_rho=True, cache=True)
     zr_bot = -G['h'].reshape(1, G['M'], G['L']).copy()
     zr_top = zeta.reshape(1, G['M'], G['L']).copy()
     zfull0 = make_full((zr_bot, zr_mid, zr_top))
@@ -621,7 +595,7 @@ def get_sect(fn, vn, x_e, y_e):
     zeta[mask==0] = 0
 
     # get zw field, used for cell edges.
-    zw = zrfun.get_z(h, zeta, S, only_w=True)
+    zw = zrfun.get_z(h, zeta, S, only_w=True, cache=True)
     N = zw.shape[0]
 
     # Get 3-D field that we will full the section from
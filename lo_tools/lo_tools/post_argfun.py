@@ -20,6 +20,8 @@ def intro():
     parser.add_argument('-job', default='', type=str) # e.g. surface0
     parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_string)
     parser.add_argument('-Nproc', type=int, default=10) # number of subprocesses to use
+    # layers jobs: make the layer weights for each time from its zeta, instead of daily
+    parser.add_argument('-exact_z', default=False, type=Lfun.boolean_string)
     # get the args and put into Ldir
     args = parser.parse_args()
     argsd = args.__dict__
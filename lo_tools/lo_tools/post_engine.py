@@ -0,0 +1,359 @@
+"""
+An engine for post-processing jobs that reads each history file only once.
+
+In the original system driver_post1.py runs each post/[job]/post_main.py as its own
+process, and each job re-opens the same forecast history files, often to get the
+same fields. Here the main process reads each history file once, putting the
+fields into a ring of shared-memory slots, and hands each slot to every job that
+wants that time. Each job (a "consumer") runs in its own forked process, so the
+jobs work in parallel with each other and with the reading, and the total time is
+roughly that of one pass through the history files plus the slowest job.
+
+A job takes part by having a consumer.py in its post/[job] folder (or in
+LO_user/post/[job], which is looked at first) with a function:
+
+get_consumer(Ldir, fn_list)
+
+that returns an instance of a subclass of Consumer, or None to run post_main.py
+as usual. Jobs that have no consumer.py are unchanged.
+
+The consumer writes its output and Info/results.txt just as post_main.py would, so
+the driver bookkeeping is the same. Its screen output goes to Info/screen_output.txt,
+and any error traceback to Info/subprocess_error.txt.
+
+Used by driver_post1.py -engine True. See BoxConsumer below for an example.
+"""
+
+import sys
+import traceback
+import queue
+import multiprocessing as mp
+from datetime import datetime
+import numpy as np
+import xarray as xr
+
+from lo_tools import Lfun, zfun, zrfun, post_argfun
+
+class Consumer:
+    """
+    Base class for a post-processing job that gets its fields from run().
+
+    Subclasses set self.vn_list (the time-varying fields from the history files
+    that they need) in __init__(), which is called in the main process, and
+    override use() and finish(), which are called in the job's own process.
+    The defaults do nothing and return 'success'.
+
+    They may also set self.isel_dict, the part of each field they need, as used by
+    Dataset.isel(), e.g. {'s_rho': slice(29,30), 'eta_rho': slice(100,200), ...}.
+    Use slices, so that the dimensions are kept. Only that part of each field
+    is read and passed to use(). The default is the whole field.
+    """
+    def __init__(self, Ldir):
+        self.Ldir = Ldir # Ldir for this job, as made by post_argfun.intro()
+        self.vn_list = []
+        self.isel_dict = dict()
+        self.note = ''
+        self.out_dir = (Ldir['LOo'] / 'post' / Ldir['gtagex'] /
+            ('f' + Ldir['date_string']) / Ldir['job'])
+
+    def want(self, ii):
+        # True if the job uses fn_list[ii]
+        return True
+
+    def setup(self, fn_list):
+        # Called once before the first use(), e.g. to read grid info.
+        pass
+
+    def use(self, ii, F):
+        # F is a dict of the fields in self.vn_list, plus ocean_time, from fn_list[ii].
+        # Each array has the shape it has in the history file (including the
+        # ocean_time dimension of length 1), cut down by self.isel_dict. They are
+        # read-only and are only valid during this call, so copy anything you want to keep.
+        pass
+
+    def finish(self):
+        # Write the output and return 'success' or 'fail'. Set self.note
+        # to add a note to results.txt.
+        return 'success'
+
+def get_consumer(Ldir, fn_list):
+    """
+    Returns the consumer for Ldir['job'], or None if the job has no consumer.py,
+    looking first in LO_user.
+    """
+    c_fn = Ldir['LOu'] / 'post' / Ldir['job'] / 'consumer.py'
+    if not c_fn.is_file():
+        c_fn = Ldir['LO'] / 'post' / Ldir['job'] / 'consumer.py'
+    if not c_fn.is_file():
+        return None
+    cmod = Lfun.module_from_file('consumer_' + Ldir['job'], c_fn)
+    # register the module so that its functions can be used with a Pool
+    sys.modules[cmod.__name__] = cmod
+    return cmod.get_consumer(Ldir, fn_list)
+
+def _consumer_main(c, k, fn_list, bufs, in_q, done_q):
+    # This runs in the forked process for consumer c (number k in the list).
+    Info_dir = c.out_dir / 'Info'
+    sys.stdout = open(Info_dir / 'screen_output.txt', 'w')
+    for vn in bufs.keys():
+        # only the reader writes to the shared memory
+        bufs[vn] = bufs[vn].view()
+        bufs[vn].setflags(write=False)
+    result_dict = dict()
+    result_dict['start_dt'] = datetime.now()
+    ok = True
+    def error():
+        with open(Info_dir / 'subprocess_error.txt', 'a') as ffout:
+            ffout.write(traceback.format_exc())
+        return False
+    try:
+        c.setup(fn_list)
+    except Exception:
+        ok = error()
+    while True:
+        msg = in_q.get()
+        if msg is None:
+            break
+        ii, slot = msg
+        if ok:
+            # after an error we keep taking messages, so the reader never waits for us
+            try:
+                c.use(ii, {vn: bufs[vn][slot] for vn in c.vn_list + ['ocean_time']})
+            except Exception:
+                ok = error()
+        done_q.put((k, slot))
+    result_dict['result'] = 'fail'
+    if ok:
+        try:
+            result_dict['result'] = c.finish()
+        except Exception:
+            error()
+    if len(c.note) > 0:
+        result_dict['note'] = c.note
+    result_dict['end_dt'] = datetime.now()
+    post_argfun.finale(c.Ldir, result_dict)
+    sys.stdout.flush()
+
+def run(fn_list, c_list, nslot=3):
+    """
+    Read each file in fn_list once and hand the fields to all the consumers in
+    c_list that want them. nslot is the number of times held in shared memory,
+    which sets how far the reading can get ahead of the slowest consumer.
+    """
+    ctx = mp.get_context('fork') # fork so the consumers inherit the shared memory
+    # Consumers with the same isel_dict share a "window" of the fields.
+    win_list = []
+    c_win = [] # the window of each consumer
+    for c in c_list:
+        if c.isel_dict not in win_list:
+            win_list.append(c.isel_dict)
+        c_win.append(win_list.index(c.isel_dict))
+    # make the ring of shared-memory slots for each field and window, using
+    # the first file to get the shape and type
+    bufs = dict()
+    ds = xr.open_dataset(fn_list[0])
+    for k, c in enumerate(c_list):
+        w = c_win[k]
+        for vn in ['ocean_time'] + c.vn_list:
+            if (vn, w) in bufs.keys():
+                continue
+            shape = ds[vn].isel(win_list[w], missing_dims='ignore').shape
+            dtype = ds[vn].dtype
+            A = ctx.RawArray('b', int(nslot * np.prod(shape) * dtype.itemsize))
+            bufs[(vn, w)] = np.frombuffer(A, dtype=dtype).reshape((nslot,) + shape)
+    ds.close()
+
+    # start the consumers
+    done_q = ctx.Queue()
+    q_list = []
+    p_list = []
+    for k, c in enumerate(c_list):
+        in_q = ctx.Queue()
+        c_bufs = {vn: bufs[(vn, c_win[k])] for vn in ['ocean_time'] + c.vn_list}
+        p = ctx.Process(target=_consumer_main, args=(c, k, fn_list, c_bufs, in_q, done_q))
+        p.start()
+        q_list.append(in_q)
+        p_list.append(p)
+
+    # read the files
+    users = [[] for slot in range(nslot)] # consumers that still have each slot
+    def wait_for(slot):
+        while len(users[slot]) > 0:
+            try:
+                k, s = done_q.get(timeout=60)
+                users[s].remove(k)
+            except queue.Empty:
+                # check for consumers that died without releasing their slots
+                for k, p in enumerate(p_list):
+                    if not p.is_alive():
+                        for s in range(nslot):
+                            if k in users[s]:
+                                users[s].remove(k)
+    try:
+        for ii, fn in enumerate(fn_list):
+            slot = ii % nslot
+            wait_for(slot)
+            k_list = [k for k, c in enumerate(c_list) if c.want(ii) and p_list[k].is_alive()]
+            if len(k_list) == 0:
+                continue
+            # only read the fields and windows wanted at this time
+            vw_list = []
+            for k in k_list:
+                vw_list += [(vn, c_win[k]) for vn in ['ocean_time'] + c_list[k].vn_list
+                    if (vn, c_win[k]) not in vw_list]
+            ds = xr.open_dataset(fn)
+            for vn in set([vn for vn, w in vw_list]):
+                w_list = [w for vv, w in vw_list if vv == vn]
+                if any([len(win_list[w]) == 0 for w in w_list]):
+                    # read the whole field once, and cut the other windows from it
+                    a = ds[vn].values
+                    for w in w_list:
+                        bufs[(vn, w)][slot] = a[tuple([win_list[w].get(dim, slice(None))
+                            for dim in ds[vn].dims])]
+                else:
+                    for w in w_list:
+                        bufs[(vn, w)][slot] = ds[vn].isel(win_list[w], missing_dims='ignore').values
+            ds.close()
+            users[slot] = k_list
+            for k in k_list:
+                q_list[k].put((ii, slot))
+    except Exception:
+        # Stop the consumers so they do not write results for a partial job.
+        for p in p_list:
+            p.terminate()
+        raise
+
+    # tell the consumers we are done, and wait for them to finish
+    for in_q in q_list:
+        in_q.put(None)
+    for p in p_list:
+        p.join()
+
+class BoxConsumer(Consumer):
+    """
+    Makes the same file as extract/box/extract_box.py, for a box job defined in
+    extract/box/job_definitions.py (with the usual LO_user hook), and saves it
+    as [share_name].nc in the job output directory.
+    """
+    def __init__(self, Ldir, fn_list, box_job, share_name,
+            surf=False, bot=False, uv_to_rho=False):
+        super().__init__(Ldir)
+        self.share_name = share_name
+        self.surf = surf
+        self.bot = bot
+        self.uv_to_rho = uv_to_rho
+        G, S, T = zrfun.get_basic_info(fn_list[0])
+        self.S = S
+        Lon = G['lon_rho'][0,:]
+        Lat = G['lat_rho'][:,0]
+        pth = Ldir['LO'] / 'extract' / 'box'
+        upth = Ldir['LOu'] / 'extract' / 'box'
+        if (upth / 'job_definitions.py').is_file():
+            job_definitions = Lfun.module_from_file('job_definitions', upth / 'job_definitions.py')
+        else:
+            job_definitions = Lfun.module_from_file('job_definitions', pth / 'job_definitions.py')
+        aa, vn_list = job_definitions.get_box(box_job, Lon, Lat)
+        lon0, lon1, lat0, lat1 = aa
+        for lon, lat in [(lon0, lat0), (lon1, lat1)]:
+            if (lon < Lon[0]) or (lon > Lon[-1]) or (lat < Lat[0]) or (lat > Lat[-1]):
+                raise ValueError('box ' + box_job + ' is out of bounds')
+        ilon0 = zfun.find_nearest_ind(Lon, lon0)
+        ilat0 = zfun.find_nearest_ind(Lat, lat0)
+        ilon1 = zfun.find_nearest_ind(Lon, lon1)
+        ilat1 = zfun.find_nearest_ind(Lat, lat1)
+        # the index window, matching the ncks calls in extract_box.py
+        self.isel_dict = {'xi_rho':slice(ilon0, ilon1+1), 'eta_rho':slice(ilat0, ilat1+1),
+            'xi_u':slice(ilon0, ilon1), 'eta_u':slice(ilat0, ilat1+1),
+            'xi_v':slice(ilon0, ilon1+1), 'eta_v':slice(ilat0, ilat1)}
+        if surf:
+            self.isel_dict['s_rho'] = slice(S['N']-1, S['N'])
+        elif bot:
+            self.isel_dict['s_rho'] = slice(0, 1)
+        # the time-varying fields come from the engine, and the rest
+        # from the first history file
+        ds = xr.open_dataset(fn_list[0])
+        vn_List = [vn for vn in vn_list.split(',') if vn in ds.data_vars]
+        self.vn_list = [vn for vn in vn_List if 'ocean_time' in ds[vn].dims]
+        self.static_list = [vn for vn in vn_List if vn not in self.vn_list]
+        ds.close()
+
+    def setup(self, fn_list):
+        ds = xr.open_dataset(fn_list[0])
+        self.dims = {vn: ds[vn].dims for vn in self.vn_list}
+        self.attrs = {vn: ds[vn].attrs for vn in ds.data_vars}
+        self.coords = ds[self.vn_list].reset_coords().drop_vars(self.vn_list + ['ocean_time'])
+        self.coords = self.coords.isel(self.isel_dict, missing_dims='ignore').load()
+        self.static = ds[self.static_list].isel(self.isel_dict, missing_dims='ignore').load()
+        ds.close()
+        self.ds_list = []
+
+    def use(self, ii, F):
+        # (the engine has already cut the fields down to self.isel_dict)
+        dsi = xr.Dataset({vn: (self.dims[vn], F[vn]) for vn in self.vn_list},
+            coords={'ocean_time': F['ocean_time']})
+        # (copy so that we are not holding on to the shared memory)
+        self.ds_list.append(dsi.copy(deep=True))
+
+    def finish(self):
+        S = self.S
+        ds = xr.concat(self.ds_list, dim='ocean_time')
+        self.ds_list = []
+        ds = xr.merge([ds, self.static, self.coords.set_coords(list(self.coords.data_vars))],
+            compat='override')
+        NT = len(ds.ocean_time)
+
+        # add z variables
+        if (self.surf==False) and (self.bot==False) and ('zeta' in ds.data_vars):
+            h = ds.h.values
+            NR, NC = h.shape
+            z_rho = np.nan * np.ones((NT, S['N'], NR, NC))
+            z_w = np.nan * np.ones((NT, S['N']+1, NR, NC))
+            for ii in range(NT):
+                z_rho[ii,:,:,:], z_w[ii,:,:,:] = zrfun.get_z(h, ds.zeta[ii,:,:].values, S, cache=True)
+            ds['z_rho'] = (('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), z_rho)
+            ds['z_w'] = (('ocean_time', 's_w', 'eta_rho', 'xi_rho'), z_w)
+            ds.z_rho.attrs = {'units':'m', 'long_name': 'vertical position on s_rho grid, positive up'}
+            ds.z_w.attrs = {'units':'m', 'long_name': 'vertical position on s_w grid, positive up'}
+
+        if self.uv_to_rho:
+            # interpolate anything on the u and v grids to the rho grid, assuming
+            # zero values where masked, and leaving a masked ring around the outermost edge
+            Maskr = ds.mask_rho.values == 1 # True over water
+            for vn in list(ds.data_vars):
+                dims = ds[vn].dims
+                if ('ocean_time' not in dims) or (('xi_u' not in dims) and ('xi_v' not in dims)):
+                    continue
+                uu = ds[vn].values
+                uu[np.isnan(uu)] = 0
+                if 'xi_u' in dims:
+                    UU = (uu[...,1:-1,1:]+uu[...,1:-1,:-1])/2
+                else:
+                    UU = (uu[...,1:,1:-1]+uu[...,:-1,1:-1])/2
+                uuu = np.nan * np.ones(UU.shape[:-2] + Maskr.shape)
+                uuu[...,1:-1,1:-1] = UU
+                uuu[...,~Maskr] = np.nan
+                ds = ds.drop_vars(vn)
+                ds[vn] = (dims[:-2] + ('eta_rho', 'xi_rho'), uuu)
+
+        # remove singleton dimensions, and coordinates left over from the u and v grids
+        ds = ds.squeeze()
+        ds = ds.drop_dims([dim for dim in ['eta_u','xi_u','eta_v','xi_v']
+            if (dim in ds.dims) and not any([dim in ds[vn].dims for vn in ds.data_vars])])
+        for vn in ds.data_vars:
+            for att in ['long_name', 'units']:
+                if (vn in self.attrs) and (att in self.attrs[vn]):
+                    ds[vn].attrs[att] = self.attrs[vn][att]
+        for vn in ds.variables:
+            ds[vn].encoding = {}
+        enc_dict = {'zlib':True, 'complevel':1, '_FillValue':1e20}
+        Enc_dict = {vn:enc_dict for vn in ds.data_vars if 'ocean_time' in ds[vn].dims}
+        out_fn = self.out_dir / (self.share_name + '.nc')
+        out_fn.unlink(missing_ok=True)
+        ds.to_netcdf(out_fn, encoding=Enc_dict)
+        ds.close()
+        print('\nPath to file:\n%s' % (str(out_fn)))
+        post_argfun.copy_to_kopah(self.Ldir, out_fn)
+        if out_fn.is_file():
+            return 'success'
+        else:
+            return 'fail'
@@ -0,0 +1,397 @@
+"""
+Functions for a store of hourly time series at named points ("stations") from a
+model run, e.g. tide gauges, moorings, and the daymovie mooring points.
+
+Getting a time series at a few points from the history files means opening every
+hourly file, which is slow (e.g. 2000 sec for a year of tide gauges). Here we do that
+once: each day's new output is appended to a per-station store, and after that the
+time series can be read for any time range in milliseconds.
+
+Everything is in LO_output/extract/[gtagex]/stations/[name]/:
+- info.p = dict of the station lon, lat, method, and the grid indices j, i
+  that method resolved them to (see get_ji())
+- ot.bin = ocean_time (seconds since Lfun.modtime0), one float64 per hour
+- [vn].bin = the field vn at (j, i), e.g. zeta.bin, as float64, one per time
+
+The .bin files are just packed float64 columns, only ever appended to (or trimmed at
+the end). The data columns are written before ot.bin, so len(ot) is always the number
+of good rows, and any longer columns (e.g. after a crash) are trimmed back to it.
+Each station has its own folder so jobs running at the same time, registering
+different stations, never write the same file. A new station folder is made
+under LO_output/extract/[gtagex]/stations/.temp/ and then renamed into place, so
+jobs registering the same station at the same time do not delete each other's files.
+
+Use register() to add stations, update() to append the new times from a list of
+history files (extract/stations/extract_stations.py and post/stations1 do this), and
+read_station() or read_stations() to get the time series.
+"""
+
+import os
+import sys
+import shutil
+import pickle
+import multiprocessing as mp
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from lo_tools import Lfun, zfun
+
+# default fields to store: the surface fields used for tides and the daymovies
+vn_list_default = ['zeta', 'Uwind', 'Vwind']
+
+def get_sta_dir(Ldir):
+    sta_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'stations'
+    Lfun.make_dir(sta_dir)
+    return sta_dir
+
+def get_ji_good(G, lat00, lon00):
+    # Function to find the indices of the nearest unmasked point.
+
+    # G is the grid info dict
+    # lat00, lon00 is the mooring/cast location
+
+    # useful things
+    lat = G['lat_rho']
+    lon = G['lon_rho']
+    yvec = G['lat_rho'][:,0]
+    xvec = G['lon_rho'][0,:]
+    mask = G['mask_rho']
+
+    # Out of bounds error checking
+    if (lat00 < yvec[0]) or (lat00 > yvec[-1]):
+        print(' ERROR: lat00 out of bounds ')
+        sys.exit()
+    if (lon00 < xvec[0]) or (lon00 > xvec[-1]):
+        print(' ERROR: lon00 out of bounds ')
+        sys.exit()
+
+    # initial guess
+    j0 = zfun.find_nearest_ind(yvec, lat00)
+    i0 = zfun.find_nearest_ind(xvec, lon00)
+
+    # starting point
+    lat0 = lat[j0,i0]
+    lon0 = lon[j0,i0]
+
+    pad = 5 # how far to look (points)
+
+    # indices of box to search over
+    jmax = len(yvec)-1
+    imax = len(xvec)-1
+    J = np.arange(j0-pad,j0+pad)
+    I = np.arange(i0-pad, i0+pad)
+
+    # account for out-of-range points (not needed?)
+    if I[0] < 0:
+        I = I - I[0]
+    if I[-1] > imax:
+        I = I - (I[-1] - imax)
+    if J[0] < 0:
+        J = J - J[0]
+    if J[-1] > jmax:
+        J = J - (J[-1] - jmax)
+
+    # array of indices to search
+    ii, jj = np.meshgrid(I, J)
+
+    # sub arrays, distances
+    llat = lat[jj,ii]
+    llon = lon[jj,ii]
+    xxx, yyy = zfun.ll2xy(llon, llat, lon0, lat0)
+    ddd = np.sqrt(xxx**2 + yyy**2) # distance from original point
+    mmask = mask[jj,ii]
+    mm = mmask==1 # Boolean array of good points
+    dddm = ddd[mm] # vector of good distances
+
+    # indices of best point
+    jgood = jj[mm][dddm==dddm.min()][0]
+    igood = ii[mm][dddm==dddm.min()][0]
+
+    return jgood, igood
+
+def find_good(G, ilat, ilon):
+    # The rho-grid version of find_good() in extract/moor/extract_moor.py:
+    # use (ilat, ilon) if it is water, or else the first water point on its four sides.
+    for jig in [[0,0],[1,0],[-1,0],[0,1],[0,-1]]:
+        Ilat = ilat + jig[0]
+        Ilon = ilon + jig[1]
+        if G['mask_rho'][Ilat,Ilon] == 1:
+            return Ilat, Ilon
+    print('ERROR: no good nearby point found on mask for rho')
+    sys.exit()
+
+def get_ji(G, lon, lat, method):
+    """
+    Resolve lon, lat to grid indices (j, i) on the rho grid, using:
+    'good' = get_ji_good(), the nearest water point (as in extract_tide.py)
+    'moor' = the nearest point, moved by find_good() if needed (as in extract_moor.py)
+    'nearest' = the nearest point, even if it is land (as in the daymovies)
+    """
+    if method == 'good':
+        return get_ji_good(G, lat, lon)
+    Lon = G['lon_rho'][0,:]
+    Lat = G['lat_rho'][:,0]
+    j = zfun.find_nearest_ind(Lat, lat)
+    i = zfun.find_nearest_ind(Lon, lon)
+    if method == 'moor':
+        if (lon < Lon[0]) or (lon > Lon[-1]) or (lat < Lat[0]) or (lat > Lat[-1]):
+            print('ERROR: station out of bounds: lon = %0.4f lat = %0.4f' % (lon, lat))
+            sys.exit()
+        return find_good(G, j, i)
+    elif method == 'nearest':
+        return j, i
+    else:
+        print('ERROR: unknown station method: ' + method)
+        sys.exit()
+
+def register(sta_dir, G, sta_dict, method='good'):
+    """
+    Add the stations in sta_dict = {name: (lon, lat)} to the store, resolving them
+    to grid indices with get_ji(G, lon, lat, method). A station that is already
+    there with the same lon, lat, and method is left as is. If any of these have
+    changed its old time series are removed.
+    Returns the registry DataFrame for these stations.
+    """
+    for name in sta_dict.keys():
+        lon, lat = sta_dict[name]
+        sdir = sta_dir / name
+        if is_registered(sdir, lon, lat, method):
+            continue
+        j, i = get_ji(G, lon, lat, method)
+        info = {'lon':lon, 'lat':lat, 'method':method, 'j':int(j), 'i':int(i)}
+        # Make the new station folder under a name unique to this job and then
+        # rename it into place, so that a job registering the same station at the
+        # same time never sees a partial folder or has its files deleted.
+        temp_dir = sta_dir / '.temp' / (name + '_' + str(os.getpid()))
+        Lfun.make_dir(temp_dir, clean=True)
+        pickle.dump(info, open(temp_dir / 'info.p', 'wb'))
+        if sdir.is_dir() and not is_registered(sdir, lon, lat, method):
+            # the station has changed, so its old time series are removed
+            old_dir = sta_dir / '.temp' / ('old_' + name + '_' + str(os.getpid()))
+            try:
+                os.rename(sdir, old_dir)
+                shutil.rmtree(str(old_dir), ignore_errors=True)
+            except FileNotFoundError:
+                # another job moved it first
+                pass
+        try:
+            os.rename(temp_dir, sdir)
+        except OSError:
+            # another job registered the station first
+            shutil.rmtree(str(temp_dir), ignore_errors=True)
+    return get_registry(sta_dir, list(sta_dict.keys()))
+
+def is_registered(sdir, lon, lat, method):
+    # True if station folder sdir is there with the same lon, lat, and method
+    info_fn = sdir / 'info.p'
+    if not info_fn.is_file():
+        return False
+    info = pickle.load(open(info_fn, 'rb'))
+    return (info['lon'], info['lat'], info['method']) == (lon, lat, method)
+
+def get_registry(sta_dir, name_list=None):
+    """
+    DataFrame of the info for the stations in name_list (default = all),
+    with the station name as the index.
+    """
+    if name_list is None:
+        name_list = sorted([item.parent.name for item in sta_dir.glob('*/info.p')])
+    reg_df = pd.DataFrame(columns=['lon','lat','method','j','i'])
+    for name in name_list:
+        info = pickle.load(open(sta_dir / name / 'info.p', 'rb'))
+        reg_df.loc[name,:] = [info[item] for item in reg_df.columns]
+    return reg_df
+
+def read_col(sdir, vn, n=None):
+    # Read the first n rows (default = all) of column vn of a station.
+    fn = sdir / (vn + '.bin')
+    if not fn.is_file():
+        return np.zeros(0)
+    return np.fromfile(fn, dtype='<f8', count=-1 if n is None else n)
+
+def get_vn_list(sdir):
+    # the data columns of a station
+    return sorted([item.stem for item in sdir.glob('*.bin') if item.stem != 'ot'])
+
+def trim(sdir, n):
+    # Trim all the columns of a station to n rows. ot.bin goes first, so that
+    # a reader never sees a data column shorter than ot.
+    for fn in [sdir / 'ot.bin'] + [sdir / (vn + '.bin') for vn in get_vn_list(sdir)]:
+        if fn.is_file() and (fn.stat().st_size > 8*n):
+            os.truncate(fn, 8*n)
+
+def append(sdir, ot, D, overwrite=False):
+    """
+    Append the times ot (vector of ocean_time) and fields D = {vn: vector} to the
+    station in sdir. Only times after the last stored time are added, unless
+    overwrite is True, in which case the stored times from ot[0] on are replaced
+    (e.g. for the new forecast days). Columns in the store that are not in D, and
+    new columns in D, are filled with nan for the missing rows.
+    Returns the number of times added.
+    """
+    ot_old = read_col(sdir, 'ot')
+    n = len(ot_old)
+    if n > 0 and len(ot) > 0:
+        if overwrite:
+            n = np.searchsorted(ot_old, ot[0], side='left')
+        else:
+            keep = ot > ot_old[-1]
+            ot = ot[keep]
+            D = {vn: D[vn][keep] for vn in D.keys()}
+    trim(sdir, n)
+    if len(ot) == 0:
+        return 0
+    for vn in sorted(set(get_vn_list(sdir) + list(D.keys()))):
+        fn = sdir / (vn + '.bin')
+        with open(fn, 'ab') as f:
+            if n > 0 and (fn.stat().st_size < 8*n):
+                # a new column
+                (np.nan * np.ones(n - fn.stat().st_size//8)).astype('<f8').tofile(f)
+            if vn in D.keys():
+                np.asarray(D[vn], dtype='<f8').tofile(f)
+            else:
+                (np.nan * np.ones(len(ot))).astype('<f8').tofile(f)
+    with open(sdir / 'ot.bin', 'ab') as f:
+        np.asarray(ot, dtype='<f8').tofile(f)
+    return len(ot)
+
+def get_fn_ot(fn):
+    """
+    The ocean_time of hourly history file fn, from its name
+    ([roms_out]/[gtagex]/f[date_string]/ocean_his_[nnnn].nc is at
+    hour nnnn - 1 of that day), or else from the file.
+    """
+    try:
+        dt = datetime.strptime(fn.parent.name[1:], Lfun.ds_fmt)
+        nnnn = int(fn.stem.split('_')[-1])
+        if fn.stem != 'ocean_his_%04d' % (nnnn):
+            raise ValueError
+        return Lfun.datetime_to_modtime(dt + timedelta(hours=nnnn-1))
+    except ValueError:
+        ds = xr.open_dataset(fn)
+        ot = get_ot(ds)
+        ds.close()
+        return ot
+
+def get_ot(ds):
+    # ocean_time of a history file Dataset, as seconds since Lfun.modtime0
+    return Lfun.datetime_to_modtime(pd.Timestamp(ds.ocean_time.values[0]).to_pydatetime())
+
+def get_one_file(fn, jj, ii, vn_list):
+    """
+    Get the fields in vn_list at the points (jj, ii) from history file fn.
+    Returns ot and a dict of vectors. Fields missing from the file are nan.
+    """
+    D = dict()
+    ds = xr.open_dataset(fn)
+    ot = get_ot(ds)
+    for vn in vn_list:
+        if vn in ds.data_vars:
+            # read the 2D field (for 3D fields the top level) and use fancy indexing
+            fld = ds[vn][0,...].values
+            if fld.ndim == 3:
+                fld = fld[-1,:,:]
+            D[vn] = fld[jj,ii].astype(float)
+        else:
+            D[vn] = np.nan * np.ones(len(jj))
+    ds.close()
+    return ot, D
+
+def do_file(k):
+    # for extract_files(): the arguments are inherited by the forked workers
+    fn_list, jj, ii, vn_list = file_args
+    return get_one_file(fn_list[k], jj, ii, vn_list)
+
+def extract_files(fn_list, jj, ii, vn_list=vn_list_default, Nproc=1):
+    """
+    Get the fields in vn_list at the points (jj, ii) from all the files in fn_list,
+    reading each file once, using Nproc workers.
+    Returns the vector ot and a dict of arrays (time, point).
+    """
+    global file_args
+    file_args = (fn_list, jj, ii, vn_list)
+    nt = len(fn_list)
+    ot = np.nan * np.ones(nt)
+    A = {vn: np.nan * np.ones((nt, len(jj))) for vn in vn_list}
+    def put(k, ot_k, D):
+        ot[k] = ot_k
+        for vn in vn_list:
+            A[vn][k,:] = D[vn]
+    if Nproc > 1 and nt > 1:
+        with mp.get_context('fork').Pool(Nproc) as pool:
+            for k, (ot_k, D) in enumerate(pool.imap(do_file, range(nt))):
+                put(k, ot_k, D)
+    else:
+        for k in range(nt):
+            put(k, *do_file(k))
+    return ot, A
+
+def update(sta_dir, fn_list, name_list=None, vn_list=vn_list_default,
+    overwrite=False, Nproc=1):
+    """
+    Append the times in the hourly history files in fn_list to the stations in
+    name_list (default = all registered stations). Only the files after the last
+    time already stored for all the stations are read, unless overwrite is True
+    (see append()). Returns the number of files read.
+    """
+    reg_df = get_registry(sta_dir, name_list)
+    if len(reg_df) == 0:
+        return 0
+    if overwrite:
+        fn_new = fn_list
+    else:
+        ot_last = []
+        for name in reg_df.index:
+            ot_old = read_col(sta_dir / name, 'ot')
+            ot_last.append(ot_old[-1] if len(ot_old) > 0 else -np.inf)
+        fn_new = [fn for fn in fn_list if get_fn_ot(fn) > min(ot_last)]
+    if len(fn_new) == 0:
+        return 0
+    jj = reg_df.j.to_numpy(dtype=int)
+    ii = reg_df.i.to_numpy(dtype=int)
+    ot, A = extract_files(fn_new, jj, ii, vn_list=vn_list, Nproc=Nproc)
+    for k, name in enumerate(reg_df.index):
+        append(sta_dir / name, ot, {vn: A[vn][:,k] for vn in vn_list},
+            overwrite=overwrite)
+    return len(fn_new)
+
+def read_station(sta_dir, name, vn_list=None, ot0=None, ot1=None):
+    """
+    Read the time series of a station for ot0 <= ocean_time <= ot1 (default = all).
+    Returns a dict with ot and the fields in vn_list (default = all).
+    """
+    sdir = sta_dir / name
+    ot = read_col(sdir, 'ot')
+    n = len(ot)
+    k0 = 0 if ot0 is None else np.searchsorted(ot, ot0, side='left')
+    k1 = n if ot1 is None else np.searchsorted(ot, ot1, side='right')
+    if vn_list is None:
+        vn_list = get_vn_list(sdir)
+    D = {'ot': ot[k0:k1]}
+    for vn in vn_list:
+        v = read_col(sdir, vn, n)
+        if len(v) < n:
+            # a field that was never stored
+            v = np.nan * np.ones(n)
+        D[vn] = v[k0:k1]
+    return D
+
+def read_stations(sta_dir, name_list, vn, ot0=None, ot1=None):
+    """
+    Read the field vn at the stations in name_list for ot0 <= ocean_time <= ot1
+    (default = all) into a DataFrame with the station names as the columns and
+    the times (as Timestamps) as the index.
+    """
+    s_list = []
+    for name in name_list:
+        D = read_station(sta_dir, name, vn_list=[vn], ot0=ot0, ot1=ot1)
+        tt = pd.to_datetime([Lfun.modtime_to_datetime(ot) for ot in D['ot']])
+        s_list.append(pd.Series(D[vn], index=tt, name=name))
+    return pd.concat(s_list, axis=1)
+
+def is_complete(ot, ot0, ot1, dt=3600):
+    # True if ot has all the hourly (dt) times from ot0 to ot1
+    nt = int(round((ot1 - ot0)/dt)) + 1
+    return (len(ot) == nt) and (nt > 0) and (ot[0] == ot0) and (ot[-1] == ot1)
@@ -1,11 +1,20 @@
 """
 Functions for tpxo extraction and processing.
+
+Only the nodal corrections depend on the day, so the work is split into
+get_tpxo_base(), which does the extraction for a constituent, and nodal_correct().
+For making forcing, get_roms_tpxo() caches the results of get_tpxo_base() for a
+ROMS grid on disk, packed at the tpxo9 water points along with the index to go to
+the ROMS grid, and then each day is just get_nodal() and get_roms_fields().
 """
 from lo_tools import pyTMD_functions as tmd_fun
+import pickle
 import xarray as xr
 import numpy as np
+from scipy.spatial import cKDTree
 from lo_tools import zfun
 from lo_tools import plotting_functions as pfun
+from lo_tools import ocn_functions as ocnfun
 from datetime import datetime, timedelta
 import sys
 
@@ -42,6 +51,27 @@ def get_tpxo_clip(Ldir, con, time_dt, domain_tup):
     uphase = current ellipse phase [deg, 0-360]
     """
 
+    B = get_tpxo_base(Ldir, con, domain_tup)
+    pu, pf, G = tmd_fun.load_nodal_corrections(get_mjd(time_dt), [con])
+    # pu = nodal correction of phase [rad]
+    # pf = nodal correction to multiply amplitude by [dimensionless]
+    amp, phase, umajor, uminor, uincl, uphase = nodal_correct(B, pu, pf)
+    
+    return (B['om'], B['lon'], B['lat'], B['plon'], B['plat'], B['h'],
+        amp, phase, umajor, uminor, uincl, uphase)
+
+def get_tpxo_base(Ldir, con, domain_tup):
+    """
+    This does the part of get_tpxo_clip() that does not depend on the day.
+    
+    Output: a dict with om, lon, lat, plon, plat, h (as in get_tpxo_clip()) and
+    ph = Greenwich phase of the constituent [rad]
+    amp = elevation amplitude [mm] (no nodal correction)
+    phase = elevation phase [rad, -pi:pi] (no Greenwich phase or nodal correction)
+    umajor, uminor, uincl = current ellipse parameters (no nodal correction)
+    uphase = current ellipse phase [deg, 0-360] (no Greenwich phase or nodal correction)
+    """
+
     lon0, lon1, lat0, lat1 = domain_tup
     if lon0 > 0 or lon1 > 0:
         print('tpxo_functions.py error: currently positive lon is not supported')
@@ -132,17 +162,31 @@ def get_tpxo_clip(Ldir, con, time_dt, domain_tup):
     # uincl is degresse 0:180
     # uphase is segrees 0:360
 
-    # Apply nodal corrections and Greenwich phase using pyTMD functions
+    # Get the Greenwich phase and frequency using pyTMD functions
     junk, ph, om, junk, junk = tmd_fun.load_constituent(con)
     # ph = Greenwich phase of this constituent [rad] without nodal correction
     # om = frequency of this constituent [rad s-1]
     # 2*np.pi/(om*3600) gives period in hours.
+    
+    return {'om':om, 'ph':ph, 'lon':lon, 'lat':lat, 'plon':plon, 'plat':plat, 'h':h,
+        'amp':amp, 'phase':phase, 'umajor':umajor, 'uminor':uminor,
+        'uincl':uincl, 'uphase':uphase}
+
+def get_mjd(time_dt):
     # The pyTMD nodal correction code expects time in Modified Julian Date (mjd)
     # which is the number of days since midnight on November 17, 1858.  Weird.
-    mjd = (time_dt - datetime(1858,11,17)).days
-    pu, pf, G = tmd_fun.load_nodal_corrections(mjd, [con])
-    # pu = nodal correction of phase [rad]
-    # pf = nodal correction to multiply amplitude by [dimensionless]
+    return (time_dt - datetime(1858,11,17)).days
+
+def nodal_correct(B, pu, pf):
+    """
+    Apply the Greenwich phase and the nodal corrections pu, pf (from
+    tmd_fun.load_nodal_corrections()) to the fields in B, a dict from get_tpxo_base()
+    or get_roms_tpxo(). Returns amp, phase, umajor, uminor, uincl, uphase in the
+    units of get_tpxo_clip().
+    """
+    ph = B['ph']
+    phase = B['phase']
+    uphase = B['uphase']
     # include Greenwich phase and nodal phase corrrection
     phase = phase - ph - pu
     uphase = np.pi*uphase/180 - ph - pu
@@ -156,8 +200,79 @@ def get_tpxo_clip(Ldir, con, time_dt, domain_tup):
     phase[phase<0] += 360 # [0:360]
     uphase[uphase<0] += 360 # [0:360]
     # apply nodal correction to amplitude
-    amp = pf * amp / 1000 # also convert mm to m
-    umajor = pf * umajor
-    uminor = pf * uminor
+    amp = pf * B['amp'] / 1000 # also convert mm to m
+    umajor = pf * B['umajor']
+    uminor = pf * B['uminor']
+    
+    
+    return amp, phase, umajor, uminor, B['uincl'], uphase
+
+# names of the ROMS tide fields made from the outputs of nodal_correct()
+roms_item_list = ['tide_Eamp', 'tide_Ephase', 'tide_Cmax', 'tide_Cmin', 'tide_Cangle', 'tide_Cphase']
+
+def get_roms_tpxo(Ldir, G, c_list, domain_tup, cache_dir):
+    """
+    Get the output of get_tpxo_base() for each constituent in c_list, with the
+    fields packed as vectors of the tpxo9 water points, and IM = the index of the
+    nearest of these points for each point of the ROMS grid G (flattened).
+    Returns a dict of these dicts, keyed by constituent.
     
-    return om, lon, lat, plon, plat, h, amp, phase, umajor, uminor, uincl, uphase
\ No newline at end of file
+    These do not depend on the day, so they are saved in cache_dir (keyed by the
+    ROMS grid and domain_tup) and made only once.
+    """
+    key = ocnfun.get_sig(G['lon_rho'], G['lat_rho'], np.array(domain_tup, dtype=float))
+    XY = np.array((G['lon_rho'].flatten(), G['lat_rho'].flatten())).T # shape is (NR*NC, 2)
+    T = dict()
+    wet0 = None
+    for con in c_list:
+        cache_fn = cache_dir / ('tpxo_' + con + '_' + key + '.p')
+        if cache_fn.is_file():
+            T[con] = pickle.load(open(cache_fn, 'rb'))
+            continue
+        B = get_tpxo_base(Ldir, con, domain_tup)
+        wet = ~np.isnan(B['amp'])
+        C = {'om':B['om'], 'ph':B['ph']}
+        for vn in ['amp', 'phase', 'umajor', 'uminor', 'uincl', 'uphase']:
+            C[vn] = B[vn][wet].flatten()
+        # get nearest neighbor tree to use with the tpxo grid to interpolate
+        # values from the tpxo grid onto the ROMS grid (the mask is the same for
+        # all constituents so we only do this once)
+        if (wet0 is None) or not np.array_equal(wet, wet0):
+            XY2 = np.array((B['lon'][wet].flatten(), B['lat'][wet].flatten())).T
+            IM = cKDTree(XY2).query(XY)[1]
+            wet0 = wet
+        C['IM'] = IM
+        # write to a temp file first so that a job running at the same time
+        # never reads a partial file
+        temp_fn = cache_dir / (cache_fn.name + '.temp')
+        pickle.dump(C, open(temp_fn, 'wb'))
+        temp_fn.replace(cache_fn)
+        T[con] = C
+    return T
+
+def get_nodal(c_list, dt_list):
+    """
+    The nodal corrections pu, pf for all the constituents in c_list and days in
+    dt_list (datetimes) in one call. These are packed (day, constituent).
+    """
+    mjd = np.array([get_mjd(dt) for dt in dt_list])
+    pu, pf, G = tmd_fun.load_nodal_corrections(mjd, c_list)
+    return pu, pf
+
+def get_roms_fields(C, pu, pf, mask, fadj=1):
+    """
+    Make the ROMS tide fields for one constituent and day, from C (an item from
+    get_roms_tpxo()) and the nodal corrections pu, pf for this day. The amplitudes are
+    multiplied by fadj, and land (mask==0) is nan. Returns a dict keyed by the
+    names in roms_item_list.
+    """
+    amp, phase, umajor, uminor, uincl, uphase = nodal_correct(C, pu, pf)
+    amp = fadj * amp
+    umajor = fadj * umajor
+    uminor = fadj * uminor
+    F = dict()
+    for item, fld in zip(roms_item_list, [amp, phase, umajor, uminor, uincl, uphase]):
+        new_roms_field = fld[C['IM']].reshape(mask.shape)
+        new_roms_field[mask==0] = np.nan
+        F[item] = new_roms_field
+    return F
@@ -5,13 +5,15 @@ Module of functions specific to ROMS.
 2021.08.05 Recoded using xarray instead of netCDF4.
 """
 import xarray as xr
+import netCDF4 as nc
 import numpy as np
-import pandas as pd
 from lo_tools import Lfun
-import sys
+import sys, os, shutil
 import pickle
+import hashlib
+from datetime import datetime
 
-def get_basic_info(fn, only_G=False, only_S=False, only_T=False):
+def get_basic_info(fn, only_G=False, only_S=False, only_T=False, use_cache=True):
     """
     Gets grid, vertical coordinate, and time info from a ROMS NetCDF
     history file with full name 'fn'
@@ -20,48 +22,232 @@ def get_basic_info(fn, only_G=False, only_S=False, only_T=False):
     Example calls:
     G, S, T = zfun.get_basic_info(fn)
     T = zfun.get_basic_info(fn, only_T=True)
+
+    NEW 2026.10.18: G and S are saved in a disk cache the first time they are
+    made for a given grid (see get_grid_key()), and later calls load them from there,
+    with the 2-D arrays memory-mapped so they are only read when used. The arrays are
+    copy-on-write, so editing them in your code does not change the cache.
+    Use use_cache=False to always get them from the history file.
+    T only needs the ocean_time header, and only_T=True reads nothing else.
     """
-    ds = xr.open_dataset(fn)
-    def make_G(ds):
-        # get grid and bathymetry info
-        g_varlist = ['h', 'lon_rho', 'lat_rho', 'lon_u', 'lat_u', 'lon_v', 'lat_v',
-        'lon_psi', 'lat_psi', 'mask_rho', 'mask_u', 'mask_v', 'pm', 'pn',]
-        G = dict()
-        for vv in g_varlist:
-            G[vv] = ds[vv].values
-        G['DX'] = 1/G['pm']
-        G['DY'] = 1/G['pn']
-        G['M'], G['L'] = np.shape(G['lon_rho']) # M = rows, L = columns
-        return G
-    def make_S(ds):
-        # get vertical sigma-coordinate info (vectors are bottom to top)
-        s_varlist = ['s_rho', 's_w', 'hc', 'Cs_r', 'Cs_w', 'Vtransform']
-        S = dict()
-        for vv in s_varlist:
-            S[vv] = ds[vv].values
-        S['N'] = len(S['s_rho']) # number of vertical levels
-        return S
-    def make_T(ds):
-        # returns two single values, one a datatime, and one a float
-        ot = ds.ocean_time.values # an array with dtype='datetime64[ns]'
-        dti = pd.to_datetime(ot) # a pandas DatetimeIndex with dtype='datetime64[ns]'
-        dt = dti.to_pydatetime() # an array of datetimes
-        T = dict()
-        T['dt'] = dt[0] # a datetime object
-        T['ocean_time'] = Lfun.datetime_to_modtime(dt[0]) # a float, "seconds since..."
-        return T
+    if only_T:
+        return get_T(fn)
+    if use_cache:
+        try:
+            G, S = get_GS_cached(fn)
+        except OSError:
+            # e.g. if we cannot write to LO_output
+            G, S = make_GS(fn)
+    else:
+        G, S = make_GS(fn)
     # return results
     if only_G:
-        return make_G(ds)
+        return G
+    elif len(S) == 0:
+        # e.g. a grid.nc file, which only has G
+        raise KeyError('No S-coordinate info in ' + str(fn))
     elif only_S:
-        return make_S(ds)
-    elif only_T:
-        return make_T(ds)
+        return S
     else:
-        return make_G(ds), make_S(ds), make_T(ds)
+        return G, S, get_T(fn)
+
+# variables used by get_basic_info()
+g_varlist = ['h', 'lon_rho', 'lat_rho', 'lon_u', 'lat_u', 'lon_v', 'lat_v',
+    'lon_psi', 'lat_psi', 'mask_rho', 'mask_u', 'mask_v', 'pm', 'pn',]
+s_varlist = ['s_rho', 's_w', 'hc', 'Cs_r', 'Cs_w', 'Vtransform']
+
+# where the G and S cache lives
+grid_cache_dir = Lfun.Ldir['LOo'] / 'zrfun_grid_cache'
+
+def make_GS(fn):
+    # get grid and vertical sigma-coordinate info from a history file
+    ds = xr.open_dataset(fn)
+    G = dict()
+    for vv in g_varlist:
+        G[vv] = ds[vv].values
+    G['DX'] = 1/G['pm']
+    G['DY'] = 1/G['pn']
+    G['M'], G['L'] = np.shape(G['lon_rho']) # M = rows, L = columns
+    # (vectors are bottom to top)
+    # S is left empty for files without S-coordinates (e.g. grid.nc)
+    S = dict()
+    if 's_rho' in ds.variables:
+        for vv in s_varlist:
+            S[vv] = ds[vv].values
+        S['N'] = len(S['s_rho']) # number of vertical levels
     ds.close()
+    return G, S
+
+def get_T(fn):
+    # returns two single values, one a datatime, and one a float
+    # NOTE: we use netCDF4 because it opens a file much faster than xarray,
+    # and we only need ocean_time.
+    with nc.Dataset(fn) as ds:
+        ot = ds['ocean_time']
+        calendar = getattr(ot, 'calendar', 'standard')
+        dt = nc.num2date(ot[0], ot.units, calendar=calendar,
+            only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    # convert from cftime.real_datetime to a plain datetime
+    dt = datetime(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond)
+    T = dict()
+    T['dt'] = dt # a datetime object
+    T['ocean_time'] = Lfun.datetime_to_modtime(dt) # a float, "seconds since..."
+    return T
+
+def get_grid_key(fn):
+    """
+    A string that identifies the grid and vertical coordinates of a history file,
+    made from the contents of h, mask_rho, and the S-coordinate vectors.
+
+    Hashing h and mask_rho means reading them, so we only do that the first time
+    we see a file. The key is then saved in an index under a name made from the
+    file path, modification time, and size, and the S-coordinate scalars (see
+    get_file_id()), and later calls just read it from there.
+
+    The index has one small file for each history file, so when it has more than
+    index_max files we delete the least recently used ones (see trim_index()).
+    """
+    file_id = get_file_id(fn)
+    if file_id in grid_key_dict.keys():
+        return grid_key_dict[file_id]
+    index_fn = grid_cache_dir / 'index' / (file_id + '.txt')
+    if index_fn.is_file():
+        key = index_fn.read_text().strip()
+        try:
+            # record the time the entry was last used
+            os.utime(index_fn)
+        except OSError:
+            pass
+    else:
+        key = hash_grid(fn)
+        try:
+            Lfun.make_dir(index_fn.parent)
+            temp_fn = index_fn.parent / ('temp_' + file_id + '_' + str(os.getpid()))
+            temp_fn.write_text(key)
+            os.replace(temp_fn, index_fn)
+            # count and trim the index only now and then, or when our estimate is too big
+            index_size['n_new'] += 1
+            if index_size['n'] != None:
+                index_size['n'] += 1
+            if ((index_size['n'] == None) or (index_size['n'] > index_max)
+                    or (index_size['n_new'] >= index_trim_every)):
+                index_size['n'] = trim_index(keep=index_fn)
+                index_size['n_new'] = 0
+        except OSError:
+            # e.g. if we cannot write to LO_output
+            pass
+    grid_key_dict[file_id] = key
+    return key
+
+# grid keys already found by this process, using the file_id as the key
+grid_key_dict = dict()
+
+# maximum number of files in the grid key index
+index_max = 10000
+
+# number of new index entries made by this process between counts of the index
+index_trim_every = 100
+
+# running estimate of the number of files in the index made by this process
+index_size = {'n': None, 'n_new': 0}
 
-def get_z(h, zeta, S, only_rho=False, only_w=False):
+def trim_index(keep=None, max_n=None):
+    """
+    If there are more than max_n (default index_max) grid key index files,
+    delete them, least recently used first, until there are 90% of max_n, so that
+    the index does not have to be counted again after every new entry.
+    The file keep is never deleted. Returns the number of files in the index afterwards.
+    """
+    if max_n == None:
+        max_n = index_max
+    time_dict = dict()
+    for index_fn in (grid_cache_dir / 'index').glob('*.txt'):
+        # another job may be deleting files at the same time
+        try:
+            time_dict[index_fn] = index_fn.stat().st_mtime
+        except FileNotFoundError:
+            pass
+    n = len(time_dict)
+    if n <= max_n:
+        return n
+    # sort with the oldest first
+    index_list = sorted(time_dict.keys(), key=lambda item: time_dict[item])
+    for index_fn in index_list:
+        if n <= int(0.9*max_n):
+            break
+        if index_fn == keep:
+            continue
+        try:
+            index_fn.unlink()
+        except FileNotFoundError:
+            pass
+        n -= 1
+    return n
+
+def get_file_id(fn):
+    # a string that identifies a version of file fn without reading its arrays
+    st = os.stat(fn)
+    id_list = [str(os.path.abspath(fn)), str(st.st_mtime_ns), str(st.st_size)]
+    with nc.Dataset(fn) as ds:
+        if 's_rho' in ds.variables:
+            id_list.append(str(len(ds.dimensions['s_rho'])))
+            for vv in ['hc', 'Vtransform']:
+                id_list.append(str(ds[vv][:]))
+    return hashlib.md5(':'.join(id_list).encode()).hexdigest()
+
+def hash_grid(fn):
+    # the grid key, from the contents of the arrays in file fn
+    hash_list = []
+    with nc.Dataset(fn) as ds:
+        for vv in ['h', 'mask_rho'] + s_varlist:
+            if vv not in ds.variables:
+                # e.g. grid.nc has no S-coordinates
+                continue
+            a = ds[vv][:]
+            hash_list.append(vv + str(np.shape(a)))
+            hash_list.append(np.ma.filled(a, np.nan).tobytes())
+    md5 = hashlib.md5()
+    for item in hash_list:
+        md5.update(item.encode() if isinstance(item, str) else item)
+    return md5.hexdigest()
+
+def get_GS_cached(fn):
+    """
+    Get G and S from the disk cache, making the cache entry first if needed.
+    """
+    key = get_grid_key(fn)
+    out_dir = grid_cache_dir / key
+    if not (out_dir / 'G_lon_rho.npy').is_file():
+        G, S = make_GS(fn)
+        # We write to a temporary folder and then rename it, so that other jobs
+        # never see a partly written entry.
+        temp_dir = grid_cache_dir / ('temp_' + key + '_' + str(os.getpid()))
+        Lfun.make_dir(temp_dir, clean=True)
+        for vv in g_varlist:
+            np.save(temp_dir / ('G_' + vv + '.npy'), G[vv])
+        for vv in s_varlist:
+            if vv in S.keys():
+                np.save(temp_dir / ('S_' + vv + '.npy'), S[vv])
+        try:
+            os.rename(temp_dir, out_dir)
+        except OSError:
+            # another job made the same entry first
+            shutil.rmtree(str(temp_dir), ignore_errors=True)
+        return G, S
+    G = dict()
+    for vv in g_varlist:
+        G[vv] = np.load(out_dir / ('G_' + vv + '.npy'), mmap_mode='c')
+    G['DX'] = 1/G['pm']
+    G['DY'] = 1/G['pn']
+    G['M'], G['L'] = np.shape(G['lon_rho'])
+    S = dict()
+    if (out_dir / 'S_s_rho.npy').is_file():
+        for vv in s_varlist:
+            S[vv] = np.load(out_dir / ('S_' + vv + '.npy'))
+        S['N'] = len(S['s_rho'])
+    return G, S
+
+def get_z(h, zeta, S, only_rho=False, only_w=False, cache=False, dtype=None, out=None):
     """
     Used to calculate the z position of fields in a ROMS history file
 
@@ -74,6 +260,15 @@ def get_z(h, zeta, S, only_rho=False, only_w=False):
     vectors of length VL, the output array (e.g. z_rho) will have size (N, VL)
     (i.e. it will never return an array with size (N, VL, 1), even if (VL, 1) was
     the input shape).  This is a result of the initial and final squeeze calls.
+
+    NEW 2026.10.18: z is linear in zeta, z = A*zeta + B, where A and B depend only
+    on h and S (see get_z_coefs()). Optional arguments:
+    - cache=True keeps A and B from one call to the next, so when you call get_z()
+    for many history files with the same h each call is just a multiply-add.
+    Don't use it if h changes with every call (e.g. particle positions).
+    - dtype=np.float32 gives float32 output, which is faster and uses half the memory.
+    - out is a preallocated C-contiguous array (or a tuple of two if you are getting
+    both z_rho and z_w) with the size of the output, which is filled and returned.
     """
     # input error checking
     if ( (not isinstance(h, np.ndarray))
@@ -81,8 +276,6 @@ def get_z(h, zeta, S, only_rho=False, only_w=False):
         print('WARNING from get_z(): Inputs must be numpy arrays')
     if not isinstance(S, dict):
         print('WARNING from get_z(): S must be a dict')
-    # number of vertical levels
-    N = S['N']
     # remove singleton dimensions
     h = h.squeeze()
     zeta = zeta.squeeze()
@@ -93,60 +286,93 @@ def get_z(h, zeta, S, only_rho=False, only_w=False):
     if h.shape != zeta.shape:
         print('WARNING from get_z(): h and zeta must be the same shape')
     M, L = h.shape
-    def make_z_rho(h, zeta, S, N, M, L):
-        # rho
-        # create some useful arrays
-        csr = S['Cs_r']
-        csrr = csr.reshape(N, 1, 1).copy()
-        Cs_r = np.tile(csrr, [1, M, L])
-        H_r = np.tile(h.reshape(1, M, L).copy(), [N, 1, 1])
-        Zeta_r = np.tile(zeta.reshape(1, M, L).copy(), [N, 1, 1])
-        if S['hc'] == 0: # if hc = 0 the transform is simpler (and faster)
-            z_rho = H_r*Cs_r + Zeta_r + Zeta_r*Cs_r
-        elif S['hc'] != 0: # need to calculate a few more useful arrays
-            sr = S['s_rho'] # PM edit 2019.01.24
-            srr = sr.reshape(N, 1, 1).copy()
-            S_rho = np.tile(srr, [1, M, L])
-            Hc_r = np.tile(S['hc'], [N, M, L])
-            if S['Vtransform'] == 1:
-                zr0 = (S_rho - Cs_r) * Hc_r + Cs_r*H_r
-                z_rho = zr0 + Zeta_r * (1 + zr0/H_r)
-            elif S['Vtransform'] == 2:
-                zr0 = (S_rho*Hc_r + Cs_r*H_r) / (Hc_r + H_r)
-                z_rho = Zeta_r + (Zeta_r + H_r)*zr0
-        z_rho = z_rho.squeeze()
-        return z_rho
-    def make_z_w(h, zeta, S, N, M, L):
-        # w
-        # create some useful arrays
-        csw = S['Cs_w']
-        csww = csw.reshape(N+1, 1, 1).copy()
-        Cs_w = np.tile(csww, [1, M, L])
-        H_w = np.tile(h.reshape(1, M, L).copy(), [N+1, 1, 1])
-        Zeta_w = np.tile(zeta.reshape(1, M, L).copy(), [N+1, 1, 1])
-        if S['hc'] == 0: # if hc = 0 the transform is simpler (and faster)
-            z_w = H_w*Cs_w + Zeta_w + Zeta_w*Cs_w
-        elif S['hc'] != 0: # need to calculate a few more useful arrays
-            #sw = S['s_w']
-            sw = S['s_w'] # PM edit 2019.01.24
-            sww = sw.reshape(N+1, 1, 1).copy()
-            S_w = np.tile(sww, [1, M, L])    #
-            Hc_w = np.tile(S['hc'], [N+1, M, L])
-            if S['Vtransform'] == 1:
-                zw0 = (S_w - Cs_w) * Hc_w + Cs_w*H_w
-                z_w = zw0 + Zeta_w * (1 + zw0/H_w)
-            elif S['Vtransform'] == 2:
-                zw0 = (S_w*Hc_w  + Cs_w*H_w) / (Hc_w + H_w)
-                z_w = Zeta_w + (Zeta_w + H_w)*zw0
-        z_w = z_w.squeeze()
-        return z_w
-    # return results
+    if dtype == None:
+        dtype = np.result_type(h, zeta, S['Cs_r'])
     if only_rho:
-        return make_z_rho(h, zeta, S, N, M, L)
+        gtype_list = ['rho']
     elif only_w:
-        return make_z_w(h, zeta, S, N, M, L)
-    else :
-        return make_z_rho(h, zeta, S, N, M, L), make_z_w(h, zeta, S, N, M, L)
+        gtype_list = ['w']
+    else:
+        gtype_list = ['rho', 'w']
+    if out is None:
+        out_list = [None]*len(gtype_list)
+    elif len(gtype_list) == 1:
+        out_list = [out]
+    else:
+        out_list = list(out)
+    Zeta = zeta.reshape(1, M, L)
+    z_list = []
+    for gtype, z in zip(gtype_list, out_list):
+        A, B = get_z_coefs(h, S, gtype, cache=cache, dtype=dtype)
+        NZ = A.shape[0]
+        if np.ma.isMaskedArray(zeta):
+            # keep the mask of zeta in the result
+            z = A*Zeta.astype(dtype) + B
+        else:
+            if z is None:
+                z = np.empty((NZ, M, L), dtype=dtype)
+            else:
+                z = z.reshape(NZ, M, L) # a view, because out must be C-contiguous
+            np.multiply(A, Zeta, out=z)
+            z += B
+        z_list.append(z.squeeze())
+    # return results
+    if len(z_list) == 1:
+        return z_list[0]
+    else:
+        return z_list[0], z_list[1]
+
+# Cache used by get_z_coefs(), holding the results for a few recent (h, S) pairs.
+z_coef_cache = dict()
+z_coef_cache_max = 4
+
+def get_z_coefs(h, S, gtype, cache=False, dtype=float):
+    """
+    Returns arrays A and B, packed (N, M, L) for gtype = 'rho' or (N+1, M, L)
+    for gtype = 'w', such that z = A*zeta + B for a 2-D h of shape (M, L).
+
+    These are the zeta-independent parts of the S-coordinate transform, for example
+    with Vtransform = 2:
+    z = zeta + (zeta + h)*z0 where z0 = (hc*s + h*Cs)/(hc + h)
+    so A = 1 + z0 and B = h*z0.
+
+    With cache=True the result is saved, keyed by the contents of h and S,
+    and reused by later calls.
+    """
+    if gtype == 'rho':
+        cs = S['Cs_r']; ss = S['s_rho']
+    elif gtype == 'w':
+        cs = S['Cs_w']; ss = S['s_w']
+    if cache:
+        key = (gtype, np.dtype(dtype).str, h.shape, hash(h.tobytes()),
+            float(S['hc']), int(S['Vtransform']), cs.tobytes(), ss.tobytes())
+        if key in z_coef_cache:
+            return z_coef_cache[key]
+    NZ = len(cs)
+    M, L = h.shape
+    Cs = cs.reshape(NZ, 1, 1)
+    H = h.reshape(1, M, L)
+    if S['hc'] == 0: # if hc = 0 the transform is simpler (and faster)
+        A = 1 + Cs*np.ones_like(H)
+        B = H*Cs
+    else:
+        Ss = ss.reshape(NZ, 1, 1) # PM edit 2019.01.24
+        if S['Vtransform'] == 1:
+            z0 = (Ss - Cs)*S['hc'] + Cs*H
+            A = 1 + z0/H
+            B = z0
+        elif S['Vtransform'] == 2:
+            z0 = (Ss*S['hc'] + Cs*H) / (S['hc'] + H)
+            A = 1 + z0
+            B = H*z0
+    A = A.astype(dtype)
+    B = B.astype(dtype)
+    if cache:
+        # forget the oldest entry
+        if len(z_coef_cache) >= z_coef_cache_max:
+            z_coef_cache.pop(next(iter(z_coef_cache)))
+        z_coef_cache[key] = (A, B)
+    return A, B
     
 def get_S(S_info_dict):
     """
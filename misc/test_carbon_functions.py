@@ -0,0 +1,83 @@
+"""
+Code to test that carbon_functions.py gives the same pH and ARAG as the CO2SYS
+call it replaces, on random inputs, so it does not need any model output.
+
+Run with:
+python test_carbon_functions.py
+(or with pytest)
+"""
+
+import numpy as np
+import gsw
+from PyCO2SYS import CO2SYS
+
+from lo_tools import carbon_functions as carbfun
+
+def co2sys_ph_arag(alk, tic, salt, temp, pres):
+    # the call used in the plotting code before carbon_functions.py
+    CO2dict = CO2SYS(alk, tic, 1, 2, salt, temp, temp, pres, pres, 50, 2, 1, 10, 1,
+        NH3=0.0, H2S=0.0)
+    return CO2dict['pHout'], CO2dict['OmegaARout']
+
+def test_ph_arag():
+    rng = np.random.default_rng(0)
+    N = 2000
+    alk = rng.uniform(500, 2600, N)
+    tic = alk * rng.uniform(0.8, 1.05, N)
+    salt = rng.uniform(1, 36, N)
+    temp = rng.uniform(-2, 30, N)
+    pres = rng.uniform(0, 3000, N)
+    ph, arag = carbfun.get_ph_arag(alk, tic, salt, temp, pres)
+    ph0, arag0 = co2sys_ph_arag(alk, tic, salt, temp, pres)
+    assert np.max(np.abs(ph - ph0)) < 1e-12
+    assert np.max(np.abs(arag - arag0) / arag0) < 1e-12
+
+def test_get_carbon():
+    # a small grid in the Salish Sea, with land, a wetdry mask, and some points
+    # with alkalinity or TIC below the 100 umol/kg cutoff
+    rng = np.random.default_rng(1)
+    sh = (20, 30)
+    lon, lat = np.meshgrid(np.linspace(-125, -122.5, sh[1]), np.linspace(47, 49, sh[0]))
+    h = rng.uniform(4, 300, sh)
+    mask = (rng.uniform(size=sh) > 0.2).astype(int)
+    wetdry = (rng.uniform(size=sh) > 0.1).astype(int)
+    v_dict = dict()
+    v_dict['temp'] = rng.uniform(5, 20, sh)
+    v_dict['salt'] = rng.uniform(10, 34, sh)
+    v_dict['alkalinity'] = rng.uniform(1500, 2300, sh)
+    v_dict['TIC'] = v_dict['alkalinity'] * rng.uniform(0.9, 1.05, sh)
+    v_dict['alkalinity'][rng.uniform(size=sh) < 0.05] = 50
+    v_dict['TIC'][rng.uniform(size=sh) < 0.05] = 50
+    for z in [-h, 0]:
+        # small chunks so more than one is used
+        C = carbfun.get_static(lon, lat, z, mask)
+        out_dict = carbfun.get_carbon(C, v_dict, mask=wetdry, chunk=100)
+        # the gsw and CO2SYS steps as they were in the plotting code
+        pres = gsw.p_from_z(z * np.ones(sh), lat)
+        SA = gsw.SA_from_SP(v_dict['salt'], pres, lon, lat)
+        CT = gsw.CT_from_pt(SA, v_dict['temp'])
+        rho = gsw.rho(SA, CT, pres)
+        temp = gsw.t_from_CT(SA, CT, pres)
+        alk = 1000 * v_dict['alkalinity'] / rho
+        alk[alk < 100] = np.nan
+        tic = 1000 * v_dict['TIC'] / rho
+        tic[tic < 100] = np.nan
+        ph0, arag0 = co2sys_ph_arag(alk.flatten(), tic.flatten(), v_dict['salt'].flatten(),
+            temp.flatten(), pres.flatten())
+        land = (mask == 0) | (wetdry == 0)
+        ph0 = ph0.reshape(sh)
+        ph0[land] = np.nan
+        arag0 = arag0.reshape(sh)
+        arag0[land] = np.nan
+        rho[land] = np.nan
+        for vn, fld0 in [('rho', rho), ('PH', ph0), ('ARAG', arag0)]:
+            fld = out_dict[vn]
+            assert np.array_equal(np.isnan(fld), np.isnan(fld0)), vn
+        assert np.nanmax(np.abs(out_dict['rho'] - rho)) < 1e-9
+        assert np.nanmax(np.abs(out_dict['PH'] - ph0)) < 1e-12
+        assert np.nanmax(np.abs(out_dict['ARAG'] - arag0) / arag0) < 1e-12
+
+if __name__ == '__main__':
+    test_ph_arag()
+    test_get_carbon()
+    print('All carbon_functions tests passed')
@@ -106,6 +106,13 @@ for source in source_list:
         cid_list = list(info_df.index)
             
     mod_dir = (Ldir['LOo'] / 'extract' / gtx / 'cast' / (source + '_' + otype + '_' + year))
+    # extract_casts_grouped.py puts all the casts in one file
+    all_fn = mod_dir / 'casts.nc'
+    if all_fn.is_file():
+        ds_all = xr.load_dataset(all_fn)
+        all_cid_list = set(ds_all.cast.values)
+    else:
+        ds_all = None
 
     # Fill DataFrames with model extractions,
     # matching the format of the observations.
@@ -124,8 +131,16 @@ for source in source_list:
     for cid in cid_list:
     
         fn = mod_dir / (str(int(cid)) + '.nc')
-        if fn.is_file(): # useful for testing, and for missing casts
+        if ds_all is not None:
+            if int(cid) in all_cid_list:
+                ds = ds_all.sel(cast=int(cid))
+            else:
+                ds = None
+        elif fn.is_file(): # useful for testing, and for missing casts
             ds = xr.open_dataset(fn)
+        else:
+            ds = None
+        if ds is not None:
             # check on which bio variables to get
             if ii == 0:
                 if 'NH4' in ds.data_vars:
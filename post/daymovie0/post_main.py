@@ -86,6 +86,9 @@ for moviename in moviename_list:
         '-ds0', ds0, '-ds1', ds1, '-lt', lt, '-mov', mov, '-pt', pt,
         '-dom', dom, '-vn', vn, '-tracks', tracks, '-emask', emask, '-ttag', ttag,
         '-avl', avl, '-bot', bot]
+    if moviename == 'Phab_full_salt_top':
+        # keep the frame that is sent for the HAB Bulletin
+        cmd += ['-png', '72']
     
     proc = Po(cmd,stdout=Pi, stderr=Pi)
     procs.append(proc)
@@ -0,0 +1,69 @@
+"""
+Consumer for lo_tools/post_engine.py, used by driver_post1.py -engine True.
+
+It makes the same layers.nc as post_main.py, from fields read once by the engine.
+The times are handed to a Pool of Nproc processes as they arrive, and written
+to the output file in order.
+"""
+
+from pathlib import Path
+import multiprocessing as mp
+
+from lo_tools import Lfun, post_engine, post_argfun
+
+make_layers = Lfun.module_from_file('make_layers_layers1',
+    Path(__file__).absolute().parent / 'make_layers.py')
+
+def get_time(k, F):
+    # (run in the Pool processes, which inherit L from the consumer)
+    return L.get_time(k, F)
+
+class LayersConsumer(post_engine.Consumer):
+    share_name = 'layers'
+
+    def __init__(self, Ldir, fn_list):
+        super().__init__(Ldir)
+        # the same times as post_main.py
+        if Ldir['testing']:
+            ii_list = [0, 1]
+        else:
+            ii_list = list(range(0, len(fn_list), 4))
+        self.k_dict = {ii: k for k, ii in enumerate(ii_list)}
+        self.fn_list = [fn_list[ii] for ii in ii_list]
+        self.L = make_layers.Layers(self.fn_list, testing=Ldir['testing'],
+            exact_z=Ldir['exact_z'])
+        self.vn_list = self.L.vn_list
+
+    def want(self, ii):
+        return ii in self.k_dict.keys()
+
+    def setup(self, fn_list):
+        global L
+        L = self.L
+        L.make_weights(self.fn_list)
+        self.Nproc = max(1, min(self.Ldir['Nproc'], len(self.fn_list)))
+        self.pool = mp.get_context('fork').Pool(self.Nproc)
+        self.out_fn = self.out_dir / (self.share_name + '.nc')
+        self.lf = L.make_file(self.out_fn)
+        self.pending = []
+
+    def use(self, ii, F):
+        F = {vn: F[vn].copy() for vn in F.keys()}
+        self.pending.append(self.pool.apply_async(get_time, (self.k_dict[ii], F)))
+        while len(self.pending) > self.Nproc:
+            self.lf.write(*self.pending.pop(0).get())
+
+    def finish(self):
+        while len(self.pending) > 0:
+            self.lf.write(*self.pending.pop(0).get())
+        self.lf.close()
+        self.pool.close()
+        print('\nPath to file:\n%s' % (str(self.out_fn)))
+        post_argfun.copy_to_kopah(self.Ldir, self.out_fn)
+        if self.out_fn.is_file():
+            return 'success'
+        else:
+            return 'fail'
+
+def get_consumer(Ldir, fn_list):
+    return LayersConsumer(Ldir, fn_list)
@@ -1,200 +1,176 @@
 """
-This creates a layers file for a single time.
+This makes the layers for the layers1 job, for use by post_main.py and consumer.py.
+
+Each time is done by Layers.get_time(), which only needs the fields from one
+history file, so each file is read once. The vertical interpolation weights for the
+depth layers are made once per day from the daily mean zeta, using
+lo_tools/layer_functions.py, so for each time the layers are just a vectorized
+gather. Use exact_z=True to make the weights for each time from its own zeta instead.
+
+This used to be a script run as a separate process for each time, writing a
+temp file that post_main.py combined using ncrcat, and it used zeta = 0 for the
+layer depths.
 
 To test on mac:
 
-run make_layers -test True
+run post_main.py -gtx cas7_t0_x4b -ro 0 -d 2017.07.04 -r backfill -job layers1 -test True
 """
 
-from pathlib import Path
-import argparse
 import xarray as xr
-from time import time
-from PyCO2SYS import CO2SYS
-import seawater as sw
-from warnings import filterwarnings
-filterwarnings('ignore') # skip some warning messages from CO2YS
+import pandas as pd
 import numpy as np
-import sys
-
-from lo_tools import plotting_functions as pfun
-
-# defaults for testing
-from lo_tools import Lfun
-Ldir = Lfun.Lstart()
-in_fn = (Ldir['roms_out'] /
-    'cas7_t1_x11b' / 'f2025.06.20' / 'ocean_his_0001.nc')
-out_fn = (Ldir['parent'] / 'LO_output' / 'post' /
-    'cas7_t1_x11b' / 'f2025.06.20' / 'layers0' / 'tempfiles' / 'layers_000000.nc')
-# in_fn = (Ldir['roms_out'] /
-#     'cas6_v00_uu0mb' / 'f2021.07.04' / 'ocean_his_0002.nc')
-# out_fn = (Ldir['parent'] / 'LO_output' / 'post' /
-#     'cas6_v00_uu0mb' / 'f2021.07.04' / 'layers0' / 'tempfiles' / 'layers_000000.nc')
-# make sure output directory exists
-Lfun.make_dir(out_fn.parent)
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-in_fn', default=in_fn, type=str)
-parser.add_argument('-out_fn', default=out_fn, type=str)
-parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_string)
-
-args = parser.parse_args()
-in_fn = Path(args.in_fn)
-out_fn = Path(args.out_fn)
-testing = args.testing
-
-out_fn.unlink(missing_ok=True)
-
-in_ds = xr.open_dataset(in_fn, decode_times=False)
-out_ds = xr.Dataset()
-
-# add time
-out_ds['ocean_time'] = (('ocean_time'), in_ds.ocean_time.values)
-out_ds['ocean_time'].attrs['units'] = Ldir['roms_time_units']
-# add coordinates and other static 2-D fields
-vn_list = [ 'lon_rho', 'lat_rho', 'mask_rho', 'h']
-for vn in vn_list:
-    out_ds[vn] = (('eta_rho', 'xi_rho'), in_ds[vn].values)
-    out_ds[vn].attrs['long_name'] = in_ds[vn].attrs['long_name']
-    try:
-        out_ds[vn].attrs['units'] = in_ds[vn].attrs['units']
-    except KeyError:
-        pass
-
-# Get ready to initialize the data layers.
-if testing:
-    depth_list = ['10']
-else:
-    # depth_list = ['surface', '10', '20', '30', '50', 'bottom']
-    depth_list = ['surface', '10', '20', '30', '50',
-        '100', '500', '1000', '1500', '2000', '2500', 'bottom']
 
-tag_dict = dict()
-for depth in depth_list:
-    if depth in ['surface', 'bottom']:
-        tag_dict[depth] = ' at ' + depth
-    else:
-        tag_dict[depth] = ' at ' + depth + ' m depth'
-
-if testing:
-    # vn_in_list = ['temp', 'salt']
-    # vn_out_list = ['temp', 'salt']
-    vn_in_list = ['temp', 'salt', 'alkalinity', 'TIC']
-    vn_out_list = ['temp', 'salt' , 'PH', 'ARAG']
-else:
-    # vn_in_list = ['temp', 'salt', 'phytoplankton', 'NO3', 'oxygen', 'rho', 'alkalinity', 'TIC']
-    vn_in_list = ['temp', 'salt', 'phytoplankton', 'NO3', 'oxygen', 'alkalinity', 'TIC']
-    vn_out_list = ['temp', 'salt', 'phytoplankton', 'NO3', 'oxygen', 'PH', 'ARAG']
-
-do_carbon = True
-# this flag is introduced to handle different testgin choices
-if 'TIC' not in vn_in_list:
-    do_carbon = False
-
-# create zfull to use with the pfun.get_laym() function
-zfull = pfun.get_zfull(in_ds, in_fn, 'rho')
-in_mask_rho = in_ds.mask_rho.values # 1 = water, 0 = land
-
-def get_layer(vn, depth, in_ds, zfull, in_mask_rho):
-    if depth == 'surface':
-        L = in_ds[vn][0,-1,:,:].values
-    elif depth == 'bottom':
-        L = in_ds[vn][0,0,:,:].values
+from lo_tools import Lfun, zrfun
+from lo_tools import layer_functions as layfun
+from lo_tools import carbon_functions as carbfun
+
+def get_vn_lists(testing):
+    if testing:
+        # vn_in_list = ['temp', 'salt']
+        # vn_out_list = ['temp', 'salt']
+        vn_in_list = ['temp', 'salt', 'alkalinity', 'TIC']
+        vn_out_list = ['temp', 'salt' , 'PH', 'ARAG']
     else:
-        L = pfun.get_laym(in_ds, zfull, in_mask_rho, vn, -float(depth))
-    return L
+        vn_in_list = ['temp', 'salt', 'phytoplankton', 'NO3', 'oxygen', 'alkalinity', 'TIC']
+        vn_out_list = ['temp', 'salt', 'phytoplankton', 'NO3', 'oxygen', 'PH', 'ARAG']
+    return vn_in_list, vn_out_list
 
-def get_Ld(depth, in_ds, in_mask_rho):
+def get_Ld(depth, h, mask_rho):
     # makes a field of layer depth (m)
     if depth == 'surface':
-        Ld = 0 * np.ones(in_mask_rho.shape)
+        Ld = 0 * np.ones(mask_rho.shape)
     elif depth == 'bottom':
-        Ld = in_ds.h.values
+        Ld = h.copy()
     else:
-        Ld = float(depth) * np.ones(in_mask_rho.shape)
-    Ld[in_mask_rho == 0] = np.nan
+        Ld = float(depth) * np.ones(mask_rho.shape)
+    Ld[mask_rho == 0] = np.nan
     return Ld
 
-# Fill the layers
-for depth in depth_list:
-    if testing:
-        print(' - Depth = ' + depth)
-    suffix = '_' + depth
-    v_dict = dict()
-    tt0 = time()
-    for vn in vn_in_list:
-        v_dict[vn] = get_layer(vn, depth, in_ds, zfull, in_mask_rho)
-    if testing:
-        print('   -- fill v_dict took %0.2f sec' % (time()-tt0))
-        
-    if do_carbon:
-        # ------------- the CO2SYS steps -------------------------
-        tt0 = time()
-        # ===============================================================
-        # OLD
-        # Ld = get_Ld(depth, in_ds, in_mask_rho)
-        # lat = in_ds.lat_rho.values
-        # # create pressure
-        # Lpres = sw.pres(Ld, lat)
-        # # get in situ temperature from potential temperature
-        # Ltemp = sw.ptmp(v_dict['salt'], v_dict['temp'], 0, Lpres)
-        # # convert from umol/L to umol/kg using in situ dentity
-        # Lalkalinity = 1000 * v_dict['alkalinity'] / (v_dict['rho'] + 1000)
-        # Lalkalinity[Lalkalinity < 100] = np.nan
-        # LTIC = 1000 * v_dict['TIC'] / (v_dict['rho'] + 1000)
-        # LTIC[LTIC < 100] = np.nan
-        # CO2dict = CO2SYS(Lalkalinity, LTIC, 1, 2, v_dict['salt'], Ltemp, Ltemp,
-        #     Lpres, Lpres, 50, 2, 1, 10, 1, NH3=0.0, H2S=0.0)
-        # ===============================================================
-        # NEW: using gsw to create in-situ density
-        import gsw
-        lon = in_ds.lon_rho.values
-        lat = in_ds.lat_rho.values
-        Ld = get_Ld(depth, in_ds, in_mask_rho)
-        Lpres = gsw.p_from_z(-Ld, lat) # pressure [dbar]
-        SA = gsw.SA_from_SP(v_dict['salt'], Lpres, lon, lat)
-        CT = gsw.CT_from_pt(SA, v_dict['temp'])
-        rho = gsw.rho(SA, CT, Lpres) # in situ density
-        Ltemp = gsw.t_from_CT(SA, CT, Lpres) # in situ temperature
-        # convert from umol/L to umol/kg using in situ dentity
-        Lalkalinity = 1000 * v_dict['alkalinity'] / rho
-        Lalkalinity[Lalkalinity < 100] = np.nan
-        LTIC = 1000 * v_dict['TIC'] / rho
-        LTIC[LTIC < 100] = np.nan
-        CO2dict = CO2SYS(Lalkalinity, LTIC, 1, 2, v_dict['salt'], Ltemp, Ltemp,
-            Lpres, Lpres, 50, 2, 1, 10, 1, NH3=0.0, H2S=0.0)
-        # ===============================================================
-        # NOTE that the "in" and "out" versions of the returned variables will be
-        # identical because we pass the same pressure and temperature for
-        # input and output (in-situ in both cases)
-        PH = CO2dict['pHout']
-        v_dict['PH'] = PH.reshape((v_dict['salt'].shape))
-        ARAG = CO2dict['OmegaARout']
-        v_dict['ARAG'] = ARAG.reshape((v_dict['salt'].shape))
+class Layers:
+    """
+    Makes the layers for the times in fn_list. Call make_weights() before
+    using get_time().
+    """
+    # the layers to make (when testing we just do 10 m)
+    # depth_list = ['surface', '10', '20', '30', '50', 'bottom']
+    depth_list = ['surface', '10', '20', '30', '50',
+        '100', '500', '1000', '1500', '2000', '2500', 'bottom']
+    # set to True to use wetdry_mask_rho (if it exists) as the mask at each time
+    wetdry = False
+
+    def __init__(self, fn_list, testing=False, exact_z=False):
+        self.testing = testing
+        self.exact_z = exact_z
         if testing:
-            print('   -- carbon took %0.2f sec' % (time()-tt0))
-        # --------------------------------------------------------
-    
-    # Write data to the output file.
-    for vn in vn_out_list:
-        out_ds[vn + suffix] = (('ocean_time', 'eta_rho', 'xi_rho'), v_dict[vn].reshape((1,) + in_mask_rho.shape))
-        if vn == 'PH':
-            out_ds[vn + suffix].attrs['long_name'] = 'pH' + tag_dict[depth]
-        elif vn == 'ARAG':
-            out_ds[vn + suffix].attrs['long_name'] = 'Aragonite Saturation State' + tag_dict[depth]
+            self.depth_list = ['10']
+        self.vn_in_list, self.vn_out_list = get_vn_lists(testing)
+        self.do_carbon = 'TIC' in self.vn_in_list
+
+        G, S, T = zrfun.get_basic_info(fn_list[0])
+        self.S = S
+        ds = xr.open_dataset(fn_list[0])
+        self.static = {vn: ds[vn].values for vn in ['lon_rho', 'lat_rho', 'mask_rho', 'h']}
+        self.attrs = {vn: ds[vn].attrs for vn in list(self.static.keys()) + self.vn_in_list}
+        self.dtypes = {vn: ds[vn].dtype for vn in self.vn_in_list}
+        self.wetdry = self.wetdry and ('wetdry_mask_rho' in ds.data_vars)
+        ds.close()
+        self.mask_rho = self.static['mask_rho'] # 1 = water, 0 = land
+        # the time-invariant parts of the carbon calculation for each depth
+        self.C_dict = dict()
+
+        # the fields that get_time() needs from each history file
+        self.vn_list = self.vn_in_list.copy()
+        if self.wetdry:
+            self.vn_list.append('wetdry_mask_rho')
+        if exact_z:
+            self.vn_list.append('zeta')
+
+        # the depth layers that need interpolation
+        self.z_list = [-float(depth) for depth in self.depth_list
+            if depth not in ['surface', 'bottom']]
+
+    def make_weights(self, fn_list):
+        # Make the weights for each day, using the daily mean zeta from the
+        # files in fn_list (this does nothing if exact_z is True).
+        if not self.exact_z:
+            zeta_dict, self.day_list = layfun.get_daily_zeta(fn_list)
+            self.W_dict = dict()
+            for day in zeta_dict.keys():
+                zfull = layfun.get_zfull(self.static['h'], zeta_dict[day], self.S)
+                self.W_dict[day] = layfun.get_weights(zfull, self.z_list)
+
+    def make_file(self, out_fn):
+        # Start the output file, returning a LayersFile to pass to write()
+        lf = layfun.LayersFile(out_fn, Lfun.roms_time_units)
+        dims = ('eta_rho', 'xi_rho')
+        for vn in self.static.keys():
+            attrs = {att: self.attrs[vn][att] for att in ['long_name', 'units']
+                if att in self.attrs[vn]}
+            lf.add_static(vn, dims, self.static[vn], attrs)
+        for depth in self.depth_list:
+            if depth in ['surface', 'bottom']:
+                tag = ' at ' + depth
+            else:
+                tag = ' at ' + depth + ' m depth'
+            for vn in self.vn_out_list:
+                if vn == 'PH':
+                    attrs = {'long_name': 'pH' + tag}
+                elif vn == 'ARAG':
+                    attrs = {'long_name': 'Aragonite Saturation State' + tag}
+                else:
+                    attrs = {'long_name': self.attrs[vn]['long_name'] + tag}
+                    if 'units' in self.attrs[vn]:
+                        attrs['units'] = self.attrs[vn]['units']
+                if (depth in ['surface', 'bottom']) and (vn in self.vn_in_list):
+                    # these are copied from the history file, not interpolated
+                    lf.add_var(vn + '_' + depth, dims, attrs, dtype=self.dtypes[vn])
+                else:
+                    lf.add_var(vn + '_' + depth, dims, attrs)
+        return lf
+
+    def get_time(self, ii, F):
+        """
+        Make the layers for fn_list[ii] from the dict of fields F (as from
+        post_engine, with the fields in self.vn_list and ocean_time). Returns
+        ocean_time (sec) and a dict of the output fields to pass to write().
+        """
+        ot = Lfun.datetime_to_modtime(pd.Timestamp(F['ocean_time'][0]).to_pydatetime())
+        if self.wetdry:
+            mask = F['wetdry_mask_rho'][0,:,:]
         else:
-            out_ds[vn + suffix].attrs['long_name'] = in_ds[vn].attrs['long_name'] + tag_dict[depth]
-        try:
-            out_ds[vn + suffix].attrs['units'] = in_ds[vn].attrs['units']
-        except KeyError:
-            pass
-    sys.stdout.flush()
-
-
-in_ds.close()
-
-enc_dict = {'zlib':True, 'complevel':1, '_FillValue':1e20}
-Enc_dict = {vn:enc_dict for vn in out_ds.data_vars if 'ocean_time' in out_ds[vn].dims}
-out_ds.to_netcdf(out_fn, unlimited_dims='ocean_time', encoding=Enc_dict)
-# NOTE: we use unlimited_dims so that ncrcat knows what to do later
-out_ds.close()
\ No newline at end of file
+            mask = self.mask_rho
+        if self.exact_z:
+            zfull = layfun.get_zfull(self.static['h'], F['zeta'][0,:,:].astype(float), self.S)
+            W = layfun.get_weights(zfull, self.z_list)
+        else:
+            W = self.W_dict[self.day_list[ii]]
+        # the interpolated layers for each input field
+        lay_dict = dict()
+        for vn in self.vn_in_list:
+            lay_dict[vn] = layfun.get_layers(F[vn][0,:,:,:], W)
+        out_dict = dict()
+        iz = 0
+        for depth in self.depth_list:
+            v_dict = dict()
+            for vn in self.vn_in_list:
+                if depth == 'surface':
+                    v_dict[vn] = F[vn][0,-1,:,:].copy()
+                elif depth == 'bottom':
+                    v_dict[vn] = F[vn][0,0,:,:].copy()
+                else:
+                    v_dict[vn] = lay_dict[vn][iz,:,:].copy()
+                    v_dict[vn][mask == 0] = np.nan
+            if depth not in ['surface', 'bottom']:
+                iz += 1
+            if self.do_carbon:
+                # the pressure etc. for each depth are made once, by carbfun.get_static()
+                if depth not in self.C_dict.keys():
+                    Ld = get_Ld(depth, self.static['h'], self.mask_rho)
+                    self.C_dict[depth] = carbfun.get_static(self.static['lon_rho'],
+                        self.static['lat_rho'], -Ld, self.mask_rho)
+                C = carbfun.get_carbon(self.C_dict[depth], v_dict, mask=mask)
+                v_dict['PH'] = C['PH']
+                v_dict['ARAG'] = C['ARAG']
+            for vn in self.vn_out_list:
+                out_dict[vn + '_' + depth] = v_dict[vn]
+        return ot, out_dict
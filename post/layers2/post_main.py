@@ -31,20 +31,17 @@ share_name = 'layers2'
 # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 # imports
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
 from time import time
-import shutil
+import multiprocessing as mp
+import xarray as xr
 from lo_tools import Lfun
-import numpy as np
+import make_layers
 
 print(' - Creating extraction file for ' + Ldir['date_string'])
 
 # this is where the output ends up
 out_dir = Ldir['LOo'] / 'post' / Ldir['gtagex'] / ('f' + Ldir['date_string']) / Ldir['job']
 out_fn = out_dir / (share_name + '.nc')
-temp_dir = out_dir / 'tempfiles'
-Lfun.make_dir(temp_dir, clean=True)
 
 # create time range for extraction
 ds0 = Ldir['date_string']
@@ -63,54 +60,31 @@ else:
 
 # do the extractions
 N = len(fn_list)
-proc_list = []
 tt0 = time()
 print('Working on ' + Ldir['job'] + ' (' + str(N) + ' times)')
-for ii in range(N):
-    in_fn = fn_list[ii]
-    sys.stdout.flush()
-    count_str = ('000000' + str(ii))[-6:]
-    temp_out_fn = temp_dir / ('layers_' + count_str + '.nc')
-    this_dir = str(Ldir['LO'] / 'post' / Ldir['job']) + '/'
-    cmd_list = ['python', this_dir + 'make_layers.py', '-in_fn', str(in_fn),
-        '-out_fn', str(temp_out_fn), '-test', str(Ldir['testing'])]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-        
-    # Nproc controls how many ncks subprocesses we allow to stack up
-    # before we require them all to finish.
-    # NOTE: we add the (ii > 0) because otherwise it starts by doing a single
-    # job, and in this case the jobs are long enough for that to be a significant
-    # slowdown.
-    if ((np.mod(ii,Ldir['Nproc']) == 0) and (ii > 0)) or (ii == N-1):
-        for proc in proc_list:
-            stdout, stderr = proc.communicate()
-            # make sure everyone is finished before continuing
-            if True:
-                if len(stdout) > 0:
-                    print('\n'+stdout.decode())
-                if len(stderr) > 0:
-                    print('\n'+stderr.decode())
-        proc_list = []
-    ii += 1
-    
-# concatenate the records into one file
-# This bit of code is a nice example of how to replicate a bash pipe
-pp1 = Po(['ls', str(temp_dir)], stdout=Pi)
-pp2 = Po(['grep','layers'], stdin=pp1.stdout, stdout=Pi)
-cmd_list = ['ncrcat','-p', str(temp_dir), '-O', str(out_fn)]
-proc = Po(cmd_list, stdin=pp2.stdout, stdout=Pi, stderr=Pi)
-stdout, stderr = proc.communicate()
-if True:
-    if len(stdout) > 0:
-        print('\n'+stdout.decode())
-    if len(stderr) > 0:
-        print('\n'+stderr.decode())
+# this makes the interpolation weights for each day
+L = make_layers.Layers(fn_list, testing=Ldir['testing'], exact_z=Ldir['exact_z'])
+L.make_weights(fn_list)
+print(' - Time to make weights = %0.2f sec' % (time()- tt0))
+sys.stdout.flush()
+
+def get_time(ii):
+    # read the fields for one time and make its layers
+    ds = xr.open_dataset(fn_list[ii])
+    F = {vn: ds[vn].values for vn in L.vn_list + ['ocean_time']}
+    ds.close()
+    return L.get_time(ii, F)
+
+# The times are done in parallel by Nproc processes, and written to
+# the output file in order by this one.
+Nproc = max(1, min(Ldir['Nproc'], N))
+with mp.get_context('fork').Pool(Nproc) as pool:
+    lf = L.make_file(out_fn)
+    for ot, out_dict in pool.imap(get_time, range(N)):
+        lf.write(ot, out_dict)
+    lf.close()
 print('Time for full layers extraction = %0.2f sec' % (time()- tt0))
 
-if not Ldir['testing']:
-    Lfun.make_dir(temp_dir, clean=True)
-
 print('\nPath to file:\n%s' % (str(out_fn)))
 
 # copy the file to kopah
@@ -1,5 +1,5 @@
 """
-This creates a layers file for a single time.
+This makes the layers for the layers_uv job, for use by post_main.py.
 
 It is designed for the needs of some APL glider researchers who
 want velocities in the Strait of Juan de Fuca.
@@ -9,272 +9,158 @@ packs the fields as 3-D (t,z,y,x) instead of individual files for
 individual layers. Time is a singleton dimension, but unlimited in
 case we wanted to concatenate later.
 
+Each time is done by Layers.write_time(), which only needs the fields from one
+history file. The region is cut out of the fields in memory (this used to be done by
+running ncks to make a small temp file), and the vertical interpolation weights for
+the rho, u, and v grids are made once per day from the daily mean zeta using
+lo_tools/layer_functions.py. Use exact_z=True to make the weights for each time from
+its own zeta instead. Before this the layers used zeta = 0.
+
 To test on mac:
 
-run make_layers -test True
+run post_main.py -gtx cas7_t0_x4b -ro 0 -d 2017.07.04 -r backfill -job layers_uv -test True
 """
 
-from pathlib import Path
-import argparse
 import xarray as xr
-from time import time
+import pandas as pd
 import numpy as np
-import sys
-
-from lo_tools import plotting_functions as pfun
-from lo_tools import zfun
-
-# defaults for testing
-from lo_tools import Lfun
-Ldir = Lfun.Lstart()
-in_fn = (Ldir['roms_out'] /
-    'cas7_t0_x4b' / 'f2017.07.04' / 'ocean_his_0002.nc')
-in_num_str = in_fn.name[-7:-3]
-out_fn = (Ldir['parent'] / 'LO_output' / 'post' /
-    'cas7_t0_x4b' / 'f2017.07.04' / 'layers_uv' / ('layers_' + in_num_str + '.nc'))
-
-# command line arguments, passed from post_main.py
-parser = argparse.ArgumentParser()
-parser.add_argument('-in_fn', default=in_fn, type=str)
-parser.add_argument('-out_fn', default=out_fn, type=str)
-parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_string)
-
-args = parser.parse_args()
-in_fn = Path(args.in_fn)
-out_fn = Path(args.out_fn)
-testing = args.testing
-
-# make sure output directory exists
-out_dir = out_fn.parent
-Lfun.make_dir(out_dir)
-out_fn.unlink(missing_ok=True)
-
-"""
-The algorithm strategy is to first use ncks to create a version of the
-history file that oonly has a specific region and only the needed variables.
-This makes things much faster when we go to extract layers, and it makes
-the output files much smaller.
-"""
-# specify region to extract and get its indices
-#
-# just the Strait of Juan de Fuca
-aa = [-125.3, -122.3, 47.9, 48.8]
-#
-in_ds = xr.open_dataset(in_fn, decode_times=False)
-Lon = in_ds.lon_rho[0,:].values
-Lat = in_ds.lat_rho[:,0].values
-def check_bounds(lon, lat):
-    # error checking
-    if (lon < Lon[0]) or (lon > Lon[-1]):
-        print('ERROR: lon out of bounds ')
-        sys.exit()
-    if (lat < Lat[0]) or (lat > Lat[-1]):
-        print('ERROR: lat out of bounds ')
-        sys.exit()
-    # get indices
-    ilon = zfun.find_nearest_ind(Lon, lon)
-    ilat = zfun.find_nearest_ind(Lat, lat)
-    return ilon, ilat
-lon0, lon1, lat0, lat1 = aa
-ilon0, ilat0 = check_bounds(lon0, lat0)
-ilon1, ilat1 = check_bounds(lon1, lat1)
-in_ds.close()
-
-Ncenter = 30
-verbose = False
-def messages(stdout, stderr, mtitle, verbose):
-    # utility function for displaying subprocess info
-    if verbose:
-        print((' ' + mtitle + ' ').center(Ncenter,'='))
-        if len(stdout) > 0:
-            print(' sdtout '.center(Ncenter,'-'))
-            print(stdout.decode())
-    if len(stderr) > 0:
-        print((' ' + mtitle + ' ').center(Ncenter,'='))
-        # always print errors
-        print(' stderr '.center(Ncenter,'-'))
-        print(stderr.decode())
-    sys.stdout.flush()
-
-# Here we do the ncks extraction to get a smaller file to work with. Note
-# that we take care to have all the grid limits just like in a history file,
-# meaning that the rho-grid extends to the corners and the u, v, and psi
-# grids are smaller.
-out_fn_small = out_dir / out_fn.name.replace('layers','small')
-# use ncks to extract a sub-domain
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
-vn_list = 'h,f,pm,pn,mask_rho,mask_u,mask_v,mask_psi,salt,temp,zeta,u,v,w,Vtransform'
-cmd_list1 = ['ncks',
-    '-v', vn_list,
-    '-d', 'xi_rho,'+str(ilon0)+','+str(ilon1), '-d', 'eta_rho,'+str(ilat0)+','+str(ilat1),
-    '-d', 'xi_u,'+str(ilon0)+','+str(ilon1-1), '-d', 'eta_u,'+str(ilat0)+','+str(ilat1),
-    '-d', 'xi_v,'+str(ilon0)+','+str(ilon1), '-d', 'eta_v,'+str(ilat0)+','+str(ilat1-1),
-    '-d', 'xi_psi,'+str(ilon0)+','+str(ilon1-1), '-d', 'eta_psi,'+str(ilat0)+','+str(ilat1-1),
-    '--mk_rec_dim', 'ocean_time']
-cmd_list1 += ['-O', str(in_fn), str(out_fn_small)]
-proc = Po(cmd_list1, stdout=Pi, stderr=Pi)
-stdout, stderr = proc.communicate()
-messages(stdout, stderr, 'ncks', verbose)
-
-# rename "in_fn" so that now we will do the rest of the work using our small file.
-in_fn = out_fn_small
-in_ds = xr.open_dataset(in_fn, decode_times=False)
-# NOTE: now "in_ds" refers to our small temporary file
-
-# initiate the output Dataset
-out_ds = xr.Dataset()
-# add time
-out_ds['ocean_time'] = (('ocean_time'), in_ds.ocean_time.values)
-out_ds['ocean_time'].attrs['units'] = Ldir['roms_time_units']
-# add coordinates and other static 2-D fields
-vn_list = [ 'lon_rho', 'lat_rho', 'mask_rho', 'h']
-for vn in vn_list:
-    out_ds[vn] = (('eta_rho', 'xi_rho'), in_ds[vn].values)
-    out_ds[vn].attrs['long_name'] = in_ds[vn].attrs['long_name']
-    try:
-        out_ds[vn].attrs['units'] = in_ds[vn].attrs['units']
-    except KeyError:
-        pass
-
-# Specify the z-levels to use
-if testing:
-    z_vec = np.array([-4000,-50,-10,0]) 
-else:
-    z_vec = np.linspace(-300,0,16)
-
-# add z as a coordinate and as a data_var
-out_ds['z'] = (('z'), z_vec)
-out_ds['z'].attrs['units'] = 'm'
-out_ds['z'].attrs['long_name'] = 'vertical coordinate relative to flat sea surface, positive up'
 
-# set list of variables we will interpolate to layers
-vn_in_list = ['temp', 'salt', 'u', 'v']
-vn_out_list = ['temp', 'salt' , 'ur', 'vr']
-# we introduce the variable names ur and vr for the u and v velocities
-# interpolated to the rho grid.
-
-# create zfull to use with the pfun.get_laym() function
-zfull_rho = pfun.get_zfull(in_ds, in_fn, 'rho')
-zfull_u = pfun.get_zfull(in_ds, in_fn, 'u')
-zfull_v = pfun.get_zfull(in_ds, in_fn, 'v')
-# also get masks
-in_mask_rho = in_ds.mask_rho.values # 1 = water, 0 = land
-in_mask_u = in_ds.mask_u.values # 1 = water, 0 = land
-in_mask_v = in_ds.mask_v.values # 1 = water, 0 = land
-
-def get_layer(vn, z, in_ds, zfull, in_mask):
-    # convenience function that wraps pfun.get_laym() and makes sure
-    # that z = 0 is interpreted as the topmost (-1) bin.
-    if vn in ['salt','temp']:
-        if z == 0:
-            L = in_ds[vn][0,-1,:,:].values
+from lo_tools import Lfun, zfun, zrfun
+from lo_tools import layer_functions as layfun
+
+class Layers:
+    """
+    Makes the layers for the times in fn_list. Call make_weights() before
+    using write_time().
+    """
+    # specify region to extract
+    #
+    # just the Strait of Juan de Fuca
+    aa = [-125.3, -122.3, 47.9, 48.8]
+
+    def __init__(self, fn_list, testing=False, exact_z=False):
+        self.exact_z = exact_z
+
+        G, S, T = zrfun.get_basic_info(fn_list[0])
+        self.S = S
+        Lon = G['lon_rho'][0,:]
+        Lat = G['lat_rho'][:,0]
+        lon0, lon1, lat0, lat1 = self.aa
+        for lon, lat in [(lon0, lat0), (lon1, lat1)]:
+            if (lon < Lon[0]) or (lon > Lon[-1]) or (lat < Lat[0]) or (lat > Lat[-1]):
+                raise ValueError('layers_uv region is out of bounds')
+        ilon0 = zfun.find_nearest_ind(Lon, lon0)
+        ilat0 = zfun.find_nearest_ind(Lat, lat0)
+        ilon1 = zfun.find_nearest_ind(Lon, lon1)
+        ilat1 = zfun.find_nearest_ind(Lat, lat1)
+        # Note that we take care to have all the grid limits just like in a history
+        # file, meaning that the rho-grid extends to the corners and the u and v
+        # grids are smaller.
+        self.jj = {'rho':slice(ilat0, ilat1+1), 'u':slice(ilat0, ilat1+1), 'v':slice(ilat0, ilat1)}
+        self.ii = {'rho':slice(ilon0, ilon1+1), 'u':slice(ilon0, ilon1), 'v':slice(ilon0, ilon1+1)}
+
+        ds = xr.open_dataset(fn_list[0])
+        self.static = dict()
+        for vn in ['lon_rho', 'lat_rho', 'mask_rho', 'h', 'mask_u', 'mask_v']:
+            gr = vn.split('_')[-1] if vn != 'h' else 'rho'
+            self.static[vn] = ds[vn].values[self.jj[gr], self.ii[gr]]
+        self.attrs = {vn: ds[vn].attrs for vn in list(self.static.keys()) + ['temp', 'salt']}
+        ds.close()
+
+        # Specify the z-levels to use
+        if testing:
+            self.z_vec = np.array([-4000,-50,-10,0])
         else:
-            L = pfun.get_laym(in_ds, zfull_rho, in_mask_rho, vn, z)
-    elif vn == 'u':
-        if z == 0:
-            L = in_ds[vn][0,-1,:,:].values
+            self.z_vec = np.linspace(-300,0,16)
+        # z = 0 is interpreted as the topmost s_rho level
+        self.z_list = [z for z in self.z_vec if z != 0]
+
+        # set list of variables we will interpolate to layers
+        self.vn_in_list = ['temp', 'salt', 'u', 'v']
+        self.vn_out_list = ['temp', 'salt' , 'ur', 'vr']
+        # we introduce the variable names ur and vr for the u and v velocities
+        # interpolated to the rho grid.
+        self.gr_dict = {'temp':'rho', 'salt':'rho', 'u':'u', 'v':'v'}
+
+        # the fields that write_time() needs from each history file
+        self.vn_list = self.vn_in_list.copy()
+        if exact_z:
+            self.vn_list.append('zeta')
+
+    def get_weights(self, zeta):
+        # weights for each grid, with zeta on the rho grid of the region
+        W = dict()
+        for gr in ['rho', 'u', 'v']:
+            zfull = layfun.get_zfull(self.static['h'], zeta, self.S, which_grid=gr)
+            W[gr] = layfun.get_weights(zfull, self.z_list, mask=self.static['mask_' + gr])
+        return W
+
+    def make_weights(self, fn_list):
+        # Make the weights for each day, using the daily mean zeta from the
+        # files in fn_list (this does nothing if exact_z is True).
+        if not self.exact_z:
+            zeta_dict, self.day_list = layfun.get_daily_zeta(fn_list)
+            self.W_dict = dict()
+            for day in zeta_dict.keys():
+                self.W_dict[day] = self.get_weights(zeta_dict[day][self.jj['rho'], self.ii['rho']])
+
+    def write_time(self, ii, F, out_fn):
+        """
+        Make the layers for fn_list[ii] from the dict of fields F (with the fields
+        in self.vn_list and ocean_time) and save them to out_fn.
+        """
+        ot = Lfun.datetime_to_modtime(pd.Timestamp(F['ocean_time'][0]).to_pydatetime())
+        if self.exact_z:
+            W = self.get_weights(F['zeta'][0, self.jj['rho'], self.ii['rho']].astype(float))
         else:
-            L = pfun.get_laym(in_ds, zfull_u, in_mask_u, vn, z)
-    elif vn == 'v':
-        if z == 0:
-            L = in_ds[vn][0,-1,:,:].values
-        else:
-            L = pfun.get_laym(in_ds, zfull_v, in_mask_v, vn, z)
-    return L
-
-# prepare a dict of nan arrays for output
-out_dict = dict()
-NZ = len(z_vec)
-NY, NX = in_ds.lon_rho.shape
-out_mat = np.nan * np.ones((1,NZ,NY,NX))
-for vn in vn_out_list:
-    out_dict[vn] = out_mat.copy()
-
-# Fill the output arrays by interpolating to each layer z. We also interpolate
-# u and v to be on the rho-grid. This leaves a band of nan on the outer edge
-# of the ur and vr fields, but we assume the box is bigger than what the user
-# needs.
-for vn in vn_in_list:
-    tt0 = time()
-    ii = 0
-    for z in z_vec:
-        if vn in ['salt','temp']:
-            out_dict[vn][0,ii,:,:] = get_layer(vn, z, in_ds, zfull_rho, in_mask_rho)
-        elif vn == 'u':
-            u = get_layer(vn, z, in_ds, zfull_u, in_mask_u)
-            out_dict['ur'][0,ii,1:-1,1:-1] = u[1:-1,:-1] + (u[1:-1,1:]-u[1:-1,:-1])/2
-        elif vn == 'v':
-            v = get_layer(vn, z, in_ds, zfull_v, in_mask_v)
-            out_dict['vr'][0,ii,1:-1,1:-1] = v[:-1,1:-1] + (v[1:,1:-1]-v[:-1,1:-1])/2
-        ii += 1
-    if testing:
-        print('   -- vn = %s: fill out_dict took %0.2f sec' % (vn,time()-tt0))
-        sys.stdout.flush()
-    
-# Write data to the output file.
-for vn in vn_out_list:
-    out_ds[vn] = (('ocean_time', 'z', 'eta_rho', 'xi_rho'), out_dict[vn])
-    if vn == 'ur':
-        out_ds[vn].attrs['long_name'] = 'u-velocity, positive to east'
-        out_ds[vn].attrs['units'] = 'm s-1'
-    elif vn == 'vr':
-        out_ds[vn].attrs['long_name'] = 'v-velocity, positive to north'
-        out_ds[vn].attrs['units'] = 'm s-1'
-    else:
-        out_ds[vn].attrs['long_name'] = in_ds[vn].attrs['long_name']
-        try:
-            out_ds[vn].attrs['units'] = in_ds[vn].attrs['units']
-        except KeyError:
-            pass
-out_ds['salt'].attrs['units'] = 'PSU'
-
-
-# compress and write to output NetCDF file
-enc_dict = {'zlib':True, 'complevel':1, '_FillValue':1e20}
-Enc_dict = {vn:enc_dict for vn in out_ds.data_vars if 'ocean_time' in out_ds[vn].dims}
-out_ds.to_netcdf(out_fn, unlimited_dims='ocean_time', encoding=Enc_dict)
-# NOTE: we use unlimited_dims so that ncrcat knows what to do later, if we decide
-# to concatenate to a larger file.
-
-# close open Datasets
-in_ds.close()
-out_ds.close()
-
-if testing == False:
-    # clean up temp file
-    in_fn.unlink(missing_ok=True)
-
-if testing:
-    # a visual check that things are not way off
-
-    out_ds = xr.open_dataset(out_fn)
-    # plotting
-    import matplotlib.pyplot as plt
-    plt.close('all')
-    pfun.start_plot(figsize=(20,10))
-    lon = out_ds.lon_rho.values
-    lat = out_ds.lat_rho.values
-    plon, plat = pfun.get_plon_plat(lon,lat)
-
-    lim_dict = {'salt':(25,34),'temp':(8,18),'ur':(-1,1),'vr':(-1,1)}
-    cmap_dict = {'salt':'Spectral_r','temp':'jet','ur':'RdBu_r','vr':'RdBu_r'}
-
-    for vn in vn_out_list:
-        fig = plt.figure()
-        vmin, vmax = lim_dict[vn]
-        NT, NZ, NY, NX = out_ds[vn].shape
-        zz = out_ds.z.values
-        ii = 0
-        for z in zz:
-            ax = fig.add_subplot(2,2,ii+1)
-            cs = ax.pcolormesh(plon,plat,out_ds[vn][0,ii,:,:].values,
-                vmin=vmin,vmax=vmax,cmap=cmap_dict[vn])
-            fig.colorbar(cs,ax=ax)
-            ax.set_title('%s, z = %d m' % (vn,z))
-            pfun.dar(ax)
-            ii += 1
-
-    plt.show()
-    pfun.end_plot()
-
+            W = self.W_dict[self.day_list[ii]]
+
+        # prepare a dict of nan arrays for output
+        out_dict = dict()
+        NZ = len(self.z_vec)
+        NY, NX = self.static['lon_rho'].shape
+        out_mat = np.nan * np.ones((NZ,NY,NX))
+        for vn in self.vn_out_list:
+            out_dict[vn] = out_mat.copy()
+
+        # Fill the output arrays by interpolating to each layer z. We also interpolate
+        # u and v to be on the rho-grid. This leaves a band of nan on the outer edge
+        # of the ur and vr fields, but we assume the box is bigger than what the user
+        # needs.
+        iz_list = [iz for iz in range(NZ) if self.z_vec[iz] != 0]
+        for vn in self.vn_in_list:
+            gr = self.gr_dict[vn]
+            fld = F[vn][0, :, self.jj[gr], self.ii[gr]]
+            lay = np.nan * np.ones((NZ,) + fld.shape[1:])
+            lay[iz_list,:,:] = layfun.get_layers(fld, W[gr])
+            lay[self.z_vec == 0,:,:] = fld[-1,:,:]
+            if vn in ['salt','temp']:
+                out_dict[vn] = lay
+            elif vn == 'u':
+                out_dict['ur'][:,1:-1,1:-1] = lay[:,1:-1,:-1] + (lay[:,1:-1,1:]-lay[:,1:-1,:-1])/2
+            elif vn == 'v':
+                out_dict['vr'][:,1:-1,1:-1] = lay[:,:-1,1:-1] + (lay[:,1:,1:-1]-lay[:,:-1,1:-1])/2
+
+        # write data to the output file
+        lf = layfun.LayersFile(out_fn, Lfun.roms_time_units)
+        for vn in ['lon_rho', 'lat_rho', 'mask_rho', 'h']:
+            attrs = {att: self.attrs[vn][att] for att in ['long_name', 'units']
+                if att in self.attrs[vn]}
+            lf.add_static(vn, ('eta_rho', 'xi_rho'), self.static[vn], attrs)
+        # add z as a coordinate and as a data_var
+        lf.add_static('z', ('z',), self.z_vec, {'units':'m',
+            'long_name':'vertical coordinate relative to flat sea surface, positive up'})
+        for vn in self.vn_out_list:
+            if vn == 'ur':
+                attrs = {'long_name':'u-velocity, positive to east', 'units':'m s-1'}
+            elif vn == 'vr':
+                attrs = {'long_name':'v-velocity, positive to north', 'units':'m s-1'}
+            else:
+                attrs = {'long_name':self.attrs[vn]['long_name']}
+                if 'units' in self.attrs[vn]:
+                    attrs['units'] = self.attrs[vn]['units']
+            if vn == 'salt':
+                attrs['units'] = 'PSU'
+            lf.add_var(vn, ('z', 'eta_rho', 'xi_rho'), attrs)
+        lf.write(ot, out_dict)
+        lf.close()
@@ -29,9 +29,10 @@ result_dict['start_dt'] = datetime.now()
 from subprocess import Popen as Po
 from subprocess import PIPE as Pi
 from time import time
-import shutil
+import multiprocessing as mp
+import xarray as xr
 from lo_tools import Lfun
-import numpy as np
+import make_layers
 
 print(' - Creating extraction file for ' + Ldir['date_string'])
 
@@ -80,35 +81,29 @@ messages(stdout, stderr, 's3cmd mb', verbose)
 
 # do the extractions
 N = len(fn_list)
-proc_list = []
+tt0 = time()
 print('Working on ' + Ldir['job'] + ' (' + str(N) + ' times)')
-for ii in range(N):
-    tt0 = time()
-    in_fn = fn_list[ii]
-    sys.stdout.flush()
+# this makes the interpolation weights for each day
+L = make_layers.Layers(fn_list, testing=False, exact_z=Ldir['exact_z'])
+L.make_weights(fn_list)
+print(' - Time to make weights = %0.2f sec' % (time()- tt0))
+sys.stdout.flush()
+
+def do_time(ii):
+    # read the fields for one time and write its layers file
+    ds = xr.open_dataset(fn_list[ii])
+    F = {vn: ds[vn].values for vn in L.vn_list + ['ocean_time']}
+    ds.close()
     hour_str = ('000000' + str(ii))[-4:] # name by UTC hour for this forecast day.
-    out_fn = out_dir / ('layers_hour_' + hour_str + '.nc')
-    this_dir = str(Ldir['LO'] / 'post' / Ldir['job']) + '/'
-    cmd_list = ['python', this_dir + 'make_layers.py', '-in_fn', str(in_fn),
-        '-out_fn', str(out_fn), '-test', 'False']
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-        
-    # Nproc controls how many ncks subprocesses we allow to stack up
-    # before we require them all to finish.
-    # NOTE: we add the (ii > 0) because otherwise it starts by doing a single
-    # job, and in this case the jobs are long enough for that to be a significant
-    # slowdown.
-    if ((np.mod(ii,Ldir['Nproc']) == 0) and (ii > 0)) or (ii == N-1):
-        for proc in proc_list:
-            stdout, stderr = proc.communicate()
-            # make sure everyone is finished before continuing
-            if True:
-                if len(stdout) > 0:
-                    print('\n'+stdout.decode())
-                if len(stderr) > 0:
-                    print('\n'+stderr.decode())
-        proc_list = []
+    L.write_time(ii, F, out_dir / ('layers_hour_' + hour_str + '.nc'))
+
+# the times are done in parallel by Nproc processes
+Nproc = max(1, min(Ldir['Nproc'], N))
+with mp.get_context('fork').Pool(Nproc) as pool:
+    pool.map(do_time, range(N))
+print('Time for full layers extraction = %0.2f sec' % (time()- tt0))
+# the last file, used to test for success
+out_fn = out_dir / ('layers_hour_' + ('000000' + str(N-1))[-4:] + '.nc')
     
 if Ldir['testing'] == False:
     for ii in range(N):
@@ -0,0 +1,11 @@
+"""
+Consumer for lo_tools/post_engine.py, used by driver_post1.py -engine True.
+
+It makes the same sequim.nc as post_main.py, but from fields read once by the
+engine instead of running extract_box.py.
+"""
+
+from lo_tools import post_engine
+
+def get_consumer(Ldir, fn_list):
+    return post_engine.BoxConsumer(Ldir, fn_list, 'sequim0', 'sequim')
@@ -0,0 +1,48 @@
+"""
+Consumer for lo_tools/post_engine.py, used by driver_post1.py -engine True.
+
+It does the same as post_main.py, from fields read once by the engine.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from lo_tools import Lfun, post_engine
+from lo_tools import station_functions as stafun
+
+class StationsConsumer(post_engine.Consumer):
+
+    def __init__(self, Ldir, fn_list):
+        super().__init__(Ldir)
+        self.sta_dir = stafun.get_sta_dir(Ldir)
+        self.reg_df = stafun.get_registry(self.sta_dir)
+        self.jj = self.reg_df.j.to_numpy(dtype=int)
+        self.ii = self.reg_df.i.to_numpy(dtype=int)
+        ds = xr.open_dataset(fn_list[0])
+        self.vn_list = [vn for vn in stafun.vn_list_default if vn in ds.data_vars]
+        ds.close()
+
+    def setup(self, fn_list):
+        self.ot_list = []
+        self.D_list = []
+
+    def use(self, ii, F):
+        self.ot_list.append(Lfun.datetime_to_modtime(
+            pd.Timestamp(F['ocean_time'][0]).to_pydatetime()))
+        self.D_list.append({vn: F[vn][0,self.jj,self.ii].astype(float)
+            for vn in self.vn_list})
+
+    def finish(self):
+        ot = np.array(self.ot_list)
+        for k, name in enumerate(self.reg_df.index):
+            D = {vn: np.array([Di[vn][k] for Di in self.D_list]) for vn in self.vn_list}
+            stafun.append(self.sta_dir / name, ot, D,
+                overwrite=(self.Ldir['run_type'] == 'forecast'))
+        print('Appended %d times to %d stations in\n%s' % (len(ot), len(self.reg_df),
+            str(self.sta_dir)))
+        self.note = '%d stations' % (len(self.reg_df))
+        return 'success'
+
+def get_consumer(Ldir, fn_list):
+    return StationsConsumer(Ldir, fn_list)
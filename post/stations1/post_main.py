@@ -0,0 +1,64 @@
+"""
+This is the main program for appending the forecast to the station store
+(lo_tools/station_functions.py), which holds hourly surface time series at the
+registered stations: tide gauges, moorings, and the daymovie mooring points.
+
+For a forecast the days from the new forecast replace any that were there from the
+day before. Run it before daymovie0 so the movies can get their time series from it.
+The store is in LO_output/extract/[gtagex]/stations, not in the post output folder.
+
+Testing on mac:
+run post_main.py -gtx cas6_v3_lo8b -ro 2 -d 2019.07.04 -r backfill -job stations1 -test True
+
+Run for real on apogee:
+python post_main.py -gtx cas6_v0_u0mb -ro 0 -d [today's date string] -r forecast -job stations1
+
+"""
+
+from datetime import datetime, timedelta
+
+from lo_tools import post_argfun
+
+Ldir = post_argfun.intro() # this handles all the argument passing
+result_dict = dict()
+result_dict['start_dt'] = datetime.now()
+
+# ****************** CASE-SPECIFIC CODE *****************
+
+from time import time
+from lo_tools import Lfun
+from lo_tools import station_functions as stafun
+
+print(' - Appending to the station store for ' + Ldir['date_string'])
+
+# create time range
+ds0 = Ldir['date_string']
+dt0 = datetime.strptime(ds0, Lfun.ds_fmt)
+if Ldir['run_type'] == 'backfill':
+    ds1 = ds0
+elif Ldir['run_type'] == 'forecast':
+    ndays = Ldir['forecast_days']
+    dt1 = dt0 + timedelta(days=ndays-1)
+    ds1 = dt1.strftime(Lfun.ds_fmt)
+fn_list = Lfun.get_fn_list('hourly', Ldir, ds0, ds1)
+
+tt0 = time()
+sta_dir = stafun.get_sta_dir(Ldir)
+reg_df = stafun.get_registry(sta_dir)
+print(reg_df)
+nfile = stafun.update(sta_dir, fn_list, overwrite=(Ldir['run_type'] == 'forecast'),
+    Nproc=Ldir['Nproc'])
+print('Read %d of %d history files' % (nfile, len(fn_list)))
+print('Elapsed time = %0.2f sec' % (time()-tt0))
+print('\nPath to store:\n%s' % (str(sta_dir)))
+
+# -------------------------------------------------------
+
+# test for success
+result_dict['result'] = 'success'
+result_dict['note'] = '%d stations' % (len(reg_df))
+
+# *******************************************************
+
+result_dict['end_dt'] = datetime.now()
+post_argfun.finale(Ldir, result_dict)
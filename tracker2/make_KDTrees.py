@@ -14,6 +14,20 @@ python make_KDTrees.py -gtx cas7_t0_x4b -d 2017.07.04 -ro 0
 
 PERFORMANCE: takes about 30 sec on my mac for the cas7 grid.
 
+2026.10.18 Version 3 of the tree folder format:
+- each tree is saved as its pickle state, with the arrays (the points, the
+index, and the node buffer) as .npy files and the rest in a small [tree_name].p file.
+trackfun.get_tree() rebuilds the tree from these with the large arrays memory-mapped,
+so it loads in a fraction of the time of an unpickled tree, only reads the pages
+the queries touch, and processes running at the same time share them.
+
+2026.10.18 Version 2 of the tree folder format:
+- the trees are built with balanced_tree=False and compact_nodes=False, which
+is about 2x faster to build and gives the same nearest neighbors
+- we write tree_info.csv (version number and grid size) after all the trees are
+done, so trackfun.py can tell if the folder is complete and up to date. trackfun.py
+only loads the trees a run actually uses, when it first needs them.
+
 """
 
 from lo_tools import Lfun, zrfun, zfun
@@ -54,26 +68,43 @@ Lfun.make_dir(outdir, clean=True)
 G, S, T = zrfun.get_basic_info(fn)
 h = G['h']
 
+tree_version = 3 # must match trackfun.py
+
+def make_tree(xy):
+    # faster to build than the default, and the queries give the same results
+    return cKDTree(xy, balanced_tree=False, compact_nodes=False)
+
+def save_tree(tree, tree_name):
+    # Save the arrays in the state of the tree as .npy files, and the rest of the
+    # state in a pickle, with the string 'npy' in place of each array.
+    state = list(tree.__getstate__())
+    for ii, item in enumerate(state):
+        if isinstance(item, np.ndarray):
+            np.save(outdir / ('%s_%d.npy' % (tree_name, ii)), item)
+            state[ii] = 'npy'
+    with open(outdir / (tree_name + '.p'), 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
 # 2D trees
 X = G['lon_rho']; Y = G['lat_rho']
 Maskr = G['mask_rho']==1 # True over water
 xy = np.array((X[Maskr],Y[Maskr])).T
-xyT_rho = cKDTree(xy)
+xyT_rho = make_tree(xy)
 xy = np.array((X.flatten(),Y.flatten())).T
-xyT_rho_un = cKDTree(xy) # unmasked version
+xyT_rho_un = make_tree(xy) # unmasked version
 X = G['lon_u']; Y = G['lat_u']
 Masku = G['mask_u']==1 # True over water
 xy = np.array((X[Masku],Y[Masku])).T
-xyT_u = cKDTree(xy)
+xyT_u = make_tree(xy)
 X = G['lon_v']; Y = G['lat_v']
 Maskv = G['mask_v']==1 # True over water
 xy = np.array((X[Maskv],Y[Maskv])).T
-xyT_v = cKDTree(xy)
+xyT_v = make_tree(xy)
 
-pickle.dump(xyT_rho, open(outdir / 'xyT_rho.p', 'wb'))
-pickle.dump(xyT_rho_un, open(outdir / 'xyT_rho_un.p', 'wb'))
-pickle.dump(xyT_u, open(outdir / 'xyT_u.p', 'wb'))
-pickle.dump(xyT_v, open(outdir / 'xyT_v.p', 'wb'))
+save_tree(xyT_rho, 'xyT_rho')
+save_tree(xyT_rho_un, 'xyT_rho_un')
+save_tree(xyT_u, 'xyT_u')
+save_tree(xyT_v, 'xyT_v')
 
 # 3D trees
 for tag in ['w', 'rho', 'u', 'v']:
@@ -123,27 +154,13 @@ for tag in ['w', 'rho', 'u', 'v']:
     # create the nearest neighbor Tree objects
     tt0 = time()
 
-    if tag == 'rho':
-        xyzT_rho = cKDTree(xyz)
-        pickle.dump(xyzT_rho, open(outdir / 'xyzT_rho.p', 'wb'))
-        xyzT_rho_m = cKDTree(xyz_m)  #jx
-        pickle.dump(xyzT_rho_m, open(outdir / 'xyzT_rho_m.p', 'wb')) #jx
-    elif tag == 'u':
-        xyzT_u = cKDTree(xyz)
-        pickle.dump(xyzT_u, open(outdir / 'xyzT_u.p', 'wb'))
-        xyzT_u_m = cKDTree(xyz_m)  #jx
-        pickle.dump(xyzT_u_m, open(outdir / 'xyzT_u_m.p', 'wb'))  #jx
-    elif tag == 'v':
-        xyzT_v = cKDTree(xyz)
-        pickle.dump(xyzT_v, open(outdir / 'xyzT_v.p', 'wb'))
-        xyzT_v_m = cKDTree(xyz_m) #jx
-        pickle.dump(xyzT_v_m, open(outdir / 'xyzT_v_m.p', 'wb'))  #jx
-    elif tag == 'w':
-        xyzT_w = cKDTree(xyz)
-        pickle.dump(xyzT_w, open(outdir / 'xyzT_w.p', 'wb'))
-        xyzT_w_m = cKDTree(xyz_m) #jx
-        pickle.dump(xyzT_w_m, open(outdir / 'xyzT_w_m.p', 'wb'))  #jx
+    save_tree(make_tree(xyz), 'xyzT_' + tag)
+    save_tree(make_tree(xyz_m), 'xyzT_' + tag + '_m') #jx
 
     print('Create 3D tree for %s: %0.2f sec' % (tag, time()-tt0))
     sys.stdout.flush()
-    
+
+# write this last, to show the folder is complete
+tree_info = {'version':tree_version, 'gridname':Ldir['gridname'],
+    'N':S['N'], 'M':G['M'], 'L':G['L']}
+Lfun.dict_to_csv(tree_info, outdir / 'tree_info.csv')
@@ -0,0 +1,84 @@
+"""
+Code to test that with TR['adapt'] = True particles stranded on the shore are
+dropped from the integration, and stay dropped on the following days.
+
+It uses the experiment of the last tracker.py run (LO_output/tracks2/exp_info.csv)
+for the grid and history files, and makes copies of the first day of history
+files with the velocity set to zero, so every particle is stuck on that day.
+
+Run with:
+python test_stranded.py
+(or with pytest)
+"""
+
+import tempfile
+from pathlib import Path
+from datetime import datetime, timedelta
+import numpy as np
+import xarray as xr
+
+from lo_tools import Lfun
+import trackfun as tfun
+
+TR = {'3d':False, 'turb':False, 'ndiv':12, 'sph':1, 'windage':0, 'interp':'nn',
+    'adapt':True, 'no_advection':False, 'sink':0, 'stay':0, 'cache':False}
+
+def get_day_lists():
+    # the history files for two days of the experiment
+    Ldir = tfun.Ldir.copy()
+    Ldir['roms_out'] = Path(tfun.TR0['roms_out'])
+    Ldir['gtagex'] = tfun.TR0['gtagex']
+    dt0 = datetime.strptime(tfun.TR0['date_string'], Lfun.ds_fmt)
+    return [tfun.get_fn_list(dt0 + timedelta(days=nd), Ldir) for nd in range(2)]
+
+def get_ic():
+    # particles at water points in the middle of the domain
+    G = tfun.G
+    NR, NC = G['lon_rho'].shape
+    jj, ii = np.meshgrid(np.arange(NR//4, 3*NR//4, 8), np.arange(NC//4, 3*NC//4, 8))
+    jj = jj.flatten(); ii = ii.flatten()
+    wet = G['mask_rho'][jj, ii] == 1
+    plon = G['lon_rho'][jj[wet], ii[wet]]
+    plat = G['lat_rho'][jj[wet], ii[wet]]
+    return plon, plat, np.zeros(len(plon))
+
+def track(day_lists):
+    plon0, plat0, pcs0 = get_ic()
+    P, alive = tfun.get_tracks(day_lists[0], plon0, plat0, pcs0, TR, trim_loc=True)
+    alive1 = alive.copy()
+    P, alive = tfun.get_tracks(day_lists[1], P['lon'][-1,:], P['lat'][-1,:], P['cs'][-1,:],
+        TR, alive0=alive)
+    return P, alive1, alive
+
+def test_moving():
+    # with the model velocity most particles keep moving
+    P, alive1, alive = track(get_day_lists())
+    assert alive.mean() > 0.5
+
+def test_stranded():
+    # with no velocity on the first day all particles are stranded after
+    # n_strand saves, and are not brought back on the next day even though
+    # the water is moving again
+    day_lists = get_day_lists()
+    out_dir = Path(tempfile.mkdtemp())
+    still_list = []
+    for fn in day_lists[0]:
+        still_fn = out_dir / (fn.parent.name + '_' + fn.name)
+        ds = xr.load_dataset(fn, decode_times=False)
+        for vn in ['u', 'v', 'w', 'ubar', 'vbar']:
+            if vn in ds.data_vars:
+                ds[vn] = 0 * ds[vn]
+        ds.to_netcdf(still_fn)
+        still_list.append(still_fn)
+    P, alive1, alive = track([still_list, day_lists[1]])
+    assert len(alive1) > 0
+    assert not alive1.any()
+    assert not alive.any()
+    # so they hold their positions on the second day
+    assert (P['lon'] == P['lon'][0,:]).all()
+    assert (P['lat'] == P['lat'][0,:]).all()
+
+if __name__ == '__main__':
+    test_moving()
+    test_stranded()
+    print('All stranded particle tests passed')
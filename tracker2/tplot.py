@@ -28,6 +28,9 @@ dsr = xr.open_dataset(fn, decode_times=False)
 dsg = xr.open_dataset(fng)
 
 NT, NP = dsr.lon.shape
+# releases are written one day at a time, so this may be a run still in progress
+if 'ndays' in dsr.attrs:
+    print('Release has %d day(s) written' % (dsr.attrs['ndays']))
 
 # get a list of datetimes
 ot_vec = dsr.ot.values
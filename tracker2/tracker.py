@@ -41,6 +41,10 @@ the same command, with all the arguments typed, instead of getting them as defau
 
 python tracker.py -gtx cas7_t0_x4b -ro 0 -d 2017.07.04 -exp jdf0 -clb True
 
+and to do 12 monthly releases, running 4 of them at a time:
+
+python tracker.py -exp jdf0 -3d True -nsd 12 -dbs 30 -dtt 30 -Nproc 4
+
 """
 
 import sys
@@ -48,6 +52,7 @@ from datetime import datetime, timedelta
 from time import time
 import argparse
 import numpy as np
+import multiprocessing as mp
 
 from lo_tools import Lfun, zfun
 Ldir = Lfun.Lstart()
@@ -108,6 +113,13 @@ parser.add_argument('-nsd', '--number_of_start_days', default=1, type=int)
 parser.add_argument('-dbs', '--days_between_starts', default=1, type=int)
 parser.add_argument('-dtt', '--days_to_track', default=1, type=int)
 parser.add_argument('-sh', '--start_hour', default=0, type=int)
+# number of releases to run at the same time, each in its own process
+parser.add_argument('-Nproc', default=1, type=int)
+# adapt = True chooses the number of time steps between saves from the flow speed
+# (a CFL condition), and stops integrating particles that leave the domain
+parser.add_argument('-adapt', default=False, type=zfun.boolean_string)
+# use the disk cache of prepared history file fields (see trackfun_cache.py)
+parser.add_argument('-cache', default=False, type=zfun.boolean_string)
 
 # number of divisions to make between saves for the integration
 # e.g. if ndiv = 12 and we have hourly saves, we use a 300 sec step
@@ -116,6 +128,11 @@ parser.add_argument('-sh', '--start_hour', default=0, type=int)
 parser.add_argument('-ndiv', default=12, type=int)
 parser.add_argument('-sph', default=1, type=int)
 # sph = saves per hour, a new argument to allow more frequent writing of output.
+parser.add_argument('-interp', default='nn', type=str)
+# interp = method for getting fields at particle positions:
+# - nn = nearest neighbor using the KDTrees (the default)
+# - trilinear = find the grid cell of each particle once per RK4 stage and
+#   interpolate linearly in all three dimensions (much faster for many particles)
 
 args = parser.parse_args()
 TR = args.__dict__ 
@@ -180,6 +197,13 @@ if TR['no_advection'] == True:
     out_name += '_nadv'
 if TR['ndiv'] != 12: # only mention ndiv if it is NOT 12
     out_name += '_ndiv' + str(TR['ndiv'])
+if TR['adapt'] == True:
+    out_name += '_adapt'
+if TR['interp'] == 'trilinear':
+    out_name += '_tri'
+elif TR['interp'] != 'nn':
+    print('Error: unknown interp method ' + TR['interp'])
+    sys.exit()
 if len(TR['sub_tag']) > 0:
     out_name += '_' + TR['sub_tag']
 
@@ -235,9 +259,11 @@ plon00, plat00, pcs00 = exp.get_ic(TR)
 # save this in case cust.update_TR() changes it.
 TR_orig = TR.copy()
 
-# step through the releases, one for each start day
-write_grid = True
-for idt0 in idt_list:
+def run_release(idt0):
+    """
+    Do all the days of tracking for the release starting on idt0, writing
+    the results to a single NetCDF file.
+    """
     tt0 = time() # monitor integration time
     
     # Start each release with original TR.
@@ -257,16 +283,9 @@ for idt0 in idt_list:
         # get or replace the history file list for this day
         idt = idt0 + timedelta(days=nd)
         idt_str = datetime.strftime(idt,'%Y.%m.%d')
-        print(' - working on ' + idt_str)
+        print(' - working on ' + idt_str + ' (' + outname + ')')
         sys.stdout.flush()
         fn_list = tfun.get_fn_list(idt, Ldir)
-        
-        # write the grid file (once per experiment) for plotting
-        if write_grid == True:
-            g_infile = fn_list[0]
-            g_outfile = outdir / 'grid.nc'
-            tfnc.write_grid(g_infile, g_outfile)
-            write_grid = False
             
         # apply customizations, if any
         cust.update_TR(nd, TR)
@@ -282,7 +301,7 @@ for idt0 in idt_list:
             # do the tracking
             if TR['start_hour'] > 0:
                 fn_list = fn_list[TR['start_hour']:]
-            P = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=True)
+            P, alive = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=True)
             # save the results to NetCDF
             tfnc.start_outfile(out_fn, P)
         else: # subsequent days
@@ -291,11 +310,41 @@ for idt0 in idt_list:
             plat0 = P['lat'][-1,:]
             pcs0 = P['cs'][-1,:]
             # do the tracking
-            P = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR)
+            P, alive = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR, alive0=alive)
             tfnc.append_to_outfile(out_fn, P)
         
-    print(' - Took %0.1f sec for %s day(s)' %
-            (time() - tt0, str(TR['days_to_track'])))
+    print(' - Took %0.1f sec for %s day(s) of %s' %
+            (time() - tt0, str(TR['days_to_track']), outname))
     print(50*'=')
-print(50*'*' + '\nWrote to ' + str(outdir))
+    sys.stdout.flush()
 
+def start_worker():
+    # Each forked worker starts with a copy of the parent random state, so
+    # we reseed to keep the turbulent random walks independent between releases.
+    np.random.seed()
+
+# write the grid file (once per experiment) for plotting
+g_infile = tfun.get_fn_list(idt_list[0], Ldir)[0]
+g_outfile = outdir / 'grid.nc'
+tfnc.write_grid(g_infile, g_outfile)
+
+# step through the releases, one for each start day
+if (TR['Nproc'] == 1) or (len(idt_list) == 1):
+    for idt0 in idt_list:
+        run_release(idt0)
+else:
+    # Run releases at the same time, each in its own process. We fork the
+    # processes so that they share the grid info and trees already loaded by
+    # trackfun instead of each loading them again.
+    Nproc = min(TR['Nproc'], len(idt_list))
+    # load the trees before forking so the processes share them
+    if hasattr(tfun, 'get_tree_list'):
+        for tree_name in tfun.get_tree_list(TR):
+            tfun.get_tree(tree_name)
+    print('Running %d releases using %d processes' % (len(idt_list), Nproc))
+    sys.stdout.flush()
+    with mp.get_context('fork').Pool(Nproc, initializer=start_worker) as pool:
+        # use chunksize=1 so that releases are handed out one at a time as workers finish
+        for result in pool.imap_unordered(run_release, idt_list, chunksize=1):
+            pass
+print(50*'*' + '\nWrote to ' + str(outdir))
@@ -7,6 +7,7 @@ LO_output/tracks2/exp_info.csv.
 """
 # setup (assume path to alpha set by calling code)
 from lo_tools import Lfun, zfun, zrfun
+import trackfun_cache as tcache
 import numpy as np
 import xarray as xr
 from scipy.spatial import cKDTree
@@ -43,27 +44,55 @@ G, S, T = zrfun.get_basic_info(TR0['fn00'])
 Maskr = G['mask_rho']==1 # True over water
 Masku = G['mask_u']==1 # True over water
 Maskv = G['mask_v']==1 # True over water
-Maskr3 = np.tile(Maskr.reshape(1,G['M'],G['L']),[S['N'],1,1])
-Masku3 = np.tile(Masku.reshape(1,G['M'],G['L']-1),[S['N'],1,1])
-Maskv3 = np.tile(Maskv.reshape(1,G['M']-1,G['L']),[S['N'],1,1])
-Maskw3 = np.tile(Maskr.reshape(1,G['M'],G['L']),[S['N']+1,1,1])
-# load pre-made trees
+# NOTE: 3-D fields are flattened using e.g. u[:,Masku].flatten(), which gives
+# the same result as u[Masku3] where Masku3 is Masku tiled over all levels,
+# without having to keep the tiled masks in memory.
+
+# Pre-made trees, made by make_KDTrees.py. These are loaded the first time they
+# are needed by get_tree(), so that, for example, surface runs never load the 3D trees.
 tree_dir = Ldir['LOo'] / 'tracker2_trees' / TR0['gridname']
-# 2D
-xyT_rho = pickle.load(open(tree_dir / 'xyT_rho.p', 'rb'))
-xyT_u   = pickle.load(open(tree_dir / 'xyT_u.p', 'rb'))
-xyT_v   = pickle.load(open(tree_dir / 'xyT_v.p', 'rb'))
-xyT_rho_un = pickle.load(open(tree_dir / 'xyT_rho_un.p', 'rb'))
-# 3D
-xyzT_rho = pickle.load(open(tree_dir / 'xyzT_rho.p', 'rb'))
-xyzT_u   = pickle.load(open(tree_dir / 'xyzT_u.p', 'rb'))
-xyzT_v   = pickle.load(open(tree_dir / 'xyzT_v.p', 'rb'))
-xyzT_w   = pickle.load(open(tree_dir / 'xyzT_w.p', 'rb'))
-# 3D in meters #jx
-xyzT_rho_m = pickle.load(open(tree_dir / 'xyzT_rho_m.p', 'rb'))
-xyzT_u_m   = pickle.load(open(tree_dir / 'xyzT_u_m.p', 'rb'))
-xyzT_v_m   = pickle.load(open(tree_dir / 'xyzT_v_m.p', 'rb'))
-xyzT_w_m   = pickle.load(open(tree_dir / 'xyzT_w_m.p', 'rb'))
+tree_version = 3 # must match make_KDTrees.py
+if (tree_dir / 'tree_info.csv').is_file():
+    tree_info = Lfun.csv_to_dict(tree_dir / 'tree_info.csv')
+else:
+    tree_info = {'version':'1'}
+if int(tree_info['version']) < tree_version:
+    print('NOTE: trees in %s are an old version, consider rerunning make_KDTrees.py' % (str(tree_dir)))
+tree_dict = dict()
+def get_tree(tree_name):
+    """
+    Return the pre-made tree tree_name (e.g. 'xyT_rho'), loading it if needed.
+
+    In version 3 tree folders the arrays of the tree are memory-mapped from .npy
+    files (see make_KDTrees.py), so only the parts used by the queries are read,
+    and processes using the same trees share them. Older folders have the whole
+    tree pickled.
+    """
+    if tree_name not in tree_dict:
+        with open(tree_dir / (tree_name + '.p'), 'rb') as f:
+            state = pickle.load(f)
+        if int(tree_info['version']) >= 3:
+            for ii, item in enumerate(state):
+                if isinstance(item, str) and (item == 'npy'):
+                    state[ii] = np.load(tree_dir / ('%s_%d.npy' % (tree_name, ii)), mmap_mode='r')
+            tree = cKDTree.__new__(cKDTree)
+            tree.__setstate__(tuple(state))
+            tree_dict[tree_name] = tree
+        else:
+            tree_dict[tree_name] = state
+    return tree_dict[tree_name]
+
+def get_tree_list(TR):
+    """
+    Names of the trees that a run with the choices in TR will use (assuming jx = True).
+    """
+    tree_list = ['xyT_rho', 'xyT_rho_un']
+    if TR['interp'] == 'nn':
+        if TR['3d']:
+            tree_list += ['xyzT_rho_m', 'xyzT_u_m', 'xyzT_v_m', 'xyzT_w_m']
+        else:
+            tree_list += ['xyT_u', 'xyT_v']
+    return tree_list
 # the "f" below refers to flattened, which is the result of passing
 # a Boolean array like Maskr to an array.
 lonrf = G['lon_rho'][Maskr]
@@ -80,16 +109,47 @@ x_c = np.mean(x)
 y = G['lat_rho']
 y_c = np.mean(y)
 
-def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
+# Info for the trilinear interpolation option (TR['interp'] = 'trilinear').
+# These maps take a 2-D (j,i) grid index to the index of the same point in
+# the flattened fields, e.g. uf0 = u0[:,Masku].flatten(), so that we can interpolate
+# directly from the flattened arrays used by the nearest neighbor code.
+# Land points are -1. For a 3-D field the flattened index of (k,j,i)
+# is k*nwet + imap[j,i] because the masks are tiled in the vertical.
+def make_imap(mask):
+    imap = -np.ones(mask.shape, dtype=int)
+    imap[mask] = np.arange(mask.sum())
+    return imap
+imap_r = make_imap(Maskr)
+imap_u = make_imap(Masku)
+imap_v = make_imap(Maskv)
+nwet_r = Maskr.sum()
+nwet_u = Masku.sum()
+nwet_v = Maskv.sum()
+# info for the TR['adapt'] = True option
+lon_min = G['lon_rho'].min(); lon_max = G['lon_rho'].max()
+lat_min = G['lat_rho'].min(); lat_max = G['lat_rho'].max()
+dx_min = min(G['DX'].min(), G['DY'].min()) # smallest grid spacing (m)
+# plaid grids let us find the fractional index without a tree query
+plaid = zfun.is_plaid(G['lon_rho']) and zfun.is_plaid(G['lat_rho'])
+lonr_vec = G['lon_rho'][0,:]
+latr_vec = G['lat_rho'][:,0]
+
+def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False, alive0=None):
     """
     This is the main function doing the particle tracking.
+
+    Returns the results P and the boolean vector alive of particles still being
+    integrated. With TR['adapt'] = True, pass alive back in as alive0 for the next
+    day so that particles that were dropped stay dropped.
     """
     # unpack items needed from TR
     surface = not TR['3d']
     turb = TR['turb']
     ndiv = TR['ndiv']
     windage = TR['windage']
-    
+    tri = TR['interp'] == 'trilinear'
+    adapt = TR['adapt']
+
     # get time vector of history files
     NT = len(fn_list)
     NTS = TR['sph']*(NT-1) + 1
@@ -102,7 +162,6 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
         ds.close
     sys.stdout.flush()
     delta_t_his = rot[1] - rot[0] # seconds between saves
-    delt = delta_t_his/ndiv # time step in seconds
     delt_save = delta_t_his/TR['sph']
     rot_save = np.linspace(rot[0], rot[-1], NTS)
 
@@ -133,9 +192,191 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
     k_nei = 1 
     # Set average_W to True to average k_nei neighbors of w in get_vel.
     # For example, we needed k_nei=20 in the high-resolution (10m) model.
+    
+    # Used with TR['adapt'] = True: the number of steps between saves is chosen
+    # so that the fastest active particle moves no more than cfl grid cells per step.
+    # The turbulence is always done with steps no longer than the fixed ndiv steps,
+    # so a long advective step is split into several turbulence steps.
+    cfl = 0.5
+    nihr = int(ndiv/TR['sph']) # number of fixed steps between saves
+    nstep_max = 10*nihr
+    nstep_min = 1
+    delt_turb = delt_save/nihr # longest turbulence step (sec)
+    # Also, particles that move less than strand_m meters over n_strand saves (six
+    # hours) are taken to be stranded on the shore and are dropped from the integration.
+    n_strand = 6*TR['sph']
+    strand_m = 0.01*dx_min
 
     # >>>>>>>>>>>>>>>>>>>>>>>> <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-    
+
+    # These functions hide the choice of interpolation method from the
+    # integration below. They use whatever fields (uf0, zf0, etc.) are current
+    # for this pair of history files. With TR['interp'] = 'trilinear' the grid
+    # cell C of the particles is found once and reused for every field sampled
+    # at that position, instead of doing a separate tree query for each one.
+    def sample_vel(plon, plat, pcs, frac):
+        if tri:
+            C = get_cell(plon, plat, pcs, hf, surface)
+            V = get_vel_tri(C, uf0,uf1,vf0,vf1,wf0,wf1, frac, surface)
+            ZH = get_zh_tri(C, zf0,zf1, frac)
+        else:
+            C = None
+            V = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, frac, surface, use_new_tree,zf0,zf1,hf,x_c,y_c,average_W,k_nei)
+            ZH = get_zh(zf0,zf1,hf, plon, plat, frac)
+        return V, ZH, C
+
+    def sample_zh(plon, plat, frac):
+        if tri:
+            C = get_cell(plon, plat, None, hf, surface)
+            return get_zh_tri(C, zf0,zf1, frac)
+        else:
+            return get_zh(zf0,zf1,hf, plon, plat, frac)
+
+    def sample_tracer(vn, plon, plat, pcs, frac, C):
+        if tri:
+            return get_VR_tri(C, trf0_dict[vn], trf1_dict[vn], frac, surface)
+        else:
+            return get_VR(trf0_dict[vn], trf1_dict[vn], plon, plat, pcs, frac, surface, use_new_tree,zf0,zf1,hf,x_c,y_c)
+
+    def rk4_step(plon, plat, pcs, fr0, fr1, delt):
+        """
+        Advance the particles from time fraction fr0 to fr1, which is a time step
+        of delt seconds, with RK4 advection and then turbulence.
+        """
+        NP = len(plon)
+        frmid = (fr0 + fr1)/2
+        
+        if TR['no_advection'] == False:
+            # RK4 integration
+            V0, ZH0, C0 = sample_vel(plon, plat, pcs, fr0)
+            if jx == False:
+                plon1, plat1, pcs1 = update_position(dxg, dyg, maskr, V0, ZH0, S, delt/2,
+                                                    plon, plat, pcs, surface)
+            else:
+                plon1, plat1 = update_position_lonlat(dxg, dyg, maskr, V0, delt/2, plon, plat)
+                ZH0_new = sample_zh(plon1, plat1, frmid)  #jx: ZH0_new is the same as ZH1
+                pcs1 = update_position_z(V0, ZH0, ZH0_new, delt/2, pcs, surface)
+            
+            
+            V1, ZH1, C1 = sample_vel(plon1, plat1, pcs1, frmid)
+
+            if jx == False:
+                plon2, plat2, pcs2 = update_position(dxg, dyg, maskr, V1, ZH1, S, delt/2,
+                                                    plon, plat, pcs, surface)
+            else:
+                plon2, plat2 = update_position_lonlat(dxg, dyg, maskr, V1, delt/2, plon, plat)
+                ZH1_new = sample_zh(plon2, plat2, frmid)  #jx: ZH1_new is the same as ZH2
+                pcs2 = update_position_z(V1, ZH1, ZH1_new, delt/2, pcs, surface)
+            
+            
+            V2, ZH2, C2 = sample_vel(plon2, plat2, pcs2, frmid)
+
+            if jx == False:
+                plon3, plat3, pcs3 = update_position(dxg, dyg, maskr, V2, ZH2, S, delt,
+                                                    plon, plat, pcs, surface)
+            else:
+                plon3, plat3 = update_position_lonlat(dxg, dyg, maskr, V2, delt, plon, plat)
+                ZH2_new = sample_zh(plon3, plat3, fr1)  #jx: ZH2_new is the same as ZH3
+                pcs3 = update_position_z(V2, ZH2, ZH2_new, delt, pcs, surface)
+            
+            
+            V3, ZH3, C3 = sample_vel(plon3, plat3, pcs3, fr1) # ZH3 not needed?
+            
+            # add windage, calculated from the middle time
+            if (surface == True) and (windage > 0):
+                if tri:
+                    Vwind3 = get_wind_tri(C0, Uwindf0, Uwindf1, Vwindf0, Vwindf1, frmid, windage)
+                else:
+                    Vwind3 = get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, plon, plat, frmid, windage)
+            else:
+                Vwind3 = np.zeros((NP,3))
+            
+            # add sinking speed
+            if TR['sink'] != 0:
+                Vsink3 = np.zeros((NP,3))
+                Vsink3[:,2] = -TR['sink'] / 86400
+            else:
+                Vsink3 = np.zeros((NP,3))
+            
+            # stay close to a set depth TR['stay'] (or the bottom if it is shallower)
+            if TR['stay'] != 0:
+                stay_H = ZH1.sum(axis=1)
+                stay_h = ZH1[:,1]
+                stay_z = stay_H*pcs2 + ZH1[:,0]
+                # head for the shallower of the target depth or the bottom
+                stay_target_depth = np.minimum(stay_h, TR['stay'])
+                stay_target_z = - stay_target_depth
+                stay_dz = stay_z - stay_target_z
+                # Note TR['stay'] is a depth, assumed positive down, so the
+                # signs can be confusing because z is positive up. That is why we introduce
+                # stay_target_z, which is positive up
+                Vstay3 = np.zeros((NP,3))
+                # move halfway to the desired depth each timestep
+                Vstay3[:,2] = - stay_dz / (2 * delt)
+            else:
+                Vstay3 = np.zeros((NP,3))
+            
+            if jx == False:
+                plon, plat, pcs = update_position(dxg, dyg, maskr, (V0 + 2*V1 + 2*V2 + V3)/6 + Vwind3 + Vsink3 + Vstay3, (ZH0 + 2*ZH1 + 2*ZH2 + ZH3)/6, S, delt, plon, plat, pcs, surface)
+            else:
+                plon, plat = update_position_lonlat(dxg, dyg, maskr, (V0 + 2*V1 + 2*V2 + V3)/6 + Vwind3 + Vsink3 + Vstay3, delt, plon, plat)
+                ZH_new = sample_zh(plon, plat, fr1)
+                pcs = update_position_z((V0 + 2*V1 + 2*V2 + V3)/6 + Vwind3 + Vsink3 + Vstay3,
+                                        ZH0, ZH_new, delt, pcs, surface)
+            
+        elif TR['no_advection'] == True:
+            V3 = np.zeros((NP,3))
+            ZH3 = sample_zh(plon, plat, frmid)  #jx: may not need this? should it be ZH3 = get_zh(zf0,zf1,hf, plon, plat, fr1)?
+                                          
+        # add turbulence to vertical position change (advection already added above)
+        if turb == True:
+            nturb = int(np.ceil(delt/delt_turb - 1e-6))
+            for nt in range(nturb):
+                pcs = turb_step(plon, plat, pcs, fr0 + (fr1 - fr0)*nt/nturb,
+                    fr0 + (fr1 - fr0)*(nt + 1)/nturb, delt/nturb)
+
+        return plon, plat, pcs
+
+    def turb_step(plon, plat, pcs, fr0, fr1, delt):
+        """
+        Move the particles vertically by turbulence from time fraction fr0 to fr1,
+        which is a time step of delt seconds.
+        """
+        NP = len(plon)
+        frmid = (fr0 + fr1)/2
+        # pull values of VdAKs and add up to 3-dimensions
+        if tri:
+            C = get_cell(plon, plat, pcs, hf, surface)
+            VdAKs = get_dAKs_tri(C, dKdzf0, dKdzf1, frmid)
+            ZH = get_zh_tri(C, zf0,zf1, frmid)
+        else:
+            VdAKs = get_dAKs_new(dKdzf0, dKdzf1, plon, plat, pcs, frmid, use_new_tree,zf0,zf1,hf,x_c,y_c)
+            ZH = get_zh(zf0,zf1,hf, plon, plat, frmid)
+        VdAKs3 = np.zeros((NP,3))
+        VdAKs3[:,2] = VdAKs
+        # update position advecting vertically with 1/2 of AKs gradient
+        #plon_junk, plat_junk, pcs_half = update_position(dxg, dyg, maskr,
+        #                VdAKs3/2, ZH, S, delt/2, plon, plat, pcs, surface)
+        #pcs_half = update_position_z(VdAKs3/2, ZH, ZH, delt/2, pcs, surface)  #jx
+        pcs_half = update_position_z(VdAKs3, ZH, ZH, delt/2, pcs, surface)  #jx
+        # get AKs at this height, and thence the turbulent perturbation velocity
+        if tri:
+            C_half = get_cell(plon, plat, pcs_half, hf, surface)
+            Vturb = get_turb_tri(VdAKs, AKsf0, AKsf1, delt, C_half, frmid)
+        else:
+            Vturb = get_turb(VdAKs, AKsf0, AKsf1, delt, plon, plat, pcs_half, frmid, use_new_tree,zf0,zf1,hf,x_c,y_c)
+        Vturb3 = np.zeros((NP,3))
+        Vturb3[:,2] = Vturb
+        # update vertical position for real
+        if jx == False:
+            plon_junk, plat_junk, pcs = update_position(dxg, dyg, maskr, Vturb3, ZH, S, delt,
+                                                plon, plat, pcs, surface)
+        else:
+            ZH_new = sample_zh(plon, plat, fr1)  #jx: need this if testing no advection; ZH_new, ZH3, and ZH2_new are the same.
+            pcs = update_position_z(Vturb3, ZH_new, ZH_new, delt, pcs, surface)  #jx
+
+        return pcs
+
     # Step through times.
     #
     for counter_his in range(len(fn_list)-1):
@@ -146,173 +387,45 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
                 
         it0 = TR['sph']*counter_his
         
-        # get Datasets
+        # get the fields for this pair of history files
         fn0 = fn_list[counter_his]
         fn1 = fn_list[counter_his+1]
-        
-        ds0 = xr.open_dataset(fn0)
-        ds1 = xr.open_dataset(fn1)
-        
-        # prepare the fields for nearest neighbor interpolation
         tt0 = time()
         if counter_his == 0:
             h = G['h']
             hf = h[Maskr]
-            if surface == True:
-                u0 = ds0['u'][0,-1,:,:].values
-                u1 = ds1['u'][0,-1,:,:].values
-                uf0 = u0[Masku]
-                uf1 = u1[Masku]
-                v0 = ds0['v'][0,-1,:,:].values
-                v1 = ds1['v'][0,-1,:,:].values
-                vf0 = v0[Maskv]
-                vf1 = v1[Maskv]
-                wf0 = 0; wf1 = 0
-                
-                trf0_dict = dict()
-                trf1_dict = dict()
-                for vn in tracer_list:
-                    tr0 = ds0[vn][0,-1,:,:].values
-                    tr1 = ds1[vn][0,-1,:,:].values
-                    trf0_dict[vn] = tr0[Maskr]
-                    trf1_dict[vn] = tr1[Maskr]
-                
-                if windage > 0:
-                    Uwind0 = ds0['Uwind'][0,:,:].values
-                    Uwind1 = ds1['Uwind'][0,:,:].values
-                    Uwindf0 = Uwind0[Maskr]
-                    Uwindf1 = Uwind1[Maskr]
-                    Vwind0 = ds0['Vwind'][0,:,:].values
-                    Vwind1 = ds1['Vwind'][0,:,:].values
-                    Vwindf0 = Vwind0[Maskr]
-                    Vwindf1 = Vwind1[Maskr]
-            else:
-                u0 = ds0['u'][0,:,:,:].values
-                u1 = ds1['u'][0,:,:,:].values
-
-                uf0 = u0[Masku3]
-                uf1 = u1[Masku3]
-                v0 = ds0['v'][0,:,:,:].values
-                v1 = ds1['v'][0,:,:,:].values
-
-                vf0 = v0[Maskv3]
-                vf1 = v1[Maskv3]
-                w0 = ds0['w'][0,:,:,:].values
-                w1 = ds1['w'][0,:,:,:].values
-
-                wf0 = w0[Maskw3]
-                wf1 = w1[Maskw3]
-                
-                trf0_dict = dict()
-                trf1_dict = dict()
-                for vn in tracer_list:
-                    tr0 = ds0[vn][0,:,:,:].values
-                    tr1 = ds1[vn][0,:,:,:].values
-                    trf0_dict[vn] = tr0[Maskr3]
-                    trf1_dict[vn] = tr1[Maskr3]
-                    
-                if turb == True:
-                    AKs0_temp = ds0['AKs'][0,:,:,:].values
-                    # modify top and bottom AKs to be non-negligible
-                    AKs0_temp[0,:,:] = AKs0_temp[1,:,:]
-                    AKs0_temp[-1,:,:] = AKs0_temp[-2,:,:]
-                    AKs0 = AKs0_temp.copy()
-                    AKs0[1:-1,:,:] = 0.25*AKs0_temp[:-2,:,:] + 0.5*AKs0_temp[1:-1,:,:] + 0.25*AKs0_temp[2:,:,:]
-                    AKsf0 = AKs0[Maskw3]
-                    #
-                    AKs1_temp = ds1['AKs'][0,:,:,:].values
-                    # modify top and bottom AKs to be non-negligible
-                    AKs1_temp[0,:,:] = AKs1_temp[1,:,:]
-                    AKs1_temp[-1,:,:] = AKs1_temp[-2,:,:]
-                    AKs1 = AKs1_temp.copy()
-                    AKs1[1:-1,:,:] = 0.25*AKs1_temp[:-2,:,:] + 0.5*AKs1_temp[1:-1,:,:] + 0.25*AKs1_temp[2:,:,:]
-                    AKsf1 = AKs1[Maskw3]
-                    #
-                    # New 2022.11.14 use time-varying dz
-                    zeta0 = ds0['zeta'].values #jx
-                    zeta1 = ds1['zeta'].values #jx
-                    zw0 = zrfun.get_z(G['h'], zeta0, S, only_w=True) #jx
-                    zw1 = zrfun.get_z(G['h'], zeta1, S, only_w=True) #jx
-                    dz0 = np.diff(zw0, axis=0) #jx
-                    dz1 = np.diff(zw1, axis=0) #jx
-                    dKdz0 = np.diff(AKs0, axis=0)/dz0 #jx
-                    dKdz1 = np.diff(AKs1, axis=0)/dz1 #jx
-                    dKdzf0 = dKdz0[Maskr3]
-                    dKdzf1 = dKdz1[Maskr3]
-                    
-                    
-            z0 = ds0['zeta'][0,:,:].values
-            z1 = ds1['zeta'][0,:,:].values
-            zf0 = z0[Maskr]
-            zf1 = z1[Maskr]
+            F0 = get_fields(fn0, surface, turb, windage, True, TR['cache'])
+            F1 = get_fields(fn1, surface, turb, windage, True, TR['cache'])
             if verbose:
                 print('   > Prepare fields for tree %0.4f sec' % (time()-tt0))
         else:
             # subsequent time steps
-            if surface == True:
-                u1 = ds1['u'][0,-1,:,:].values
-                uf0 = uf1.copy()
-                uf1 = u1[Masku]
-                v1 = ds1['v'][0,-1,:,:].values
-                vf0 = vf1.copy()
-                vf1 = v1[Maskv]
-                wf0 = 0; wf1 = 0
-                
-                for vn in tracer_list:
-                    tr1 = ds1[vn][0,-1,:,:].values
-                    trf0_dict[vn] = trf1_dict[vn].copy()
-                    trf1_dict[vn] = tr1[Maskr]
-                
-                if windage > 0:
-                    Uwind1 = ds1['Uwind'][0,:,:].values
-                    Uwindf0 = Uwindf1
-                    Uwindf1 = Uwind1[Maskr]
-                    Vwind1 = ds1['Vwind'][0,:,:].values
-                    Vwindf0 = Vwindf1
-                    Vwindf1 = Vwind1[Maskr]
-            else:
-                if TR['no_advection'] == False:
-                    u1 = ds1['u'][0,:,:,:].values
-                    uf0 = uf1.copy()
-                    uf1 = u1[Masku3]
-                    v1 = ds1['v'][0,:,:,:].values
-                    vf0 = vf1.copy()
-                    vf1 = v1[Maskv3]
-                    w1 = ds1['w'][0,:,:,:].values
-                    wf0 = wf1.copy()
-                    wf1 = w1[Maskw3]
-                    
-                    for vn in tracer_list:
-                        tr1 = ds1[vn][0,:,:,:].values
-                        trf0_dict[vn] = trf1_dict[vn].copy()
-                        trf1_dict[vn] = tr1[Maskr3]
-                    
-                if turb == True:
-                    AKsf0 = AKsf1.copy()
-                    #
-                    AKs1_temp = ds1['AKs'][0,:,:,:].values
-                    # modify top and bottom AKs to be non-negligible
-                    AKs1_temp[0,:,:] = AKs1_temp[1,:,:]
-                    AKs1_temp[-1,:,:] = AKs1_temp[-2,:,:]
-                    AKs1 = AKs1_temp.copy()
-                    AKs1[1:-1,:,:] = 0.25*AKs1_temp[:-2,:,:] + 0.5*AKs1_temp[1:-1,:,:] + 0.25*AKs1_temp[2:,:,:]
-                    AKsf1 = AKs1[Maskw3]
-                    #
-                    dKdzf0 = dKdzf1.copy()
-                    # new 2022.11.14 Use time-varying dz
-                    zeta1 = ds1['zeta'].values #jx
-                    zw1 = zrfun.get_z(G['h'], zeta1, S, only_w=True) #jx
-                    dz1 = np.diff(zw1, axis=0) #jx 
-                    dKdz1 = np.diff(AKs1, axis=0)/dz1
-                    dKdzf1 = dKdz1[Maskr3]
-                    
-            z1 = ds1['zeta'][0,:,:].values
-            zf0 = zf1.copy()
-            zf1 = z1[Maskr]
+            F0 = F1
+            F1 = F0.copy()
+            # With no advection in 3D we only need the turbulence fields.
+            advection = surface or (TR['no_advection'] == False)
+            F1.update(get_fields(fn1, surface, turb, windage, advection, TR['cache']))
             if verbose:
                 print('   > Prepare subsequent fields for tree %0.4f sec' % (time()-tt0))
-        ds0.close()
-        ds1.close()
+        # unpack the fields (the "f" means flattened)
+        uf0 = F0['u']; uf1 = F1['u']
+        vf0 = F0['v']; vf1 = F1['v']
+        if surface == True:
+            wf0 = 0; wf1 = 0
+        else:
+            wf0 = F0['w']; wf1 = F1['w']
+        trf0_dict = dict()
+        trf1_dict = dict()
+        for vn in tracer_list:
+            trf0_dict[vn] = F0[vn]
+            trf1_dict[vn] = F1[vn]
+        zf0 = F0['zeta']; zf1 = F1['zeta']
+        if (surface == False) and (turb == True):
+            AKsf0 = F0['AKs']; AKsf1 = F1['AKs']
+            dKdzf0 = F0['dKdz']; dKdzf1 = F1['dKdz']
+        if (surface == True) and (windage > 0):
+            Uwindf0 = F0['Uwind']; Uwindf1 = F1['Uwind']
+            Vwindf0 = F0['Vwind']; Vwindf1 = F1['Vwind']
 
         if counter_his == 0:
             if trim_loc == True:
@@ -320,7 +433,7 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
                 xy = np.array((plon0,plat0)).T
                 #print(' ++ making pmask')
                 #print(maskr.shape)
-                pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
+                pmask = maskr[get_tree('xyT_rho_un').query(xy, workers=-1)[1]]
                 #print(pmask)
                 # keep only points with pmask >= maskr_crit
                 pcond = pmask >= maskr_crit
@@ -334,6 +447,14 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
                 pcs = pcs0.copy()
             # create result arrays
             NP = len(plon)
+            # Particles that have left the domain are dropped from the
+            # integration when using TR['adapt'] = True.
+            if adapt:
+                alive = in_domain(plon, plat)
+                if alive0 is not None:
+                    alive = alive & alive0
+            else:
+                alive = np.ones(NP, dtype=bool)
             P = dict()
             for vn in plist_main:
                 # NOTE: output is packed in a dict P of arrays ordered as [time, particle]
@@ -346,11 +467,10 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
                 pcs[:] = S['Cs_r'][-1]
             P['cs'][it0,:] = pcs
             
+            V, ZH, C = sample_vel(plon, plat, pcs, 0)
             for vn in tracer_list:
-                P[vn][it0,:] = get_VR(trf0_dict[vn], trf1_dict[vn], plon, plat, pcs, 0, surface, use_new_tree,zf0,zf1,hf,x_c,y_c)
+                P[vn][it0,:] = sample_tracer(vn, plon, plat, pcs, 0, C)
                 
-            V = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, 0, surface, use_new_tree,zf0,zf1,hf,x_c,y_c,average_W,k_nei)
-            ZH = get_zh(zf0,zf1,hf, plon, plat, 0)
             P['u'][it0,:] = V[:,0]
             P['v'][it0,:] = V[:,1]
             P['w'][it0,:] = V[:,2]
@@ -361,154 +481,160 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
         # do the particle tracking for a single pair of history files in ndiv steps
         it1 = it0
         tt00 = time()
-        for nd in range(ndiv):
-            fr0 = nd/ndiv
-            fr1 = (nd + 1)/ndiv
-            frmid = (fr0 + fr1)/2
-            
-            if TR['no_advection'] == False:
-                # RK4 integration
-                V0 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, fr0, surface, use_new_tree,zf0,zf1,hf,x_c,y_c,average_W,k_nei)
-                ZH0 = get_zh(zf0,zf1,hf, plon, plat, fr0)
-                if jx == False:
-                    plon1, plat1, pcs1 = update_position(dxg, dyg, maskr, V0, ZH0, S, delt/2,
-                                                        plon, plat, pcs, surface)
-                else:
-                    plon1, plat1 = update_position_lonlat(dxg, dyg, maskr, V0, delt/2, plon, plat)
-                    ZH0_new = get_zh(zf0,zf1,hf, plon1, plat1, frmid)  #jx: ZH0_new is the same as ZH1
-                    pcs1 = update_position_z(V0, ZH0, ZH0_new, delt/2, pcs, surface)
-                
-                
-                V1 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon1, plat1, pcs1, frmid, surface, use_new_tree,zf0,zf1,hf,x_c,y_c,average_W,k_nei)
-                ZH1 = get_zh(zf0,zf1,hf, plon1, plat1, frmid)
-
-                if jx == False:
-                    plon2, plat2, pcs2 = update_position(dxg, dyg, maskr, V1, ZH1, S, delt/2,
-                                                        plon, plat, pcs, surface)
-                else:
-                    plon2, plat2 = update_position_lonlat(dxg, dyg, maskr, V1, delt/2, plon, plat)
-                    ZH1_new = get_zh(zf0,zf1,hf, plon2, plat2, frmid)  #jx: ZH1_new is the same as ZH2
-                    pcs2 = update_position_z(V1, ZH1, ZH1_new, delt/2, pcs, surface)
-                
+        for isave in range(TR['sph']):
+            frs0 = isave/TR['sph']
+            frs1 = (isave + 1)/TR['sph']
+            # only integrate the active particles
+            ia = np.flatnonzero(alive)
+            if adapt:
+                nstep = get_nstep(P['u'][it1,ia], P['v'][it1,ia], P['w'][it1,ia], P['h'][it1,ia],
+                    P['zeta'][it1,ia], delt_save, cfl, nstep_min, nstep_max)
+            else:
+                nstep = nihr
+            for nd in range(nstep):
+                fr0 = frs0 + (frs1 - frs0)*nd/nstep
+                fr1 = frs0 + (frs1 - frs0)*(nd + 1)/nstep
+                plon[ia], plat[ia], pcs[ia] = rk4_step(plon[ia], plat[ia], pcs[ia], fr0, fr1, delt_save/nstep)
                 
-                V2 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon2, plat2, pcs2, frmid, surface, use_new_tree,zf0,zf1,hf,x_c,y_c,average_W,k_nei)
-                ZH2 = get_zh(zf0,zf1,hf, plon2, plat2, frmid)
+            it1 += 1
+            # write positions to the results arrays
+            P['lon'][it1,:] = plon
+            P['lat'][it1,:] = plat
+            if surface == True:
+                pcs[:] = S['Cs_r'][-1]
+            P['cs'][it1,:] = pcs
+            
+            V_save, ZH_save, C_save = sample_vel(plon[ia], plat[ia], pcs[ia], frs1)
+            for vn in tracer_list:
+                P[vn][it1,ia] = sample_tracer(vn, plon[ia], plat[ia], pcs[ia], frs1, C_save)
 
-                if jx == False:
-                    plon3, plat3, pcs3 = update_position(dxg, dyg, maskr, V2, ZH2, S, delt,
-                                                        plon, plat, pcs, surface)
-                else:
-                    plon3, plat3 = update_position_lonlat(dxg, dyg, maskr, V2, delt, plon, plat)
-                    ZH2_new = get_zh(zf0,zf1,hf, plon3, plat3, fr1)  #jx: ZH2_new is the same as ZH3
-                    pcs3 = update_position_z(V2, ZH2, ZH2_new, delt, pcs, surface)
-                
-                
-                V3 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon3, plat3, pcs3, fr1, surface, use_new_tree,zf0,zf1,hf,x_c,y_c,average_W,k_nei)
-                ZH3 = get_zh(zf0,zf1,hf, plon3, plat3, fr1) # not needed?
-                
-                # add windage, calculated from the middle time
-                if (surface == True) and (windage > 0):
-                    Vwind3 = get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, plon, plat, frmid, windage)
-                else:
-                    Vwind3 = np.zeros((NP,3))
-                
-                # add sinking speed
-                if TR['sink'] != 0:
-                    Vsink3 = np.zeros((NP,3))
-                    Vsink3[:,2] = -TR['sink'] / 86400
-                else:
-                    Vsink3 = np.zeros((NP,3))
-                
-                # stay close to a set depth TR['stay'] (or the bottom if it is shallower)
-                if TR['stay'] != 0:
-                    stay_H = ZH1.sum(axis=1)
-                    stay_h = ZH1[:,1]
-                    stay_z = stay_H*pcs2 + ZH1[:,0]
-                    # head for the shallower of the target depth or the bottom
-                    stay_target_depth = np.minimum(stay_h, TR['stay'])
-                    stay_target_z = - stay_target_depth
-                    stay_dz = stay_z - stay_target_z
-                    # Note TR['stay'] is a depth, assumed positive down, so the
-                    # signs can be confusing because z is positive up. That is why we introduce
-                    # stay_target_z, which is positive up
-                    Vstay3 = np.zeros((NP,3))
-                    # move halfway to the desired depth each timestep
-                    Vstay3[:,2] = - stay_dz / (2 * delt)
-                else:
-                    Vstay3 = np.zeros((NP,3))
-                
-                if jx == False:
-                    plon, plat, pcs = update_position(dxg, dyg, maskr, (V0 + 2*V1 + 2*V2 + V3)/6 + Vwind3 + Vsink3 + Vstay3, (ZH0 + 2*ZH1 + 2*ZH2 + ZH3)/6, S, delt, plon, plat, pcs, surface)
-                else:
-                    plon, plat = update_position_lonlat(dxg, dyg, maskr, (V0 + 2*V1 + 2*V2 + V3)/6 + Vwind3 + Vsink3 + Vstay3, delt, plon, plat)
-                    ZH_new = get_zh(zf0,zf1,hf, plon, plat, fr1)
-                    pcs = update_position_z((V0 + 2*V1 + 2*V2 + V3)/6 + Vwind3 + Vsink3 + Vstay3,
-                                            ZH0, ZH_new, delt, pcs, surface)
-                
-            elif TR['no_advection'] == True:
-                V3 = np.zeros((NP,3))
-                ZH3 = get_zh(zf0,zf1,hf, plon, plat, frmid)  #jx: may not need this? should it be ZH3 = get_zh(zf0,zf1,hf, plon, plat, fr1)?
-                                              
-            # add turbulence to vertical position change (advection already added above)
-            if turb == True:
-                # pull values of VdAKs and add up to 3-dimensions
-                VdAKs = get_dAKs_new(dKdzf0, dKdzf1, plon, plat, pcs, frmid, use_new_tree,zf0,zf1,hf,x_c,y_c)
-                VdAKs3 = np.zeros((NP,3))
-                VdAKs3[:,2] = VdAKs
-                # update position advecting vertically with 1/2 of AKs gradient
-                ZH = get_zh(zf0,zf1,hf, plon, plat, frmid)
-                #plon_junk, plat_junk, pcs_half = update_position(dxg, dyg, maskr,
-                #                VdAKs3/2, ZH, S, delt/2, plon, plat, pcs, surface)
-                #pcs_half = update_position_z(VdAKs3/2, ZH, ZH, delt/2, pcs, surface)  #jx
-                pcs_half = update_position_z(VdAKs3, ZH, ZH, delt/2, pcs, surface)  #jx
-                # get AKs at this height, and thence the turbulent perturbation velocity
-                Vturb = get_turb(VdAKs, AKsf0, AKsf1, delt, plon, plat, pcs_half, frmid, use_new_tree,zf0,zf1,hf,x_c,y_c)
-                Vturb3 = np.zeros((NP,3))
-                Vturb3[:,2] = Vturb
-                # update vertical position for real
-                if jx == False:
-                    plon_junk, plat_junk, pcs = update_position(dxg, dyg, maskr, Vturb3, ZH, S, delt,
-                                                        plon, plat, pcs, surface)
-                else:
-                    ZH_new = get_zh(zf0,zf1,hf, plon, plat, fr1)  #jx: need this if testing no advection; ZH_new, ZH3, and ZH2_new are the same.
-                    pcs = update_position_z(Vturb3, ZH_new, ZH_new, delt, pcs, surface)  #jx
-
-            ihr = nd + 1 # number of fractions 1/ndiv into the hour
-            nihr = int(ndiv/TR['sph']) # number of fractions 1/ndiv between saves
-            if np.mod(ihr,nihr) == 0:
-                it1 += 1
-                # write positions to the results arrays
-                P['lon'][it1,:] = plon
-                P['lat'][it1,:] = plat
-                if surface == True:
-                    pcs[:] = S['Cs_r'][-1]
-                P['cs'][it1,:] = pcs
-                
-                for vn in tracer_list:
-                    P[vn][it1,:] = get_VR(trf0_dict[vn], trf1_dict[vn], plon, plat, pcs, fr1, surface, use_new_tree,zf0,zf1,hf,x_c,y_c)
-
-                V_save = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, fr1, surface, use_new_tree,zf0,zf1,hf,x_c,y_c,average_W,k_nei)
-                P['u'][it1,:] = V_save[:,0]
-                P['v'][it1,:] = V_save[:,1]
-                P['w'][it1,:] = V_save[:,2] # average of k neighbors
-                # P['u'][it1,:] = V3[:,0]
-                # P['v'][it1,:] = V3[:,1]
-                # P['w'][it1,:] = V3[:,2]
-                ZH_save = get_zh(zf0,zf1,hf, plon, plat, fr1)
-                P['zeta'][it1,:] = ZH_save[:,0]
-                P['h'][it1,:] = ZH_save[:,1]
-                P['z'][it1,:] = pcs * ZH_save.sum(axis=1) + ZH_save[:,0]
-                # P['zeta'][it1,:] = ZH3[:,0]
-                # P['h'][it1,:] = ZH3[:,1]
-                # P['z'][it1,:] = pcs * ZH3.sum(axis=1) + ZH3[:,0]
+            P['u'][it1,ia] = V_save[:,0]
+            P['v'][it1,ia] = V_save[:,1]
+            P['w'][it1,ia] = V_save[:,2] # average of k neighbors
+            P['zeta'][it1,ia] = ZH_save[:,0]
+            P['h'][it1,ia] = ZH_save[:,1]
+            P['z'][it1,ia] = pcs[ia] * ZH_save.sum(axis=1) + ZH_save[:,0]
+            
+            if adapt:
+                # inactive particles keep their last values
+                dead = ~alive
+                for vn in ['z'] + vn_list_other:
+                    P[vn][it1,dead] = P[vn][it1-1,dead]
+                # and particles that have left the domain become inactive
+                alive = alive & in_domain(plon, plat)
+                # as do particles that are stranded
+                if (it1 >= n_strand) and (TR['no_advection'] == False):
+                    alive = alive & ~stranded(P['lon'][it1-n_strand,:], P['lat'][it1-n_strand,:],
+                        plon, plat, strand_m)
         if verbose:
             print('   > RK4 integration took %0.4f sec' % (time()-tt00))
         
     # and save the time vector (seconds in whatever the model reports)
     P['ot'] = rot_save
 
-    return P
+    return P, alive
+
+def stranded(plon0, plat0, plon1, plat1, strand_m):
+    # True for particles that moved less than strand_m meters from (plon0, plat0)
+    dx = zfun.earth_rad(plat1) * np.cos(np.pi*plat1/180) * (np.pi/180) * (plon1 - plon0)
+    dy = zfun.earth_rad(plat1) * (np.pi/180) * (plat1 - plat0)
+    return np.sqrt(dx**2 + dy**2) < strand_m
+
+def in_domain(plon, plat):
+    # True for particles inside the lon, lat limits of the rho grid
+    return ((plon >= lon_min) & (plon <= lon_max)
+        & (plat >= lat_min) & (plat <= lat_max))
+
+def get_nstep(u, v, w, h, zeta, dt_save, cfl, nstep_min, nstep_max):
+    """
+    Number of steps to take over the time dt_save so that no particle moves more
+    than cfl grid cells per step horizontally, or cfl of a vertical level.
+    Velocities are from the start of the interval.
+    """
+    if len(u) == 0:
+        return nstep_min
+    with np.errstate(invalid='ignore'):
+        # horizontal, using the smallest grid spacing
+        rate_h = np.nanmax(np.sqrt(u**2 + v**2)) / dx_min
+        # vertical, using the mean layer thickness H/N
+        rate_v = np.nanmax(np.abs(w) * S['N'] / (h + zeta))
+    rate = np.nanmax([rate_h, rate_v, 0])
+    nstep = int(np.ceil(rate * dt_save / cfl))
+    return int(np.clip(nstep, nstep_min, nstep_max))
+
+def make_fields(fn, surface, turb, windage, advection):
+    """
+    Read the fields needed for tracking from history file fn, and return them
+    in a dict of arrays flattened using the masks, e.g. F['u'] = u[:,Masku].flatten().
+    
+    Use advection=False to only get zeta and the turbulence fields.
+    """
+    ds = xr.open_dataset(fn)
+    F = dict()
+    if surface == True:
+        if advection:
+            F['u'] = ds['u'][0,-1,:,:].values[Masku]
+            F['v'] = ds['v'][0,-1,:,:].values[Maskv]
+            for vn in tracer_list:
+                F[vn] = ds[vn][0,-1,:,:].values[Maskr]
+        if windage > 0:
+            F['Uwind'] = ds['Uwind'][0,:,:].values[Maskr]
+            F['Vwind'] = ds['Vwind'][0,:,:].values[Maskr]
+    else:
+        if advection:
+            F['u'] = ds['u'][0,:,:,:].values[:,Masku].flatten()
+            F['v'] = ds['v'][0,:,:,:].values[:,Maskv].flatten()
+            F['w'] = ds['w'][0,:,:,:].values[:,Maskr].flatten()
+            for vn in tracer_list:
+                F[vn] = ds[vn][0,:,:,:].values[:,Maskr].flatten()
+        if turb == True:
+            AKs_temp = ds['AKs'][0,:,:,:].values
+            # modify top and bottom AKs to be non-negligible
+            AKs_temp[0,:,:] = AKs_temp[1,:,:]
+            AKs_temp[-1,:,:] = AKs_temp[-2,:,:]
+            AKs = AKs_temp.copy()
+            AKs[1:-1,:,:] = 0.25*AKs_temp[:-2,:,:] + 0.5*AKs_temp[1:-1,:,:] + 0.25*AKs_temp[2:,:,:]
+            F['AKs'] = AKs[:,Maskr].flatten()
+            #
+            # New 2022.11.14 use time-varying dz
+            zeta = ds['zeta'].values #jx
+            zw = zrfun.get_z(G['h'], zeta, S, only_w=True) #jx
+            dz = np.diff(zw, axis=0) #jx
+            dKdz = np.diff(AKs, axis=0)/dz #jx
+            F['dKdz'] = dKdz[:,Maskr].flatten()
+    F['zeta'] = ds['zeta'][0,:,:].values[Maskr]
+    ds.close()
+    return F
 
+def get_fields(fn, surface, turb, windage, advection, use_cache):
+    """
+    Get the dict of flattened fields from make_fields(), looking first in the
+    cache made by trackfun_cache.py if use_cache is True.
+    """
+    if use_cache:
+        tag = get_fields_tag(surface, turb, windage, advection)
+        return tcache.get_fields(fn, tag,
+            lambda fn: make_fields(fn, surface, turb, windage, advection))
+    else:
+        return make_fields(fn, surface, turb, windage, advection)
+        
+def get_fields_tag(surface, turb, windage, advection):
+    # name that identifies the set of fields in the cache
+    if surface == True:
+        tag = 'surf'
+        if windage > 0:
+            tag += '_wind'
+    else:
+        tag = '3d'
+        if turb == True:
+            tag += '_turb'
+    if not advection:
+        tag += '_nadv'
+    elif len(tracer_list) > 0:
+        # make_fields() saves the tracers, so a new tracer_list needs new entries
+        tag += '_' + '_'.join(sorted(tracer_list))
+    return tag
+    
 def update_position_lonlat(dxg, dyg, maskr, V, dt_sec, plon, plat):   #jx
     # find the new position
     Plon = plon.copy()
@@ -530,7 +656,7 @@ def update_position_lonlat(dxg, dyg, maskr, V, dt_sec, plon, plat):   #jx
     # Experiments with "trap0" to explore trapping in the Skokomish
     # showed that ## = 0.5 is a reasonable choice.
     xy = np.array((Plon,Plat)).T
-    pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
+    pmask = maskr[get_tree('xyT_rho_un').query(xy, workers=-1)[1]]
     pcond = pmask < maskr_crit # a Boolean mask
     if len(pcond) > 0:
         # these randint calls give random vectors of -1,0,1 (note the 2!)
@@ -541,11 +667,11 @@ def update_position_lonlat(dxg, dyg, maskr, V, dt_sec, plon, plat):   #jx
         
     # move any particles on land to the middle of the nearest good rho point.
     xy = np.array((Plon,Plat)).T
-    pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
+    pmask = maskr[get_tree('xyT_rho_un').query(xy, workers=-1)[1]]
     pcond = pmask < maskr_crit # a Boolean mask
     if len(pcond) > 0:
-        Plon_NEW = lonrf[xyT_rho.query(xy, workers=-1)[1]]
-        Plat_NEW = latrf[xyT_rho.query(xy, workers=-1)[1]]
+        Plon_NEW = lonrf[get_tree('xyT_rho').query(xy, workers=-1)[1]]
+        Plat_NEW = latrf[get_tree('xyT_rho').query(xy, workers=-1)[1]]
         Plon[pcond] = Plon_NEW[pcond]
         Plat[pcond] = Plat_NEW[pcond]
     return Plon, Plat
@@ -616,7 +742,7 @@ def update_position(dxg, dyg, maskr, V, ZH, S, dt_sec, plon, plat, pcs, surface)
     # Experiments with "trap0" to explore trapping in the Skokomish
     # showed that ## = 0.5 is a reasonable choice.
     xy = np.array((Plon,Plat)).T
-    pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
+    pmask = maskr[get_tree('xyT_rho_un').query(xy, workers=-1)[1]]
     pcond = pmask < maskr_crit # a Boolean mask
     if len(pcond) > 0:
         # these randint calls give random vectors of -1,0,1 (note the 2!)
@@ -627,11 +753,11 @@ def update_position(dxg, dyg, maskr, V, ZH, S, dt_sec, plon, plat, pcs, surface)
         
     # move any particles on land to the middle of the nearest good rho point.
     xy = np.array((Plon,Plat)).T
-    pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
+    pmask = maskr[get_tree('xyT_rho_un').query(xy, workers=-1)[1]]
     pcond = pmask < maskr_crit # a Boolean mask
     if len(pcond) > 0:
-        Plon_NEW = lonrf[xyT_rho.query(xy, workers=-1)[1]]
-        Plat_NEW = latrf[xyT_rho.query(xy, workers=-1)[1]]
+        Plon_NEW = lonrf[get_tree('xyT_rho').query(xy, workers=-1)[1]]
+        Plat_NEW = latrf[get_tree('xyT_rho').query(xy, workers=-1)[1]]
         Plon[pcond] = Plon_NEW[pcond]
         Plat[pcond] = Plat_NEW[pcond]
         
@@ -677,10 +803,10 @@ def get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, frac, surface, use_new_tre
     if surface == True:
         xy = np.array((plon,plat)).T
         # use workers=-1 to use all available cores
-        ui0 = uf0[xyT_u.query(xy, workers=-1)[1]]
-        vi0 = vf0[xyT_v.query(xy, workers=-1)[1]]
-        ui1 = uf1[xyT_u.query(xy, workers=-1)[1]]
-        vi1 = vf1[xyT_v.query(xy, workers=-1)[1]]
+        ui0 = uf0[get_tree('xyT_u').query(xy, workers=-1)[1]]
+        vi0 = vf0[get_tree('xyT_v').query(xy, workers=-1)[1]]
+        ui1 = uf1[get_tree('xyT_u').query(xy, workers=-1)[1]]
+        vi1 = vf1[get_tree('xyT_v').query(xy, workers=-1)[1]]
         ui = (1 - frac)*ui0 + frac*ui1
         vi = (1 - frac)*vi0 + frac*vi1
         V[:,0] = ui
@@ -692,35 +818,35 @@ def get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, frac, surface, use_new_tre
             pcs_m = ZH[:,1] * pcs # in meter 
             plon_m, plat_m = zfun.ll2xy(plon, plat, x_c, y_c) # in meter
             xys_m = np.array((plon_m,plat_m,pcs_m)).T
-            ui0 = uf0[xyzT_u_m.query(xys_m, workers=-1)[1]]
-            vi0 = vf0[xyzT_v_m.query(xys_m, workers=-1)[1]]
+            ui0 = uf0[get_tree('xyzT_u_m').query(xys_m, workers=-1)[1]]
+            vi0 = vf0[get_tree('xyzT_v_m').query(xys_m, workers=-1)[1]]
             if average_W:
-                wi0tmp = wf0[xyzT_w_m.query(xys_m, k=k_nei, workers=-1)[1]]
+                wi0tmp = wf0[get_tree('xyzT_w_m').query(xys_m, k=k_nei, workers=-1)[1]]
                 if k_nei==1:
                     wi0 = wi0tmp.mean()
                 else:
                     wi0 = wi0tmp.mean(axis=1)
             else:
-                wi0 = wf0[xyzT_w_m.query(xys_m, workers=-1)[1]]
-            ui1 = uf1[xyzT_u_m.query(xys_m, workers=-1)[1]]
-            vi1 = vf1[xyzT_v_m.query(xys_m, workers=-1)[1]]
+                wi0 = wf0[get_tree('xyzT_w_m').query(xys_m, workers=-1)[1]]
+            ui1 = uf1[get_tree('xyzT_u_m').query(xys_m, workers=-1)[1]]
+            vi1 = vf1[get_tree('xyzT_v_m').query(xys_m, workers=-1)[1]]
             if average_W:
-                wi1tmp = wf1[xyzT_w_m.query(xys_m, k=k_nei, workers=-1)[1]]
+                wi1tmp = wf1[get_tree('xyzT_w_m').query(xys_m, k=k_nei, workers=-1)[1]]
                 if k_nei==1:
                     wi1 = wi1tmp.mean()
                 else:    
                     wi1 = wi1tmp.mean(axis=1)
             else:
-                wi1 = wf1[xyzT_w_m.query(xys_m, workers=-1)[1]]
+                wi1 = wf1[get_tree('xyzT_w_m').query(xys_m, workers=-1)[1]]
         
         else:
             xys = np.array((plon,plat,pcs)).T
-            ui0 = uf0[xyzT_u.query(xys, workers=-1)[1]]
-            vi0 = vf0[xyzT_v.query(xys, workers=-1)[1]]
-            wi0 = wf0[xyzT_w.query(xys, workers=-1)[1]]
-            ui1 = uf1[xyzT_u.query(xys, workers=-1)[1]]
-            vi1 = vf1[xyzT_v.query(xys, workers=-1)[1]]
-            wi1 = wf1[xyzT_w.query(xys, workers=-1)[1]]
+            ui0 = uf0[get_tree('xyzT_u').query(xys, workers=-1)[1]]
+            vi0 = vf0[get_tree('xyzT_v').query(xys, workers=-1)[1]]
+            wi0 = wf0[get_tree('xyzT_w').query(xys, workers=-1)[1]]
+            ui1 = uf1[get_tree('xyzT_u').query(xys, workers=-1)[1]]
+            vi1 = vf1[get_tree('xyzT_v').query(xys, workers=-1)[1]]
+            wi1 = wf1[get_tree('xyzT_w').query(xys, workers=-1)[1]]
             
         ui = (1 - frac)*ui0 + frac*ui1
         vi = (1 - frac)*vi0 + frac*vi1
@@ -736,9 +862,9 @@ def get_zh(zf0,zf1,hf, plon, plat, frac):
     # Get zeta and h at all points, at an arbitrary time between two saves
     NP = len(plon)
     xy = np.array((plon,plat)).T
-    zi0 = zf0[xyT_rho.query(xy, workers=-1)[1]]
-    zi1 = zf1[xyT_rho.query(xy, workers=-1)[1]]
-    hi = hf[xyT_rho.query(xy, workers=-1)[1]]
+    zi0 = zf0[get_tree('xyT_rho').query(xy, workers=-1)[1]]
+    zi1 = zf1[get_tree('xyT_rho').query(xy, workers=-1)[1]]
+    hi = hf[get_tree('xyT_rho').query(xy, workers=-1)[1]]
     zi = (1 - frac)*zi0 + frac*zi1
     ZH = np.zeros((NP,2))
     ZH[:,0] = zi
@@ -749,8 +875,8 @@ def get_VR(tf0,tf1, plon, plat, pcs, frac, surface, use_new_tree,zf0,zf1,hf,x_c,
     # Get a variable on the z_rho grid at all points.
     if surface == True:
         xy = np.array((plon,plat)).T
-        ti0 = tf0[xyT_rho.query(xy, workers=-1)[1]]
-        ti1 = tf1[xyT_rho.query(xy, workers=-1)[1]]
+        ti0 = tf0[get_tree('xyT_rho').query(xy, workers=-1)[1]]
+        ti1 = tf1[get_tree('xyT_rho').query(xy, workers=-1)[1]]
     else:
         if use_new_tree:
             ZH = get_zh(zf0,zf1,hf, plon, plat, frac)
@@ -758,12 +884,12 @@ def get_VR(tf0,tf1, plon, plat, pcs, frac, surface, use_new_tree,zf0,zf1,hf,x_c,
             pcs_m = ZH[:,1] * pcs # in meter
             plon_m, plat_m = zfun.ll2xy(plon, plat, x_c, y_c) # in meter
             xys_m = np.array((plon_m,plat_m,pcs_m)).T
-            ti0 = tf0[xyzT_rho_m.query(xys_m, workers=-1)[1]]
-            ti1 = tf1[xyzT_rho_m.query(xys_m, workers=-1)[1]]
+            ti0 = tf0[get_tree('xyzT_rho_m').query(xys_m, workers=-1)[1]]
+            ti1 = tf1[get_tree('xyzT_rho_m').query(xys_m, workers=-1)[1]]
         else:
             xys = np.array((plon,plat,pcs)).T
-            ti0 = tf0[xyzT_rho.query(xys, workers=-1)[1]]
-            ti1 = tf1[xyzT_rho.query(xys, workers=-1)[1]]
+            ti0 = tf0[get_tree('xyzT_rho').query(xys, workers=-1)[1]]
+            ti1 = tf1[get_tree('xyzT_rho').query(xys, workers=-1)[1]]
     ti = (1 - frac)*ti0 + frac*ti1
     return ti
     
@@ -772,11 +898,11 @@ def get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, plon, plat, frac, windage):
     NP = len(plon)
     Vwind3 = np.zeros((NP,3))
     xy = np.array((plon,plat)).T
-    Uwind00 = Uwindf0[xyT_rho.query(xy, workers=-1)[1]]
-    Uwind11 = Uwindf1[xyT_rho.query(xy, workers=-1)[1]]
+    Uwind00 = Uwindf0[get_tree('xyT_rho').query(xy, workers=-1)[1]]
+    Uwind11 = Uwindf1[get_tree('xyT_rho').query(xy, workers=-1)[1]]
     Uwind = (1 - frac)*Uwind00 + frac*Uwind11
-    Vwind00 = Vwindf0[xyT_rho.query(xy, workers=-1)[1]]
-    Vwind11 = Vwindf1[xyT_rho.query(xy, workers=-1)[1]]
+    Vwind00 = Vwindf0[get_tree('xyT_rho').query(xy, workers=-1)[1]]
+    Vwind11 = Vwindf1[get_tree('xyT_rho').query(xy, workers=-1)[1]]
     Vwind = (1 - frac)*Vwind00 + frac*Vwind11
     Vwind3[:,0] = windage*Uwind
     Vwind3[:,1] = windage*Vwind
@@ -790,10 +916,10 @@ def get_AKs(AKsf, plon, plat, pcs, frac, use_new_tree,zf0,zf1,hf,x_c,y_c):
         pcs_m = ZH[:,1] * pcs #
         plon_m, plat_m = zfun.ll2xy(plon, plat, x_c, y_c) # in meter
         xys_m = np.array((plon_m,plat_m,pcs_m)).T
-        AKsi = AKsf[xyzT_w_m.query(xys_m, workers=-1)[1]]
+        AKsi = AKsf[get_tree('xyzT_w_m').query(xys_m, workers=-1)[1]]
     else:
         xys = np.array((plon,plat,pcs)).T
-        AKsi = AKsf[xyzT_w.query(xys, workers=-1)[1]]
+        AKsi = AKsf[get_tree('xyzT_w').query(xys, workers=-1)[1]]
     return AKsi
     
 def get_dAKs_new(dKdzf0, dKdzf1, plon, plat, pcs, frac, use_new_tree,zf0,zf1,hf,x_c,y_c):
@@ -803,12 +929,12 @@ def get_dAKs_new(dKdzf0, dKdzf1, plon, plat, pcs, frac, use_new_tree,zf0,zf1,hf,
         pcs_m = ZH[:,1] * pcs #
         plon_m, plat_m = zfun.ll2xy(plon, plat, x_c, y_c) # in meter
         xys_m = np.array((plon_m,plat_m,pcs_m)).T
-        dKdzi0 = dKdzf0[xyzT_rho_m.query(xys_m, workers=-1)[1]]
-        dKdzi1 = dKdzf1[xyzT_rho_m.query(xys_m, workers=-1)[1]]
+        dKdzi0 = dKdzf0[get_tree('xyzT_rho_m').query(xys_m, workers=-1)[1]]
+        dKdzi1 = dKdzf1[get_tree('xyzT_rho_m').query(xys_m, workers=-1)[1]]
     else:
         xys = np.array((plon,plat,pcs)).T
-        dKdzi0 = dKdzf0[xyzT_rho.query(xys, workers=-1)[1]]
-        dKdzi1 = dKdzf1[xyzT_rho.query(xys, workers=-1)[1]]
+        dKdzi0 = dKdzf0[get_tree('xyzT_rho').query(xys, workers=-1)[1]]
+        dKdzi1 = dKdzf1[get_tree('xyzT_rho').query(xys, workers=-1)[1]]
         
     dKdzi = (1 - frac)*dKdzi0 + frac*dKdzi1
     return dKdzi
@@ -826,6 +952,161 @@ def get_turb(dAKs, AKsf0, AKsf1, delta_t, plon, plat, pcs, frac, use_new_tree,zf
     V = rand*np.sqrt(2*Vave/delta_t) + dAKs
     return V
 
+# Functions for the trilinear interpolation option.
+#
+# A "cell" C is a dict of (index, weight) pairs for each type of field,
+# e.g. C['u3'] = (I, W) where I and W are arrays of shape (nc, NP), nc being
+# the number of corners (4 for 2-D and 8 for 3-D). I indexes into the flattened
+# fields (like uf0) and W is zero for corners on land. The value at a particle
+# is then sum(W*F[I])/sum(W), ignoring corners where F is nan.
+
+def get_frac_index(plon, plat):
+    # Get the fractional (j,i) index of each particle on the rho grid.
+    if plaid:
+        fi = np.interp(plon, lonr_vec, np.arange(G['L']))
+        fj = np.interp(plat, latr_vec, np.arange(G['M']))
+    else:
+        # find the nearest rho point and then solve for the offset using the
+        # local grid vectors, which works for a smoothly curvilinear grid
+        xy = np.array((plon,plat)).T
+        jj, ii = np.unravel_index(get_tree('xyT_rho_un').query(xy, workers=-1)[1], (G['M'],G['L']))
+        ii = np.clip(ii, 0, G['L']-2)
+        jj = np.clip(jj, 0, G['M']-2)
+        lon = G['lon_rho']; lat = G['lat_rho']
+        dxi = lon[jj,ii+1] - lon[jj,ii]; dyi = lat[jj,ii+1] - lat[jj,ii]
+        dxj = lon[jj+1,ii] - lon[jj,ii]; dyj = lat[jj+1,ii] - lat[jj,ii]
+        px = plon - lon[jj,ii]; py = plat - lat[jj,ii]
+        det = dxi*dyj - dxj*dyi
+        fi = np.clip(ii + (px*dyj - py*dxj)/det, 0, G['L']-1)
+        fj = np.clip(jj + (dxi*py - dyi*px)/det, 0, G['M']-1)
+    return fj, fi
+
+def split_index(f, n):
+    # Split fractional index f into a lower index i0 and fraction a,
+    # with 0 <= i0 <= n-2 and 0 <= a <= 1.
+    i0 = np.clip(np.floor(f).astype(int), 0, n-2)
+    a = np.clip(f - i0, 0, 1)
+    return i0, a
+
+def get_corners_2d(imap, fj, fi):
+    # bilinear weights on the grid described by imap
+    M, L = imap.shape
+    j0, b = split_index(fj, M)
+    i0, a = split_index(fi, L)
+    I = np.array([imap[j0,i0], imap[j0,i0+1], imap[j0+1,i0], imap[j0+1,i0+1]])
+    W = np.array([(1-b)*(1-a), (1-b)*a, b*(1-a), b*a])
+    W[I < 0] = 0 # land
+    I[I < 0] = 0
+    return I, W
+
+def get_corners_3d(IW, nwet, k0, c):
+    # add vertical levels k0 and k0+1 with weights (1-c) and c to 2-D corners
+    I, W = IW
+    I3 = np.concatenate((k0*nwet + I, (k0+1)*nwet + I))
+    W3 = np.concatenate(((1-c)*W, c*W))
+    return I3, W3
+
+def get_kfrac(z0, pcs):
+    # Get the lower level index and fraction of pcs in the columns z0,
+    # which have shape (number of levels, NP) and are increasing upward.
+    NK, NP = z0.shape
+    k0 = np.clip((z0 <= pcs).sum(axis=0) - 1, 0, NK-2)
+    ip = np.arange(NP)
+    za = z0[k0,ip]
+    zb = z0[k0+1,ip]
+    c = np.clip((pcs - za)/(zb - za), 0, 1)
+    return k0, c
+
+def get_cell(plon, plat, pcs, hf, surface):
+    # Find the grid cell and weights of all particles, once, for all fields.
+    # Pass pcs = None (and surface = True) if only 2-D fields are needed.
+    NP = len(plon)
+    C = dict()
+    fj, fi = get_frac_index(plon, plat)
+    C['r2'] = get_corners_2d(imap_r, fj, fi)
+    C['h'] = apply_cell(hf, C['r2'])
+    if pcs is not None:
+        # u and v points are half a cell from rho points in the xi and eta directions
+        C['u2'] = get_corners_2d(imap_u, fj, fi - 0.5)
+        C['v2'] = get_corners_2d(imap_v, fj - 0.5, fi)
+    if (surface == False) and (pcs is not None):
+        # Fractional depth of the rho and w levels for the local h, using zeta = 0,
+        # which is the same vertical coordinate used in making the 3D trees.
+        hp = C['h'].reshape(1,NP)
+        zr0 = zrfun.get_z(hp, 0*hp, S, only_rho=True).reshape(S['N'],NP)/hp
+        zw0 = zrfun.get_z(hp, 0*hp, S, only_w=True).reshape(S['N']+1,NP)/hp
+        kr, cr = get_kfrac(zr0, pcs)
+        kw, cw = get_kfrac(zw0, pcs)
+        C['r3'] = get_corners_3d(C['r2'], nwet_r, kr, cr)
+        C['u3'] = get_corners_3d(C['u2'], nwet_u, kr, cr)
+        C['v3'] = get_corners_3d(C['v2'], nwet_v, kr, cr)
+        C['w3'] = get_corners_3d(C['r2'], nwet_r, kw, cw)
+    return C
+
+def apply_cell(Ff, IW):
+    # Interpolate the flattened field Ff using indices and weights IW.
+    I, W = IW
+    F = Ff[I]
+    W = W * np.isfinite(F)
+    den = W.sum(axis=0)
+    num = (W * np.nan_to_num(F)).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Fi = num/den
+    return Fi
+
+def apply_cell_time(Ff0, Ff1, IW, frac):
+    # interpolate in space and then in time
+    return (1 - frac)*apply_cell(Ff0, IW) + frac*apply_cell(Ff1, IW)
+
+def get_vel_tri(C, uf0,uf1,vf0,vf1,wf0,wf1, frac, surface):
+    # trilinear version of get_vel()
+    NP = C['r2'][0].shape[1]
+    V = np.zeros((NP,3))
+    if surface == True:
+        V[:,0] = apply_cell_time(uf0, uf1, C['u2'], frac)
+        V[:,1] = apply_cell_time(vf0, vf1, C['v2'], frac)
+    else:
+        V[:,0] = apply_cell_time(uf0, uf1, C['u3'], frac)
+        V[:,1] = apply_cell_time(vf0, vf1, C['v3'], frac)
+        V[:,2] = apply_cell_time(wf0, wf1, C['w3'], frac)
+    # The line below is to account for wet-dry cells.
+    V[np.isnan(V)] = 0.0
+    return V
+
+def get_zh_tri(C, zf0,zf1, frac):
+    # bilinear version of get_zh()
+    NP = len(C['h'])
+    ZH = np.zeros((NP,2))
+    ZH[:,0] = apply_cell_time(zf0, zf1, C['r2'], frac)
+    ZH[:,1] = C['h']
+    return ZH
+
+def get_VR_tri(C, tf0,tf1, frac, surface):
+    # trilinear version of get_VR()
+    if surface == True:
+        return apply_cell_time(tf0, tf1, C['r2'], frac)
+    else:
+        return apply_cell_time(tf0, tf1, C['r3'], frac)
+
+def get_wind_tri(C, Uwindf0, Uwindf1, Vwindf0, Vwindf1, frac, windage):
+    # bilinear version of get_wind()
+    NP = len(C['h'])
+    Vwind3 = np.zeros((NP,3))
+    Vwind3[:,0] = windage*apply_cell_time(Uwindf0, Uwindf1, C['r2'], frac)
+    Vwind3[:,1] = windage*apply_cell_time(Vwindf0, Vwindf1, C['r2'], frac)
+    return Vwind3
+
+def get_dAKs_tri(C, dKdzf0, dKdzf1, frac):
+    # trilinear version of get_dAKs_new()
+    return apply_cell_time(dKdzf0, dKdzf1, C['r3'], frac)
+
+def get_turb_tri(dAKs, AKsf0, AKsf1, delta_t, C, frac):
+    # trilinear version of get_turb()
+    Vave = apply_cell_time(AKsf0, AKsf1, C['w3'], frac)
+    rand = np.random.standard_normal(len(Vave))
+    V = rand*np.sqrt(2*Vave/delta_t) + dAKs
+    return V
+
 def get_fn_list(idt, Ldir):
     # Gets history files for 1 day only:
     # ocean_his_0025.nc from the day before through ocean_his_0025.nc of this day.
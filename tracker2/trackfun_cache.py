@@ -0,0 +1,119 @@
+"""
+Functions for a disk cache of the fields used by trackfun.get_tracks().
+
+Reading a history file, masking and flattening its fields, and smoothing AKs
+takes a good part of the time of a tracking run. The first time a history file
+is used we save the results of trackfun.make_fields() as .npy files, and later
+runs (including several tracker jobs running at the same time, or repeated
+experiments on the same days) load them as memory-mapped arrays instead.
+
+The cache is organized like the ROMS output, in:
+LO_output/tracker2_cache/[gtagex]/[f_string]/[his_name]_[tag]/[vn].npy
+where tag describes the set of fields, e.g. "3d_turb_salt_temp" (see trackfun.get_fields_tag()).
+
+When the cache grows beyond cache_max_gb we delete whole day folders,
+least recently used first. To avoid looking at every file in the cache after
+each new entry, each job keeps a running total of the cache size, which it adds
+its own entries to and only measures again every trim_every new entries.
+"""
+
+from lo_tools import Lfun
+import numpy as np
+import os, shutil
+
+Ldir = Lfun.Lstart()
+
+cache_dir0 = Ldir['LOo'] / 'tracker2_cache'
+
+# maximum size of the cache before we start deleting days
+cache_max_gb = 100
+
+# number of new entries made by this job between measurements of the cache size
+trim_every = 24
+
+# running estimate of the cache size made by this job
+cache_size = {'gb': None, 'n_new': 0}
+
+def get_fields(fn, tag, make_fields):
+    """
+    Return the dict of flattened fields for history file fn, either from the
+    cache or by calling make_fields(fn) and then saving the result to the cache.
+
+    The cache entry is rebuilt if the history file is newer than the entry.
+    """
+    # fn is like .../[gtagex]/[f_string]/ocean_his_0002.nc
+    day_dir = cache_dir0 / fn.parent.parent.name / fn.parent.name
+    out_dir = day_dir / (fn.stem + '_' + tag)
+    info_fn = out_dir / 'info.csv'
+    if info_fn.is_file():
+        info = Lfun.csv_to_dict(info_fn)
+        if float(info['mtime']) >= fn.stat().st_mtime:
+            F = dict()
+            for vn in info['vn_list'].split(':'):
+                F[vn] = np.load(out_dir / (vn + '.npy'), mmap_mode='r')
+            touch(day_dir)
+            return F
+        else:
+            shutil.rmtree(str(out_dir), ignore_errors=True)
+
+    # make the fields and save them
+    F = make_fields(fn)
+    # We write to a temporary folder and then rename it, so that other jobs
+    # using the cache never see a partly written entry.
+    temp_dir = day_dir / ('temp_' + out_dir.name + '_' + str(os.getpid()))
+    Lfun.make_dir(temp_dir, clean=True)
+    for vn in F.keys():
+        np.save(temp_dir / (vn + '.npy'), F[vn])
+    info = {'mtime': fn.stat().st_mtime, 'vn_list': ':'.join(F.keys())}
+    Lfun.dict_to_csv(info, temp_dir / 'info.csv')
+    entry_gb = sum([ff.stat().st_size for ff in temp_dir.glob('*')])/1e9
+    try:
+        os.rename(temp_dir, out_dir)
+    except OSError:
+        # another job made the same entry first
+        shutil.rmtree(str(temp_dir), ignore_errors=True)
+        entry_gb = 0
+    touch(day_dir)
+    # measure and trim the cache only now and then, or when our estimate is too big
+    cache_size['n_new'] += 1
+    if cache_size['gb'] != None:
+        cache_size['gb'] += entry_gb
+    if ((cache_size['gb'] == None) or (cache_size['gb'] > cache_max_gb)
+            or (cache_size['n_new'] >= trim_every)):
+        cache_size['gb'] = trim_cache(keep=day_dir)
+        cache_size['n_new'] = 0
+    return F
+
+def touch(day_dir):
+    # record the time a day folder was last used
+    (day_dir / 'last_used').touch()
+
+def trim_cache(keep=None, max_gb=None):
+    """
+    Delete day folders, least recently used first, until the cache is
+    smaller than max_gb (default cache_max_gb). The folder keep is never deleted.
+    Returns the size of the cache in GB afterwards.
+    """
+    if max_gb == None:
+        max_gb = cache_max_gb
+    size_dict = dict()
+    time_dict = dict()
+    for day_dir in cache_dir0.glob('*/f*'):
+        # another job may be deleting folders at the same time
+        try:
+            time_dict[day_dir] = (day_dir / 'last_used').stat().st_mtime
+            size_dict[day_dir] = sum([ff.stat().st_size for ff in day_dir.glob('**/*') if ff.is_file()])
+        except FileNotFoundError:
+            time_dict.pop(day_dir, None)
+    total_gb = sum(size_dict.values())/1e9
+    # sort with the oldest first
+    day_list = sorted(time_dict.keys(), key=lambda item: time_dict[item])
+    for day_dir in day_list:
+        if total_gb <= max_gb:
+            break
+        if day_dir == keep:
+            continue
+        shutil.rmtree(str(day_dir), ignore_errors=True)
+        total_gb -= size_dict[day_dir]/1e9
+        print(' - removed %s from tracker2 cache' % (str(day_dir)))
+    return total_gb
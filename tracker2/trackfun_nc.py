@@ -4,6 +4,12 @@ Functions associated with NetCDF for tracker.
 
 from lo_tools import Lfun
 import xarray as xr
+import netCDF4 as nc
+
+# Chunk sizes for the release files. One chunk along Time holds a day of hourly
+# saves, and the Particle chunk keeps the chunks a few MB for large releases.
+time_chunk = 24
+particle_chunk = 10000
 
 # Info for NetCDF output, organized as {variable name: (long_name, units)}
 name_unit_dict = {'lon':('Longitude','degrees'), 'lat':('Latitude','degrees'),
@@ -33,37 +39,46 @@ def write_grid(g_infile, g_outfile):
     dsg.close()
     
 def start_outfile(out_fn, P):
-    v_dict = dict()
+    """
+    Create the release file and write the first day of tracks.
+    
+    The file has a fixed layout: an unlimited Time dimension and a fixed Particle
+    dimension, with every variable chunked (time_chunk hours by the
+    particles) and compressed. Later days are written in place by append_to_outfile(),
+    so the cost of a day does not grow with the length of the release.
+    
+    The global attribute "ndays" is the number of days written so far, and
+    the file is closed after each day, so a partially written release can be opened
+    and plotted (e.g. by tplot.py) while the tracker is still running.
+    """
+    out_fn.unlink(missing_ok=True)
+    NT, NP = P['lon'].shape
+    foo = nc.Dataset(out_fn, 'w')
+    foo.createDimension('Time', None)
+    foo.createDimension('Particle', NP)
     for vn in P.keys():
         if vn == 'ot':
-            v_dict[vn] = (('Time'), P[vn])
+            vv = foo.createVariable(vn, float, ('Time',), zlib=True, complevel=1,
+                chunksizes=(time_chunk,))
         else:
-            v_dict[vn] = (('Time', 'Particle'), P[vn])
-    ds = xr.Dataset(v_dict)
-    for vn in P.keys():
-        ds[vn].attrs['long_name'] = name_unit_dict[vn][0]
-        ds[vn].attrs['units'] = name_unit_dict[vn][1]
-    ds.to_netcdf(out_fn)
-    ds.close()
+            vv = foo.createVariable(vn, float, ('Time', 'Particle'), zlib=True, complevel=1,
+                chunksizes=(time_chunk, min(NP, particle_chunk)))
+        vv.long_name = name_unit_dict[vn][0]
+        vv.units = name_unit_dict[vn][1]
+        vv[:NT] = P[vn]
+    foo.ndays = 1
+    foo.close()
     
 def append_to_outfile(out_fn, P):
     """
-    This works fine, but I worry about it when there are many days.  Will it slow down?
+    Append a day of tracks to the end of the Time dimension of an existing release file.
     
-    It could be replaced by putting each daily output file in a temp dir, and then
-    using ncrcat at the end.
+    The first time of P is the same as the last time already in the file, so we skip it.
     """
-    v_dict = dict()
+    foo = nc.Dataset(out_fn, 'a')
+    it0 = len(foo.dimensions['Time'])
+    NT = len(P['ot']) - 1
     for vn in P.keys():
-        if vn == 'ot':
-            v_dict[vn] = (('Time'), P[vn][1:])
-        else:
-            v_dict[vn] = (('Time', 'Particle'), P[vn][1:,:])
-    ds1 = xr.Dataset(v_dict)
-    ds0 = xr.open_dataset(out_fn, decode_times=False)
-    ds2 = xr.concat((ds0,ds1), 'Time')
-    ds0.close()
-    ds1.close()
-    out_fn.unlink(missing_ok=True)
-    ds2.to_netcdf(out_fn)
-    ds2.close()
+        foo[vn][it0:it0 + NT] = P[vn][1:]
+    foo.ndays = foo.ndays + 1
+    foo.close()